@@ -4,6 +4,7 @@ import numpy as np
 import mne
 from tqdm import tqdm
 from src.utils import utils
+from src.utils import labels_utils as lu
 from src.preproc import anatomy as anat
 from src.preproc import fMRI as fmri
 
@@ -33,7 +34,7 @@ def calc_contoures(subject, fmri_names, thresholds_min=2, thresholds_max=None, t
 
 def merge_labels(subject, fmri_names):
     utils.delete_folder_files(op.join(MMVT_DIR, subject, 'fmri', 'labels'))
-    vertices_labels_lookup = utils.load(op.join(MMVT_DIR, subject, 'aparc.DKTatlas40_vertices_labels_lookup.pkl'))
+    vertices_labels_lookup = lu.create_vertices_labels_lookup(subject, 'aparc.DKTatlas40')
     output_fol = utils.make_dir(op.join(MMVT_DIR, subject, 'fmri', 'labels'))
     for fmri_name in fmri_names:
         labels = []
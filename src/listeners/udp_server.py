@@ -89,6 +89,21 @@ def send_data(sock, server_address, data, interval=0.0006):
         time.sleep(interval)
 
 
+def send_binary_data(server_address, data, interval=0, packets_num=None):
+    # Sends every sample of data (channels x time) as a float64 packet, like the streaming panel's udp_reader expects.
+    # The samples are sent packets_num times (cycling), or forever if it's None
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    packets = [np.ascontiguousarray(data[:, t], dtype=np.float64).tobytes() for t in range(data.shape[1])]
+    packets = cycle(packets)
+    ind = 0
+    while packets_num is None or ind < packets_num:
+        sock.sendto(next(packets), server_address)
+        ind += 1
+        if interval > 0:
+            time.sleep(interval)
+    sock.close()
+
+
 if __name__ == '__main__':
     data = load_electrodes_data(False, 'all')
     # sock, server_address = bind_socket()
@@ -0,0 +1,66 @@
+import os.path as op
+import time
+import tempfile
+import numpy as np
+
+from src.misc.benchmarks.topology_store import create_grid_mesh
+from src.mmvt_addon import mmvt_utils as mu
+from src.utils import utils
+from src.utils import args_utils as au
+
+
+def loop_set_verts_loops_colors(layer_colors, lookup, valid_verts, verts_colors):
+    # The previous verts_lookup_loop_coloring's loop over the valid vertices' loops, as a reference
+    for vert, vert_color in zip(valid_verts, verts_colors):
+        x = lookup[vert]
+        for loop_ind in x[x > -1]:
+            layer_colors[loop_ind, :3] = vert_color
+    return layer_colors
+
+
+def time_coloring(coloring_func, layer_colors, lookup, valid_verts, verts_colors, runs_num):
+    times = []
+    for _ in range(runs_num):
+        colors = layer_colors.copy()
+        now = time.time()
+        coloring_func(colors, lookup, valid_verts, verts_colors)
+        times.append(time.time() - now)
+    return colors, np.mean(times)
+
+
+def benchmark(grid_sizes, runs_num, channels_num, loop_max_verts):
+    # The colors of a hemisphere, like color_hemi_data with values in [-1, 1] and a zero threshold, so about half of
+    # the vertices are colored. The vertex colors layer is the foreach_get array (RGB in 2.7x, RGBA from 2.8)
+    print('verts\tloops\tcolored\tbulk (s)\tloop (s)\tspeedup\tidentical')
+    cm = np.random.rand(256, 3)
+    with tempfile.TemporaryDirectory() as fol:
+        lookup_fname = op.join(fol, 'faces_verts.npy')
+        for grid_size in grid_sizes:
+            verts_num, faces = create_grid_mesh(grid_size, grid_size)
+            utils.calc_ply_faces_verts(np.zeros((verts_num, 3)), faces, lookup_fname, overwrite=True)
+            lookup = np.load(lookup_fname)
+            data = np.random.uniform(-1, 1, verts_num)
+            valid_verts = np.where(data > 0)[0]
+            verts_colors = mu.calc_colors_from_cm(data[valid_verts], -1, 128, cm)
+            layer_colors = np.ones((faces.size, channels_num), dtype=np.float32)
+            bulk_colors, bulk_time = time_coloring(
+                mu.set_verts_loops_colors, layer_colors, lookup, valid_verts, verts_colors, runs_num)
+            if verts_num > loop_max_verts:
+                print('{}\t{}\t{}\t{:.4f}\t-\t-\t-'.format(verts_num, faces.size, len(valid_verts), bulk_time))
+                continue
+            loop_colors, loop_time = time_coloring(
+                loop_set_verts_loops_colors, layer_colors, lookup, valid_verts, verts_colors, runs_num)
+            print('{}\t{}\t{}\t{:.4f}\t{:.4f}\t{:.0f}x\t{}'.format(
+                verts_num, faces.size, len(valid_verts), bulk_time, loop_time, loop_time / bulk_time,
+                np.array_equal(bulk_colors, loop_colors)))
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Cortex loops coloring benchmark')
+    parser.add_argument('--grid_sizes', required=False, default='100,200,400', type=au.int_arr_type)
+    parser.add_argument('--runs_num', required=False, default=5, type=int)
+    parser.add_argument('--channels_num', required=False, default=4, type=int)
+    parser.add_argument('--loop_max_verts', required=False, default=200000, type=int)
+    args = utils.Bag(au.parse_parser(parser))
+    benchmark(args.grid_sizes, args.runs_num, args.channels_num, args.loop_max_verts)
@@ -0,0 +1,115 @@
+import time
+import itertools
+import numpy as np
+
+from src.preproc import connectivity as con
+from src.utils import utils
+from src.utils import args_utils as au
+
+
+def loop_pli(data):
+    # The labels pairs loop the PLI was calculated with, as a reference for the vectorized kernel
+    from scipy.signal import hilbert
+    data_hil = hilbert(data)
+    channels_num = data.shape[0]
+    m = np.zeros((channels_num, channels_num))
+    for i in range(channels_num):
+        for j in range(i + 1, channels_num):
+            m[i, j] = abs(np.mean(np.sign(np.imag(data_hil[i] / data_hil[j]))))
+    return m + m.T
+
+
+def loop_mi(corr_w):
+    nch = corr_w.shape[0]
+    conn = np.zeros((nch, nch))
+    for i in range(nch):
+        for j in range(i + 1, nch):
+            conn[i, j] = -0.5 * np.log(1 - corr_w[i, j] ** 2)
+    return conn + conn.T
+
+
+def benchmark(labels_nums=(50, 100, 200, 400), windows_nums=(10, 50, 100), windows_length=200, windows_shift=20,
+              loops_max_windows=5):
+    print('labels\twindows\tmetric\tvectorized (s)\tloop (s, extrapolated)\tspeedup\tmax abs diff')
+    for labels_num, windows_num in itertools.product(labels_nums, windows_nums):
+        T = (windows_num - 1) * windows_shift + windows_length
+        data = np.random.randn(labels_num, T)
+        windows = con.calc_windows(T, windows_length, windows_shift)
+        windows_data = con.get_windows_data(data, windows)
+        # The loops are timed on the first loops_max_windows windows only, and extrapolated
+        loop_windows = min(windows_num, loops_max_windows)
+
+        now = time.time()
+        corr = con.corr_windows(windows_data)
+        corr_time = time.time() - now
+        now = time.time()
+        ref_corr = np.zeros((labels_num, labels_num, loop_windows))
+        for w in range(loop_windows):
+            ref_corr[:, :, w] = np.corrcoef(windows_data[w])
+            np.fill_diagonal(ref_corr[:, :, w], 0)
+        loop_time = (time.time() - now) * windows_num / loop_windows
+        print_results(labels_num, windows_num, 'corr', corr_time, loop_time, corr[:, :, :loop_windows], ref_corr)
+
+        now = time.time()
+        mi = con.mi(corr)
+        mi_time = time.time() - now
+        now = time.time()
+        ref_mi = np.stack([loop_mi(corr[:, :, w]) for w in range(loop_windows)], 2)
+        loop_time = (time.time() - now) * windows_num / loop_windows
+        print_results(labels_num, windows_num, 'mi', mi_time, loop_time, mi[:, :, :loop_windows], ref_mi)
+
+        now = time.time()
+        pli = con.pli_windows(windows_data)
+        pli_time = time.time() - now
+        now = time.time()
+        ref_pli = np.stack([loop_pli(windows_data[w]) for w in range(loop_windows)], 2)
+        loop_time = (time.time() - now) * windows_num / loop_windows
+        print_results(labels_num, windows_num, 'pli', pli_time, loop_time, pli[:, :, :loop_windows], ref_pli)
+
+        # The streaming engine, with the vectorized corr (which holds all the windows in memory) as the reference
+        now = time.time()
+        stream_corr = np.stack([c for _, c in con.corr_windows_generator(data, windows)], 2)
+        stream_time = time.time() - now
+        print_results(labels_num, windows_num, 'corr stream', stream_time, corr_time, stream_corr, corr)
+
+
+def benchmark_seed_corr(verts_num=160000, T=300, seeds_nums=(1, 10, 100), loop_max_verts=2000):
+    # The seed correlation maps (one hemi) vs the vertices loop of np.corrcoef, which is timed on loop_max_verts
+    # vertices and extrapolated
+    print('vertices\tseeds\tmetric\tvectorized (s)\tloop (s, extrapolated)\tspeedup\tmax abs diff')
+    x = np.random.randn(verts_num, T).astype(np.float32)
+    now = time.time()
+    zscored_x = con.zscore_ts(x)
+    zscore_time = time.time() - now
+    for seeds_num in seeds_nums:
+        seeds_ts = np.random.randn(seeds_num, T)
+        now = time.time()
+        corr = con.calc_seeds_corr(zscored_x, seeds_ts)
+        corr_time = time.time() - now + zscore_time
+        now = time.time()
+        ref_corr = np.array([[np.corrcoef(seed_ts, v_ts)[0, 1] for seed_ts in seeds_ts] for v_ts in x[:loop_max_verts]])
+        loop_time = (time.time() - now) * verts_num / loop_max_verts
+        print('{}\t{}\tseed corr\t{:.3f}\t{:.3f}\t{:.1f}\t{:.2e}'.format(
+            verts_num, seeds_num, corr_time, loop_time, loop_time / corr_time,
+            np.max(np.abs(corr[:loop_max_verts] - ref_corr))))
+
+
+def print_results(labels_num, windows_num, metric, vectorized_time, loop_time, res, ref_res):
+    print('{}\t{}\t{}\t{:.3f}\t{:.3f}\t{:.1f}\t{:.2e}'.format(
+        labels_num, windows_num, metric, vectorized_time, loop_time, loop_time / vectorized_time,
+        np.nanmax(np.abs(res - ref_res))))
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Connectivity kernels benchmark')
+    parser.add_argument('--labels_nums', required=False, default='50,100,200,400', type=au.int_arr_type)
+    parser.add_argument('--windows_nums', required=False, default='10,50,100', type=au.int_arr_type)
+    parser.add_argument('--windows_length', required=False, default=200, type=int)
+    parser.add_argument('--windows_shift', required=False, default=20, type=int)
+    parser.add_argument('--seed_verts_num', required=False, default=160000, type=int)
+    parser.add_argument('--seed_T', required=False, default=300, type=int)
+    parser.add_argument('--seeds_nums', required=False, default='1,10,100', type=au.int_arr_type)
+    args = utils.Bag(au.parse_parser(parser))
+    benchmark(args.labels_nums, args.windows_nums, args.windows_length, args.windows_shift)
+    benchmark_seed_corr(args.seed_verts_num, args.seed_T, args.seeds_nums)
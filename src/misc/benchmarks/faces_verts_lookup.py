@@ -0,0 +1,55 @@
+import os.path as op
+import time
+import tempfile
+import numpy as np
+from collections import Counter
+
+from src.misc.benchmarks.topology_store import create_grid_mesh
+from src.utils import utils
+from src.utils import args_utils as au
+
+
+def loop_calc_ply_faces_verts(verts, faces):
+    # The previous calc_ply_faces_verts' loop over the faces, as a reference
+    _faces = faces.ravel()
+    faces_arg_sort = np.argsort(_faces)
+    faces_sort = np.sort(_faces)
+    faces_count = Counter(faces_sort)
+    max_len = max([v for v in faces_count.values()])
+    lookup = np.ones((verts.shape[0], max_len)) * -1
+    diff = np.diff(faces_sort)
+    n = 0
+    for ind, (k, v) in enumerate(zip(faces_sort, faces_arg_sort)):
+        lookup[k, n] = v
+        n = 0 if ind < len(diff) and diff[ind] > 0 else n + 1
+    return lookup.astype(int)
+
+
+def benchmark(grid_sizes, loop_max_faces):
+    print('verts\tfaces\tvectorized (s)\tloop (s)\tspeedup\tidentical')
+    with tempfile.TemporaryDirectory() as fol:
+        out_file = op.join(fol, 'faces_verts.npy')
+        for grid_size in grid_sizes:
+            verts_num, faces = create_grid_mesh(grid_size, grid_size)
+            verts = np.zeros((verts_num, 3))
+            now = time.time()
+            utils.calc_ply_faces_verts(verts, faces, out_file, overwrite=True)
+            vectorized_time = time.time() - now
+            if len(faces) > loop_max_faces:
+                print('{}\t{}\t{:.3f}\t-\t-\t-'.format(verts_num, len(faces), vectorized_time))
+                continue
+            now = time.time()
+            loop_lookup = loop_calc_ply_faces_verts(verts, faces)
+            loop_time = time.time() - now
+            identical = np.array_equal(np.load(out_file), loop_lookup)
+            print('{}\t{}\t{:.3f}\t{:.3f}\t{:.0f}x\t{}'.format(
+                verts_num, len(faces), vectorized_time, loop_time, loop_time / vectorized_time, identical))
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='faces_verts lookup builder benchmark')
+    parser.add_argument('--grid_sizes', required=False, default='50,100,200,400', type=au.int_arr_type)
+    parser.add_argument('--loop_max_faces', required=False, default=400000, type=int)
+    args = utils.Bag(au.parse_parser(parser))
+    benchmark(args.grid_sizes, args.loop_max_faces)
@@ -0,0 +1,76 @@
+import os
+import os.path as op
+import glob
+import time
+import shutil
+import tempfile
+import numpy as np
+
+from src.mmvt_addon import ply_utils
+from src.utils import utils
+from src.utils import args_utils as au
+
+
+def time_reads(ply_fnames):
+    # Parsing the plys (without the cache), the first cached read (parsing + writing the cache), and the cache hits
+    parse_time, first_time, hit_time = 0, 0, 0
+    for ply_fname in ply_fnames:
+        now = time.time()
+        ply_utils.read_ply_file(ply_fname)
+        parse_time += time.time() - now
+        cache_fname = ply_utils.get_cache_fname(ply_fname)
+        if op.isfile(cache_fname):
+            os.remove(cache_fname)
+        now = time.time()
+        ply_utils.read_ply_file_cached(ply_fname)
+        first_time += time.time() - now
+        now = time.time()
+        ply_utils.read_ply_file_cached(ply_fname)
+        hit_time += time.time() - now
+    return parse_time, first_time, hit_time
+
+
+def benchmark_subject(subject_fol):
+    # The plys are copied to a temp folder, so the subject's npz files won't be touched
+    ply_fnames = glob.glob(op.join(subject_fol, '**', '*.ply'), recursive=True)
+    if len(ply_fnames) == 0:
+        print('No ply files in {}!'.format(subject_fol))
+        return
+    with tempfile.TemporaryDirectory() as fol:
+        tmp_ply_fnames = []
+        for ind, ply_fname in enumerate(ply_fnames):
+            tmp_ply_fnames.append(op.join(fol, '{}_{}'.format(ind, op.basename(ply_fname))))
+            shutil.copy(ply_fname, tmp_ply_fnames[-1])
+        report(subject_fol, tmp_ply_fnames)
+
+
+def benchmark_synthetic(verts_nums):
+    with tempfile.TemporaryDirectory() as fol:
+        for verts_num in verts_nums:
+            verts = np.random.randn(verts_num, 3) * 50
+            faces = np.random.randint(0, verts_num, (verts_num * 2, 3))
+            for binary in [False, True]:
+                ply_fname = op.join(fol, '{}_{}.ply'.format(verts_num, 'binary' if binary else 'ascii'))
+                ply_utils.write_ply_file(verts, faces, ply_fname, binary)
+                report('{} vertices, {} ply'.format(verts_num, 'binary' if binary else 'ascii'), [ply_fname])
+
+
+def report(name, ply_fnames):
+    size = sum([op.getsize(ply_fname) for ply_fname in ply_fnames]) / 2 ** 20
+    parse_time, first_time, hit_time = time_reads(ply_fnames)
+    print('{}: {} ply files ({:.1f} MB), parse {:.3f}s, first read {:.3f}s, cached {:.3f}s ({:.1f}x)'.format(
+        name, len(ply_fnames), size, parse_time, first_time, hit_time, parse_time / hit_time))
+
+
+if __name__ == '__main__':
+    import argparse
+    from src.utils import preproc_utils as pu
+    parser = argparse.ArgumentParser(description='ply parsing vs npz mesh cache benchmark')
+    parser.add_argument('-s', '--subject', required=False, default='')
+    parser.add_argument('--verts_nums', required=False, default='10000,150000', type=au.int_arr_type)
+    args = utils.Bag(au.parse_parser(parser))
+    if args.subject != '':
+        _, MMVT_DIR, _ = pu.get_links()
+        benchmark_subject(op.join(MMVT_DIR, args.subject))
+    else:
+        benchmark_synthetic(args.verts_nums)
@@ -0,0 +1,80 @@
+import os.path as op
+import time
+import tempfile
+import numpy as np
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+import matplotlib.image as mpimg
+
+from src.utils import utils
+from src.utils import make_movie
+from src.utils import movies_utils as mu
+from src.utils import args_utils as au
+
+
+def create_synthetic_frames(fol, frames_num, width, height):
+    time_range = np.arange(frames_num)
+    for t in time_range:
+        image = np.zeros((height, width, 4), dtype=np.uint8)
+        image[:, :, 0] = (t * 5) % 255
+        image[height // 4:-height // 4, width // 4:-width // 4] = (40, 80, 200, 255)
+        plt.imsave(op.join(fol, '{}_t{}.png'.format(t, t)), image)
+    graph_data = {'stim': {'elc1': np.sin(time_range / 10), 'elc2': np.cos(time_range / 10)}}
+    graph_colors = {'stim': {'elc1': (1, 0, 0), 'elc2': (0, 0, 1)}}
+    utils.save((graph_data, graph_colors), op.join(fol, 'data.pkl'))
+    return time_range
+
+
+def savefig_movie(fol, time_range, dpi, fps):
+    # The previous encoder: the whole figure is drawn and saved for every frame, and the saved images are combined
+    images = make_movie.get_pics(fol)
+    movie_fig = make_movie.create_movie_figure(
+        time_range, time_range[::10], images, dpi, 'stim', 'stim', fol, '', xticklabels=None)
+    new_images_fol = op.join(fol, 'movie_images')
+    utils.make_dir(new_images_fol)
+    for image_index, image_fname in enumerate(images):
+        movie_fig.im.set_data(mpimg.imread(image_fname))
+        current_t = make_movie.get_t(images, image_index, time_range)
+        movie_fig.t_line.set_data([current_t, current_t], [movie_fig.ymin, movie_fig.ymax])
+        plt.savefig(op.join(new_images_fol, 'mv_{}.png'.format(image_index)),
+                    facecolor=movie_fig.fig.get_facecolor(), transparent=True)
+    plt.close(movie_fig.fig)
+    mu.combine_images(new_images_fol, op.join(fol, 'savefig_movie'), frame_rate=fps, movie_name_full_path=True)
+
+
+def stream_movie(fol, time_range, dpi, fps, n_jobs):
+    images = make_movie.get_pics(fol)
+    movie_fig = make_movie.create_movie_figure(
+        time_range, time_range[::10], images, dpi, 'stim', 'stim', fol, '', xticklabels=None)
+    make_movie.stream_movie(movie_fig, images, (), time_range, fps, op.join(fol, 'stream_movie.mp4'), n_jobs)
+    plt.close(movie_fig.fig)
+
+
+def benchmark(frames_num, width, height, dpi, fps, n_jobs_list):
+    with tempfile.TemporaryDirectory() as fol:
+        time_range = create_synthetic_frames(fol, frames_num, width, height)
+        now = time.time()
+        savefig_movie(fol, time_range, dpi, fps)
+        report('savefig + combine_images', frames_num, time.time() - now)
+        for n_jobs in n_jobs_list:
+            now = time.time()
+            stream_movie(fol, time_range, dpi, fps, n_jobs)
+            report('stream, {} decoding threads'.format(n_jobs), frames_num, time.time() - now)
+
+
+def report(name, frames_num, run_time):
+    print('{}: {} frames in {:.2f}s, {:.1f} frames per second'.format(name, frames_num, run_time, frames_num / run_time))
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='make_movie encoders benchmark')
+    parser.add_argument('--frames_num', required=False, default=200, type=int)
+    parser.add_argument('--width', required=False, default=800, type=int)
+    parser.add_argument('--height', required=False, default=600, type=int)
+    parser.add_argument('--dpi', required=False, default=100, type=int)
+    parser.add_argument('--fps', required=False, default=10, type=int)
+    parser.add_argument('--n_jobs', required=False, default='1,4', type=au.int_arr_type)
+    args = utils.Bag(au.parse_parser(parser))
+    benchmark(args.frames_num, args.width, args.height, args.dpi, args.fps, args.n_jobs)
@@ -0,0 +1,73 @@
+import os.path as op
+import time
+import tempfile
+import numpy as np
+
+from src.mmvt_addon import slicer
+from src.utils import utils
+from src.utils import args_utils as au
+
+
+def create_synthetic_volume(fol, subject, modality, size, dtype):
+    # A volume with a bright sphere, saved like anatomy.save_images_data_and_header, so slicer.init memory maps it
+    fname = op.join(fol, subject, 'ct' if modality == 'ct' else 'freeview', '{}_data.npz'.format(modality))
+    utils.make_dir(op.dirname(fname))
+    grid = np.ogrid[:size, :size, :size]
+    dists = sum([(g - size / 2) ** 2 for g in grid])
+    data = (np.random.rand(size, size, size) * 50).astype(dtype)
+    data[dists < (size / 3) ** 2] += 100
+    affine = np.diag([256 / size, 256 / size, 256 / size, 1])
+    np.savez(fname, data=data, affine=affine, precentiles=np.percentile(data[::4, ::4, ::4], (1, 99)),
+             colors_ratio=256 / (data.max() - data.min()))
+    return fname
+
+
+def time_clicks(state, modality, clicks):
+    times = []
+    for xyz in clicks:
+        now = time.time()
+        slicer.create_slices(None, xyz, state, modality)
+        times.append(time.time() - now)
+    return np.array(times) * 1000
+
+
+def benchmark(modality, size, dtype, clicks_num):
+    with tempfile.TemporaryDirectory() as fol:
+        create_synthetic_volume(fol, 'bench', modality, size, dtype)
+        colormap = np.repeat(np.linspace(0, 1, 256)[:, np.newaxis], 3, axis=1)
+        now = time.time()
+        state = {modality: slicer.init(None, modality, colormap=colormap, subject='bench', mmvt_dir=fol)}
+        if modality != 'mri':
+            state['mri'] = state[modality]
+        print('{} {}^3: init (memory map) {:.2f}s'.format(modality, size, time.time() - now))
+        # The removed per click full volume allocation of the marked voxel volume
+        alloc_times = []
+        for _ in range(5):
+            now = time.time()
+            np.zeros_like(state[modality].data)
+            alloc_times.append(time.time() - now)
+        random_clicks = np.random.randint(0, size, (clicks_num, 3))
+        # Dragging the cursor back and forth, where the second pass is in the slices cache
+        drag = [(size // 2 + dx, size // 2, size // 2) for dx in range(-clicks_num // 4, clicks_num // 4)]
+        drag = drag + drag[::-1]
+        report('random clicks', time_clicks(state, modality, random_clicks))
+        report('drag', time_clicks(state, modality, drag))
+        print('  the previous per click zeros_like(volume): {:.1f}ms'.format(np.median(alloc_times) * 1000))
+        cache = state[modality].slices_cache
+        print('  slices cache: {} hits, {} misses'.format(cache.hits, cache.misses))
+
+
+def report(name, times):
+    print('  {}: median {:.1f}ms, 95% {:.1f}ms, max {:.1f}ms per click'.format(
+        name, np.median(times), np.percentile(times, 95), times.max()))
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='slicer per click latency benchmark')
+    parser.add_argument('--clicks_num', required=False, default=100, type=int)
+    parser.add_argument('--mri_size', required=False, default=256, type=int)
+    parser.add_argument('--ct_size', required=False, default=512, type=int)
+    args = utils.Bag(au.parse_parser(parser))
+    benchmark('mri', args.mri_size, np.uint8, args.clicks_num)
+    benchmark('ct', args.ct_size, np.int16, args.clicks_num)
@@ -0,0 +1,60 @@
+import time
+import numpy as np
+from itertools import cycle
+
+from src.mmvt_addon import mmvt_utils as mu
+from src.utils import utils
+from src.utils import args_utils as au
+
+
+def loop_set_fcurves_window_co(co, mat, fcurves_inds, curr_t, max_steps, curves_num, curves_sep):
+    # The previous change_graph_all_vals' loop over the fcurves and the samples, as a reference
+    elecs_cycle = cycle(range(mat.shape[0]))
+    for fcurve_co, fcurve_ind in zip(co, fcurves_inds):
+        elc_ind = next(elecs_cycle)
+        for ind in range(mat.shape[1]):
+            t = curr_t + ind
+            if t > max_steps:
+                t = ind
+            fcurve_co[t, 1] = mat[elc_ind, ind] + (curves_num / 2 - fcurve_ind) * curves_sep
+
+
+def time_updates(update_func, channels_num, window_length, buffer_size, runs_num, curves_sep):
+    # Streams runs_num buffers into the electrodes' fcurves, like change_graph_all_vals, from the first frame
+    co = np.zeros((channels_num, window_length, 2), dtype=np.float32)
+    co[:, :, 0] = np.arange(window_length)
+    fcurves_inds = np.arange(channels_num)
+    max_steps, curr_t, times = window_length - 2, 0, []
+    for _ in range(runs_num):
+        mat = np.random.randn(channels_num, buffer_size)
+        now = time.time()
+        update_func(co, mat, fcurves_inds, curr_t, max_steps, channels_num, curves_sep)
+        times.append(time.time() - now)
+        curr_t = (curr_t + buffer_size) % max_steps
+    return co, np.mean(times), np.max(times)
+
+
+def benchmark(channels_nums, window_length, buffer_size, runs_num, curves_sep):
+    print('channels\tbuffer\tbatched mean (s)\tbatched max (s)\tloop mean (s)\tloop max (s)\tspeedup\tidentical')
+    for channels_num in channels_nums:
+        np.random.seed(0)
+        batched_co, batched_mean, batched_max = time_updates(
+            mu.set_fcurves_window_co, channels_num, window_length, buffer_size, runs_num, curves_sep)
+        np.random.seed(0)
+        loop_co, loop_mean, loop_max = time_updates(
+            loop_set_fcurves_window_co, channels_num, window_length, buffer_size, runs_num, curves_sep)
+        print('{}\t{}\t{:.5f}\t{:.5f}\t{:.5f}\t{:.5f}\t{:.0f}x\t{}'.format(
+            channels_num, buffer_size, batched_mean, batched_max, loop_mean, loop_max, loop_mean / batched_mean,
+            np.array_equal(batched_co, loop_co)))
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Streaming fcurves update benchmark')
+    parser.add_argument('--channels_nums', required=False, default='64,128,256', type=au.int_arr_type)
+    parser.add_argument('--window_length', required=False, default=2500, type=int)
+    parser.add_argument('--buffer_size', required=False, default=100, type=int)
+    parser.add_argument('--runs_num', required=False, default=20, type=int)
+    parser.add_argument('--curves_sep', required=False, default=1, type=float)
+    args = utils.Bag(au.parse_parser(parser))
+    benchmark(args.channels_nums, args.window_length, args.buffer_size, args.runs_num, args.curves_sep)
@@ -0,0 +1,140 @@
+import os
+import os.path as op
+import time
+import pickle
+import tempfile
+import multiprocessing
+import numpy as np
+from collections import defaultdict
+
+from src.mmvt_addon import topology_utils as tu
+from src.utils import utils
+from src.utils import args_utils as au
+
+HEMIS = ['rh', 'lh']
+
+
+def create_grid_mesh(rows_num, cols_num):
+    # A torus grid mesh, where every vertex has 6 neighbors, like most of the cortical surface vertices
+    inds = np.arange(rows_num * cols_num).reshape((rows_num, cols_num))
+    right, down = np.roll(inds, -1, axis=1), np.roll(inds, -1, axis=0)
+    down_right = np.roll(right, -1, axis=0)
+    faces = np.concatenate([np.stack((inds, right, down_right), axis=-1).reshape((-1, 3)),
+                            np.stack((inds, down_right, down), axis=-1).reshape((-1, 3))])
+    return rows_num * cols_num, faces
+
+
+def create_files(fol, verts_num, faces, labels_num):
+    # Writes the same topology in the legacy pickles and in the new CSR / int16 arrays
+    labels_names = ['label{}'.format(ind) for ind in range(labels_num)]
+    legacy_labels_lookup = {}
+    for hemi in HEMIS:
+        neighbors = tu.calc_verts_neighbors(faces, verts_num)
+        verts_faces = tu.calc_verts_faces(faces, verts_num)
+        labels_ids = (np.arange(verts_num) * labels_num // verts_num).astype(np.int16)
+        tu.save_csr(neighbors, tu.verts_neighbors_fname(fol, hemi))
+        tu.save_csr(verts_faces, tu.verts_faces_fname(fol, hemi))
+        hemi_labels_names = ['{}-{}'.format(name, hemi) for name in labels_names] + ['unknown_{}'.format(hemi)]
+        tu.save_vertices_labels_lookup(fol, 'atlas', hemi, labels_ids, hemi_labels_names)
+        legacy_neighbors, legacy_faces = defaultdict(list), defaultdict(list)
+        for vert in range(verts_num):
+            legacy_neighbors[vert] = list(neighbors[vert])
+            legacy_faces[vert] = list(verts_faces[vert])
+        utils.save(legacy_neighbors, op.join(fol, 'verts_neighbors_{}.pkl'.format(hemi)))
+        utils.save(legacy_faces, op.join(fol, 'faces_verts_lookup_{}.pkl'.format(hemi)))
+        legacy_labels_lookup[hemi] = {vert: hemi_labels_names[labels_ids[vert]] for vert in range(verts_num)}
+    utils.save(legacy_labels_lookup, op.join(fol, 'atlas_vertices_labels_lookup.pkl'))
+
+
+def get_rss():
+    # The current resident set size in MB (linux only)
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+
+
+def load_pickle(fname):
+    with open(fname, 'rb') as fp:
+        return pickle.load(fp)
+
+
+def load_legacy(fol):
+    data = {}
+    for hemi in HEMIS:
+        data['neighbors_{}'.format(hemi)] = load_pickle(op.join(fol, 'verts_neighbors_{}.pkl'.format(hemi)))
+        data['faces_{}'.format(hemi)] = load_pickle(op.join(fol, 'faces_verts_lookup_{}.pkl'.format(hemi)))
+    labels_lookup = load_pickle(op.join(fol, 'atlas_vertices_labels_lookup.pkl'))
+    for hemi in HEMIS:
+        data['labels_{}'.format(hemi)] = labels_lookup[hemi]
+    return data
+
+
+def load_topology(fol, mmap):
+    data = {}
+    for hemi in HEMIS:
+        data['neighbors_{}'.format(hemi)] = tu.load_csr(tu.verts_neighbors_fname(fol, hemi), mmap)
+        data['faces_{}'.format(hemi)] = tu.load_csr(tu.verts_faces_fname(fol, hemi), mmap)
+        data['labels_{}'.format(hemi)] = tu.load_vertices_labels_lookup(fol, 'atlas', hemi, mmap=mmap)
+    return data
+
+
+def query(data, verts):
+    # A typical access pattern: the labels of the vertices' neighbors, and the vertices' faces
+    for hemi in HEMIS:
+        neighbors, faces, labels = [data['{}_{}'.format(k, hemi)] for k in ['neighbors', 'faces', 'labels']]
+        for vert in verts:
+            set([labels[nei] for nei in neighbors[vert]])
+            len(faces[vert])
+
+
+def run_loader(loader, fol, queries_num, verts_num, pipe):
+    rss = get_rss()
+    now = time.time()
+    if loader == 'pickles':
+        data = load_legacy(fol)
+    else:
+        data = load_topology(fol, mmap=loader == 'npy (mmap)')
+    load_time = time.time() - now
+    load_rss = get_rss() - rss
+    verts = np.random.randint(0, verts_num, queries_num)
+    now = time.time()
+    query(data, verts)
+    query_time = time.time() - now
+    pipe.send((load_time, load_rss, query_time, get_rss() - rss))
+
+
+def files_size(fol, loader):
+    fnames = [op.join(fol, fname) for fname in os.listdir(fol)] if loader == 'pickles' else \
+        [op.join(tu.get_topology_fol(fol), fname) for fname in os.listdir(tu.get_topology_fol(fol))]
+    return sum([op.getsize(fname) for fname in fnames if fname.endswith('.pkl') == (loader == 'pickles')]) / 2 ** 20
+
+
+def benchmark(rows_num, cols_num, labels_num, queries_num):
+    verts_num, faces = create_grid_mesh(rows_num, cols_num)
+    # Each loader runs in a new process, so the RSS deltas won't be affected by the previous loaders
+    ctx = multiprocessing.get_context('spawn')
+    with tempfile.TemporaryDirectory() as fol:
+        now = time.time()
+        create_files(fol, verts_num, faces, labels_num)
+        print('{} vertices per hemi, {} faces, files were created in {:.2f}s'.format(
+            verts_num, len(faces), time.time() - now))
+        print('loader\tfiles (MB)\tload (s)\tRSS after load (MB)\t{} queries (s)\tRSS after queries (MB)'.format(
+            queries_num))
+        for loader in ['pickles', 'npy', 'npy (mmap)']:
+            parent_pipe, child_pipe = ctx.Pipe()
+            p = ctx.Process(target=run_loader, args=(loader, fol, queries_num, verts_num, child_pipe))
+            p.start()
+            load_time, load_rss, query_time, query_rss = parent_pipe.recv()
+            p.join()
+            print('{}\t{:.1f}\t{:.3f}\t{:.1f}\t{:.3f}\t{:.1f}'.format(
+                loader, files_size(fol, loader), load_time, load_rss, query_time, query_rss))
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Mesh topology store (pickles vs CSR npy) benchmark')
+    parser.add_argument('--rows_num', required=False, default=400, type=int)
+    parser.add_argument('--cols_num', required=False, default=400, type=int)
+    parser.add_argument('--labels_num', required=False, default=70, type=int)
+    parser.add_argument('--queries_num', required=False, default=10000, type=int)
+    args = utils.Bag(au.parse_parser(parser))
+    benchmark(args.rows_num, args.cols_num, args.labels_num, args.queries_num)
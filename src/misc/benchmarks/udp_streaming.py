@@ -0,0 +1,108 @@
+import time
+import socket
+import threading
+import multiprocessing
+import numpy as np
+from queue import Queue, Empty
+
+from src.listeners import udp_server
+from src.mmvt_addon import streaming_utils
+from src.utils import utils
+from src.utils import args_utils as au
+
+
+def bind_socket(port, rcvbuf_size=2 ** 22):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf_size)
+    sock.bind(('localhost', port))
+    return sock
+
+
+def legacy_reader(sock, udp_queue, while_termination_func, buffer_size, timeout=0.1):
+    # The previous udp_reader's loop (without the prints), as a reference: frombuffer + hstack per packet
+    sock.settimeout(timeout)
+    buffer, prev_val, packets = [], None, 0
+    while while_termination_func():
+        try:
+            next_val = sock.recv(2048 * 16)
+        except socket.timeout:
+            continue
+        packets += 1
+        next_val = np.frombuffer(next_val, dtype=np.dtype(np.float64)).copy()
+        if np.allclose(next_val, 0):
+            continue
+        if prev_val is not None and np.allclose(next_val.ravel(), prev_val.ravel()):
+            continue
+        prev_val = next_val.copy()
+        next_val = next_val[..., np.newaxis]
+        buffer = next_val if len(buffer) == 0 else np.hstack((buffer, next_val))
+        if buffer.shape[1] >= buffer_size:
+            udp_queue.put(buffer)
+            buffer = []
+    return packets
+
+
+def consumer(udp_queue, while_termination_func, ring_holder):
+    while while_termination_func():
+        try:
+            udp_queue.get(timeout=0.1)
+        except Empty:
+            continue
+        if ring_holder.get('ring') is not None:
+            ring_holder['ring'].block_consumed()
+
+
+def run(reader, channels_num, packets_num, buffer_size, interval, port):
+    data = np.random.randn(channels_num, 1000)
+    sock = bind_socket(port)
+    sender = multiprocessing.Process(
+        target=udp_server.send_binary_data, args=(('localhost', port), data, interval, packets_num))
+    udp_queue, ring_holder = Queue(), {}
+    reading = [True]
+    consumer_thread = threading.Thread(target=consumer, args=(udp_queue, lambda: reading[0], ring_holder))
+    consumer_thread.start()
+    sender.start()
+    now = time.time()
+    sender_end_time = [None]
+
+    def while_termination_func():
+        # Read until the sender is done, and the socket's buffer was drained
+        if sender.is_alive():
+            return True
+        if sender_end_time[0] is None:
+            sender_end_time[0] = time.time()
+        return time.time() - sender_end_time[0] < 0.5
+
+    if reader == 'ring':
+        ring = streaming_utils.read_udp_to_ring_buffer(
+            sock, udp_queue, while_termination_func, buffer_size, timeout=0.05,
+            ring_buffer_created=lambda r: ring_holder.update(ring=r))
+        stats = ring.stats() if ring is not None else {}
+        received = stats.get('packets', 0)
+    else:
+        received = legacy_reader(sock, udp_queue, while_termination_func, buffer_size, timeout=0.05)
+        stats = {}
+    run_time = sender_end_time[0] - now
+    reading[0] = False
+    consumer_thread.join()
+    sock.close()
+    sender.join()
+    print('{}: {} channels, sent {} packets in {:.2f}s ({:.0f}/s), received {} ({} lost), {}'.format(
+        reader, channels_num, packets_num, run_time, packets_num / run_time, received, packets_num - received,
+        ', '.join(['{}={}'.format(k, '{:.5f}'.format(v) if isinstance(v, float) else v)
+                   for k, v in stats.items()])))
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='UDP streaming ingestion loopback benchmark')
+    parser.add_argument('--channels_nums', required=False, default='64,256', type=au.int_arr_type)
+    parser.add_argument('--packets_num', required=False, default=100000, type=int)
+    parser.add_argument('--buffer_size', required=False, default=100, type=int)
+    parser.add_argument('--interval', required=False, default=0, type=float)
+    parser.add_argument('--port', required=False, default=45455, type=int)
+    args = utils.Bag(au.parse_parser(parser))
+    for channels_num in args.channels_nums:
+        for reader in ['ring', 'legacy']:
+            run(reader, channels_num, args.packets_num, args.buffer_size, args.interval, args.port)
@@ -0,0 +1,65 @@
+import os.path as op
+import time
+import tempfile
+import numpy as np
+import nibabel as nib
+
+from src.misc.benchmarks.topology_store import create_grid_mesh
+from src.mmvt_addon import mmvt_utils as mu
+from src.utils import utils
+from src.utils import args_utils as au
+
+
+def create_synthetic_annot(fol, verts_num, labels_num):
+    # labels_num patches of consecutive vertices, and the last patch is left without a label
+    annot_fname = op.join(fol, 'lh.synthetic.annot')
+    vertices_labels = np.arange(verts_num) * (labels_num + 1) // verts_num
+    vertices_labels[vertices_labels == labels_num] = -1
+    ctab = np.hstack((np.random.randint(0, 256, (labels_num, 3)), np.zeros((labels_num, 1), dtype=int)))
+    names = ['label{}'.format(ind) for ind in range(labels_num)]
+    nib.freesurfer.write_annot(annot_fname, vertices_labels, ctab, names)
+    return annot_fname
+
+
+def scan_vertex_label(annot_fname, vertex_ind):
+    # The previous find_closest_label's scan, as a reference: the annot is read, and all the labels' vertices are
+    # scanned for every query
+    labels = mu.read_labels_from_annot(annot_fname)
+    vert_labels = [l for l in labels if vertex_ind in l.vertices]
+    return vert_labels[0] if len(vert_labels) > 0 else None
+
+
+def time_queries(find_func, annot_fname, vertices):
+    labels_names, times = [], []
+    for vertex_ind in vertices:
+        now = time.time()
+        label = find_func(annot_fname, vertex_ind)
+        times.append(time.time() - now)
+        labels_names.append(label.name if label is not None else None)
+    return labels_names, times
+
+
+def benchmark(grid_sizes, labels_num, queries_num):
+    print('verts\tlabels\tlookup first (s)\tlookup mean (s)\tscan mean (s)\tspeedup\tidentical')
+    with tempfile.TemporaryDirectory() as fol:
+        for grid_size in grid_sizes:
+            verts_num, _ = create_grid_mesh(grid_size, grid_size)
+            annot_fname = create_synthetic_annot(fol, verts_num, labels_num)
+            vertices = np.random.randint(0, verts_num, queries_num)
+            mu.ANNOT_LOOKUPS_CACHE.clear()
+            lookup_names, lookup_times = time_queries(mu.find_vertex_label, annot_fname, vertices)
+            scan_names, scan_times = time_queries(scan_vertex_label, annot_fname, vertices)
+            lookup_mean = np.mean(lookup_times[1:]) if queries_num > 1 else lookup_times[0]
+            print('{}\t{}\t{:.4f}\t{:.6f}\t{:.4f}\t{:.0f}x\t{}'.format(
+                verts_num, labels_num, lookup_times[0], lookup_mean, np.mean(scan_times),
+                np.mean(scan_times) / lookup_mean, lookup_names == scan_names))
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Where am I vertex to label lookup benchmark')
+    parser.add_argument('--grid_sizes', required=False, default='100,200,400', type=au.int_arr_type)
+    parser.add_argument('--labels_num', required=False, default=70, type=int)
+    parser.add_argument('--queries_num', required=False, default=100, type=int)
+    args = utils.Bag(au.parse_parser(parser))
+    benchmark(args.grid_sizes, args.labels_num, args.queries_num)
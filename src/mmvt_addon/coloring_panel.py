@@ -1,5 +1,6 @@
 import mmvt_utils as mu
 import colors_utils as cu
+import topology_utils as tu
 import numpy as np
 import os.path as op
 import os
@@ -382,6 +383,20 @@ def object_coloring(obj, rgb):
     return True
 
 
+def objects_coloring(objs, colors):
+    # Colors many objects in one pass, without making every object the active one like object_coloring
+    use_nodes = not _addon().is_solid()
+    for obj, rgb in zip(objs, colors):
+        if obj is None or obj.active_material is None:
+            continue
+        cur_mat = obj.active_material
+        new_color = (rgb[0], rgb[1], rgb[2], 1)
+        cur_mat.diffuse_color = new_color[:3]
+        if can_color_obj(obj):
+            cur_mat.node_tree.nodes["RGB"].outputs[0].default_value = new_color
+        cur_mat.use_nodes = use_nodes
+
+
 def get_obj_color(obj):
     cur_mat = obj.active_material
     try:
@@ -581,6 +596,17 @@ def meg_labels_coloring(override_current_mat=True, labels_data_dict=None):
     if not mu.both_hemi_files_exist(labels_data_fname):
         print('Can\'t find {}!'.format(labels_data_fname))
         return
+    meg_labels_min, meg_labels_max = get_meg_labels_minmax(labels_data_fname)
+    for hemi in hemispheres:
+        # labels_data = np.load(op.join(user_fol, 'meg', 'labels_data_{}_{}_{}.npz'.format(atlas, em, hemi)))
+        labels_data = np.load(labels_data_fname.format(hemi=hemi)) \
+            if labels_data_dict is None else labels_data_dict[hemi]
+        labels_coloring_hemi(
+            labels_data, ColoringMakerPanel.faces_verts, hemi, threshold, bpy.context.scene.meg_labels_coloring_type,
+            override_current_mat, meg_labels_min, meg_labels_max)
+
+
+def get_meg_labels_minmax(labels_data_fname):
     labels_data_minmax_fname = _addon().meg.get_label_data_minmax_fname()
     if not op.isfile(labels_data_minmax_fname):
         mu.add_mmvt_code_root_to_path()
@@ -591,14 +617,7 @@ def meg_labels_coloring(override_current_mat=True, labels_data_dict=None):
     meg_labels_min, meg_labels_max = labels_data_minimax['labels_diff_minmax'] \
         if bpy.context.scene.meg_labels_coloring_type == 'diff' else labels_data_minimax['labels_minmax']
     data_minmax = max(map(abs, [meg_labels_max, meg_labels_min]))
-    meg_labels_min, meg_labels_max = -data_minmax, data_minmax
-    for hemi in hemispheres:
-        # labels_data = np.load(op.join(user_fol, 'meg', 'labels_data_{}_{}_{}.npz'.format(atlas, em, hemi)))
-        labels_data = np.load(labels_data_fname.format(hemi=hemi)) \
-            if labels_data_dict is None else labels_data_dict[hemi]
-        labels_coloring_hemi(
-            labels_data, ColoringMakerPanel.faces_verts, hemi, threshold, bpy.context.scene.meg_labels_coloring_type,
-            override_current_mat, meg_labels_min, meg_labels_max)
+    return -data_minmax, data_minmax
 
 
 # def color_connections_labels_avg(override_current_mat=True):
@@ -941,6 +960,25 @@ def color_hemi_data(hemi, data, data_min=None, colors_ratio=None, threshold=0, o
         hemi=org_hemi, valid_verts=valid_verts)
 
 
+def color_hemi_precomputed(hemi, values, valid_verts, verts_colors, override_current_mat=True):
+    # Colors the hemi with colors that were already calculated, like by the play prefetcher
+    cur_obj = mu.get_hemi_obj(hemi)
+    _addon().show_activity()
+    set_activity_values(cur_obj, values)
+    if len(valid_verts) == 0:
+        return
+    mesh = cur_obj.data
+    bpy.context.scene.objects.active = cur_obj
+    cur_obj.select = True
+    if override_current_mat:
+        recreate_coloring_layers(mesh, 'Col')
+    if len(mesh.vertex_colors) > 1 and 'inflated' in cur_obj.name:
+        mesh.vertex_colors.active_index = mesh.vertex_colors.keys().index('Col')
+        mesh.vertex_colors['Col'].active_render = True
+    verts_lookup_bulk_coloring(valid_verts, ColoringMakerPanel.faces_verts[hemi], mesh.vertex_colors['Col'],
+                               verts_colors)
+
+
 @mu.timeit
 def plot_activity(map_type, faces_verts, threshold, meg_sub_activity=None,
         plot_subcorticals=True, override_current_mat=True, clusters=False):
@@ -948,7 +986,6 @@ def plot_activity(map_type, faces_verts, threshold, meg_sub_activity=None,
     current_root_path = mu.get_user_fol()# bpy.path.abspath(bpy.context.scene.conf_path)
     not_hiden_hemis = [hemi for hemi in HEMIS if not mu.get_hemi_obj(hemi).hide]
     t = bpy.context.scene.frame_current
-    frame_str = str(t)
     data_min, data_max = 0, 0
     f = None
     for hemi in not_hiden_hemis:
@@ -957,25 +994,24 @@ def plot_activity(map_type, faces_verts, threshold, meg_sub_activity=None,
             if map_type == 'MEG':
                 activity_type = bpy.context.scene.meg_files
                 activity_type = '' if activity_type == 'conditions diff' else '{}_'.format(activity_type)
-                fname = op.join(current_root_path, 'activity_map_{}{}'.format(
-                    activity_type, hemi), 't' + frame_str + '.npy')
+                fol = op.join(current_root_path, 'activity_map_{}{}'.format(activity_type, hemi))
                 colors_ratio = ColoringMakerPanel.meg_activity_colors_ratio
                 data_min, data_max = ColoringMakerPanel.meg_activity_data_minmax
                 cb_title = 'MEG'
             elif map_type == 'FMRI_DYNAMICS':
-                fname =  op.join(current_root_path, 'fmri', 'activity_map_' + hemi, 't' + frame_str + '.npy')
+                fol = op.join(current_root_path, 'fmri', 'activity_map_' + hemi)
                 colors_ratio = ColoringMakerPanel.fmri_activity_colors_ratio
                 data_min, data_max = ColoringMakerPanel.fmri_activity_data_minmax
                 cb_title = 'fMRI'
-            if op.isfile(fname):
-                f = np.load(fname)
+            f = mu.load_activity_map_t(fol, t)
+            if f is not None:
                 if _addon().colorbar_values_are_locked():
                     data_max, data_min = _addon().get_colorbar_max_min()
                     colors_ratio = 256 / (data_max - data_min)
                 else:
                     _addon().set_colorbar_max_min(data_max, data_min)
             else:
-                print("Can't load {}".format(fname))
+                print("Can't load {} for time {}".format(fol, t))
                 return False
         elif map_type == 'FMRI':
             if not ColoringMakerPanel.fmri_activity_data_minmax is None:
@@ -1209,10 +1245,10 @@ def activity_map_obj_coloring(
     if remove_unknown is None:
         remove_unknown = bpy.context.scene.remove_unknown_from_plotting
     if remove_unknown and hemi != '':
-        vertices_labels_lookup_fname = glob.glob(op.join(mu.get_user_fol(), '*_vertices_labels_lookup.pkl'))
-        if len(vertices_labels_lookup_fname) > 0:
-            vertices_labels_lookup = mu.load(vertices_labels_lookup_fname[0])
-            valid_verts = [v for v in valid_verts if 'unknown' not in vertices_labels_lookup[hemi][v]]
+        atlases = tu.get_atlases_with_vertices_labels_lookup(mu.get_user_fol())
+        if len(atlases) > 0:
+            vertices_labels_lookup = tu.load_atlas_vertices_labels_lookup(mu.get_user_fol(), atlases[0], hemi)
+            valid_verts = vertices_labels_lookup.remove_unknown_vertices(valid_verts)
 
     colors_picked_from_cm = False
     # cm = _addon().get_cm()
@@ -1308,12 +1344,12 @@ def vertex_object_coloring(cur_obj, mesh, coloring_layer, valid_verts, vert_valu
     vcol_layer = mesh.vertex_colors[coloring_layer]
     if save_prev_colors:
         ColoringMakerPanel.prev_colors[cur_obj.name] = {'lookup':lookup, 'vcol_layer':vcol_layer, 'colors':{}}
+    valid_verts = np.asarray(valid_verts, dtype=int)
     if colors_picked_from_cm:
-        verts_lookup_loop_coloring(
-            valid_verts, lookup, vcol_layer, lambda vert:verts_colors[vert], cur_obj.name, save_prev_colors)
+        valid_verts_colors = verts_colors[valid_verts]
     else:
-        verts_lookup_loop_coloring(
-            valid_verts, lookup, vcol_layer, lambda vert:vert_values[vert, 1:], cur_obj.name, save_prev_colors)
+        valid_verts_colors = vert_values[valid_verts, 1:]
+    verts_lookup_bulk_coloring(valid_verts, lookup, vcol_layer, valid_verts_colors)
 
 
 def verts_lookup_loop_coloring(valid_verts, lookup, vcol_layer, colors_func, cur_obj_name='', save_prev_colors=False):
@@ -1333,11 +1369,27 @@ def verts_lookup_loop_coloring(valid_verts, lookup, vcol_layer, colors_func, cur
     bpy.context.window.cursor_set("DEFAULT")
 
 
+def verts_lookup_bulk_coloring(valid_verts, lookup, vcol_layer, verts_colors):
+    # Sets the colors of all the valid vertices loops at once, using foreach_get / foreach_set, instead of
+    # setting the loops colors one by one. verts_colors[k] is the color of valid_verts[k]
+    loops_num = len(vcol_layer.data)
+    if loops_num == 0 or len(valid_verts) == 0:
+        return
+    bpy.context.window.cursor_set("WAIT")
+    # In Blender 2.7x the loops colors are RGB, and from 2.8 RGBA
+    channels_num = len(vcol_layer.data[0].color)
+    layer_colors = np.empty(loops_num * channels_num, dtype=np.float32)
+    vcol_layer.data.foreach_get('color', layer_colors)
+    layer_colors = layer_colors.reshape((loops_num, channels_num))
+    mu.set_verts_loops_colors(layer_colors, lookup, valid_verts, verts_colors)
+    vcol_layer.data.foreach_set('color', layer_colors.ravel())
+    bpy.context.window.cursor_set("DEFAULT")
+
+
 def clear_vertices(obj, vertices, lookup):
     mesh = obj.data
     vcol_layer = mesh.vertex_colors['Col']
-    colors_func = lambda vert:(0, 0, 0)
-    verts_lookup_loop_coloring(vertices, lookup, vcol_layer, colors_func)
+    verts_lookup_bulk_coloring(np.asarray(vertices, dtype=int), lookup, vcol_layer, np.zeros((len(vertices), 3)))
 
 
 def recreate_coloring_layers(mesh, coloring_layer='Col'):
@@ -1685,7 +1737,7 @@ def _meg_files_update(context):
     user_fol = mu.get_user_fol()
     ColoringMakerPanel.activity_map_chosen = False
     ColoringMakerPanel.stc_file_chosen = False
-    activity_types = [mu.namebase(f)[len('activity_map_'):-2] for f in glob.glob(op.join(user_fol, 'activity_map_*rh'))]
+    activity_types = get_meg_activity_types(user_fol)
     for activity_type in activity_types:
         if activity_type != '':
             activity_type = activity_types[:-1]
@@ -2445,8 +2497,8 @@ def draw(self, context):
         layout.prop(context.scene, 'remove_unknown_from_plotting', text='Remove unknown labels')
 
     if faces_verts_exist:
-        meg_current_activity_data_exist = mu.hemi_files_exists(
-            op.join(user_fol, 'activity_map_{hemi}', 't{}.npy'.format(bpy.context.scene.frame_current)))
+        meg_current_activity_data_exist = all([mu.activity_map_t_exists(
+            op.join(user_fol, 'activity_map_{}'.format(hemi)), bpy.context.scene.frame_current) for hemi in mu.HEMIS])
         if ColoringMakerPanel.meg_activity_data_exist and meg_current_activity_data_exist or \
                 ColoringMakerPanel.stc_file_exist:
             col = layout.box().column()
@@ -2743,12 +2795,12 @@ def init_labels_vertices():
 def init_meg_activity_map():
     user_fol = mu.get_user_fol()
     list_items = []
-    activity_types = [mu.namebase(f)[len('activity_map_'):-2] for f in glob.glob(op.join(user_fol, 'activity_map_*rh'))]
+    activity_types = get_meg_activity_types(user_fol)
     for activity_type in activity_types:
         if activity_type != '':
             activity_type = activity_type[:-1]
-        meg_files_exist = len(glob.glob(op.join(user_fol, 'activity_map_{}rh'.format(activity_type), 't*.npy'))) > 0 and \
-                          len(glob.glob(op.join(user_fol, 'activity_map_{}lh'.format(activity_type), 't*.npy'))) > 0
+        meg_files_exist = mu.hemi_activity_map_exists(
+            op.join(user_fol, 'activity_map_{}{}'.format(activity_type, '{hemi}')))
         meg_data_maxmin_fname = op.join(mu.get_user_fol(), 'meg_activity_map_{}minmax.pkl'.format(activity_type))
         if meg_files_exist and op.isfile(meg_data_maxmin_fname):
             data_min, data_max = mu.load(meg_data_maxmin_fname)
@@ -2775,6 +2827,13 @@ def init_meg_activity_map():
         ColoringMakerPanel.activity_types.append('meg')
 
 
+def get_meg_activity_types(user_fol):
+    # Both the activity maps stores (activity_map_*rh.npy) and the legacy folders (activity_map_*rh/t{t}.npy)
+    activity_maps = glob.glob(op.join(user_fol, 'activity_map_*rh')) + \
+                    glob.glob(op.join(user_fol, 'activity_map_*rh.npy'))
+    return list(set([mu.namebase(f)[len('activity_map_'):-2] for f in activity_maps]))
+
+
 def create_stc_files_list(list_items=[]):
     user_fol = mu.get_user_fol()
     stcs_files = glob.glob(op.join(user_fol, 'meg', '*.stc'))
@@ -2798,7 +2857,7 @@ def create_stc_files_list(list_items=[]):
 
 def init_fmri_activity_map():
     user_fol = mu.get_user_fol()
-    fmri_files_exist = mu.hemi_files_exists(op.join(user_fol, 'fmri', 'activity_map_{hemi}', 't0.npy'))
+    fmri_files_exist = mu.hemi_activity_map_exists(op.join(user_fol, 'fmri', 'activity_map_{hemi}'))
     fmri_data_maxmin_fname = op.join(user_fol, 'fmri', 'activity_map_minmax.npy')
     if fmri_files_exist and op.isfile(fmri_data_maxmin_fname):
         ColoringMakerPanel.fmri_activity_map_exist = True
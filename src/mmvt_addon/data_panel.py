@@ -832,6 +832,10 @@ def add_data_to_obj(obj_name, data, conditions):
         return
     data = data.squeeze()
     T = len(data)
+    data_hash = mu.calc_data_hash([data], conditions)
+    if mu.get_animation_data_hash(cur_obj) == data_hash:
+        print('{}: The data was not changed, skipping'.format(obj_name))
+        return
     clear_animation = False
     fcurves_num = mu.count_fcurves(cur_obj)
     if cur_obj.animation_data is not None:
@@ -841,30 +845,31 @@ def add_data_to_obj(obj_name, data, conditions):
         clear_animation = True
 
     # if fcurves_num != len(f['conditions']) or keyframe_points_num != data.shape[0]:
+    now = time.time()
     if clear_animation:
         cur_obj.animation_data_clear()
         print('keyframing {}'.format(obj_name))
         for cond_ind, cond_str in enumerate(conditions):
             cond_str = cond_str.astype(str)
-            # Set the values to zeros in the first and last frame for current object(current label)
-            mu.insert_keyframe_to_custom_prop(cur_obj, obj_name + '_' + cond_str, 0, 1)
-            mu.insert_keyframe_to_custom_prop(cur_obj, obj_name + '_' + cond_str, 0, len(data))
-
-            # For every time point insert keyframe to current object
-            cond_data = data[:, cond_ind] if data.ndim == 2 else np.reshape(data, (len(data), 1))
-            for ind, t in enumerate(cond_data):
-                mu.insert_keyframe_to_custom_prop(cur_obj, obj_name + '_' + cond_str, t, ind)
-
+            # The values are keyframed from frame 0, with zeros in the first and last frames
+            cond_data = data[:, cond_ind] if data.ndim == 2 else data
+            fcurve = mu.set_custom_prop_keyframes(cur_obj, obj_name + '_' + cond_str, cond_data, 0, (1, T))
             # remove the orange keyframe sign in the fcurves window
-            fcurves = bpy.data.objects[obj_name].animation_data.action.fcurves[cond_ind]
-            mod = fcurves.modifiers.new(type='LIMITS')
+            mod = fcurve.modifiers.new(type='LIMITS')
     elif bpy.context.scene.add_meg_labels_data_overwrite:
         for fcurve_ind, fcurve in enumerate(cur_obj.animation_data.action.fcurves):
-            fcurve.keyframe_points[0].co[1] = 0
-            fcurve.keyframe_points[-1].co[1] = 0
-            cond_data = data[:, fcurve_ind] if data.ndim == 2 else np.reshape(data, (len(data), 1))
-            for t in range(T):
-                fcurve.keyframe_points[t + 1].co[1] = cond_data[t, fcurve_ind]
+            cond_data = data[:, fcurve_ind] if data.ndim == 2 else data
+            mu.set_custom_prop_keyframes(cur_obj, '', cond_data, 0, (1, T), fcurve)
+    else:
+        return
+    mu.set_animation_data_hash(cur_obj, data_hash)
+    report_keyframing(obj_name, (T + 1) * len(conditions), now)
+
+
+def report_keyframing(obj_name, keyframes_num, start_time):
+    run_time = time.time() - start_time
+    print('{}: {} keyframes in {:.2f}s ({:.0f} keyframes per second)'.format(
+        obj_name, keyframes_num, run_time, keyframes_num / run_time if run_time > 0 else 0))
 
 
 def add_data_pool(parent_name, data, conditions):
@@ -995,35 +1000,9 @@ def add_data_to_parent_obj(parent_obj, source_files, stat):
         mu.log_err('No sources in {}'.format(source_files), logging)
         return
     sources_names = sorted(list(sources.keys()))
-    N = len(sources_names)
     T = len(sources[sources_names[0]])
-    fcurves_num = mu.count_fcurves(parent_obj)
-    if fcurves_num < len(sources_names):
-        parent_obj.animation_data_clear()
-        now = time.time()
-        for obj_counter, source_name in enumerate(sources_names):
-            mu.time_to_go(now, obj_counter, N, runs_num_to_print=10)
-            data = sources[source_name]
-            # Set the values to zeros in the first and last frame for Brain object
-            mu.insert_keyframe_to_custom_prop(parent_obj, source_name, 0, 1)
-            mu.insert_keyframe_to_custom_prop(parent_obj, source_name, 0, T)
-
-            # For every time point insert keyframe to the main Brain object
-            for ind in range(data.shape[0]):
-                mu.insert_keyframe_to_custom_prop(parent_obj, source_name, data[ind], ind)
-
-            # remove the orange keyframe sign in the fcurves window
-            fcurves = parent_obj.animation_data.action.fcurves[obj_counter]
-            mod = fcurves.modifiers.new(type='LIMITS')
-    else:
-        for fcurve_ind, fcurve in enumerate(parent_obj.animation_data.action.fcurves):
-            fcurve_name = mu.get_fcurve_name(fcurve)
-            fcurve.keyframe_points[0].co[1] = 0
-            fcurve.keyframe_points[-1].co[1] = 0
-            T = min([len(fcurve.keyframe_points) - 1, len(sources[fcurve_name])])
-            for t in range(T):
-                fcurve.keyframe_points[t + 1].co[1] = sources[fcurve_name][t]
-
+    # The values are keyframed from frame 0, with zeros in the first and last frames
+    set_parent_obj_keyframes(parent_obj, sources, 0, (1, T))
     if bpy.data.objects.get(' '):
         bpy.context.scene.objects.active = bpy.data.objects[' ']
     print('Finished keyframing the brain parent obj!!')
@@ -1163,20 +1142,24 @@ def add_data_to_electrodes(all_data, meta_data, window_len=None, conditions=None
         fcurves_num = mu.count_fcurves(cur_obj)
         if data.ndim == 1:
             data = data.reshape((-1, 1))
+        data_hash = mu.calc_data_hash([data[:T]], conditions)
+        if not clear_animation and mu.get_animation_data_hash(cur_obj) == data_hash:
+            print('{}: The data was not changed, skipping'.format(obj_name))
+            continue
         if fcurves_num == len(conditions):
             fcurve_len = len(cur_obj.animation_data.action.fcurves[0].keyframe_points)
         else:
-            fcurve_len = T
+            fcurve_len = T + 2
         if not clear_animation:
-            clear_animation = fcurves_num != len(conditions) or fcurve_len < T
+            clear_animation = fcurves_num != len(conditions) or fcurve_len != T + 2
+        obj_now = time.time()
         if clear_animation:
             add_data_to_electrode(data, cur_obj, obj_name, conditions, T)
         else:
             for fcurve_ind, fcurve in enumerate(cur_obj.animation_data.action.fcurves):
-                fcurve.keyframe_points[0].co[1] = 0
-                fcurve.keyframe_points[-1].co[1] = 0
-                for t in range(T):
-                    fcurve.keyframe_points[t + 1].co[1] = data[t, fcurve_ind]
+                mu.set_custom_prop_keyframes(cur_obj, '', data[:T, fcurve_ind], 2, (1, T + 2), fcurve)
+        mu.set_animation_data_hash(cur_obj, data_hash)
+        report_keyframing(obj_name, (T + 2) * len(conditions), obj_now)
 
     conditions = meta_data['conditions'] if isinstance(meta_data, dict) and 'conditions' in meta_data else ['all']
     print('Finished keyframing!!')
@@ -1187,19 +1170,52 @@ def add_data_to_electrode(data, cur_obj, obj_name, conditions, T):
     cur_obj.animation_data_clear()
     for cond_ind, cond_str in enumerate(conditions):
         cond_str = cond_str.astype(str) if not isinstance(cond_str, str) else cond_str
-        # Set the values to zeros in the first and last frame for current object(current label)
-        mu.insert_keyframe_to_custom_prop(cur_obj, obj_name + '_' + cond_str, 0, 1)
+        # The values are keyframed from frame 2, with zeros in the first and last frames
         # todo: +2? WTF?!?
-        mu.insert_keyframe_to_custom_prop(cur_obj, obj_name + '_' + cond_str, 0, T + 2)
-
         print('keyframing ' + obj_name + ' object in condition ' + cond_str)
-        # For every time point insert keyframe to current object
         data_cond_ind = conditions.index(cond_str)  # np.where(conditions == cond_str)[0][0]
-        for ind, t in enumerate(data[:T, data_cond_ind]):
-            mu.insert_keyframe_to_custom_prop(cur_obj, obj_name + '_' + str(cond_str), t, ind + 2)
+        fcurve = mu.set_custom_prop_keyframes(
+            cur_obj, obj_name + '_' + str(cond_str), data[:T, data_cond_ind], 2, (1, T + 2))
         # remove the orange keyframe sign in the fcurves window
-        fcurves = bpy.data.objects[obj_name].animation_data.action.fcurves[cond_ind]
-        mod = fcurves.modifiers.new(type='LIMITS')
+        mod = fcurve.modifiers.new(type='LIMITS')
+
+
+def set_parent_obj_keyframes(parent_obj, sources, first_frame, zero_frames, clear_animation=False):
+    # An fcurve per source. The existing fcurves are updated if they all have the sources' keyframes number,
+    # otherwise the animation is created again
+    sources_names = sorted(list(sources.keys()))
+    N = len(sources_names)
+    data_hash = mu.calc_data_hash([sources[source_name] for source_name in sources_names],
+                                  sources_names + [first_frame] + list(zero_frames))
+    if not clear_animation and mu.get_animation_data_hash(parent_obj) == data_hash:
+        print('{}: The data was not changed, skipping'.format(parent_obj.name))
+        return
+    keyframes_nums = {source_name: len(mu.calc_custom_prop_keyframes(
+        sources[source_name], first_frame, zero_frames)[0]) for source_name in sources_names}
+    if mu.count_fcurves(parent_obj) < N:
+        clear_animation = True
+    elif not clear_animation:
+        clear_animation = any([len(fcurve.keyframe_points) != keyframes_nums[mu.get_fcurve_name(fcurve)]
+                               for fcurve in parent_obj.animation_data.action.fcurves
+                               if mu.get_fcurve_name(fcurve) in sources])
+    now = time.time()
+    if clear_animation:
+        parent_obj.animation_data_clear()
+        for obj_counter, source_name in enumerate(sources_names):
+            mu.time_to_go(now, obj_counter, N, runs_num_to_print=10)
+            fcurve = mu.set_custom_prop_keyframes(
+                parent_obj, source_name, sources[source_name], first_frame, zero_frames)
+            # remove the orange keyframe sign in the fcurves window
+            mod = fcurve.modifiers.new(type='LIMITS')
+    else:
+        for fcurve in parent_obj.animation_data.action.fcurves:
+            fcurve_name = mu.get_fcurve_name(fcurve)
+            if fcurve_name not in sources:
+                print('{} not in sources!'.format(fcurve_name))
+                continue
+            mu.set_custom_prop_keyframes(parent_obj, '', sources[fcurve_name], first_frame, zero_frames, fcurve)
+    mu.set_animation_data_hash(parent_obj, data_hash)
+    report_keyframing(parent_obj.name, sum(keyframes_nums.values()), now)
 
 
 @mu.tryit()
@@ -1223,40 +1239,10 @@ def add_data_to_electrodes_parent_obj(parent_obj, all_data, meta, stat=STAT_DIFF
                 data_stat = np.squeeze(np.diff(data, axis=1))
         sources[obj_name] = data_stat
 
-    sources_names = sorted(list(sources.keys()))
-    N = len(sources_names)
     # T = _addon().get_max_time_steps() # len(sources[sources_names[0]]) + 2
-    fcurves_num = mu.count_fcurves(parent_obj)
-    if parent_obj.animation_data is not None:
-        if len(parent_obj.animation_data.action.fcurves[0].keyframe_points) != T + 2:
-            clear_animation = True
-    if fcurves_num < len(sources_names):
-        clear_animation = True
-    if clear_animation:
-        now = time.time()
-        parent_obj.animation_data_clear()
-        for obj_counter, source_name in enumerate(sources_names):
-            mu.time_to_go(now, obj_counter, N, runs_num_to_print=10)
-            data = sources[source_name]
-            mu.insert_keyframe_to_custom_prop(parent_obj, source_name, 0, 1)
-            mu.insert_keyframe_to_custom_prop(parent_obj, source_name, 0, T + 2)
-
-            for ind in range(T):
-                mu.insert_keyframe_to_custom_prop(parent_obj, source_name, data[ind], ind + 2)
-
-            fcurves = parent_obj.animation_data.action.fcurves[obj_counter]
-            mod = fcurves.modifiers.new(type='LIMITS')
-    else:
-        for fcurve_ind, fcurve in enumerate(parent_obj.animation_data.action.fcurves):
-            fcurve_name = mu.get_fcurve_name(fcurve)
-            if fcurve_name not in sources:
-                print('{} not in sources!'.format(fcurve_name))
-                continue
-            fcurve.keyframe_points[0].co[1] = 0
-            fcurve.keyframe_points[-1].co[1] = 0
-            for t in range(T):
-                fcurve.keyframe_points[t + 1].co[1] = sources[fcurve_name][t]
-
+    # The values are keyframed from frame 2, with zeros in the first and last frames
+    sources = {source_name: data[:T] for source_name, data in sources.items()}
+    set_parent_obj_keyframes(parent_obj, sources, 2, (1, T + 2), clear_animation)
     mu.view_all_in_graph_editor()
     print('Finished keyframing {}!!'.format(parent_obj.name))
 
@@ -1,4 +1,5 @@
 from src.mmvt_addon.dell import find_electrodes_in_ct as fect
+from src.mmvt_addon import topology_utils as tu
 import numpy as np
 import os.path as op
 import nibabel as nib
@@ -331,8 +332,7 @@ if __name__ == '__main__':
     # subject_fol = op.join(subjects_dir, subject)
     subject_fol = op.join(MMVT_DIR, subject)
 
-    verts_dural_neighbors_fname = op.join(mmvt_dir, subject, 'verts_neighbors_dural_{hemi}.pkl')
-    verts_dural_nei = {hemi:utils.load(verts_dural_neighbors_fname.format(hemi=hemi)) for hemi in utils.HEMIS}
+    verts_dural_nei = {hemi: tu.load_verts_neighbors(user_fol, hemi, 'dural') for hemi in utils.HEMIS}
     verts_dural = fect.read_surf_verts(user_fol, 'dural')
 
     # find_local_maxima_from_voxels([97, 88, 125], ct_data, threshold, find_nei_maxima=False)
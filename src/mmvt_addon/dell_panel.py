@@ -12,6 +12,7 @@ import time
 import csv
 from itertools import cycle
 import mmvt_utils as mu
+import topology_utils as tu
 from scripts import scripts_utils as su
 
 try:
@@ -1600,9 +1601,7 @@ def init_dural():
     try:
         user_fol = mu.get_user_fol()
         subject_fol = mu.get_subject_dir()
-        verts_dural_neighbors_fname = op.join(user_fol, 'verts_neighbors_dural_{hemi}.pkl')
-        DellPanel.verts_dural_nei = {hemi:mu.load(verts_dural_neighbors_fname.format(hemi=hemi)) \
-            if op.isfile(verts_dural_neighbors_fname.format(hemi=hemi)) else None for hemi in mu.HEMIS}
+        DellPanel.verts_dural_nei = {hemi: tu.load_verts_neighbors(user_fol, hemi, 'dural') for hemi in mu.HEMIS}
         DellPanel.verts_dural, DellPanel.faces_dural = fect.read_surf_verts(user_fol, subject_fol, 'dural', True)
         if DellPanel.verts_dural['rh'] is None or DellPanel.faces_dural['rh'] is None:
             return False
@@ -188,6 +188,7 @@ coloring = coloring_panel
 set_current_time = coloring_panel.set_current_time
 get_current_time = coloring_panel.get_current_time
 object_coloring = coloring_panel.object_coloring
+objects_coloring = coloring_panel.objects_coloring
 color_objects = coloring_panel.color_objects
 get_obj_color = coloring_panel.get_obj_color
 clear_subcortical_fmri_activity = coloring_panel.clear_subcortical_fmri_activity
@@ -375,6 +376,7 @@ set_play_to = play_panel.set_play_to
 set_play_dt = play_panel.set_play_dt
 capture_graph = play_panel.capture_graph
 render_movie = play_panel.render_movie
+render_movie_in_farm = play_panel.render_movie_in_farm
 get_current_t = play_panel.get_current_t
 set_current_t = play_panel.set_current_t
 plot_something = play_panel.plot_something
@@ -391,6 +393,8 @@ get_electrodes_names = electrodes_panel.get_electrodes_names
 electode_was_manually_selected = electrodes_panel.electode_was_manually_selected
 clear_electrodes_selection = electrodes_panel.clear_electrodes_selection
 init_electrodes_labeling = electrodes_panel.init_electrodes_labeling
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~ streaming links ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+streaming = streaming_panel
 # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~ colorbar links~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 colorbar = colorbar_panel
 show_cb_in_render = colorbar_panel.show_cb_in_render
@@ -16,6 +16,11 @@ except:
     pass
 
 
+try:
+    import ply_utils
+except:
+    from src.mmvt_addon import ply_utils
+
 try:
     import scipy
     SCIPY_EXIST = True
@@ -56,6 +61,7 @@ from sys import platform as _platform
 from datetime import datetime
 import glob
 import functools
+import hashlib
 import importlib
 
 _addon = None
@@ -273,6 +279,65 @@ def insert_keyframe_to_custom_prop(obj, prop_name, value, keyframe):
     obj.keyframe_insert(data_path='[' + '"' + prop_name + '"' + ']', frame=keyframe)
 
 
+def calc_custom_prop_keyframes(values, first_frame=0, zero_frames=()):
+    # The keyframes that insert_keyframe_to_custom_prop would create for zeros in zero_frames, and then for the
+    # values from first_frame (which override the zeros in the same frames)
+    values = np.asarray(values, dtype=np.float64).ravel()
+    frames = np.arange(first_frame, first_frame + len(values))
+    zero_frames = [f for f in sorted(set(zero_frames)) if not first_frame <= f < first_frame + len(values)]
+    frames = np.concatenate((frames, zero_frames))
+    values = np.concatenate((values, np.zeros(len(zero_frames))))
+    order = np.argsort(frames, kind='stable')
+    return frames[order], values[order]
+
+
+def set_custom_prop_keyframes(obj, prop_name, values, first_frame=0, zero_frames=(), fcurve=None):
+    # Like calling insert_keyframe_to_custom_prop for every keyframe, but the fcurve's keyframes are allocated at
+    # once and their times and values are set in a single foreach_set. If fcurve is given, its keyframes (which
+    # should be of the same number) are set. The handles are calculated once for the whole fcurve in update()
+    frames, values = calc_custom_prop_keyframes(values, first_frame, zero_frames)
+    if fcurve is None:
+        if len(prop_name) > 63:
+            raise Exception('keyframe\'s key can be up to 63 characters! {} has {}!'.format(prop_name, len(prop_name)))
+        obj[prop_name] = float(values[-1]) if len(values) > 0 else 0.0
+        if obj.animation_data is None:
+            obj.animation_data_create()
+        if obj.animation_data.action is None:
+            obj.animation_data.action = bpy.data.actions.new('{}Action'.format(obj.name))
+        fcurve = obj.animation_data.action.fcurves.new(data_path='["{}"]'.format(prop_name))
+        fcurve.keyframe_points.add(len(frames))
+    elif len(fcurve.keyframe_points) != len(frames):
+        raise Exception('{} has {} keyframes, not {}!'.format(
+            fcurve.data_path, len(fcurve.keyframe_points), len(frames)))
+    co = np.empty(len(frames) * 2, dtype=np.float32)
+    co[0::2], co[1::2] = frames, values
+    fcurve.keyframe_points.foreach_set('co', co)
+    fcurve.update()
+    return fcurve
+
+
+def calc_data_hash(arrays, keys=()):
+    md5 = hashlib.md5()
+    for arr in arrays:
+        arr = np.ascontiguousarray(arr)
+        md5.update('{}{}'.format(arr.shape, arr.dtype.str).encode())
+        md5.update(arr.tobytes())
+    md5.update('\n'.join([to_str(key) for key in keys]).encode())
+    return md5.hexdigest()
+
+
+def get_animation_data_hash(obj):
+    # The hash of the data the object's animation was created from (set_animation_data_hash)
+    if obj.animation_data is None or obj.animation_data.action is None:
+        return ''
+    return obj.animation_data.action.get('mmvt_data_hash', '')
+
+
+def set_animation_data_hash(obj, data_hash):
+    if obj.animation_data is not None and obj.animation_data.action is not None:
+        obj.animation_data.action['mmvt_data_hash'] = data_hash
+
+
 def get_object(obj_name, default=None):
     return bpy.data.objects.get(obj_name, default)
 
@@ -694,6 +759,18 @@ def get_fcurve_name(fcurve):
     return fcurve.data_path.split('"')[1].replace(' ', '')
 
 
+def set_fcurves_window_co(co, mat, fcurves_inds, curr_t, max_steps, curves_num, curves_sep):
+    # co is the fcurves' keyframes coordinates (fcurves x points x 2, from foreach_get). mat (channels x T) is
+    # written into their y values from curr_t, starting again from 0 after max_steps. The k-th fcurve gets the k-th
+    # channel (cycling), shifted by its separation. Returns the channels indices of the fcurves
+    T = mat.shape[1]
+    elc_inds = np.arange(len(co)) % mat.shape[0]
+    t_inds = curr_t + np.arange(T)
+    t_inds[t_inds > max_steps] = np.arange(T)[t_inds > max_steps]
+    co[:, t_inds, 1] = mat[elc_inds] + (curves_num / 2 - np.asarray(fcurves_inds)[:, np.newaxis]) * curves_sep
+    return elc_inds
+
+
 def show_only_selected_fcurves(context):
     space = context.space_data
     dopesheet = space.dopesheet
@@ -819,6 +896,142 @@ def hemi_files_exists(fname):
         return os.path.isfile(fname.format(hemi='rh')) and os.path.isfile(fname.format(hemi='lh'))
 
 
+# The activity map of all the time points is saved in one time major (T x vertices) npy file, which is memory
+# mapped by the readers, instead of one fol/t{t}.npy file per time point (the legacy format).
+ACTIVITY_MAP_STORES = {}
+
+
+def activity_map_store_fname(fol):
+    return '{}.npy'.format(fol.rstrip(op.sep))
+
+
+def activity_map_header_fname(fol):
+    return '{}_header.pkl'.format(fol.rstrip(op.sep))
+
+
+def activity_map_exists(fol):
+    return op.isfile(activity_map_store_fname(fol)) or op.isfile(op.join(fol, 't0.npy'))
+
+
+def hemi_activity_map_exists(fol_template):
+    return all([activity_map_exists(fol_template.format(hemi=hemi)) for hemi in HEMIS])
+
+
+def get_activity_map_store(fol):
+    store_fname = activity_map_store_fname(fol)
+    if not op.isfile(store_fname):
+        return None
+    mtime = op.getmtime(store_fname)
+    if store_fname not in ACTIVITY_MAP_STORES or ACTIVITY_MAP_STORES[store_fname][1] != mtime:
+        ACTIVITY_MAP_STORES[store_fname] = (np.load(store_fname, mmap_mode='r'), mtime)
+    return ACTIVITY_MAP_STORES[store_fname][0]
+
+
+def load_activity_map_t(fol, t):
+    store = get_activity_map_store(fol)
+    if store is not None:
+        return np.array(store[t]) if 0 <= t < store.shape[0] else None
+    legacy_fname = op.join(fol, 't{}.npy'.format(t))
+    return np.load(legacy_fname) if op.isfile(legacy_fname) else None
+
+
+def activity_map_t_exists(fol, t):
+    store = get_activity_map_store(fol)
+    if store is not None:
+        return 0 <= t < store.shape[0]
+    return op.isfile(op.join(fol, 't{}.npy'.format(t)))
+
+
+def read_activity_map_header(fol):
+    header_fname = activity_map_header_fname(fol)
+    if op.isfile(header_fname):
+        return load(header_fname)
+    store = get_activity_map_store(fol)
+    if store is None:
+        return None
+    return dict(vertices_num=store.shape[1], T=store.shape[0], data_min=np.nanmin(store), data_max=np.nanmax(store))
+
+
+def save_activity_map_header(fol, vertices_num, T, data_min, data_max):
+    save(dict(vertices_num=vertices_num, T=T, data_min=float(data_min), data_max=float(data_max)),
+         activity_map_header_fname(fol))
+
+
+def save_activity_map(fol, data, chunk_size=1000):
+    # data is vertices x T, like the stc data
+    vertices_num, T = data.shape
+    ACTIVITY_MAP_STORES.pop(activity_map_store_fname(fol), None)
+    store = np.lib.format.open_memmap(
+        activity_map_store_fname(fol), mode='w+', dtype=np.float32, shape=(T, vertices_num))
+    for t in range(0, T, chunk_size):
+        store[t:t + chunk_size] = data[:, t:t + chunk_size].T
+    store.flush()
+    del store
+    save_activity_map_header(fol, vertices_num, T, np.nanmin(data), np.nanmax(data))
+    return op.isfile(activity_map_store_fname(fol))
+
+
+def save_activity_map_t(fol, data_t, t):
+    # Writes one time point into the store, and extends the store if it's too short
+    store_fname = activity_map_store_fname(fol)
+    ACTIVITY_MAP_STORES.pop(store_fname, None)
+    store = np.load(store_fname, mmap_mode='r+') if op.isfile(store_fname) else None
+    if store is not None and store.shape[1] != len(data_t):
+        store = None
+    if store is None or t >= store.shape[0]:
+        data = np.zeros((len(data_t), t + 1), dtype=np.float32)
+        if store is not None:
+            data[:, :store.shape[0]] = store.T
+            del store
+        data[:, t] = data_t
+        return save_activity_map(fol, data)
+    store[t] = data_t
+    store.flush()
+    header = read_activity_map_header(fol)
+    save_activity_map_header(fol, store.shape[1], store.shape[0], min(header['data_min'], np.nanmin(data_t)),
+                             max(header['data_max'], np.nanmax(data_t)))
+    del store
+    return True
+
+
+def convert_activity_map_folder(fol, delete_folder=False):
+    # Converts a legacy fol/t{t}.npy folder into a store file
+    times_fnames = glob.glob(op.join(fol, 't*.npy'))
+    times_fnames = [f for f in times_fnames if namebase(f)[1:].isdigit()]
+    if len(times_fnames) == 0:
+        print('convert_activity_map_folder: No time points files were found in {}'.format(fol))
+        return op.isfile(activity_map_store_fname(fol))
+    times = {int(namebase(f)[1:]): f for f in times_fnames}
+    T = max(times.keys()) + 1
+    vertices_num = len(np.load(times[min(times.keys())]))
+    print('Converting {} ({} vertices, {} time points) into {}'.format(
+        fol, vertices_num, T, activity_map_store_fname(fol)))
+    ACTIVITY_MAP_STORES.pop(activity_map_store_fname(fol), None)
+    store = np.lib.format.open_memmap(
+        activity_map_store_fname(fol), mode='w+', dtype=np.float32, shape=(T, vertices_num))
+    data_min, data_max = np.inf, -np.inf
+    now = time.time()
+    for run, (t, fname) in enumerate(times.items()):
+        time_to_go(now, run, len(times), runs_num_to_print=1000)
+        data_t = np.load(fname)
+        store[t] = data_t
+        data_min, data_max = min(data_min, np.nanmin(data_t)), max(data_max, np.nanmax(data_t))
+    store.flush()
+    del store
+    save_activity_map_header(fol, vertices_num, T, data_min, data_max)
+    if delete_folder:
+        shutil.rmtree(fol)
+    return op.isfile(activity_map_store_fname(fol))
+
+
+def convert_activity_map_folders(subject_fol, delete_folders=False):
+    # Converts all the legacy activity maps folders of the subject (MEG and fMRI)
+    fols = [fol for fol in glob.glob(op.join(subject_fol, 'activity_map_*')) +
+            glob.glob(op.join(subject_fol, 'fmri', 'activity_map_*')) if op.isdir(fol) and
+            op.isfile(op.join(fol, 't0.npy'))]
+    return all([convert_activity_map_folder(fol, delete_folders) for fol in fols])
+
+
 def atoi(text):
     return int(text) if text.isdigit() else text
 
@@ -1378,29 +1591,96 @@ class connection_to_listener(object):
 conn_to_listener = connection_to_listener()
 
 
-def min_cdist_from_obj(obj, Y):
-    vertices = obj.data.vertices
-    kd = mathutils.kdtree.KDTree(len(vertices))
-    for ind, x in enumerate(vertices):
-        kd.insert(x.co, ind)
+KDTREES_CACHE = {}
+POINTS_KDTREES_CACHE = OrderedDict()
+
+
+def get_obj_vertices_co(obj, use_shape_keys=False):
+    # The object's vertices coordinates (in its local coordinates). If use_shape_keys, the coordinates are taken
+    # after the shape keys (and modifiers) were applied, like in the inflated brain
+    mesh = obj.to_mesh(bpy.context.scene, True, 'PREVIEW') if use_shape_keys else obj.data
+    vertices_co = np.empty(len(mesh.vertices) * 3, dtype=np.float32)
+    mesh.vertices.foreach_get('co', vertices_co)
+    if use_shape_keys:
+        bpy.data.meshes.remove(mesh)
+    return vertices_co.reshape((-1, 3))
+
+
+def calc_objects_kdtree_key(objs, use_shape_keys=False):
+    # The mesh's base coordinates can't be changed in mmvt, so the tree is invalidated only when the objects or their
+    # vertices num were changed, or, if use_shape_keys, when the shape keys values (the inflation) were changed
+    key = [get_user(), use_shape_keys]
+    for obj in objs:
+        key.append((obj.name, len(obj.data.vertices)))
+        if use_shape_keys and obj.data.shape_keys is not None:
+            key.append(tuple(key_block.value for key_block in obj.data.shape_keys.key_blocks))
+    return tuple(key)
+
+
+def get_objects_kdtree(objs, name='', use_shape_keys=False):
+    # One KD-tree for all the objects' vertices, like the pial / inflated / dural surfaces, or all the labels under
+    # Cortex-lh. The vertices are in the objects' local coordinates, so the objects should share the same
+    # matrix_world (like the children of the same parent). The tree is built once and cached by name (the first
+    # object's name by default), and rebuilt only when calc_objects_kdtree_key is changed.
+    objs = objs if isinstance(objs, (list, tuple)) else [objs]
+    if len(objs) == 0:
+        return None
+    name = objs[0].name if name == '' else name
+    key = calc_objects_kdtree_key(objs, use_shape_keys)
+    tree = KDTREES_CACHE.get((name, use_shape_keys), None)
+    if tree is not None and tree.key == key:
+        return tree
+    now = time.time()
+    vertices_co = [get_obj_vertices_co(obj, use_shape_keys) for obj in objs]
+    objs_inds = np.concatenate([np.full(len(co), obj_ind, dtype=int) for obj_ind, co in enumerate(vertices_co)])
+    vertices_inds = np.concatenate([np.arange(len(co)) for co in vertices_co])
+    vertices_co = np.vstack(vertices_co)
+    kd = mathutils.kdtree.KDTree(len(vertices_co))
+    for ind, co in enumerate(vertices_co):
+        kd.insert(co, ind)
     kd.balance()
+    tree = KDTREES_CACHE[(name, use_shape_keys)] = Bag(
+        key=key, kd=kd, objs_names=[obj.name for obj in objs], objs_inds=objs_inds, vertices_inds=vertices_inds)
+    print('KD-tree for {} ({} vertices) was built in {:.2f}s'.format(name, len(vertices_co), time.time() - now))
+    return tree
+
+
+def find_closest_vertex_in_kdtree(tree, co_find):
+    # Returns the closest object's name, the vertex index in that object, its coordinates and the distance
+    co, ind, dist = tree.kd.find(co_find)
+    if ind is None:
+        return None, -1, None, np.inf
+    return tree.objs_names[tree.objs_inds[ind]], int(tree.vertices_inds[ind]), co, dist
+
+
+def clear_kdtrees_cache():
+    KDTREES_CACHE.clear()
+    POINTS_KDTREES_CACHE.clear()
+
+
+def min_cdist_from_obj(obj, Y):
+    kd = get_objects_kdtree(obj).kd
     # Find the closest point to the 3d cursor
-    res = []
-    for y in Y:
-        res.append(kd.find_n(y, 1)[0])
+    res = [kd.find(y) for y in Y]
     # co, index, dist
     return res
 
 
-def min_cdist(X, Y):
-    kd = mathutils.kdtree.KDTree(X.shape[0])
-    for ind, x in enumerate(X):
-        kd.insert(x, ind)
-    kd.balance()
+def min_cdist(X, Y, cache_size=32):
+    # The trees are cached by X's content, as the same points (like a cluster's vertices) are usually queried again
+    X = np.ascontiguousarray(X)
+    key = (X.shape, X.dtype.str, hashlib.md5(X.tobytes()).hexdigest())
+    kd = POINTS_KDTREES_CACHE.pop(key, None)
+    if kd is None:
+        kd = mathutils.kdtree.KDTree(X.shape[0])
+        for ind, x in enumerate(X):
+            kd.insert(x, ind)
+        kd.balance()
+    POINTS_KDTREES_CACHE[key] = kd
+    if len(POINTS_KDTREES_CACHE) > cache_size:
+        POINTS_KDTREES_CACHE.popitem(last=False)
     # Find the closest point to the 3d cursor
-    res = []
-    for y in Y:
-        res.append(kd.find_n(y, 1)[0])
+    res = [kd.find(y) for y in Y]
     # co, index, dist
     if len(Y) == 1:
         return res[0]
@@ -1479,15 +1759,7 @@ def create_empty_in_vertex(vertex_location, obj_name, layer, parent_name=''):
 
 
 def read_ply_file(ply_file):
-    with open(ply_file, 'r') as f:
-        lines = f.readlines()
-        verts_num = int(lines[2].split(' ')[-1])
-        faces_num = int(lines[6].split(' ')[-1])
-        verts_lines = lines[9:9 + verts_num]
-        faces_lines = lines[9 + verts_num:]
-        verts = np.array([list(map(float, l.strip().split(' '))) for l in verts_lines])
-        faces = np.array([list(map(int, l.strip().split(' '))) for l in faces_lines])[:,1:]
-    return verts, faces
+    return ply_utils.read_ply_file_cached(ply_file)
 
 
 def change_selected_fcurves_colors(selected_objects_types, color_also_objects=True, exclude=()):
@@ -2663,6 +2935,33 @@ def read_labels_from_annot(annot_fname):
     return labels
 
 
+ANNOT_LOOKUPS_CACHE = {}
+
+
+def read_vertices_labels_lookup_from_annot(annot_fname):
+    # Returns the annot's labels, and a vertex -> label index array (-1 for vertices without a label), so the label
+    # of a vertex is labels[lookup[vertex_ind]] instead of scanning all the labels' vertices. They're read once, as
+    # long as the annot file wasn't changed
+    mtime = op.getmtime(annot_fname)
+    if annot_fname in ANNOT_LOOKUPS_CACHE and ANNOT_LOOKUPS_CACHE[annot_fname][0] == mtime:
+        return ANNOT_LOOKUPS_CACHE[annot_fname][1]
+    labels = read_labels_from_annot(annot_fname)
+    vertices_num = max([l.vertices.max() + 1 for l in labels if len(l.vertices) > 0], default=0)
+    lookup = np.full(vertices_num, -1, dtype=int)
+    # Reversed, so in case of an overlap, the first label wins (like in the labels scan)
+    for label_ind in range(len(labels) - 1, -1, -1):
+        lookup[labels[label_ind].vertices] = label_ind
+    ANNOT_LOOKUPS_CACHE[annot_fname] = (mtime, (labels, lookup))
+    return labels, lookup
+
+
+def find_vertex_label(annot_fname, vertex_ind):
+    labels, lookup = read_vertices_labels_lookup_from_annot(annot_fname)
+    if vertex_ind < 0 or vertex_ind >= len(lookup) or lookup[vertex_ind] == -1:
+        return None
+    return labels[lookup[vertex_ind]]
+
+
 def _read_annot(fname):
     """Read a Freesurfer annotation from a .annot file.
 
@@ -2899,6 +3198,19 @@ def calc_colors_from_indices_cm(colors_indices, cm):
     return verts_colors
 
 
+def set_verts_loops_colors(layer_colors, lookup, valid_verts, verts_colors):
+    # layer_colors is the vertex colors layer (loops x channels, from foreach_get), and lookup is the faces_verts
+    # lookup (vertex -> its loops indices, padded with -1). Every loop of valid_verts[k] gets verts_colors[k]
+    loops_num = layer_colors.shape[0]
+    verts_loops = lookup[valid_verts]
+    loops_mask = (verts_loops > -1) & (verts_loops < loops_num)
+    verts_colors = np.asarray(verts_colors, dtype=layer_colors.dtype).reshape((len(valid_verts), -1))[:, :3]
+    # The mask is traversed row by row, like the lookup rows
+    loops_colors = np.broadcast_to(verts_colors[:, np.newaxis, :], verts_loops.shape + (3,))[loops_mask]
+    layer_colors[verts_loops[loops_mask], :3] = loops_colors
+    return layer_colors
+
+
 def get_cm_obj(cm_name, new_cm_name='', invert_cm1=False, invert_cm2=False,  cm1_minmax=(0, 1), cm2_minmax=(0, 1)):
     add_mmvt_code_root_to_path()
     from src.utils import color_maps_utils
@@ -3086,18 +3398,8 @@ def matlab_cell_str_to_list(cell_arr):
     return ret_list
 
 
-def write_ply_file(verts, faces, ply_file_name):
-    ply_header = 'ply\nformat ascii 1.0\nelement vertex {}\nproperty float x\nproperty float y\n' + \
-                 'property float z\nelement face {}\nproperty list uchar int vertex_index\nend_header\n'
-    verts_num = verts.shape[0]
-    faces_num = faces.shape[0]
-    faces = faces.astype(np.int)
-    faces_for_ply = np.hstack((np.ones((faces_num, 1)) * faces.shape[1], faces))
-    with open(ply_file_name, 'w') as f:
-        f.write(ply_header.format(verts_num, faces_num))
-    with open(ply_file_name, 'ab') as f:
-        np.savetxt(f, verts, fmt='%.5f', delimiter=' ')
-        np.savetxt(f, faces_for_ply, fmt='%d', delimiter=' ')
+def write_ply_file(verts, faces, ply_file_name, binary=True):
+    ply_utils.write_ply_file(verts, faces.astype(int), ply_file_name, binary)
 
 
 def select_time_range(t_start=None, t_end=None):
@@ -1,5 +1,8 @@
 import bpy
 import mmvt_utils as mu
+import play_utils
+import render_farm_utils as rfu
+import topology_utils as tu
 import os.path as op
 import numpy as np
 import traceback
@@ -49,6 +52,13 @@ bpy.types.Scene.add_reverse_frames = bpy.props.BoolProperty(
     default=False, description='Add reverse frames to the end of the movie')
 bpy.types.Scene.play_miscs = bpy.props.EnumProperty(
     items=[('inflating', 'inflating', '', 1), ('slicing', 'slicing', '', 2)])
+bpy.types.Scene.play_prefetch = bpy.props.BoolProperty(default=True,
+    description='Loads and colors the next frames in the background while playing\n'
+                '(MEG and fMRI activity maps, and MEG labels)')
+bpy.types.Scene.render_farm_workers = bpy.props.IntProperty(default=4, min=1,
+    description='The number of background Blender workers that render the movie')
+bpy.types.Scene.play_prefetch_window = bpy.props.IntProperty(default=10, min=1, max=100,
+    description='How many frames ahead to prefetch')
 
 
 def _addon():
@@ -92,6 +102,7 @@ class ModalTimerOperator(bpy.types.Operator):
             print('Stop!')
             self.limits = bpy.context.scene.play_from
             PlayPanel.is_playing = False
+            PlayPanel.prefetcher.clear()
             bpy.context.scene.update()
             self.cancel(context)
             return {'PASS_THROUGH'}
@@ -112,10 +123,12 @@ class ModalTimerOperator(bpy.types.Operator):
                 # print(self.limits, time.time() - self._time)
                 self._time = time.time()
                 try:
-                    plot_something(self, context, self.limits, ModalTimerOperator._uuid)
+                    plot_something(self, context, self.limits, ModalTimerOperator._uuid, use_prefetcher=True)
                 except:
                     print(traceback.format_exc())
                     print('Error in plotting at {}!'.format(self.limits))
+                else:
+                    PlayPanel.play_stats.add_frame(time.time() - self._time)
                 self.limits = self.limits - bpy.context.scene.play_dt if PlayPanel.play_reverse else \
                         self.limits + bpy.context.scene.play_dt
                 bpy.context.scene.frame_current = self.limits
@@ -152,7 +165,10 @@ def rotate_while_playing():
         _addon().rotate_brain()
 
 
-def render_movie(play_type, play_from, play_to, camera_fname='', play_dt=1, set_to_camera_mode=True, rotate_brain=False):
+def render_movie(play_type, play_from, play_to, camera_fname='', play_dt=1, set_to_camera_mode=True, rotate_brain=False,
+                 farm_worker=-1):
+    # If farm_worker >= 0, this is one of the render farm's workers (scripts/render_movie_farm.py), which renders
+    # only the frames it takes from the frames tracker
     set_play_to(play_to)
     bpy.context.scene.play_type = play_type
     bpy.context.scene.render_movie = True
@@ -160,26 +176,68 @@ def render_movie(play_type, play_from, play_to, camera_fname='', play_dt=1, set_
     print('In play movie!')
     play_range = list(range(play_from, play_to + 1, play_dt))
     runs_num = len(play_range)
-    for run, limits in enumerate(play_range):
+    frames_tracker = rfu.FramesTracker(bpy.path.abspath(bpy.context.scene.output_path)) if farm_worker >= 0 else None
+    for run, limits in enumerate(get_frames_to_render(play_range, frames_tracker, farm_worker)):
         print('limits: {}'.format(limits))
         mu.write_to_stderr('Plotting {} frame {} ({}-{}, dt {})'.format(play_type, limits, play_from, play_to, play_dt))
         bpy.context.scene.frame_current = limits
         rotate_while_playing()
         try:
             now = time.time()
-            plot_something(None, bpy.context, limits, camera_fname=camera_fname, set_to_camera_mode=set_to_camera_mode)
+            PlayPanel.rendered_image_fname = ''
+            successful_ret = plot_something(
+                None, bpy.context, limits, camera_fname=camera_fname, set_to_camera_mode=set_to_camera_mode)
         except:
             print(traceback.format_exc())
             print('Error in plotting at {}!'.format(limits))
             mu.write_to_stderr(traceback.format_exc())
         else:
+            if not successful_ret:
+                continue
             time_took = time.time() - now
             more_time = time_took / (run + 1) * (runs_num - (run +  1))
             mu.write_to_stderr(('{}/{}, {:.2f}s, {:.2f}s to go!'.format(run, runs_num, time_took, more_time)))
+            if frames_tracker is None:
+                continue
+            # The frame is done only if its image was written, so a new run will render the missing frames
+            image_fname = PlayPanel.rendered_image_fname
+            if image_fname != '' and op.isfile(image_fname):
+                frames_tracker.mark_done(limits, farm_worker, time_took, image_fname)
+            else:
+                print('No image was rendered for frame {}!'.format(limits))
+
+
+def get_frames_to_render(play_range, frames_tracker=None, farm_worker=-1):
+    if frames_tracker is None:
+        for frame in play_range:
+            yield frame
+        return
+    while True:
+        frame = frames_tracker.claim_next(play_range, farm_worker)
+        if frame is None:
+            return
+        yield frame
+
+
+def render_movie_in_farm(play_type=None, play_from=None, play_to=None, play_dt=None, workers_num=None):
+    # Renders the movie in background Blender workers (scripts/render_movie_farm.py), which share the saved
+    # blend file. The frames that were already rendered into the output folder are skipped
+    play_type = bpy.context.scene.play_type if play_type is None else play_type
+    play_from = bpy.context.scene.play_from if play_from is None else play_from
+    play_to = bpy.context.scene.play_to if play_to is None else play_to
+    play_dt = bpy.context.scene.play_dt if play_dt is None else play_dt
+    workers_num = bpy.context.scene.render_farm_workers if workers_num is None else workers_num
+    output_path = bpy.path.abspath(bpy.context.scene.output_path)
+    mu.save_blender_file()
+    flags = '-s {} -a {} -p {} --play_from {} --play_to {} --play_dt {} --workers_num {} '.format(
+        mu.get_user(), bpy.context.scene.atlas, play_type, play_from, play_to, play_dt, workers_num) + \
+        '--output_path "{}" --rel_output_path 0 -q {} --frame_rate {}'.format(
+        output_path, bpy.context.scene.render.resolution_percentage, bpy.context.scene.frames_num)
+    mu.run_mmvt_func('src.mmvt_addon.scripts.render_movie_farm', flags=flags)
 
 
 def plot_something(self=None, context=None, cur_frame=0, uuid='', camera_fname='', set_to_camera_mode=True,
-                   play_type=None):
+                   play_type=None, use_prefetcher=False):
     if context is None:
         context = bpy.context
     if bpy.context.scene.frame_current > bpy.context.scene.play_to:
@@ -201,17 +259,19 @@ def plot_something(self=None, context=None, cur_frame=0, uuid='', camera_fname='
     # if False: #PlayPanel.init_play:
 
     successful_ret = True
+    prefetched = use_prefetcher and plot_prefetched_frame(play_type, cur_frame)
     if play_type in ['meg', 'meg_elecs', 'meg_elecs_coh', 'meg_helmet_source', 'eeg_helmet_source']:
         # if PlayPanel.loop_indices:
         #     _addon().default_coloring(PlayPanel.loop_indices)
         # PlayPanel.loop_indices =
-        _addon().coloring.plot_meg()
+        if not prefetched:
+            _addon().coloring.plot_meg()
         _addon().colorbar.lock_colorbar_values(False)
         # successful_ret = _addon().plot_activity('MEG', PlayPanel.faces_verts, bpy.context.scene.meg_threshold,
         #     PlayPanel.meg_sub_activity, plot_subcorticals)
     if play_type in ['fmri']:
         successful_ret = _addon().activity_map_coloring('FMRI')
-    if play_type in ['fmri_dynamics']:
+    if play_type in ['fmri_dynamics'] and not prefetched:
         successful_ret = _addon().plot_activity(
             'FMRI_DYNAMICS', PlayPanel.faces_verts, bpy.context.scene.meg_threshold, None, False)
     if play_type in ['elecs', 'meg_elecs', 'elecs_act_coh', 'meg_elecs_coh', 'elecs_connectivity']:
@@ -219,11 +279,14 @@ def plot_something(self=None, context=None, cur_frame=0, uuid='', camera_fname='
         plot_electrodes(cur_frame, bpy.context.scene.electrodes_threshold)
     if play_type in ['elecs_connectivity']:
         _addon().coloring.color_connections()
-    if play_type == 'meg_labels':
+    if play_type == 'meg_labels' and not prefetched:
         # todo: get the aparc_name
         labels_data_fname = _addon().meg.get_label_data_fname()
-        labels_data_dict = {hemi:np.load(labels_data_fname.format(hemi=hemi)) for hemi in mu.HEMIS}
-        _addon().meg_labels_coloring(override_current_mat=True, labels_data_dict=labels_data_dict)
+        if mu.both_hemi_files_exist(labels_data_fname):
+            labels_data_dict = {hemi: load_labels_data(labels_data_fname.format(hemi=hemi)) for hemi in mu.HEMIS}
+            _addon().meg_labels_coloring(override_current_mat=True, labels_data_dict=labels_data_dict)
+        else:
+            _addon().meg_labels_coloring(override_current_mat=True)
     if play_type == 'labels_connectivity':
         _addon().color_connections()
     if play_type in ['elecs_coh', 'elecs_act_coh', 'meg_elecs_coh']:
@@ -255,9 +318,161 @@ def plot_something(self=None, context=None, cur_frame=0, uuid='', camera_fname='
         if bpy.context.scene.save_images:
             _addon().save_image(play_type, bpy.context.scene.save_selected_view, bpy.context.scene.frame_current)
         if bpy.context.scene.render_movie:
-            _addon().render_image(set_to_camera_mode=set_to_camera_mode)
+            PlayPanel.rendered_image_fname = _addon().render_image(set_to_camera_mode=set_to_camera_mode)
     else:
         print("The image wasn't rendered due to an error in the plotting.")
+    return successful_ret
+
+
+def plot_prefetched_frame(play_type, cur_frame):
+    # Colors the cortex with the prefetched frame. Returns False if the frame should be plotted the regular way,
+    # like when the prefetcher was just (re)configured, or the play type can't be prefetched
+    prefetcher = PlayPanel.prefetcher
+    if not bpy.context.scene.play_prefetch:
+        prefetcher.clear()
+        return False
+    key, create_load_frame = get_prefetch_frame_loader(play_type)
+    if key is None:
+        prefetcher.clear()
+        return False
+    step = -bpy.context.scene.play_dt if PlayPanel.play_reverse else bpy.context.scene.play_dt
+    new_key = key != prefetcher.key
+    if new_key:
+        prefetcher.configure(key, create_load_frame())
+    prefetcher.seek(cur_frame + step if new_key else cur_frame, step, bpy.context.scene.play_from,
+                    bpy.context.scene.play_to, bpy.context.scene.play_prefetch_window)
+    if new_key:
+        return False
+    frame = prefetcher.get(cur_frame)
+    if frame is None:
+        return False
+    for hemi, hemi_frame in frame.items():
+        _addon().coloring.color_hemi_precomputed(
+            hemi, hemi_frame['values'], hemi_frame['valid_verts'], hemi_frame['colors'])
+    return True
+
+
+def get_prefetch_frame_loader(play_type):
+    # Returns the key of the current data files and coloring parameters, and a function that creates the frames
+    # loader, which runs on the prefetcher thread, so it can't use bpy. (None, None) if play_type isn't supported
+    coloring_panel = _addon().coloring.ColoringMakerPanel
+    hemis = [hemi for hemi in HEMIS if not mu.get_hemi_obj(hemi).hide]
+    cm = _addon().get_cm()
+    if cm is None or len(hemis) == 0 or not all([hemi in (coloring_panel.faces_verts or {}) for hemi in hemis]):
+        return None, None
+    threshold = bpy.context.scene.coloring_lower_threshold
+    use_abs = bpy.context.scene.coloring_use_abs
+    colorbar_max_min = _addon().get_colorbar_max_min() if _addon().colorbar_values_are_locked() else None
+    if play_type in ['meg', 'meg_elecs', 'meg_elecs_coh', 'fmri_dynamics']:
+        if play_type == 'fmri_dynamics':
+            fols = {hemi: op.join(mu.get_user_fol(), 'fmri', 'activity_map_{}'.format(hemi)) for hemi in hemis}
+            data_minmax = coloring_panel.fmri_activity_data_minmax
+            colors_ratio = coloring_panel.fmri_activity_colors_ratio
+        else:
+            if coloring_panel.stc_file_chosen or not coloring_panel.activity_map_chosen or \
+                    bpy.context.scene.coloring_meg_subcorticals:
+                return None, None
+            activity_type = bpy.context.scene.meg_files
+            activity_type = '' if activity_type == 'conditions diff' else '{}_'.format(activity_type)
+            fols = {hemi: op.join(mu.get_user_fol(), 'activity_map_{}{}'.format(activity_type, hemi))
+                    for hemi in hemis}
+            data_minmax = coloring_panel.meg_activity_data_minmax
+            colors_ratio = coloring_panel.meg_activity_colors_ratio
+        if data_minmax is None or not all([mu.activity_map_exists(fol) for fol in fols.values()]):
+            return None, None
+        data_min, data_max = data_minmax
+        if colorbar_max_min is not None:
+            data_max, data_min = colorbar_max_min
+            colors_ratio = 256 / (data_max - data_min)
+        if threshold > data_max:
+            threshold = data_min
+        remove_unknown = bpy.context.scene.remove_unknown_from_plotting
+        key = (play_type, tuple(fols.items()), files_mtimes([mu.activity_map_store_fname(f) for f in fols.values()]),
+               data_min, colors_ratio, threshold, use_abs, remove_unknown, id(cm))
+
+        def create_load_frame():
+            unknown_vertices = get_unknown_vertices(hemis) if remove_unknown else {}
+
+            def load_frame(t):
+                frame = {}
+                for hemi, fol in fols.items():
+                    values = mu.load_activity_map_t(fol, t)
+                    if values is None:
+                        return None
+                    frame[hemi] = play_utils.calc_frame_colors(
+                        values, data_min, colors_ratio, cm, threshold, use_abs,
+                        unknown_vertices=unknown_vertices.get(hemi))
+                return frame
+            return load_frame
+        return key, create_load_frame
+
+    if play_type == 'meg_labels':
+        atlas = bpy.context.scene.atlas
+        labels_data_fname = _addon().meg.get_label_data_fname()
+        if bpy.context.scene.color_rois_homogeneously or atlas not in coloring_panel.labels_vertices or \
+                not mu.both_hemi_files_exist(labels_data_fname):
+            return None, None
+        labels_coloring_type = bpy.context.scene.meg_labels_coloring_type
+        minmax_fname = _addon().meg.get_label_data_minmax_fname()
+        key = (play_type, atlas, labels_data_fname, labels_coloring_type, colorbar_max_min, threshold, use_abs,
+               tuple(hemis), files_mtimes([labels_data_fname.format(hemi=hemi) for hemi in hemis] + [minmax_fname]),
+               id(cm))
+
+        def create_load_frame():
+            colors_min, colors_max = _addon().coloring.get_meg_labels_minmax(labels_data_fname)
+            colors_ratio = _addon().coloring.set_colorbar(colors_min, colors_max)
+            labels_names = coloring_panel.labels_vertices[atlas]['labels_names']
+            labels_vertices = coloring_panel.labels_vertices[atlas]['labels_vertices']
+            labels_data_matrices, vertices_rows = {}, {}
+            for hemi in hemis:
+                labels_data = load_labels_data(labels_data_fname.format(hemi=hemi))
+                labels_data_matrices[hemi] = play_utils.calc_labels_data_matrix(
+                    labels_data['data'], labels_coloring_type, labels_data.get('conditions'))
+                if labels_data_matrices[hemi] is None:
+                    return None
+                vertices_rows[hemi] = play_utils.calc_vertices_labels_rows(
+                    [mu.to_str(label_name) for label_name in labels_data['names']], labels_names[hemi],
+                    labels_vertices[hemi])
+
+            def load_frame(t):
+                frame = {}
+                for hemi in hemis:
+                    values = play_utils.labels_data_t_to_vertices(labels_data_matrices[hemi], vertices_rows[hemi], t)
+                    frame[hemi] = play_utils.calc_frame_colors(
+                        values, colors_min, colors_ratio, cm, threshold, use_abs)
+                return frame
+            return load_frame
+        return key, create_load_frame
+
+    return None, None
+
+
+def get_unknown_vertices(hemis):
+    atlases = tu.get_atlases_with_vertices_labels_lookup(mu.get_user_fol())
+    if len(atlases) == 0:
+        return {}
+    unknown_vertices = {}
+    for hemi in hemis:
+        vertices_labels_lookup = tu.load_atlas_vertices_labels_lookup(mu.get_user_fol(), atlases[0], hemi)
+        if vertices_labels_lookup is not None:
+            unknown_vertices[hemi] = vertices_labels_lookup.unknown_vertices_mask()
+    return unknown_vertices
+
+
+def files_mtimes(fnames):
+    return tuple([op.getmtime(fname) if op.isfile(fname) else 0 for fname in fnames])
+
+
+LABELS_DATA_CACHE = {}
+
+
+def load_labels_data(labels_data_fname):
+    # The npz is read once (and not on every frame), as long as it wasn't changed
+    mtime = op.getmtime(labels_data_fname)
+    if labels_data_fname not in LABELS_DATA_CACHE or LABELS_DATA_CACHE[labels_data_fname][0] != mtime:
+        with np.load(labels_data_fname) as d:
+            LABELS_DATA_CACHE[labels_data_fname] = (mtime, {k: d[k] for k in d.keys()})
+    return LABELS_DATA_CACHE[labels_data_fname][1]
 
 
 def capture_graph(play_type=None, output_path=None, selection_type=None):
@@ -585,6 +800,9 @@ class PlayPanel(bpy.types.Panel):
     play_reverse = False
     first_time = True
     init_play = True
+    prefetcher = play_utils.FramesPrefetcher()
+    play_stats = play_utils.PlayStats()
+    rendered_image_fname = ''
     # imp_times = [[148, 221], [247, 273], [410, 555], [903, 927]]
 
     def draw(self, context):
@@ -616,7 +834,22 @@ def play_panel_draw(context, layout):
     row.operator(Pause.bl_idname, text="", icon='PAUSE')
     row.operator(Play.bl_idname, text="", icon='PLAY')
     row.operator(NextKeyFrame.bl_idname, text="", icon='NEXT_KEYFRAME')
+    row = layout.row(align=True)
+    row.prop(context.scene, 'play_prefetch', text='Prefetch')
+    if bpy.context.scene.play_prefetch:
+        row.prop(context.scene, 'play_prefetch_window', text='frames')
+    if PlayPanel.play_stats.frames_num() > 1:
+        mean_latency, max_latency = PlayPanel.play_stats.latency()
+        layout.label(text='{:.1f} fps, latency {:.0f}ms (max {:.0f}ms)'.format(
+            PlayPanel.play_stats.fps(), mean_latency, max_latency))
+        prefetched_num = PlayPanel.prefetcher.hits + PlayPanel.prefetcher.misses
+        if prefetched_num > 0:
+            layout.label(text='Prefetched frames: {}/{}'.format(PlayPanel.prefetcher.hits, prefetched_num))
     layout.prop(context.scene, 'render_movie', text="Render to a movie")
+    if bpy.context.scene.render_movie:
+        row = layout.row(align=True)
+        row.prop(context.scene, 'render_farm_workers', text='Workers')
+        row.operator(RenderMovieFarm.bl_idname, text='Render in background', icon='RENDER_ANIMATION')
     layout.prop(context.scene, 'save_images', text="Save images")
     layout.prop(context.scene, 'rotate_brain_while_playing', text='Rotate the brain while playing')
     if bpy.context.scene.rotate_brain_while_playing:
@@ -648,6 +881,11 @@ def play_panel_draw(context, layout):
             layout.label(text='Rendering the movie...')
 
 
+def reset_play_stats():
+    PlayPanel.play_stats.reset()
+    PlayPanel.prefetcher.reset_stats()
+
+
 class Play(bpy.types.Operator):
     bl_idname = "mmvt.play"
     bl_label = "play"
@@ -658,6 +896,7 @@ class Play(bpy.types.Operator):
         PlayPanel.is_playing = True
         PlayPanel.play_reverse = False
         PlayPanel.init_play = True
+        reset_play_stats()
         if PlayPanel.first_time:
             print('Starting the play timer!')
             # todo: why this line is marked??
@@ -676,6 +915,7 @@ class Reverse(bpy.types.Operator):
     def invoke(self, context, event=None):
         PlayPanel.is_playing = True
         PlayPanel.play_reverse = True
+        reset_play_stats()
         if PlayPanel.first_time:
             PlayPanel.first_time = False
             PlayPanel.timer_op = bpy.ops.wm.modal_timer_operator()
@@ -690,6 +930,7 @@ class Pause(bpy.types.Operator):
 
     def invoke(self, context, event=None):
         PlayPanel.is_playing = False
+        PlayPanel.prefetcher.clear()
         plot_something(self, context, bpy.context.scene.frame_current, ModalTimerOperator._uuid)
         print('Stop!')
         return {"FINISHED"}
@@ -721,6 +962,17 @@ class NextKeyFrame(bpy.types.Operator):
         return {"FINISHED"}
 
 
+class RenderMovieFarm(bpy.types.Operator):
+    bl_idname = "mmvt.render_movie_farm"
+    bl_label = "mmvt render_movie_farm"
+    bl_description = 'Renders the movie frames (from-to, dt) in parallel background Blender workers'
+    bl_options = {"UNDO"}
+
+    def invoke(self, context, event=None):
+        render_movie_in_farm()
+        return {"FINISHED"}
+
+
 class GrabFromPlay(bpy.types.Operator):
     bl_idname = "mmvt.grab_from_play"
     bl_label = "grab from"
@@ -829,6 +1081,7 @@ def register():
         bpy.utils.register_class(ExportGraph)
         bpy.utils.register_class(CreateMovie)
         bpy.utils.register_class(InflatingMovie)
+        bpy.utils.register_class(RenderMovieFarm)
         # print('PlayPanel was registered!')
     except:
         print("Can't register PlayPanel!")
@@ -836,6 +1089,7 @@ def register():
 
 
 def unregister():
+    PlayPanel.prefetcher.stop()
     try:
         bpy.utils.unregister_class(PlayPanel)
         bpy.utils.unregister_class(GrabFromPlay)
@@ -849,6 +1103,7 @@ def unregister():
         bpy.utils.unregister_class(ExportGraph)
         bpy.utils.unregister_class(CreateMovie)
         bpy.utils.unregister_class(InflatingMovie)
+        bpy.utils.unregister_class(RenderMovieFarm)
     except:
         pass
         # print("Can't unregister PlayPanel!")
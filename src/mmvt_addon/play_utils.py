@@ -0,0 +1,211 @@
+import time
+import threading
+import traceback
+import numpy as np
+from collections import deque
+
+# The play prefetcher: a background thread that keeps a bounded window of the upcoming frames (t, t + step, ...,
+# where step is negative when playing in reverse) loaded and converted into vertices colors, so the play timer only
+# has to push the colors into the meshes. A frame is whatever load_frame(t) returns, and it's dropped once it was
+# played or once it's out of the window. When the data or the coloring parameters change, the caller sets a new key,
+# and all the prefetched frames are dropped.
+
+
+class FramesPrefetcher(object):
+
+    def __init__(self, window_size=10):
+        self.window_size = window_size
+        self.key, self.load_frame = None, None
+        self.t, self.step, self.play_from, self.play_to = 0, 1, 0, -1
+        self.frames = {}
+        self.loading_t = None
+        self.hits, self.misses = 0, 0
+        self.cond = threading.Condition()
+        self.thread, self.running = None, False
+
+    def configure(self, key, load_frame):
+        with self.cond:
+            if key == self.key:
+                return
+            self.key, self.load_frame = key, load_frame
+            self.frames = {}
+            self.cond.notify_all()
+        self.start()
+
+    def seek(self, t, step, play_from, play_to, window_size=None):
+        with self.cond:
+            self.t, self.step, self.play_from, self.play_to = t, step if step != 0 else 1, play_from, play_to
+            if window_size is not None:
+                self.window_size = window_size
+            window = set(self.window())
+            for frame_t in [frame_t for frame_t in self.frames if frame_t not in window]:
+                del self.frames[frame_t]
+            self.cond.notify_all()
+
+    def window(self):
+        times = range(self.t, self.t + self.step * self.window_size, self.step)
+        return [t for t in times if self.play_from <= t <= self.play_to]
+
+    def get(self, t):
+        # Returns the frame of time t. If it wasn't prefetched, it's loaded here (a miss). A failed load returns None
+        with self.cond:
+            if self.load_frame is None:
+                return None
+            while self.loading_t == t and t not in self.frames:
+                self.cond.wait(1)
+            # The window moves on to the next frame, so the played one won't be prefetched again
+            if t == self.t:
+                self.t += self.step
+                self.cond.notify_all()
+            if t in self.frames:
+                frame = self.frames.pop(t)
+                # A failed prefetch (None) isn't loaded again here, but it's still a miss
+                if frame is None:
+                    self.misses += 1
+                else:
+                    self.hits += 1
+                return frame
+            load_frame = self.load_frame
+        self.misses += 1
+        return self._load(load_frame, t)
+
+    def clear(self):
+        with self.cond:
+            self.key, self.load_frame = None, None
+            self.frames = {}
+
+    def reset_stats(self):
+        self.hits, self.misses = 0, 0
+
+    def start(self):
+        if self.thread is not None and self.thread.is_alive():
+            return
+        self.running = True
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        with self.cond:
+            self.running = False
+            self.cond.notify_all()
+        if self.thread is not None:
+            self.thread.join(1)
+            self.thread = None
+        self.clear()
+
+    def _next_missing_frame(self):
+        if self.load_frame is None:
+            return None
+        return next((t for t in self.window() if t not in self.frames), None)
+
+    def _run(self):
+        while True:
+            with self.cond:
+                t = self._next_missing_frame()
+                while t is None and self.running:
+                    self.cond.wait()
+                    t = self._next_missing_frame()
+                if not self.running:
+                    return
+                key, load_frame = self.key, self.load_frame
+                self.loading_t = t
+            frame = self._load(load_frame, t)
+            with self.cond:
+                self.loading_t = None
+                # A failed frame (None) is also kept, so it won't be reloaded over and over
+                if key == self.key and t in self.window():
+                    self.frames[t] = frame
+                self.cond.notify_all()
+
+    @staticmethod
+    def _load(load_frame, t):
+        try:
+            return load_frame(t)
+        except:
+            print('FramesPrefetcher: Error in loading frame {}!'.format(t))
+            print(traceback.format_exc())
+            return None
+
+
+class PlayStats(object):
+    # The played frames rate and the time it took the timer to plot each frame, over the last frames_num frames
+
+    def __init__(self, frames_num=50):
+        self.frames_times = deque(maxlen=frames_num)
+        self.latencies = deque(maxlen=frames_num)
+
+    def reset(self):
+        self.frames_times.clear()
+        self.latencies.clear()
+
+    def add_frame(self, latency):
+        self.frames_times.append(time.time())
+        self.latencies.append(latency)
+
+    def frames_num(self):
+        return len(self.frames_times)
+
+    def fps(self):
+        if len(self.frames_times) < 2 or self.frames_times[-1] == self.frames_times[0]:
+            return 0
+        return (len(self.frames_times) - 1) / (self.frames_times[-1] - self.frames_times[0])
+
+    def latency(self):
+        # The mean and max latency in ms
+        if len(self.latencies) == 0:
+            return 0, 0
+        return np.mean(self.latencies) * 1000, np.max(self.latencies) * 1000
+
+
+def calc_frame_colors(values, data_min, colors_ratio, cm, threshold=0, use_abs=False, bigger_or_equal=False,
+                      unknown_vertices=None):
+    # Returns the vertices above the threshold, and their colors (like activity_map_obj_coloring). If the values
+    # are vertices x 4, the first column is the data, and the rest are the colors
+    data = values[:, 0] if values.ndim > 1 else values
+    abs_data = np.abs(data) if use_abs else data
+    valid_verts = np.where(abs_data >= threshold if bigger_or_equal else abs_data > threshold)[0]
+    if unknown_vertices is not None:
+        valid_verts = valid_verts[~unknown_vertices[valid_verts]]
+    if values.ndim > 1:
+        verts_colors = values[valid_verts, 1:4]
+    else:
+        colors_indices = np.rint((data[valid_verts] - data_min) * colors_ratio).astype(int)
+        verts_colors = cm[np.clip(colors_indices, 0, 255)]
+    return dict(values=data, valid_verts=valid_verts, colors=np.asarray(verts_colors, dtype=np.float32))
+
+
+def calc_labels_data_matrix(labels_data, coloring_type='diff', conditions=None):
+    # labels x T (x conditions) -> labels x T, the conditions diff, or the coloring_type condition.
+    # Returns None for data which isn't a time series
+    data = np.asarray(labels_data)
+    if data.ndim == 3:
+        if coloring_type == 'diff':
+            if data.shape[2] != 2:
+                return None
+            data = data[:, :, 1] - data[:, :, 0]
+        else:
+            cond_ind = np.where(np.asarray(conditions) == coloring_type)[0]
+            if len(cond_ind) == 0:
+                return None
+            data = data[:, :, cond_ind[0]]
+    return data if data.ndim == 2 else None
+
+
+def calc_vertices_labels_rows(data_labels_names, labels_names, labels_vertices):
+    # vertex -> the row of its label in the labels data (-1 for vertices without data)
+    vertices_num = max([max(label_vertices) for label_vertices in labels_vertices if len(label_vertices) > 0]) + 1
+    vertices_rows = np.full(vertices_num, -1, dtype=np.int32)
+    labels_inds = {label_name: ind for ind, label_name in enumerate(labels_names)}
+    for row, label_name in enumerate(data_labels_names):
+        label_ind = labels_inds.get(label_name)
+        if label_ind is not None and len(labels_vertices[label_ind]) > 0:
+            vertices_rows[np.asarray(labels_vertices[label_ind], dtype=int)] = row
+    return vertices_rows
+
+
+def labels_data_t_to_vertices(labels_data_matrix, vertices_rows, t):
+    values = np.zeros(len(vertices_rows))
+    if 0 <= t < labels_data_matrix.shape[1]:
+        has_data = vertices_rows > -1
+        values[has_data] = labels_data_matrix[vertices_rows[has_data], t]
+    return values
@@ -0,0 +1,151 @@
+import os
+import os.path as op
+import numpy as np
+
+# PLY reading / writing, and the binary mesh cache: a {name}.npz sidecar next to each {name}.ply, with the verts,
+# faces, and the ply's mtime and size it was created from. The sidecar is used instead of parsing the ply as long
+# as the ply wasn't changed.
+
+PLY_TYPES = {'char': 'i1', 'int8': 'i1', 'uchar': 'u1', 'uint8': 'u1', 'short': 'i2', 'int16': 'i2',
+             'ushort': 'u2', 'uint16': 'u2', 'int': 'i4', 'int32': 'i4', 'uint': 'u4', 'uint32': 'u4',
+             'float': 'f4', 'float32': 'f4', 'double': 'f8', 'float64': 'f8'}
+BINARY_PLY_HEADER = 'ply\nformat binary_little_endian 1.0\nelement vertex {}\nproperty float x\nproperty float y\n' + \
+                    'property float z\nelement face {}\nproperty list uchar int vertex_index\nend_header\n'
+
+
+def read_ply_header(f):
+    # Returns the format, and the elements as a list of (name, num, properties), where a property is
+    # (name, type) or (name, (count_type, item_type)) for lists
+    line = f.readline().strip()
+    if line != b'ply':
+        raise Exception('Not a ply file!')
+    ply_format, elements = 'ascii', []
+    while True:
+        line = f.readline()
+        if line == b'':
+            raise Exception('No end_header in the ply file!')
+        words = line.decode('ascii').strip().split()
+        if len(words) == 0 or words[0] in ('comment', 'obj_info'):
+            continue
+        if words[0] == 'end_header':
+            break
+        elif words[0] == 'format':
+            ply_format = words[1]
+        elif words[0] == 'element':
+            elements.append((words[1], int(words[2]), []))
+        elif words[0] == 'property':
+            if words[1] == 'list':
+                elements[-1][2].append((words[4], (PLY_TYPES[words[2]], PLY_TYPES[words[3]])))
+            else:
+                elements[-1][2].append((words[2], PLY_TYPES[words[1]]))
+    return ply_format, elements
+
+
+def read_ply_file(ply_file):
+    # Reads the vertices (x, y, z) and the faces, in ascii or binary ply. The faces are assumed to have the same
+    # number of vertices (triangles in mmvt)
+    with open(ply_file, 'rb') as f:
+        ply_format, elements = read_ply_header(f)
+        elements = {name: (num, props) for name, num, props in elements}
+        verts_num, verts_props = elements['vertex']
+        faces_num, faces_props = elements.get('face', (0, [('vertex_index', ('u1', 'i4'))]))
+        if ply_format == 'ascii':
+            tokens = f.read().split()
+            verts_tokens_num = verts_num * len(verts_props)
+            verts = np.array(tokens[:verts_tokens_num], dtype=np.float64).reshape((verts_num, len(verts_props)))
+            faces = np.array(tokens[verts_tokens_num:], dtype=np.int64)
+            faces = faces.reshape((faces_num, -1))[:, 1:] if faces_num > 0 else faces.reshape((0, 3))
+        else:
+            endian = '<' if ply_format == 'binary_little_endian' else '>'
+            verts = np.fromfile(f, dtype=np.dtype([(name, endian + t) for name, t in verts_props]), count=verts_num)
+            verts = np.column_stack([verts[name] for name, _ in verts_props]).astype(np.float64)
+            if faces_num > 0:
+                count_type, item_type = faces_props[0][1]
+                face_size = int(np.fromfile(f, dtype=endian + count_type, count=1)[0])
+                f.seek(-np.dtype(count_type).itemsize, os.SEEK_CUR)
+                faces = np.fromfile(f, dtype=np.dtype(
+                    [('n', endian + count_type), ('v', endian + item_type, (face_size,))]), count=faces_num)
+                if np.any(faces['n'] != face_size):
+                    raise Exception('Only faces with the same number of vertices are supported!')
+                faces = faces['v'].astype(np.int64)
+            else:
+                faces = np.zeros((0, 3), dtype=np.int64)
+    verts_props_names = [name for name, _ in verts_props]
+    if verts_props_names[:3] != ['x', 'y', 'z']:
+        verts = verts[:, [verts_props_names.index(name) for name in ['x', 'y', 'z']]]
+    return verts[:, :3], faces
+
+
+def write_ply_file(verts, faces, ply_file_name, binary=True):
+    verts_num, faces_num = verts.shape[0], faces.shape[0]
+    if not binary:
+        with open(ply_file_name, 'w') as f:
+            f.write(BINARY_PLY_HEADER.replace('binary_little_endian', 'ascii').format(verts_num, faces_num))
+        with open(ply_file_name, 'ab') as f:
+            np.savetxt(f, verts, fmt='%.5f', delimiter=' ')
+            if faces_num > 0:
+                faces = faces.astype(int)
+                np.savetxt(f, np.hstack((np.ones((faces_num, 1), dtype=int) * faces.shape[1], faces)),
+                           fmt='%d', delimiter=' ')
+        return
+    face_size = faces.shape[1] if faces.ndim > 1 else 3
+    faces_for_ply = np.zeros(faces_num, dtype=np.dtype([('n', 'u1'), ('v', '<i4', (face_size,))]))
+    faces_for_ply['n'] = face_size
+    if faces_num > 0:
+        faces_for_ply['v'] = faces
+    with open(ply_file_name, 'wb') as f:
+        f.write(BINARY_PLY_HEADER.format(verts_num, faces_num).encode('ascii'))
+        f.write(np.ascontiguousarray(verts, dtype='<f4').tobytes())
+        f.write(faces_for_ply.tobytes())
+
+
+def get_cache_fname(ply_file):
+    return '{}.npz'.format(op.splitext(ply_file)[0])
+
+
+def ply_file_key(ply_file):
+    stat = os.stat(ply_file)
+    return stat.st_mtime, stat.st_size
+
+
+def write_cache(verts, faces, ply_file, cache_fname=''):
+    # Written to a temp file and then renamed, so parallel readers will never see a partial cache
+    cache_fname = get_cache_fname(ply_file) if cache_fname == '' else cache_fname
+    ply_mtime, ply_size = ply_file_key(ply_file)
+    tmp_fname = '{}.{}.tmp'.format(cache_fname, os.getpid())
+    try:
+        with open(tmp_fname, 'wb') as f:
+            np.savez(f, verts=verts, faces=faces, ply_mtime=ply_mtime, ply_size=ply_size)
+        os.replace(tmp_fname, cache_fname)
+    except OSError:
+        # Like in a read only folder, the ply will just be parsed next time
+        if op.isfile(tmp_fname):
+            os.remove(tmp_fname)
+
+
+def read_cache(ply_file, cache_fname=''):
+    # Returns None if there is no valid cache. A cache without the ply's key (written before the key was added)
+    # is valid if it's not older than the ply
+    cache_fname = get_cache_fname(ply_file) if cache_fname == '' else cache_fname
+    if not op.isfile(cache_fname):
+        return None
+    try:
+        ply_mtime, ply_size = ply_file_key(ply_file)
+        with np.load(cache_fname) as d:
+            if 'ply_mtime' in d and 'ply_size' in d:
+                if float(d['ply_mtime']) != ply_mtime or int(d['ply_size']) != ply_size:
+                    return None
+            elif os.stat(cache_fname).st_mtime < ply_mtime:
+                return None
+            return d['verts'], d['faces'].astype(np.int64)
+    except Exception:
+        return None
+
+
+def read_ply_file_cached(ply_file):
+    ret = read_cache(ply_file)
+    if ret is not None:
+        return ret
+    verts, faces = read_ply_file(ply_file)
+    write_cache(verts, faces, ply_file)
+    return verts, faces
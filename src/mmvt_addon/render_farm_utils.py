@@ -0,0 +1,90 @@
+import os
+import os.path as op
+import glob
+import time
+
+# The per frame bookkeeping of a movie that is rendered by several background Blender workers
+# (scripts/render_movie_farm.py), in the movie's output folder:
+# .render_farm/claims/{frame}: the worker that took the frame
+# .render_farm/done/{frame}: the worker, the render time, when it was done and the image file name, which is written
+# only after the frame was rendered.
+# The workers pull the frames by creating the frames claim files (which fails if the file already exists), so the
+# faster workers take more frames. A frame without a done file is rendered again in the next run.
+
+FARM_FOL = '.render_farm'
+
+
+def get_farm_fol(output_path):
+    return op.join(output_path, FARM_FOL)
+
+
+class FramesTracker(object):
+
+    def __init__(self, output_path):
+        self.claims_fol = op.join(get_farm_fol(output_path), 'claims')
+        self.done_fol = op.join(get_farm_fol(output_path), 'done')
+        os.makedirs(self.claims_fol, exist_ok=True)
+        os.makedirs(self.done_fol, exist_ok=True)
+
+    def claim_fname(self, frame):
+        return op.join(self.claims_fol, str(frame))
+
+    def done_fname(self, frame):
+        return op.join(self.done_fol, str(frame))
+
+    def claim(self, frame, worker):
+        try:
+            fd = os.open(self.claim_fname(frame), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, 'w') as f:
+            f.write(str(worker))
+        return True
+
+    def claim_next(self, frames, worker):
+        # Returns the next frame that wasn't rendered or taken by another worker, or None if there isn't any
+        for frame in frames:
+            if not self.is_done(frame) and self.claim(frame, worker):
+                return frame
+        return None
+
+    def mark_done(self, frame, worker, render_time, image_fname=''):
+        done_fname = self.done_fname(frame)
+        tmp_fname = '{}.{}.tmp'.format(done_fname, os.getpid())
+        with open(tmp_fname, 'w') as f:
+            f.write('{}\t{}\t{}\t{}'.format(worker, render_time, time.time(), image_fname))
+        os.replace(tmp_fname, done_fname)
+
+    def is_done(self, frame):
+        return op.isfile(self.done_fname(frame))
+
+    def pending_frames(self, frames):
+        return [frame for frame in frames if not self.is_done(frame)]
+
+    def done_frames(self):
+        # frame -> (worker, render time, done time, image file name)
+        done = {}
+        for fname in glob.glob(op.join(self.done_fol, '*')):
+            if not op.basename(fname).lstrip('-').isdigit():
+                continue
+            with open(fname, 'r') as f:
+                worker, render_time, done_time, image_fname = f.read().split('\t')
+            done[int(op.basename(fname))] = (int(worker), float(render_time), float(done_time), image_fname)
+        return done
+
+    def release_claims(self, worker=None):
+        # Removes the claims of the frames that weren't rendered, all of them, or only the worker's claims.
+        # Should be called only when the workers which took those frames aren't running anymore
+        for claim_fname in glob.glob(op.join(self.claims_fol, '*')):
+            frame = op.basename(claim_fname)
+            if self.is_done(frame):
+                continue
+            if worker is not None:
+                with open(claim_fname, 'r') as f:
+                    if f.read().strip() != str(worker):
+                        continue
+            os.remove(claim_fname)
+
+    def reset(self):
+        for fname in glob.glob(op.join(self.claims_fol, '*')) + glob.glob(op.join(self.done_fol, '*')):
+            os.remove(fname)
@@ -38,6 +38,9 @@ def add_args():
     parser.add_argument('--mark_electrodes', help='mark_electrodes', required=False, default='', type=su.str_arr_type)
     parser.add_argument('--mark_electrodes_value', help='mark_electrodes_value', required=False, default=0.1, type=float)
     parser.add_argument('--mark_other_electrodes', help='mark_other_electrodes', required=False, default=False, type=su.is_true)
+    parser.add_argument('--farm_worker', help='render farm worker index', required=False, default=-1, type=int)
+    parser.add_argument('--save_blend', help='save the blend file', required=False, default=True, type=su.is_true)
+    parser.add_argument('--capture_graph', help='capture the graph data', required=False, default=True, type=su.is_true)
     return parser
 
 
@@ -49,15 +52,20 @@ def read_args(argv=None):
     return args
 
 
+def get_output_path(args):
+    if not args.rel_output_path:
+        return args.output_path
+    mmvt_dir = op.join(su.get_links_dir(), 'mmvt')
+    output_path = args.play_type if args.output_path == '' else args.output_path
+    return op.join(mmvt_dir, args.subject, 'movies', output_path)
+
+
 def render_movie(subject_fname):
     args = read_args(su.get_python_argv())
     if args.debug:
         su.debug()
-    if args.rel_output_path:
-        mmvt_dir = op.join(su.get_links_dir(), 'mmvt')
-        if args.output_path == '':
-            args.output_path = args.play_type
-        args.output_path = op.join(mmvt_dir, args.subject, 'movies', args.output_path)
+    mmvt_dir = op.join(su.get_links_dir(), 'mmvt')
+    args.output_path = get_output_path(args)
     su.make_dir(args.output_path)
     mmvt = su.init_mmvt_addon()
     mmvt.show_hide_hemi(args.hide_lh, 'lh')
@@ -71,13 +79,16 @@ def render_movie(subject_fname):
     mmvt.filter_nodes(args.filter_nodes)
     mark_electrodes(mmvt, args)
     camera_fname = su.load_camera(mmvt, mmvt_dir, args)
-    if not op.isfile(op.join(args.output_path, 'data.pkl')):
+    if args.capture_graph and not op.isfile(op.join(args.output_path, 'data.pkl')):
         try:
             mmvt.capture_graph(args.play_type, args.output_path, args.selection_type)
         except:
             print("Graph couldn't be captured!")
-    su.save_blend_file(subject_fname)
-    mmvt.render_movie(args.play_type, args.play_from, args.play_to, camera_fname, args.play_dt, args.set_to_camera_mode)
+    # The render farm workers share the blend file, so they don't save it
+    if args.save_blend:
+        su.save_blend_file(subject_fname)
+    mmvt.render_movie(args.play_type, args.play_from, args.play_to, camera_fname, args.play_dt, args.set_to_camera_mode,
+                      farm_worker=args.farm_worker)
     su.exit_blender()
 
 
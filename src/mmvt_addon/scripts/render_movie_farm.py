@@ -0,0 +1,141 @@
+import sys
+import os
+import os.path as op
+import time
+import subprocess
+
+try:
+    from src.mmvt_addon.scripts import scripts_utils as su
+    from src.mmvt_addon.scripts import render_movie as rm
+    from src.mmvt_addon import render_farm_utils as rfu
+except:
+    # Add current folder and the addon folder the imports path
+    sys.path.append(os.path.split(__file__)[0])
+    sys.path.append(op.dirname(os.path.split(__file__)[0]))
+    import scripts_utils as su
+    import render_movie as rm
+    import render_farm_utils as rfu
+
+# Renders a movie (like render_movie.py) in workers_num background Blender processes, which share the subject's
+# blend file. The workers pull the frames one by one (render_farm_utils.FramesTracker), so a crashed worker loses
+# only the frame it was rendering. A crashed worker is restarted (up to max_restarts times), and a new run of the
+# same movie renders only the frames that weren't rendered yet. When all the frames are rendered, they are
+# combined into a movie (movies_utils.combine_images).
+# Example:
+# python -m src.mmvt_addon.scripts.render_movie_farm -s subject -p meg --play_from 0 --play_to 2000 --workers_num 6
+
+FARM_ARGS = ['workers_num', 'max_restarts', 'create_movie', 'movie_name', 'frame_rate', 'report_every', 'reset']
+
+
+def read_args(argv=None):
+    parser = rm.add_args()
+    parser.add_argument('--workers_num', help='number of Blender workers', required=False, default=4, type=int)
+    parser.add_argument('--max_restarts', help='max restarts per worker', required=False, default=2, type=int)
+    parser.add_argument('--create_movie', required=False, default=True, type=su.is_true)
+    parser.add_argument('--movie_name', required=False, default='')
+    parser.add_argument('--frame_rate', required=False, default=10, type=int)
+    parser.add_argument('--report_every', help='seconds between reports', required=False, default=30, type=float)
+    parser.add_argument('--reset', help='render all the frames again', required=False, default=False, type=su.is_true)
+    args = su.parse_args(parser, argv)
+    if args.camera == '':
+        args.camera = op.join(su.get_mmvt_dir(), args.subject, 'camera', 'camera.pkl')
+    return args
+
+
+def render_movie_farm(args):
+    output_path = rm.get_output_path(args)
+    su.make_dir(output_path)
+    frames_tracker = rfu.FramesTracker(output_path)
+    if args.reset:
+        frames_tracker.reset()
+    # No worker is running now, so the claims of the frames that weren't rendered are from a crashed run
+    frames_tracker.release_claims()
+    frames = list(range(args.play_from, args.play_to + 1, args.play_dt))
+    pending_frames = frames_tracker.pending_frames(frames)
+    print('{} frames, {} were already rendered into {}'.format(
+        len(frames), len(frames) - len(pending_frames), output_path))
+    if len(pending_frames) > 0:
+        run_workers(args, output_path, frames_tracker, frames)
+    pending_frames = frames_tracker.pending_frames(frames)
+    if len(pending_frames) > 0:
+        print('{} frames were not rendered! Run again to render only them'.format(len(pending_frames)))
+        return False
+    if args.create_movie:
+        from src.utils import movies_utils
+        movies_utils.combine_images(output_path, args.movie_name, args.frame_rate)
+    return True
+
+
+def run_workers(args, output_path, frames_tracker, frames):
+    blender_fol = su.get_blender_dir()
+    if not op.isdir(blender_fol):
+        print('No Blender folder!')
+        return
+    logs_fol = su.get_logs_fol(args.subject)
+    workers_num = min(args.workers_num, len(frames_tracker.pending_frames(frames)))
+    workers = [su.Bag(dict(process=None, start_time=0, restarts=0, run_time=0)) for _ in range(workers_num)]
+    now = time.time()
+    for worker_ind in range(workers_num):
+        start_worker(args, output_path, worker_ind, workers[worker_ind], blender_fol, logs_fol)
+    last_report = time.time()
+    while any([worker.process is not None for worker in workers]):
+        time.sleep(1)
+        for worker_ind, worker in enumerate(workers):
+            if worker.process is None or worker.process.poll() is None:
+                continue
+            worker.run_time += time.time() - worker.start_time
+            returncode, worker.process = worker.process.returncode, None
+            # The frame the worker was rendering if it crashed
+            frames_tracker.release_claims(worker_ind)
+            # A worker that exited cleanly didn't find a frame to take, so only a crashed one is restarted
+            if returncode == 0 or len(frames_tracker.pending_frames(frames)) == 0:
+                continue
+            if worker.restarts < args.max_restarts:
+                print('Worker {} crashed, restarting it'.format(worker_ind))
+                worker.restarts += 1
+                start_worker(args, output_path, worker_ind, worker, blender_fol, logs_fol)
+            else:
+                print('Worker {} crashed {} times, not restarting it'.format(worker_ind, worker.restarts + 1))
+        if time.time() - last_report > args.report_every:
+            report(frames_tracker, frames, workers, now)
+            last_report = time.time()
+    report(frames_tracker, frames, workers, now)
+
+
+def start_worker(args, output_path, worker_ind, worker, blender_fol, logs_fol):
+    worker_args = su.Bag({k: v for k, v in args.items() if k not in FARM_ARGS})
+    worker_args.update(dict(output_path=output_path, rel_output_path=False, farm_worker=worker_ind, save_blend=False,
+                            capture_graph=worker_ind == 0, subjects=''))
+    script_fname = op.join(op.dirname(op.abspath(rm.__file__)), 'render_movie.py')
+    # With --python-exit-code, an exception in the script is also a crash (a nonzero return code)
+    cmd = '"./blender" "{}" --background --python-exit-code 1 --python "{}" -- {}'.format(
+        su.get_subject_fname(args), script_fname, su.create_call_args(worker_args))
+    log_fname = op.join(logs_fol, 'render_movie_farm_worker_{}.log'.format(worker_ind))
+    print('Starting worker {}: {}'.format(worker_ind, cmd))
+    with open(log_fname, 'a') as log_file:
+        worker.process = subprocess.Popen(
+            cmd, shell=True, stdout=log_file, stderr=subprocess.STDOUT, cwd=blender_fol)
+    worker.start_time = time.time()
+
+
+def report(frames_tracker, frames, workers, start_time):
+    # The frames per second of this run, and how much of each worker's time was spent on rendering frames
+    now = time.time()
+    done_frames = {frame: done for frame, done in frames_tracker.done_frames().items() if done[2] >= start_time}
+    pending_num = len(frames_tracker.pending_frames(frames))
+    fps = len(done_frames) / (now - start_time)
+    print('{} frames were rendered in {:.0f}s ({:.2f} frames per second), {} to go{}'.format(
+        len(done_frames), now - start_time, fps, pending_num,
+        ', {:.0f}s'.format(pending_num / fps) if fps > 0 and pending_num > 0 else ''))
+    for worker_ind, worker in enumerate(workers):
+        worker_frames = [done for done in done_frames.values() if done[0] == worker_ind]
+        run_time = worker.run_time + (now - worker.start_time if worker.process is not None else 0)
+        render_time = sum([done[1] for done in worker_frames])
+        print('Worker {}: {} frames, {:.0f}% utilization{}{}'.format(
+            worker_ind, len(worker_frames), render_time / run_time * 100 if run_time > 0 else 0,
+            ', {} restarts'.format(worker.restarts) if worker.restarts > 0 else '',
+            '' if worker.process is not None else ' (finished)'))
+
+
+if __name__ == '__main__':
+    render_movie_farm(read_args())
@@ -4,6 +4,7 @@ import os.path as op
 import traceback
 import glob
 from itertools import product
+from collections import OrderedDict
 
 try:
     import nibabel as nib
@@ -20,6 +21,8 @@ except:
     from src.mmvt_addon.mmvt_utils import calc_colors_from_cm as calc_colors
     IN_BLENDER = False
 
+SLICES_CACHE_SIZE = 64
+
 
 def init(mmvt, modality, modality_data=None, colormap=None, subject='', mmvt_dir=''):
     if subject == '':
@@ -39,7 +42,7 @@ def init(mmvt, modality, modality_data=None, colormap=None, subject='', mmvt_dir
             if op.isfile(op.join(mu.get_user_fol(), 'ct', 't1_ct_mask.npy')):
                 t1_ct_mask = np.load(op.join(mu.get_user_fol(), 'ct', 't1_ct_mask.npy'))
         if op.isfile(fname):
-            modality_data = mu.Bag(np.load(fname))
+            modality_data = load_modality_data(fname)
         else:
             print('To see the slices the following command is being called:'.format(modality))
             print('python -m src.preproc.anatomy -s {} -f save_images_data_and_header'.format(mu.get_user()))
@@ -73,17 +76,69 @@ def init(mmvt, modality, modality_data=None, colormap=None, subject='', mmvt_dir
          scalers[order[1]] / scalers[order[0]]]
     extras = [0] * 3
     pial_vol_mask_fname = op.join(mmvt_dir, subject, 'freeview', 'pial_vol_mask.npy')
-    pial_vol_mask = np.load(pial_vol_mask_fname) if op.isfile(pial_vol_mask_fname) else None
+    pial_vol_mask = np.load(pial_vol_mask_fname, mmap_mode='r') if op.isfile(pial_vol_mask_fname) else None
     dural_vol_mask_fname = op.join(mmvt_dir, subject, 'freeview', 'dural_vol_mask.npy')
-    dural_vol_mask = np.load(dural_vol_mask_fname) if op.isfile(dural_vol_mask_fname) else None
-    fmri_vol = load_fmri_vol_data(mmvt)
+    dural_vol_mask = np.load(dural_vol_mask_fname, mmap_mode='r') if op.isfile(dural_vol_mask_fname) else None
+    fmri_vol = load_fmri_vol_data(mmvt) if mmvt is not None else None
     self = mu.Bag(dict(
         data=data, affine=affine, order=order, sizes=sizes, flips=flips, clim=clim, r=r, colors_ratio=colors_ratio,
         colormap=colormap, coordinates=[], modality=modality, extras=extras, pial_vol_mask=pial_vol_mask,
-        dural_vol_mask=dural_vol_mask, fmri_vol=fmri_vol, t1_ct_mask=t1_ct_mask))
+        dural_vol_mask=dural_vol_mask, fmri_vol=fmri_vol, t1_ct_mask=t1_ct_mask, slices_cache=SlicesCache()))
     return self
 
 
+def load_modality_data(fname):
+    # The volume is saved once (per npz update) as npy next to the npz, and memory mapped, so a slice reads only
+    # its own pages
+    npz = np.load(fname)
+    modality_data = mu.Bag({k: npz[k] for k in npz.files if k != 'data'})
+    volume_fname = '{}_volume.npy'.format(fname[:-len('.npz')])
+    if not op.isfile(volume_fname) or op.getmtime(volume_fname) < op.getmtime(fname):
+        try:
+            np.save(volume_fname, npz['data'])
+        except OSError:
+            print("load_modality_data: Can't write {}, loading the volume into memory".format(volume_fname))
+            modality_data.data = npz['data']
+            return modality_data
+    modality_data.data = np.load(volume_fname, mmap_mode='r')
+    return modality_data
+
+
+class SlicesCache(object):
+    # An LRU cache of a modality's rendered slices (the pixels before the cross is added). The evicted pixels arrays
+    # are reused as the buffers of the next slices
+
+    def __init__(self, max_size=SLICES_CACHE_SIZE):
+        self.max_size = max_size
+        self.slices = OrderedDict()
+        self.free_buffers = []
+        self.hits, self.misses = 0, 0
+
+    def get(self, key):
+        if key is None or key not in self.slices:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.slices.move_to_end(key)
+        return self.slices[key]
+
+    def put(self, key, pixels):
+        if key is None:
+            return
+        self.slices[key] = pixels
+        self.slices.move_to_end(key)
+        while len(self.slices) > self.max_size:
+            _, evicted_pixels = self.slices.popitem(last=False)
+            self.free_buffers.append(evicted_pixels)
+
+    def get_buffer(self):
+        return self.free_buffers.pop() if len(self.free_buffers) > 0 else None
+
+    def clear(self):
+        self.slices.clear()
+        self.free_buffers = []
+
+
 def load_fmri_vol_data(mmvt):
     fmri_vol_fnames = glob.glob(op.join(mu.get_user_fol(), 'fmri', '{}.*'.format(mmvt.coloring.get_fmri_vol_fname())))
     fmri_vol = None
@@ -119,11 +174,6 @@ def create_slices(mmvt, xyz, state=None, modalities='mri', modality_data=None, c
     for modality in modalities:
         self[modality].coordinates = np.rint(np.array([x, y, z])[self[modality].order]).astype(int)
         self[modality].cross = [None] * 3
-        self[modality].x_vox = np.zeros_like(self[modality].data)
-        if mu.in_shape(xyz, self[modality].data.shape):
-            self[modality].x_vox[tuple(xyz)] = 255
-        else:
-            self[modality].x_vox[128, 128, 128] = 255
 
     # cross_vert, cross_horiz = calc_cross(self[modality].coordinates, self[modality].sizes, self[modality].flips)
     images = {}
@@ -140,10 +190,21 @@ def create_slices(mmvt, xyz, state=None, modalities='mri', modality_data=None, c
         # self[modality].cross[ii] = cross
         for modality in modalities:
             s = self[modality]
-            cross = calc_cross(self[modality].x_vox, s, ii)
+            cross = calc_cross(xyz, s, ii)
             # print('{} ({},{})'.format(prespective, cross[0], cross[1]))
 
             self[modality].cross[ii] = cross
+            sizes = (s.sizes[xax], s.sizes[yax])
+            self[modality].extras[ii] = (int((max_sizes[0] - sizes[0])/2), int((max_sizes[1] - sizes[1])/2))
+            if clim is not None:
+                colors_ratio = 256 / (clim[1] - clim[0])
+            else:
+                clim, colors_ratio = s.clim, s.colors_ratio
+            slice_key = calc_slice_key(s, ii, cross, clim, colors_ratio, zoom_around_voxel, zoom_voxels_num, smooth,
+                                       mark_voxel)
+            pixels[modality] = s.slices_cache.get(slice_key)
+            if pixels[modality] is not None:
+                continue
             d = get_image_data(s.data, s.order, s.flips, ii, s.coordinates, cross, zoom_around_voxel, zoom_voxels_num,
                                smooth)
             if s.pial_vol_mask is not None and bpy.context.scene.slices_show_pial:
@@ -173,18 +234,13 @@ def create_slices(mmvt, xyz, state=None, modalities='mri', modality_data=None, c
             else:
                 t1_ct_mask = None
 
-            # todo: Should do that step in the state init
+            # d is a view of the volume, so it isn't changed in place
             if modality == 'ct':
-                d[np.where(d == 0)] = -200
-            sizes = (s.sizes[xax], s.sizes[yax])
-            self[modality].extras[ii] = (int((max_sizes[0] - sizes[0])/2), int((max_sizes[1] - sizes[1])/2))
-            if clim is not None:
-                colors_ratio = 256 / (clim[1] - clim[0])
-            else:
-                clim, colors_ratio = s.clim, s.colors_ratio
+                d = np.where(d == 0, -200, d)
             pixels[modality] = calc_slice_pixels(
                 mmvt, d, sizes, max_sizes, clim, colors_ratio, s.colormap, zoom_around_voxel, zoom_voxels_num, mark_voxel,
-                pial_vol_mask_data, dural_vol_mask_data, fmri_vol_data, t1_ct_mask)
+                pial_vol_mask_data, dural_vol_mask_data, fmri_vol_data, t1_ct_mask, s.slices_cache.get_buffer())
+            s.slices_cache.put(slice_key, pixels[modality])
         # image = create_image(d, sizes, max_sizes, s.clim, s.colors_ratio, prespective, s.colormap,
         #                      int(cross_horiz[ii][0, 1]), int(cross_vert[ii][0, 0]),
         #                      state[modality].extras[ii])
@@ -192,7 +248,8 @@ def create_slices(mmvt, xyz, state=None, modalities='mri', modality_data=None, c
             ct_ratio = bpy.context.scene.slices_modality_mix
             pixels = (1 - ct_ratio) * pixels['mri'] + ct_ratio * pixels['ct']
         else:
-            pixels = pixels[modality]
+            # The cached pixels are copied, as the cross is drawn on them
+            pixels = pixels[modality].copy()
         if plot_cross:
             if zoom_around_voxel:
                 cross = (128, 128)
@@ -209,13 +266,39 @@ def create_slices(mmvt, xyz, state=None, modalities='mri', modality_data=None, c
 
 
 
-def calc_cross(x_vox, state, ii):
-    x_vox_slice = get_image_data(x_vox, state.order, state.flips, ii, state.coordinates)
-    inds = np.argwhere(x_vox_slice)
-    if len(inds) == 0:
+def calc_cross(xyz, state, ii):
+    # The voxel's (row, col) in the ii slice, as get_image_data arranges it, or the center if the voxel isn't in the
+    # slice. A voxel which isn't in the volume is replaced by its center voxel
+    shape = state.data.shape
+    if not mu.in_shape(xyz, shape):
+        xyz = (128, 128, 128)
+    axis = state.order[ii]
+    slice_ind = state.coordinates[ii]
+    if not -shape[axis] <= slice_ind < shape[axis] or xyz[axis] != slice_ind % shape[axis]:
         return 128, 128
-    else:
-        return np.rint(np.argwhere(x_vox_slice)[0]).astype(int)
+    row_ax, col_ax = [ax for ax in range(3) if ax != axis]
+    rows, cols, row, col = shape[row_ax], shape[col_ax], xyz[row_ax], xyz[col_ax]
+    xax, yax = [1, 0, 0][ii], [2, 2, 1][ii]
+    if state.order[xax] < state.order[yax]:
+        rows, cols, row, col = cols, rows, col, row
+    if state.flips[xax]:
+        col = cols - 1 - col
+    if state.flips[yax]:
+        row = rows - 1 - row
+    return int(row), int(col)
+
+
+def calc_slice_key(state, ii, cross, clim, colors_ratio, zoom_around_voxel, zoom_voxels_num, smooth, mark_voxel):
+    # The slices with the fMRI overlay aren't cached, as its coloring can change
+    if state.fmri_vol is not None:
+        return None
+    pial_color = tuple(bpy.context.scene.slices_show_pial_color) \
+        if state.pial_vol_mask is not None and bpy.context.scene.slices_show_pial else None
+    dural_color = tuple(bpy.context.scene.slices_show_dural_color) \
+        if state.dural_vol_mask is not None and bpy.context.scene.slices_show_dural else None
+    zoom_params = (tuple(cross), zoom_voxels_num, smooth, mark_voxel) if zoom_around_voxel else None
+    return (ii, int(state.coordinates[ii]), tuple(float(c) for c in clim), float(colors_ratio), zoom_params,
+            pial_color, dural_color)
 
 
 # def calc_cross(coordinates, sizes, flips):
@@ -263,23 +346,25 @@ def get_image_data(image_data, order, flips, ii, pos, cross=None, zoom_around_vo
 
 def calc_slice_pixels(mmvt, data, sizes, max_sizes, clim, colors_ratio, colormap, zoom_around_voxel, pixels_zoom,
                       mark_voxel=True, pial_vol_mask_data=None, dural_vol_mask_data=None, fmri_vol_data=None,
-                      t1_ct_mask=None):
+                      t1_ct_mask=None, out=None):
+    # The colors are padded (centered, and to at least 256x256) into out, which is allocated only if it's None or
+    # its shape doesn't fit
     colors = calc_colors(data, clim[0], colors_ratio, colormap)
     max_sizes = [256, 256, 256]
 
     extra = [int((max_sizes[0] - sizes[0]) / 2), int((max_sizes[1] - sizes[1]) / 2)]
-    if max_sizes[0] > sizes[0]: # and max_sizes[1] == sizes[1]:
-        dark = np.zeros((colors.shape[0], extra[0], 3))
-        colors = np.concatenate((dark, colors, dark), axis=1)
-    if max_sizes[1] > sizes[1]: # and max_sizes[0] == sizes[0]:
-        dark = np.zeros((extra[1], colors.shape[1], 3))
-        colors = np.concatenate((dark, colors, dark), axis=0)
-
-    extra = [max_sizes[0] - colors.shape[0], max_sizes[1] - colors.shape[1]]
-    if extra[0] > 0:
-        colors = np.concatenate((np.zeros((extra[0], colors.shape[1], 3)), colors), axis=0)
-    if extra[1] > 0:
-        colors = np.concatenate((np.zeros((colors.shape[0], extra[1], 3)), colors), axis=1)
+    col_start = extra[0] if max_sizes[0] > sizes[0] else 0
+    row_start = extra[1] if max_sizes[1] > sizes[1] else 0
+    padded_rows, padded_cols = colors.shape[0] + 2 * row_start, colors.shape[1] + 2 * col_start
+    row_start += max(max_sizes[0] - padded_rows, 0)
+    col_start += max(max_sizes[1] - padded_cols, 0)
+    shape = (max(padded_rows, max_sizes[0]), max(padded_cols, max_sizes[1]), 4)
+    if out is None or out.shape != shape:
+        out = np.empty(shape)
+    out[:, :, :3] = 0
+    out[:, :, 3] = 1
+    out[row_start:row_start + colors.shape[0], col_start:col_start + colors.shape[1], :3] = colors
+    colors = out[:, :, :3]
 
     if zoom_around_voxel and mark_voxel:
         # todo: in very close zoom the red doesn't cover the whole pixel
@@ -299,20 +384,15 @@ def calc_slice_pixels(mmvt, data, sizes, max_sizes, clim, colors_ratio, colormap
             colors[fmri_inds] = mmvt.coloring.calc_colors(fmri_vol_data[fmri_inds])
     if t1_ct_mask is not None:
         colors[np.where(t1_ct_mask)] = (0, 0, 256)
-
-    pixels = np.ones((colors.shape[0], colors.shape[1], 4))
-    pixels[:, :, :3] = colors
-    return pixels
+    return out
 
 
 def add_cross_to_pixels(pixels, max_sizes, cross, extra):
     try:
         if 0 <= cross[1] < max_sizes[1]:  # data.shape[1]:
-            for x in range(max_sizes[0]):  # data.shape[0]):
-                pixels[x, cross[1] + extra[0]] = [0, 1, 0, 1]
+            pixels[:max_sizes[0], cross[1] + extra[0]] = [0, 1, 0, 1]
         if 0 <= cross[0] < max_sizes[0]:  # data.shape[0]:
-            for y in range(max_sizes[1]):  # data.shape[1]):
-                pixels[cross[0] + extra[1], y] = [0, 1, 0, 1]
+            pixels[cross[0] + extra[1], :max_sizes[1]] = [0, 1, 0, 1]
     except:
         pass
     return pixels
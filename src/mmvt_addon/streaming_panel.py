@@ -1,12 +1,12 @@
 import bpy
 import mmvt_utils as mu
+import streaming_utils
 import sys
 import os.path as op
 import time
 import numpy as np
 import glob
 # import traceback
-from itertools import cycle
 from datetime import datetime
 from queue import Queue
 import copy
@@ -50,6 +50,7 @@ def electrodes_sep_update(self, context):
         for t in range(T):
             fcurve.keyframe_points[t].co[1] = data[elc_ind, t] + \
                                              (C / 2 - fcurve_ind) * bpy.context.scene.electrodes_sep
+    StreamingPanel.fcurves_cache = None
     mu.view_all_in_graph_editor()
 
 
@@ -60,7 +61,6 @@ def change_graph_all_vals(mat, channels_names=(), stim_channels=(), stim_length=
     parent_obj = bpy.data.objects['Deep_electrodes']
     C = len(parent_obj.animation_data.action.fcurves)
     good_electrodes = range(mat.shape[0])
-    elecs_cycle = cycle(good_electrodes)
     no_zeros_data = mat[good_electrodes]
     no_zeros_data = no_zeros_data[np.where(no_zeros_data)]
     if len(no_zeros_data) == 0:
@@ -80,7 +80,6 @@ def change_graph_all_vals(mat, channels_names=(), stim_channels=(), stim_length=
     if not _addon().colorbar_values_are_locked():
         _addon().set_colorbar_max_min(data_max, data_min)
     curr_t = bpy.context.scene.frame_current
-    first_curve = True
 
     # stim
     stim_ch_indices = [channels_names.index(s) for s in stim_channels if s in channels_names]
@@ -95,34 +94,19 @@ def change_graph_all_vals(mat, channels_names=(), stim_channels=(), stim_length=
                 stim_ch[(np.arange(T) >= stim_indice) & (np.arange(T) < stim_indice + stim_length)] = 1
             mat[stim_ch_indice] = stim_ch
 
-    for fcurve_ind, fcurve in enumerate(parent_obj.animation_data.action.fcurves):
-        fcurve_name = mu.get_fcurve_name(fcurve)
-        if len(channels_names) > 0 and fcurve_name not in channels_names and fcurve_name not in stim_channels:
-            bpy.data.objects[fcurve_name].hide = bpy.context.scene.stream_show_only_good_electrodes
-            fcurve.hide = True
-            continue
-        if first_curve:
-            max_steps = min([len(fcurve.keyframe_points), MAX_STEPS]) - 2
-            first_curve = False
-        elc_ind = next(elecs_cycle) #fcurve_ind
-        if elc_ind >= mat.shape[0]:
-            continue
-        for ind in range(T):
-            t = curr_t + ind
-            if t > max_steps:
-                t = ind
-            fcurve.keyframe_points[t].co[1] = mat[elc_ind, ind] + (C / 2 - fcurve_ind) * bpy.context.scene.electrodes_sep
-            # if fcurve.keyframe_points[t].co[1] != 0:
-            #     print(elc_ind, ind, fcurve.keyframe_points[t].co[1])
-        _addon().color_objects_homogeneously([mat[elc_ind, ind]], [fcurve_name], None, data_min, colors_ratio)
-        # fcurve.keyframe_points[max_steps + 1].co[1] = 0
-        # fcurve.keyframe_points[0].co[1] = 0
-
-    try:
-        StreamingPanel.cycle_data = mat if StreamingPanel.cycle_data == [] else np.hstack((StreamingPanel.cycle_data, mat))
-    except:
-        StreamingPanel.cycle_data = mat
-        # print('asfd')
+    cache = get_fcurves_cache(parent_obj, channels_names, stim_channels)
+    if cache is None:
+        return
+    elc_inds = mu.set_fcurves_window_co(
+        cache.co, mat[:, :T], cache.fcurves_inds, curr_t, cache.max_steps, C, bpy.context.scene.electrodes_sep)
+    for fcurve, fcurve_co, points_num in zip(cache.fcurves, cache.co, cache.points_nums):
+        fcurve.keyframe_points.foreach_set('co', fcurve_co[:points_num].ravel())
+    # Color all the electrodes according to their last value in one pass
+    colors = _addon().calc_colors(mat[elc_inds, T - 1], data_min, colors_ratio)
+    _addon().objects_coloring(cache.objs, colors)
+
+    # mat can be a view of the udp ring buffer, so it's copied. The blocks are concatenated only in save_cycle
+    StreamingPanel.cycle_data.append(np.array(mat))
     bpy.context.scene.frame_current += mat.shape[1]
     if bpy.context.scene.frame_current > MAX_STEPS - 1:
         bpy.context.scene.frame_current = bpy.context.scene.frame_current - MAX_STEPS
@@ -138,6 +122,34 @@ def change_graph_all_vals(mat, channels_names=(), stim_channels=(), stim_length=
         StreamingPanel.cycle_data = []
 
 
+def get_fcurves_cache(parent_obj, channels_names=(), stim_channels=()):
+    # The shown fcurves, their objects and their keyframes coordinates (fcurves x points x 2), so every buffer
+    # is written with one foreach_set per fcurve, instead of setting the keyframes one by one
+    fcurves_key = (len(parent_obj.animation_data.action.fcurves), tuple(channels_names), tuple(stim_channels))
+    if StreamingPanel.fcurves_cache is not None and StreamingPanel.fcurves_cache.key == fcurves_key:
+        return StreamingPanel.fcurves_cache
+    fcurves, objs, fcurves_inds = [], [], []
+    for fcurve_ind, fcurve in enumerate(parent_obj.animation_data.action.fcurves):
+        fcurve_name = mu.get_fcurve_name(fcurve)
+        if len(channels_names) > 0 and fcurve_name not in channels_names and fcurve_name not in stim_channels:
+            bpy.data.objects[fcurve_name].hide = bpy.context.scene.stream_show_only_good_electrodes
+            fcurve.hide = True
+            continue
+        fcurves.append(fcurve)
+        objs.append(bpy.data.objects.get(fcurve_name))
+        fcurves_inds.append(fcurve_ind)
+    if len(fcurves) == 0:
+        return None
+    points_nums = [len(fcurve.keyframe_points) for fcurve in fcurves]
+    co = np.zeros((len(fcurves), max(points_nums), 2), dtype=np.float32)
+    for fcurve, fcurve_co, points_num in zip(fcurves, co, points_nums):
+        fcurve.keyframe_points.foreach_get('co', fcurve_co[:points_num].ravel())
+    StreamingPanel.fcurves_cache = mu.Bag(
+        key=fcurves_key, fcurves=fcurves, objs=objs, fcurves_inds=np.array(fcurves_inds), co=co,
+        points_nums=points_nums, max_steps=min([points_nums[0], StreamingPanel.max_steps]) - 2)
+    return StreamingPanel.fcurves_cache
+
+
 def show_electrodes_fcurves():
     bpy.context.scene.selection_type = 'diff'
     _addon().select_all_electrodes()
@@ -213,6 +225,9 @@ def udp_reader(udp_queue, while_termination_func, **kargs):
         sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
         return sock
 
+    def ring_buffer_created(ring):
+        StreamingPanel.ring_buffer = ring
+
     buffer_size = kargs.get('buffer_size', 1)
     server = kargs.get('server', 'localhost')
     port = kargs.get('port', 45454)
@@ -235,91 +250,27 @@ def udp_reader(udp_queue, while_termination_func, **kargs):
     bad_channels = kargs.get('bad_channels', '')
     bad_channels = list(map(mu.to_int, bad_channels.split(','))) if bad_channels != '' else []
     no_channels = kargs.get('no_channels', '')
-    no_channels = list(map(mu.to_int, no_channels.split(','))) if bad_channels != '' else []
+    no_channels = list(map(mu.to_int, no_channels.split(','))) if no_channels != '' else []
 
-    buffer = []
-    prev_val = None
-    mat_len = 0
-    first_message = True
-    now = time.time()
-    prev_value = None
-
-    while while_termination_func():
-        try:
-            sock.settimeout(timeout)
-            if multicast:
-                next_val, address = sock.recvfrom(2048)
-            else:
-                next_val = sock.recv(2048 * 16)
-        except socket.timeout as e:
-            if e.args[0] == 'timed out':
-                # print('!!! timed out !!!')
-                if prev_val is None and mat_len > 0:
-                    prev_val = np.zeros((mat_len, 1))
-                else:
-                    continue
-                next_val = prev_val
-            else:
-                print('!!! {} !!!'.format(e))
-                raise Exception(e)
-        else:
-            # https://docs.scipy.org/doc/numpy/user/basics.byteswapping.html
-            # data = pnet(socket,'read',packetSize,dtype,'intel');
-            # big-endian:
-            # x = np.ndarray(shape=(len(next_val) / 2,), dtype='>f8', buffer=next_val)
-            # dt = np.dtype(np.float64).newbyteorder('>')
-            # x = np.frombuffer(next_val, dtype=dt)
-            next_val = np.frombuffer(next_val, dtype=np.dtype(np.float64)).copy() #.reshape(14, 100)[10:, :]
-            next_val[bad_channels] = 0
-            if len(no_channels) > 0:
-                next_val = np.delete(next_val, no_channels, axis=0)
-            if good_channels:
-                next_val = next_val[good_channels]
-
-            if np.allclose(next_val, 0):
-                continue
-            if prev_val is not None and np.allclose(next_val.ravel(), prev_val.ravel()):
-                continue
-            prev_val = next_val.copy()
-            print('New packet! ({:.5f}s): {}'.format(next_val, time.time() - now, next_val))
-            now = time.time()
-
-            # print(next_val[0])
-            # next_val = next_val.decode(sys.getfilesystemencoding(), 'ignore')
-            # next_val = np.array([mu.to_float(f, 0.0) for f in next_val.split(',')])
-            if first_message:
-                mat_len = len(next_val)
-                first_message = False
-            else:
-                if len(next_val) != mat_len:
-                    pass
-                    # print('Wrong message len! {}'.format(len(next_val)))
-            # next_val = next_val[:mat_len]
-            next_val = next_val[..., np.newaxis]
-
-        try:
-            buffer = next_val if buffer == [] else np.hstack((buffer, next_val))
-        except:
-            # todo: transpose first if needed
-            buffer = next_val if buffer == [] else np.hstack((buffer, next_val.T))
-        # buffer.append(next_val)
-        if buffer.shape[1] >= buffer_size:
-        # if len(buffer) >= buffer_size:
-            # print('{} took {:.5f}s {}'.format('udp_reader', time.time() - now, buffer.shape[1]))
-            # print('udp_reader: ', datetime.now())
-            # zeros_indices = np.where(np.all(buffer == 0, 1))[0]
-            # buffer = buffer[zeros_indices]
-            udp_queue.put(buffer)
-            buffer = []
+    # https://docs.scipy.org/doc/numpy/user/basics.byteswapping.html
+    # The packets are float64 (little-endian), one sample of all the channels per packet
+    StreamingPanel.ring_buffer = None
+    ring = streaming_utils.read_udp_to_ring_buffer(
+        sock, udp_queue, while_termination_func, buffer_size, timeout, bad_channels, no_channels, good_channels,
+        ring_buffer_created=ring_buffer_created)
+    sock.close()
+    if ring is not None:
+        print('udp_reader: {}'.format(ring.stats()))
 
 
 def save_cycle():
-    if bpy.context.scene.save_streaming:
+    if bpy.context.scene.save_streaming and len(StreamingPanel.cycle_data) > 0:
         streaming_fol = datetime.strftime(datetime.now(), '%Y-%m-%d')
         output_fol = op.join(mu.get_user_fol(), 'electrodes', 'streaming', streaming_fol)
         output_fname = 'streaming_data_{}.npy'.format(datetime.strftime(datetime.now(), '%H-%M-%S'))
         mu.make_dir(output_fol)
-        np.save(op.join(output_fol, output_fname), StreamingPanel.cycle_data)
+        cycle_data = [d for d in StreamingPanel.cycle_data if d.shape[0] == StreamingPanel.cycle_data[-1].shape[0]]
+        np.save(op.join(output_fol, output_fname), np.hstack(cycle_data))
 
 
 def get_electrodes_data():
@@ -430,6 +381,8 @@ class StreamButton(bpy.types.Operator):
                 self._time = time.time()
                 data = mu.queue_get(StreamingPanel.udp_queue)
                 if not data is None:
+                    if StreamingPanel.ring_buffer is not None:
+                        StreamingPanel.ring_buffer.block_consumed()
                     # if len(np.where(data)[0]) > 0:
                     #     print('spike!!!!!')
                     # else:
@@ -478,6 +431,14 @@ def streaming_draw(self, context):
     layout.operator(StreamButton.bl_idname,
                     text="Stream data" if not StreamingPanel.is_streaming else 'Stop streaming data',
                     icon='COLOR_GREEN' if not StreamingPanel.is_streaming else 'COLOR_RED')
+    if StreamingPanel.is_streaming and StreamingPanel.ring_buffer is not None:
+        stats = StreamingPanel.ring_buffer.stats()
+        box = layout.box()
+        col = box.column()
+        col.label(text='Packets: {} ({:.0f}/s)'.format(stats['packets'], stats['packets_per_sec']))
+        col.label(text='Dropped: {} samples, {} bad packets'.format(stats['dropped_samples'], stats['bad_packets']))
+        col.label(text='Latency: {:.1f}ms (max {:.1f}ms)'.format(
+            stats['latency_mean'] * 1000, stats['latency_max'] * 1000))
     if StreamingPanel.stim_exist:
         layout.operator(StimButton.bl_idname, text="Stim", icon='COLOR_RED')
     layout.prop(context.scene, 'save_streaming', text='Save streaming data')
@@ -522,6 +483,8 @@ class StreamingPanel(bpy.types.Panel):
     # fixed_data = []
     udp_queue = None
     udp_viz_queue = None
+    ring_buffer = None
+    fcurves_cache = None
     electrodes_file = None
     electrodes_data = None
     time = datetime.now()
@@ -586,6 +549,7 @@ def init(addon):
 
 
 def init_electrodes_fcurves(window_length=2500):
+    StreamingPanel.fcurves_cache = None
     parent_obj = bpy.data.objects['Deep_electrodes']
     if parent_obj.animation_data is None:
         init_electrodes_animation(window_length)
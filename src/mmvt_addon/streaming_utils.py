@@ -0,0 +1,134 @@
+import socket
+import time
+import numpy as np
+from collections import deque
+
+
+class UDPRingBuffer(object):
+    # A preallocated samples x channels ring buffer for the UDP streaming, where every packet is one sample of all
+    # the channels (float64). The packets are received straight into the next row of the buffer (recv_into on a
+    # memoryview), and every block_size samples, a fixed size channels x block_size view is handed to the consumer.
+    # A block view is valid until the ring wraps around to it, so no more than blocks_num - 2 blocks can wait for
+    # the consumer. If it's too slow, the new blocks are dropped (and counted), and their rows are received into
+    # again, so the ring doesn't advance into the blocks the consumer didn't read yet.
+    # The bad channels are zeroed in every packet, and the empty and repeated packets are skipped, where only the
+    # check_indices channels are checked (all of them if None).
+
+    def __init__(self, channels_num, block_size, blocks_num=32, dtype=np.float64, bad_channels=(),
+                 check_indices=None):
+        self.channels_num, self.block_size, self.blocks_num = channels_num, block_size, max(blocks_num, 3)
+        self.data = np.zeros((self.blocks_num * block_size, channels_num), dtype=dtype)
+        self.buffer = memoryview(self.data).cast('B')
+        self.packet_size = channels_num * self.data.itemsize
+        self.bad_channels, self.check_indices = list(bad_channels), check_indices
+        self.prev_sample = None
+        self.ind = 0
+        self.packets, self.skipped, self.bad_packets, self.dropped_blocks, self.blocks = 0, 0, 0, 0, 0
+        self.first_packet_time, self.last_packet_time = None, None
+        self.blocks_times = deque()
+        self.latencies = deque(maxlen=1000)
+
+    def recv(self, sock):
+        # Receives one packet into the ring. Returns the block's view if this packet completed it, and the block
+        # can be handed to the consumer, otherwise None
+        row = self.ind % len(self.data)
+        packet_size = sock.recv_into(self.buffer[row * self.packet_size:(row + 1) * self.packet_size],
+                                     self.packet_size)
+        return self._add_packet(row, packet_size)
+
+    def put(self, packet):
+        # Copies a packet that was already received (like the first one, which sets the channels num) into the ring
+        row = self.ind % len(self.data)
+        self.buffer[row * self.packet_size:row * self.packet_size + len(packet)] = packet
+        return self._add_packet(row, len(packet))
+
+    def _add_packet(self, row, packet_size):
+        self.last_packet_time = time.time()
+        if self.first_packet_time is None:
+            self.first_packet_time = self.last_packet_time
+        self.packets += 1
+        if packet_size != self.packet_size:
+            self.bad_packets += 1
+            return None
+        sample = self.data[row]
+        if len(self.bad_channels) > 0:
+            sample[self.bad_channels] = 0
+        checked_sample = sample if self.check_indices is None else sample[self.check_indices]
+        # Skip empty packets and repeated ones (multicast can deliver the same packet twice)
+        if not checked_sample.any() or (
+                self.prev_sample is not None and np.array_equal(checked_sample, self.prev_sample)):
+            self.skipped += 1
+            return None
+        self.prev_sample = checked_sample.copy()
+        self.ind += 1
+        if self.ind % self.block_size != 0:
+            return None
+        if not self.can_hand_block():
+            # The block's rows will be received into again
+            self.dropped_blocks += 1
+            self.ind -= self.block_size
+            return None
+        self.blocks += 1
+        self.blocks_times.append(time.time())
+        return self.data[row + 1 - self.block_size:row + 1].T
+
+    def can_hand_block(self):
+        return len(self.blocks_times) < self.blocks_num - 2
+
+    def block_consumed(self):
+        # Should be called by the consumer for every block it takes, to calc the latency, and to free its rows
+        if len(self.blocks_times) > 0:
+            self.latencies.append(time.time() - self.blocks_times.popleft())
+
+    def stats(self):
+        run_time = self.last_packet_time - self.first_packet_time if self.packets > 1 else 0
+        return dict(
+            packets=self.packets, skipped=self.skipped, bad_packets=self.bad_packets, blocks=self.blocks,
+            dropped_blocks=self.dropped_blocks, dropped_samples=self.dropped_blocks * self.block_size,
+            packets_per_sec=self.packets / run_time if run_time > 0 else 0,
+            latency_mean=np.mean(self.latencies) if len(self.latencies) > 0 else 0,
+            latency_max=np.max(self.latencies) if len(self.latencies) > 0 else 0)
+
+
+def calc_channels_indices(channels_num, no_channels=(), good_channels=()):
+    # The indices of the channels that are left after removing no_channels, and then picking good_channels
+    # (which are relative to the channels after the removal), or None if all the channels are used
+    if len(no_channels) == 0 and len(good_channels) == 0:
+        return None
+    channels_indices = np.delete(np.arange(channels_num), no_channels)
+    if len(good_channels) > 0:
+        channels_indices = channels_indices[good_channels]
+    return channels_indices
+
+
+def read_udp_to_ring_buffer(sock, udp_queue, while_termination_func, block_size, timeout=0.1, bad_channels=(),
+                            no_channels=(), good_channels=(), blocks_num=32, max_packet_size=2048 * 16,
+                            ring_buffer_created=None):
+    # The first packet sets the channels num, and then all the packets are received into the ring buffer.
+    # ring_buffer_created is called with the ring buffer, so the caller can read its counters.
+    sock.settimeout(timeout)
+    ring, channels_indices = None, None
+    first_packet = bytearray(max_packet_size)
+    while while_termination_func():
+        try:
+            if ring is None:
+                packet_size = sock.recv_into(first_packet, max_packet_size)
+                if packet_size == 0 or packet_size % 8 != 0:
+                    continue
+                channels_num = packet_size // 8
+                channels_indices = calc_channels_indices(channels_num, no_channels, good_channels)
+                ring = UDPRingBuffer(channels_num, block_size, blocks_num, bad_channels=bad_channels,
+                                     check_indices=channels_indices)
+                if ring_buffer_created is not None:
+                    ring_buffer_created(ring)
+                block = ring.put(memoryview(first_packet)[:packet_size])
+            else:
+                block = ring.recv(sock)
+        except socket.timeout:
+            continue
+        if block is None:
+            continue
+        if channels_indices is not None:
+            block = block[channels_indices]
+        udp_queue.put(block)
+    return ring
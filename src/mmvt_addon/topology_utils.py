@@ -0,0 +1,263 @@
+import os
+import os.path as op
+import glob
+import pickle
+import numpy as np
+
+# The mesh topology is stored per hemisphere as flat npy arrays (which can be memory mapped) in the subject's
+# topology folder, instead of pickles of python dicts:
+# verts_neighbors[_surf]_{hemi}_indptr/indices.npy: vertex -> neighbors (CSR)
+# verts_faces[_surf]_{hemi}_indptr/indices.npy: vertex -> faces (CSR)
+# {atlas}_vertices_labels_{hemi}.npy: vertex -> label id (int16), and {atlas}_labels_names_{hemi}.npy: the labels names
+
+TOPOLOGY_FOL = 'topology'
+
+
+class CSR(object):
+    # A vertex -> items (neighbors / faces) lookup in compressed sparse rows, where the items of vertex v are
+    # indices[indptr[v]:indptr[v + 1]]. It can be used like the dict of lists it replaces (lookup[v], len(lookup),
+    # lookup.get(v), lookup.keys())
+
+    def __init__(self, indptr, indices):
+        self.indptr, self.indices = indptr, indices
+
+    def __getitem__(self, ind):
+        return self.indices[self.indptr[ind]:self.indptr[ind + 1]]
+
+    def __len__(self):
+        return len(self.indptr) - 1
+
+    def __iter__(self):
+        return iter(range(len(self)))
+
+    def __contains__(self, ind):
+        return 0 <= ind < len(self)
+
+    def get(self, ind, default=None):
+        return self[ind] if ind in self else default
+
+    def keys(self):
+        return range(len(self))
+
+    def items(self):
+        return ((ind, self[ind]) for ind in range(len(self)))
+
+    def lengths(self):
+        return np.diff(self.indptr)
+
+    def rows(self):
+        # The row (vertex) of every item in indices
+        return np.repeat(np.arange(len(self)), self.lengths())
+
+
+class VerticesLabelsLookup(object):
+    # A vertex -> label lookup, backed by an int16 labels ids array. The vertices without a label get the last id,
+    # which is the unknown label. It can be used like the dict it replaces, returning the labels names, or the
+    # labels ids if return_ids (np.asarray(lookup) returns the ids array)
+
+    def __init__(self, labels_ids, labels_names, return_ids=False):
+        self.labels_ids, self.labels_names, self.return_ids = labels_ids, np.asarray(labels_names), return_ids
+
+    def ids_lookup(self):
+        return VerticesLabelsLookup(self.labels_ids, self.labels_names, True)
+
+    def names_lookup(self):
+        return VerticesLabelsLookup(self.labels_ids, self.labels_names, False)
+
+    def __getitem__(self, vert):
+        label_id = self.labels_ids[vert]
+        return label_id if self.return_ids else self.labels_names[label_id]
+
+    def __len__(self):
+        return len(self.labels_ids)
+
+    def __iter__(self):
+        return iter(range(len(self)))
+
+    def __contains__(self, vert):
+        return 0 <= vert < len(self)
+
+    def __array__(self, dtype=None, copy=None):
+        return np.asarray(self.labels_ids, dtype=dtype)
+
+    def get(self, vert, default=None):
+        return self[vert] if vert in self else default
+
+    def keys(self):
+        return range(len(self))
+
+    def values(self):
+        return self.labels_ids if self.return_ids else self.labels_names[self.labels_ids]
+
+    def items(self):
+        return zip(self.keys(), self.values())
+
+    def unknown_vertices_mask(self):
+        unknown_labels = np.array(['unknown' in label_name for label_name in self.labels_names], dtype=bool)
+        return unknown_labels[self.labels_ids]
+
+    def remove_unknown_vertices(self, vertices):
+        vertices = np.asarray(vertices, dtype=int)
+        unknown_labels = np.array(['unknown' in label_name for label_name in self.labels_names], dtype=bool)
+        return vertices[~unknown_labels[self.labels_ids[vertices]]]
+
+    def label_vertices(self, label_name):
+        label_ids = np.where(self.labels_names == label_name)[0]
+        return np.where(np.isin(self.labels_ids, label_ids))[0]
+
+
+def get_topology_fol(subject_fol):
+    return op.join(subject_fol, TOPOLOGY_FOL)
+
+
+def surf_suffix(surf):
+    return '' if surf == 'pial' else '_{}'.format(surf)
+
+
+def verts_neighbors_fname(subject_fol, hemi, surf='pial'):
+    return op.join(get_topology_fol(subject_fol), 'verts_neighbors{}_{}'.format(surf_suffix(surf), hemi))
+
+
+def verts_faces_fname(subject_fol, hemi, surf='pial'):
+    return op.join(get_topology_fol(subject_fol), 'verts_faces{}_{}'.format(surf_suffix(surf), hemi))
+
+
+def vertices_labels_fname(subject_fol, atlas, hemi):
+    return op.join(get_topology_fol(subject_fol), '{}_vertices_labels_{}.npy'.format(atlas, hemi))
+
+
+def labels_names_fname(subject_fol, atlas, hemi):
+    return op.join(get_topology_fol(subject_fol), '{}_labels_names_{}.npy'.format(atlas, hemi))
+
+
+def csr_exists(fname):
+    return op.isfile('{}_indptr.npy'.format(fname)) and op.isfile('{}_indices.npy'.format(fname))
+
+
+def save_csr(csr, fname):
+    os.makedirs(op.dirname(fname), exist_ok=True)
+    np.save('{}_indptr.npy'.format(fname), csr.indptr)
+    np.save('{}_indices.npy'.format(fname), csr.indices)
+
+
+def load_csr(fname, mmap=True):
+    mmap_mode = 'r' if mmap else None
+    return CSR(np.load('{}_indptr.npy'.format(fname), mmap_mode=mmap_mode),
+               np.load('{}_indices.npy'.format(fname), mmap_mode=mmap_mode))
+
+
+def csr_from_pairs(rows, cols, rows_num=None):
+    # Stable sort by the rows, so every row's items stay in their original order
+    rows, cols = np.asarray(rows), np.asarray(cols)
+    rows_num = rows.max() + 1 if rows_num is None else rows_num
+    order = np.argsort(rows, kind='stable')
+    indptr = np.zeros(rows_num + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows, minlength=rows_num), out=indptr[1:])
+    return CSR(indptr, cols[order].astype(np.int32))
+
+
+def csr_from_dict(lookup, rows_num=None):
+    # Converts the legacy dict of lists / sets (the verts_neighbors and faces_verts_lookup pickles)
+    rows_num = max(lookup.keys()) + 1 if rows_num is None else rows_num
+    lengths = np.zeros(rows_num, dtype=np.int64)
+    for ind, items in lookup.items():
+        lengths[ind] = len(items)
+    indptr = np.zeros(rows_num + 1, dtype=np.int64)
+    np.cumsum(lengths, out=indptr[1:])
+    indices = np.zeros(indptr[-1], dtype=np.int32)
+    for ind, items in lookup.items():
+        indices[indptr[ind]:indptr[ind + 1]] = sorted(items) if isinstance(items, set) else items
+    return CSR(indptr, indices)
+
+
+def calc_verts_neighbors(faces, verts_num=None):
+    # The vertices neighbors are the mesh edges, in both directions and without duplicates
+    faces = np.asarray(faces)
+    verts_num = faces.max() + 1 if verts_num is None else verts_num
+    edges = np.concatenate([faces[:, [0, 1]], faces[:, [1, 2]], faces[:, [2, 0]]])
+    edges = np.concatenate([edges, edges[:, ::-1]])
+    edges = np.unique(edges[:, 0].astype(np.int64) * verts_num + edges[:, 1])
+    return csr_from_pairs(edges // verts_num, edges % verts_num, verts_num)
+
+
+def calc_verts_faces(faces, verts_num=None):
+    faces = np.asarray(faces)
+    verts_num = faces.max() + 1 if verts_num is None else verts_num
+    faces_inds = np.repeat(np.arange(len(faces)), faces.shape[1])
+    return csr_from_pairs(faces.ravel(), faces_inds, verts_num)
+
+
+def save_vertices_labels_lookup(subject_fol, atlas, hemi, labels_ids, labels_names):
+    os.makedirs(get_topology_fol(subject_fol), exist_ok=True)
+    np.save(vertices_labels_fname(subject_fol, atlas, hemi), np.asarray(labels_ids, dtype=np.int16))
+    np.save(labels_names_fname(subject_fol, atlas, hemi), np.asarray(labels_names, dtype=str))
+
+
+def vertices_labels_lookup_exists(subject_fol, atlas, hemi):
+    return op.isfile(vertices_labels_fname(subject_fol, atlas, hemi)) and \
+           op.isfile(labels_names_fname(subject_fol, atlas, hemi))
+
+
+def load_vertices_labels_lookup(subject_fol, atlas, hemi, return_ids=False, mmap=True):
+    if not vertices_labels_lookup_exists(subject_fol, atlas, hemi):
+        return None
+    labels_ids = np.load(vertices_labels_fname(subject_fol, atlas, hemi), mmap_mode='r' if mmap else None)
+    labels_names = np.load(labels_names_fname(subject_fol, atlas, hemi))
+    return VerticesLabelsLookup(labels_ids, labels_names, return_ids)
+
+
+def vertices_labels_lookup_from_dict(lookup, hemi):
+    # Converts the legacy {vertex: label name} dict (the vertices_labels_lookup pickle)
+    labels_names = sorted(set(lookup.values()) - {'unknown_{}'.format(hemi)}) + ['unknown_{}'.format(hemi)]
+    names_ids = {name: ind for ind, name in enumerate(labels_names)}
+    labels_ids = np.full(max(lookup.keys()) + 1, len(labels_names) - 1, dtype=np.int16)
+    for vert, label_name in lookup.items():
+        labels_ids[vert] = names_ids[label_name]
+    return VerticesLabelsLookup(labels_ids, labels_names)
+
+
+def _load_legacy_pickle(fname):
+    with open(fname, 'rb') as fp:
+        return pickle.load(fp)
+
+
+def load_verts_neighbors(subject_fol, hemi, surf='pial', mmap=True):
+    # If only the legacy pickle exists, it's converted once to the CSR arrays
+    fname = verts_neighbors_fname(subject_fol, hemi, surf)
+    if not csr_exists(fname):
+        legacy_fname = op.join(subject_fol, 'verts_neighbors{}_{}.pkl'.format(surf_suffix(surf), hemi))
+        if not op.isfile(legacy_fname):
+            return None
+        save_csr(csr_from_dict(_load_legacy_pickle(legacy_fname)), fname)
+    return load_csr(fname, mmap)
+
+
+def load_verts_faces(subject_fol, hemi, surf='pial', mmap=True):
+    fname = verts_faces_fname(subject_fol, hemi, surf)
+    if not csr_exists(fname):
+        legacy_fname = op.join(subject_fol, 'faces_verts_lookup_{}{}.pkl'.format(
+            hemi, '' if surf == 'pial' else '{}_'.format(surf)))
+        if not op.isfile(legacy_fname):
+            return None
+        save_csr(csr_from_dict(_load_legacy_pickle(legacy_fname)), fname)
+    return load_csr(fname, mmap)
+
+
+def load_atlas_vertices_labels_lookup(subject_fol, atlas, hemi, return_ids=False, mmap=True):
+    if not vertices_labels_lookup_exists(subject_fol, atlas, hemi):
+        legacy_fname = op.join(subject_fol, '{}_vertices_labels_lookup.pkl'.format(atlas))
+        if not op.isfile(legacy_fname):
+            return None
+        legacy_lookup = _load_legacy_pickle(legacy_fname)
+        for legacy_hemi in legacy_lookup.keys():
+            lookup = vertices_labels_lookup_from_dict(legacy_lookup[legacy_hemi], legacy_hemi)
+            save_vertices_labels_lookup(subject_fol, atlas, legacy_hemi, lookup.labels_ids, lookup.labels_names)
+    return load_vertices_labels_lookup(subject_fol, atlas, hemi, return_ids, mmap)
+
+
+def get_atlases_with_vertices_labels_lookup(subject_fol):
+    fnames = glob.glob(op.join(get_topology_fol(subject_fol), '*_vertices_labels_rh.npy')) + \
+             glob.glob(op.join(subject_fol, '*_vertices_labels_lookup.pkl'))
+    atlases = [op.basename(fname)[:-len('_vertices_labels_rh.npy')] if fname.endswith('.npy') else
+               op.basename(fname)[:-len('_vertices_labels_lookup.pkl')] for fname in fnames]
+    return list(dict.fromkeys(atlases))
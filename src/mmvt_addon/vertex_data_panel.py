@@ -113,33 +113,14 @@ def find_closest_vertex_index_and_mesh(pos=None, hemis=None, use_shape_keys=Fals
             obj_name = 'inflated_{}'.format(obj_name)
         obj = bpy.data.objects[obj_name]
         co_find = pos * obj.matrix_world.inverted()
-        mesh = obj.data
-        size = len(mesh.vertices)
-        kd = mathutils.kdtree.KDTree(size)
-
-        if use_shape_keys:
-            me = obj.to_mesh(bpy.context.scene, True, 'PREVIEW')
-            for i, v in enumerate(mesh.vertices):
-                try:
-                    kd.insert(me.vertices[i].co, i)
-                except:
-                    # in flat map not all the vertices exist
-                    # todo handle the case where the brain is sliced and the user click the plane with the image.
-                    print('find_closest_vertex_index_and_mesh: exception in the use_shape_keys loop')
-                    break
-            bpy.data.meshes.remove(me)
-        else:
-            for i, v in enumerate(mesh.vertices):
-                kd.insert(v.co, i)
-
-        kd.balance()
-        # print(obj.name)
-        for (co, index, dist) in kd.find_n(co_find, 1):
-            # print('cursor at {} ,vertex {}, index {}, dist {}'.format(str(co_find), str(co), str(index), str(dist)))
-            distances.append(dist)
-            names.append(obj.name)
-            vertices_idx.append(index)
-            vertices_co.append(co)
+        # The surface's tree is cached, and rebuilt only if the shape keys (the inflation) were changed
+        tree = mu.get_objects_kdtree(obj, use_shape_keys=use_shape_keys)
+        _, index, co, dist = mu.find_closest_vertex_in_kdtree(tree, co_find)
+        # print('cursor at {} ,vertex {}, index {}, dist {}'.format(str(co_find), str(co), str(index), str(dist)))
+        distances.append(dist)
+        names.append(obj.name)
+        vertices_idx.append(index)
+        vertices_co.append(co)
 
     distances = np.array(distances)
     closest_mesh_name = names[np.argmin(distances)]
@@ -183,14 +164,18 @@ class CreateVertexData(bpy.types.Operator):
     @staticmethod
     def keyframe_empty(self, empty_name, closest_mesh_name, vertex_ind, data_path):
         obj = bpy.data.objects[empty_name]
-        number_of_time_points = len(glob.glob(op.join(data_path, 'activity_map_' + closest_mesh_name + '2', '', ) + '*.npy'))
+        activity_map_fol = op.join(data_path, 'activity_map_' + closest_mesh_name + '2')
+        store = mu.get_activity_map_store(activity_map_fol)
+        number_of_time_points = store.shape[0] if store is not None else \
+            len(glob.glob(op.join(activity_map_fol, '*.npy')))
         mu.insert_keyframe_to_custom_prop(obj, 'data', 0, 0)
         mu.insert_keyframe_to_custom_prop(obj, 'data', 0, number_of_time_points + 1)
         for ii in range(number_of_time_points):
             # print(ii)
-            frame_str = str(ii)
-            f = np.load(op.join(data_path, 'activity_map_' + closest_mesh_name + '2', 't' + frame_str + '.npy'))
-            mu.insert_keyframe_to_custom_prop(obj, 'data', float(f[vertex_ind, 0]), ii + 1)
+            f = mu.load_activity_map_t(activity_map_fol, ii)
+            # The legacy t{t}.npy files are vertices x values, the store's time points are vertices values
+            value = f[vertex_ind, 0] if f.ndim == 2 else f[vertex_ind]
+            mu.insert_keyframe_to_custom_prop(obj, 'data', float(value), ii + 1)
 
         fcurves = bpy.data.objects[empty_name].animation_data.action.fcurves[0]
         mod = fcurves.modifiers.new(type='LIMITS')
@@ -251,9 +236,8 @@ def init(addon):
     if len(lookup_files) == 0:
         print('No lookup files for vertex_data_panel')
         DataInVertMakerPanel.init = False
-    DataInVertMakerPanel.activity_maps_exist = \
-        op.isdir(op.join(mu.get_user_fol(), 'activity_map_rh')) and \
-        op.isdir(op.join(mu.get_user_fol(), 'activity_map_lh'))
+    DataInVertMakerPanel.activity_maps_exist = mu.hemi_activity_map_exists(
+        op.join(mu.get_user_fol(), 'activity_map_{hemi}'))
     DataInVertMakerPanel.init = True
     register()
 
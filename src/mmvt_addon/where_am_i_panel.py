@@ -81,6 +81,11 @@ def subject_annot_files_update(self, context):
         WhereAmIPanel.labels_contours = d
     else:
         WhereAmIPanel.labels_contours = None
+    # Precalc the atlas' vertex -> label lookup, so finding the closest label will be a single query
+    for hemi in mu.HEMIS:
+        annot_fname = get_annot_fname(bpy.context.scene.subject_annot_files, hemi)
+        if op.isfile(annot_fname):
+            mu.read_vertices_labels_lookup_from_annot(annot_fname)
 
 
 def where_i_am_draw(self, context):
@@ -338,29 +343,23 @@ def find_closest_obj(search_also_for_subcorticals=True):
             # obj.active_material = cur_material
             obj.select = False
             obj.hide = parent_object.hide
+        objs = [obj for obj in parent_object.children if 'unknown' not in obj.name]
+        if len(objs) == 0:
+            continue
 
-            # 3d cursor relative to the object data
-            cursor = bpy.context.scene.cursor_location
-            if bpy.context.object and bpy.context.object.parent == bpy.data.objects.get('Deep_electrodes', None):
-                cursor = bpy.context.object.location
-
-            co_find = cursor * obj.matrix_world.inverted()
-
-            mesh = obj.data
-            size = len(mesh.vertices)
-            kd = mathutils.kdtree.KDTree(size)
-
-            for i, v in enumerate(mesh.vertices):
-                kd.insert(v.co, i)
-
-            kd.balance()
+        # 3d cursor relative to the object data (all the parent's children share the same matrix_world)
+        cursor = bpy.context.scene.cursor_location
+        if bpy.context.object and bpy.context.object.parent == bpy.data.objects.get('Deep_electrodes', None):
+            cursor = bpy.context.object.location
+        co_find = cursor * objs[0].matrix_world.inverted()
 
-            # Find the closest point to the 3d cursor
-            for (co, index, dist) in kd.find_n(co_find, 1):
-                if 'unknown' not in obj.name:
-                    distances.append(dist)
-                    names.append(obj.name)
-                    indices.append(index)
+        # Find the closest point to the 3d cursor, in one cached tree for all the parent's children
+        tree = mu.get_objects_kdtree(objs, parent_object_name)
+        obj_name, index, co, dist = mu.find_closest_vertex_in_kdtree(tree, co_find)
+        if obj_name is not None:
+            distances.append(dist)
+            names.append(obj_name)
+            indices.append(index)
 
     # print(np.argmin(np.array(distances)))
     min_index = np.argmin(np.array(distances))
@@ -371,8 +370,15 @@ def find_closest_obj(search_also_for_subcorticals=True):
     return closest_area
 
 
-def find_closest_label(atlas=None, plot_contour=True):
+def get_annot_fname(atlas, hemi):
     subjects_dir = mu.get_link_dir(mu.get_links_dir(), 'subjects')
+    annot_fname = op.join(subjects_dir, mu.get_user(), 'label', '{}.{}.annot'.format(hemi, atlas))
+    if not op.isfile(annot_fname):
+        annot_fname = op.join(mu.get_user_fol(), 'labels', '{}.{}.annot'.format(hemi, atlas))
+    return annot_fname
+
+
+def find_closest_label(atlas=None, plot_contour=True):
     if bpy.context.scene.cursor_is_snapped:
         vertex_ind, hemi = _addon().get_closest_vertex_and_mesh_to_cursor()
     else:
@@ -385,17 +391,14 @@ def find_closest_label(atlas=None, plot_contour=True):
     hemi = 'rh' if 'rh' in hemi else 'lh'
     if atlas is None:
         atlas = bpy.context.scene.subject_annot_files
-    annot_fname = op.join(subjects_dir, mu.get_user(), 'label', '{}.{}.annot'.format(hemi, atlas))
-    if not op.isfile(annot_fname):
-        annot_fname = op.join(mu.get_user_fol(), 'labels', '{}.{}.annot'.format(hemi, atlas))
+    annot_fname = get_annot_fname(atlas, hemi)
     if op.isfile(annot_fname):
-        labels = mu.read_labels_from_annot(annot_fname)
-        vert_labels = [l for l in labels if vertex_ind in l.vertices]
-        if len(vert_labels) > 0:
-            label = vert_labels[0]
-            bpy.context.scene.closest_label_output = label.name
-            if plot_contour:
-                plot_closest_label_contour(label.name, hemi)
+        label = mu.find_vertex_label(annot_fname, vertex_ind)
+        if label is None:
+            return None
+        bpy.context.scene.closest_label_output = label.name
+        if plot_contour:
+            plot_closest_label_contour(label.name, hemi)
         return label.name
     else:
         print("Can't find the annotation file for atlas {}!".format(atlas))
@@ -3,6 +3,7 @@ import os
 import os.path as op
 import shutil
 import traceback
+import time
 from collections import defaultdict
 from tqdm import tqdm
 import csv
@@ -20,6 +21,8 @@ from src.utils import utils
 from src.utils import freesurfer_utils as fu
 from src.utils import args_utils as au
 from src.utils import preproc_utils as pu
+from src.utils import pipeline_utils as plu
+from src.mmvt_addon import topology_utils as tu
 
 
 SUBJECTS_DIR, MMVT_DIR, FREESURFER_HOME = pu.get_links()
@@ -607,10 +610,13 @@ def parcelate_cortex(subject, atlas, overwrite=False, overwrite_annotation=False
 
     if len(params) > 0:
         if n_jobs > 1:
-            results = utils.run_parallel(_parcelate_cortex_parallel, params, njobs=n_jobs)
+            results = utils.run_parallel(_parcelate_cortex_parallel, params, njobs=n_jobs, reuse_pool=True)
         else:
             results = [_parcelate_cortex_parallel(p) for p in params]
-        return all(results)
+        print('Parcelate cortex timing ({}):'.format(atlas))
+        for (_, _, hemi, surface_type, _, _), (_, run_time) in zip(params, results):
+            print('{} {}: {:.2f}s'.format(hemi, surface_type, run_time))
+        return all([ret for ret, _ in results])
     else:
         return True
 
@@ -619,8 +625,10 @@ def _parcelate_cortex_parallel(p):
     from src.preproc import parcelate_cortex
     subject, atlas, hemi, surface_type, vertices_labels_ids_lookup, overwrite_vertices_labels_lookup = p
     print('Parcelate the {} {} cortex'.format(hemi, surface_type))
-    return parcelate_cortex.parcelate(subject, atlas, hemi, surface_type, vertices_labels_ids_lookup,
-                                      overwrite_vertices_labels_lookup)
+    now = time.time()
+    ret = parcelate_cortex.parcelate(subject, atlas, hemi, surface_type, vertices_labels_ids_lookup,
+                                     overwrite_vertices_labels_lookup)
+    return ret, time.time() - now
 
 
 def save_matlab_labels_vertices(subject, atlas):
@@ -654,16 +662,15 @@ def save_labels_vertices(subject, atlas, overwrite=False):
 @utils.tryit()
 def create_spatial_connectivity(subject, surf_types=('pial', 'dural'), overwrite=False):
     ret = True
+    subject_fol = op.join(MMVT_DIR, subject)
     for surf in surf_types:
-        verts_neighbors_fname = op.join(MMVT_DIR, subject, 'verts_neighbors{}_{}.pkl'.format(
-            '' if surf == 'pial' else '_{}'.format(surf), '{hemi}'))
         connectivity_fname = op.join(MMVT_DIR, subject, 'spatial_connectivity{}.pkl'.format(
             '' if surf == 'pial' else '_{}'.format(surf)))
-        if utils.both_hemi_files_exist(verts_neighbors_fname) and op.isfile(connectivity_fname) and not overwrite:
+        if all([tu.csr_exists(tu.verts_neighbors_fname(subject_fol, hemi, surf)) for hemi in utils.HEMIS]) and \
+                op.isfile(connectivity_fname) and not overwrite:
             continue
         connectivity_per_hemi = {}
         for hemi in utils.HEMIS:
-            neighbors = defaultdict(list)
             pial_fname = op.join(MMVT_DIR, subject, 'surf', '{}.{}.ply'.format(hemi, surf))
             if not op.isfile(pial_fname):
                 create_surfaces(subject)
@@ -676,15 +683,24 @@ def create_spatial_connectivity(subject, surf_types=('pial', 'dural'), overwrite
             #     continue
             # d = np.load(conn_fname)
             connectivity_per_hemi[hemi] = mne.spatial_tris_connectivity(faces)
-            rows, cols = connectivity_per_hemi[hemi].nonzero()
-            for ind in range(len(rows)):
-                neighbors[rows[ind]].append(cols[ind])
-            utils.save(neighbors, verts_neighbors_fname.format(hemi=hemi))
+            # The vertices neighbors are the connectivity matrix's rows, saved as CSR arrays
+            connectivity = connectivity_per_hemi[hemi].tocsr()
+            connectivity.sort_indices()
+            tu.save_csr(tu.CSR(connectivity.indptr.astype(np.int64), connectivity.indices.astype(np.int32)),
+                        tu.verts_neighbors_fname(subject_fol, hemi, surf))
         utils.save(connectivity_per_hemi, connectivity_fname)
         ret = ret and op.isfile(connectivity_fname)
     return ret
 
 
+def load_verts_neighbors(subject, surf='pial', mmap=True):
+    subject_fol = op.join(MMVT_DIR, subject)
+    if not all([tu.csr_exists(tu.verts_neighbors_fname(subject_fol, hemi, surf)) for hemi in utils.HEMIS]):
+        print('load_verts_neighbors: Running create_spatial_connectivity')
+        create_spatial_connectivity(subject, (surf,))
+    return {hemi: tu.load_verts_neighbors(subject_fol, hemi, surf, mmap) for hemi in utils.HEMIS}
+
+
 def load_connectivity(subject):
     connectivity_fname = op.join(MMVT_DIR, subject, 'spatial_connectivity.pkl')
     if not op.isfile(connectivity_fname):
@@ -712,10 +728,7 @@ def calc_three_rois_intersection(subject, rois, output_fol='', model_name='', at
         if op.isfile(output_fname) and not overwrite:
             return utils.load(output_fname)
 
-    verts_neighbors_fname = op.join(MMVT_DIR, subject, 'verts_neighbors_{hemi}.pkl')
-    if not utils.both_hemi_files_exist(verts_neighbors_fname):
-        print('calc_labeles_contours: You should first run create_spatial_connectivity')
-        create_spatial_connectivity(subject)
+    verts_neighbors = load_verts_neighbors(subject)
 
     contours = op.join(MMVT_DIR, subject, 'labels', '{}_contours_{}.npz'.format(atlas, '{hemi}'))
     if not utils.both_hemi_files_exist(contours):
@@ -726,7 +739,7 @@ def calc_three_rois_intersection(subject, rois, output_fol='', model_name='', at
         d = np.load(contours.format(hemi=hemi))
         hemi_contours = d['contours']
         surf, _ = utils.read_pial(subject, MMVT_DIR, hemi)
-        vertices_neighbors = np.load(verts_neighbors_fname.format(hemi=hemi))
+        vertices_neighbors = verts_neighbors[hemi]
         labels = lu.read_labels(subject, SUBJECTS_DIR, atlas, hemi=hemi)
         labels_names = [label.name for label in labels]
         labels_contoures_inds = [set(np.where(hemi_contours == labels_names.index('{}-{}'.format(roi, hemi)) + 1)[0]) \
@@ -767,11 +780,8 @@ def calc_flat_patch_cut_vertices(subject, atlas='aparc.DKTatlas', overwrite=True
                                 ('caudalanteriorcingulate', 'posteriorcingulate'),
                                 ('superiorfrontal', 'posteriorcingulate'), ('paracentral', 'superiorfrontal')]
 
-    verts_neighbors_fname = op.join(MMVT_DIR, subject, 'verts_neighbors_{hemi}.pkl')
-    if not utils.both_hemi_files_exist(verts_neighbors_fname):
-        print('calc_labeles_contours: You should first run create_spatial_connectivity')
-        create_spatial_connectivity(subject)
-        # return calc_labeles_contours(subject, atlas, overwrite, verbose)
+    verts_neighbors = load_verts_neighbors(subject)
+    # return calc_labeles_contours(subject, atlas, overwrite, verbose)
     # vertices_labels_lookup = lu.create_vertices_labels_lookup(subject, atlas, False, overwrite)
     bad_vertices = {}
 
@@ -781,7 +791,7 @@ def calc_flat_patch_cut_vertices(subject, atlas='aparc.DKTatlas', overwrite=True
         calc_labeles_contours(subject, atlas)
     for hemi in utils.HEMIS:
         d = np.load(contours_tempalte.format(hemi=hemi))
-        vertices_neighbors = np.load(verts_neighbors_fname.format(hemi=hemi))
+        vertices_neighbors = verts_neighbors[hemi]
         labels = lu.read_labels(subject, SUBJECTS_DIR, atlas, hemi=hemi)
         bad_vertices_hemi = []
         for regions_pair in neighbors_regions_for_cut:
@@ -927,11 +937,7 @@ def calc_labeles_contours(subject, atlas, hemi='both', min_nei_num=2, overwrite=
         else:
             return True
     if verts_neighbors_dict is None:
-        verts_neighbors_fname = op.join(MMVT_DIR, subject, 'verts_neighbors_{hemi}.pkl')
-        if not utils.both_hemi_files_exist(verts_neighbors_fname):
-            print('calc_labeles_contours: You should first run create_spatial_connectivity')
-            create_spatial_connectivity(subject)
-            return calc_labeles_contours(subject, atlas, overwrite=overwrite, verbose=verbose)
+        verts_neighbors_dict = load_verts_neighbors(subject)
     vertices_labels_lookup = lu.create_vertices_labels_lookup(
         subject, atlas, False, overwrite, hemi=hemi, labels_dict=labels_dict, verts_dict=verts_dict,
         check_unknown=check_unknown, save_lookup=save_lookup)
@@ -942,10 +948,7 @@ def calc_labeles_contours(subject, atlas, hemi='both', min_nei_num=2, overwrite=
         else:
             verts = verts_dict[hemi]
         contours = np.zeros((len(verts)))
-        if verts_neighbors_dict is None:
-            vertices_neighbors = utils.load(verts_neighbors_fname.format(hemi=hemi))
-        else:
-            vertices_neighbors = verts_neighbors_dict[hemi]
+        vertices_neighbors = verts_neighbors_dict[hemi]
         # labels = lu.read_hemi_labels(subject, SUBJECTS_DIR, atlas, hemi)
         if labels_dict is None:
             labels = lu.read_labels(subject, SUBJECTS_DIR, atlas, hemi=hemi)
@@ -986,45 +989,36 @@ def calc_labeles_contours(subject, atlas, hemi='both', min_nei_num=2, overwrite=
 
 
 @utils.timeit
-def create_verts_faces_lookup(subject, surface_type='pial'):
-    output_fname = op.join(MMVT_DIR, subject, 'faces_verts_lookup_{}{}.pkl'.format(
-        '{hemi}', '' if surface_type == 'pial' else '{}_'.format(surface_type)))
-    if utils.both_hemi_files_exist(output_fname):
-        return {hemi:utils.load(output_fname.format(hemi=hemi)) for hemi in utils.HEMIS}
-
+def create_verts_faces_lookup(subject, surface_type='pial', overwrite=False):
+    subject_fol = op.join(MMVT_DIR, subject)
     for hemi in utils.HEMIS:
-        if op.isfile(output_fname.format(hemi=hemi)):
+        output_fname = tu.verts_faces_fname(subject_fol, hemi, surface_type)
+        if tu.csr_exists(output_fname) and not overwrite:
             continue
         verts, faces = utils.read_pial(subject, MMVT_DIR, hemi, surface_type)
-        lookup = defaultdict(list)
-        for f_ind, f in tqdm(enumerate(faces)):
-            for v_ind in f:
-                lookup[v_ind].append(f_ind)
-        utils.save(lookup, output_fname.format(hemi=hemi))
+        tu.save_csr(tu.calc_verts_faces(faces, len(verts)), output_fname)
+    return {hemi: tu.load_verts_faces(subject_fol, hemi, surface_type) for hemi in utils.HEMIS}
 
 
 @utils.timeit
 def calc_faces_contours(subject, atlas):
-    create_verts_faces_lookup(subject)
+    verts_faces_lookup = create_verts_faces_lookup(subject)
     vertices_labels_lookup = lu.create_vertices_labels_lookup(subject, atlas)
-    verts_neighbors_fname = op.join(MMVT_DIR, subject, 'verts_neighbors_{hemi}.pkl')
+    verts_neighbors = load_verts_neighbors(subject)
     contours_fname = op.join(MMVT_DIR, subject, 'labels', '{}_contours_{}.npz'.format(atlas, '{hemi}'))
-    # verts_faces_lookup_fname = op.join(MMVT_DIR, subject, 'faces_verts_{}.npy'.format('{hemi}'))
-    verts_faces_lookup_fname = op.join(MMVT_DIR, subject, 'faces_verts_lookup_{}.pkl'.format('{hemi}'))
     output_fname = op.join(MMVT_DIR, subject, 'contours_faces_{}.pkl'.format(atlas))
     contours_faces = dict(rh=set(), lh=set())
     for hemi in utils.HEMIS:
         contours_dict = np.load(contours_fname.format(hemi=hemi))
-        vertices_neighbors = np.load(verts_neighbors_fname.format(hemi=hemi))
-        verts_faces_lookup = utils.load(verts_faces_lookup_fname.format(hemi=hemi))
+        vertices_neighbors = verts_neighbors[hemi]
         contours_vertices = np.where(contours_dict['contours'])[0]
         for vert in tqdm(contours_vertices):
             vert_label = vertices_labels_lookup[hemi].get(vert, '')
-            vert_faces = verts_faces_lookup[vert]
+            vert_faces = verts_faces_lookup[hemi][vert]
             for vert_nei in vertices_neighbors[vert]:
                 nei_label = vertices_labels_lookup[hemi].get(vert_nei, '')
                 if vert_label != nei_label:
-                    nei_faces = verts_faces_lookup[vert_nei]
+                    nei_faces = verts_faces_lookup[hemi][vert_nei]
                     common_faces = set(vert_faces) & set(nei_faces)
                     contours_faces[hemi] |= common_faces
     utils.save(contours_faces, output_fname)
@@ -1604,6 +1598,48 @@ def mne_coregistration(subject):
     mne.gui.coregistration(subject=subject, subjects_dir=SUBJECTS_DIR)
 
 
+# The main's steps, their inputs and outputs, for running the subjects with --scheduler 1 (pipeline_utils)
+PIPELINE_STEPS = [
+    plu.Step('create_surfaces',
+             inputs=['{subjects_dir}/{subject}/surf/{hemi}.pial', '{subjects_dir}/{subject}/surf/{hemi}.inflated'],
+             outputs=['{mmvt_dir}/{subject}/surf/{hemi}.pial.ply', '{mmvt_dir}/{subject}/surf/{hemi}.pial.npz',
+                      '{mmvt_dir}/{subject}/surf/{hemi}.inflated.ply', '{mmvt_dir}/{subject}/surf/{hemi}.inflated.npz']),
+    plu.Step('create_annotation', outputs=['{subjects_dir}/{subject}/label/{hemi}.{atlas}.annot'], n_jobs=True),
+    plu.Step('parcelate_cortex', inputs=['{subjects_dir}/{subject}/label/{hemi}.{atlas}.annot'],
+             outputs=['{mmvt_dir}/{subject}/labels/{atlas}.pial.{hemi}/*.ply'], n_jobs=True),
+    plu.Step('subcortical', inputs=['{subjects_dir}/{subject}/mri/aseg.mgz'],
+             outputs=['{mmvt_dir}/{subject}/subcortical/*.ply'], n_jobs=True),
+    plu.Step('calc_faces_verts_dic',
+             inputs=['{mmvt_dir}/{subject}/surf/{hemi}.pial.npz', '{mmvt_dir}/{subject}/subcortical/*.ply',
+                     '{mmvt_dir}/{subject}/labels/{atlas}.pial.{hemi}/*.ply'],
+             outputs=['{mmvt_dir}/{subject}/faces_verts_{hemi}.npy']),
+    plu.Step('save_labels_vertices', inputs=['{subjects_dir}/{subject}/label/{hemi}.{atlas}.annot'],
+             outputs=['{mmvt_dir}/{subject}/labels_vertices_{atlas}.pkl']),
+    plu.Step('save_hemis_curv', inputs=['{subjects_dir}/{subject}/surf/{hemi}.curv'],
+             outputs=['{mmvt_dir}/{subject}/surf/{hemi}.curv.npy'], after=['create_annotation']),
+    plu.Step('create_high_level_atlas', after=['create_annotation']),
+    plu.Step('create_spatial_connectivity', inputs=['{mmvt_dir}/{subject}/surf/{hemi}.pial.ply'],
+             outputs=['{mmvt_dir}/{subject}/spatial_connectivity.pkl',
+                      '{mmvt_dir}/{subject}/topology/verts_neighbors_{hemi}_indptr.npy']),
+    plu.Step('calc_labeles_contours', inputs=['{subjects_dir}/{subject}/label/{hemi}.{atlas}.annot'],
+             outputs=['{mmvt_dir}/{subject}/labels/{atlas}_contours_{hemi}.npz']),
+    plu.Step('calc_labels_center_of_mass', inputs=['{subjects_dir}/{subject}/label/{hemi}.{atlas}.annot'],
+             outputs=['{subjects_dir}/{subject}/label/{atlas}_center_of_mass.pkl',
+                      '{mmvt_dir}/{subject}/{atlas}_center_of_mass.pkl']),
+    plu.Step('save_labels_coloring', inputs=['{subjects_dir}/{subject}/label/{hemi}.{atlas}.annot'],
+             outputs=['{mmvt_dir}/{subject}/coloring/labels_{atlas}_coloring.csv'], n_jobs=True),
+    plu.Step('save_subject_orig_trans', inputs=['{subjects_dir}/{subject}/mri/T1.mgz'],
+             outputs=['{mmvt_dir}/{subject}/t1_trans.npz']),
+    plu.Step('save_images_data_and_header', inputs=['{subjects_dir}/{subject}/mri/T1.mgz'],
+             outputs=['{mmvt_dir}/{subject}/freeview/mri_data.npz']),
+    plu.Step('create_pial_volume_mask', inputs=['{mmvt_dir}/{subject}/surf/{hemi}.pial.ply'],
+             outputs=['{mmvt_dir}/{subject}/freeview/pial_vol_mask.npy']),
+    plu.Step('create_new_subject_blend_file',
+             after=['create_surfaces', 'parcelate_cortex', 'subcortical', 'calc_faces_verts_dic',
+                    'save_labels_vertices', 'create_spatial_connectivity', 'save_labels_coloring']),
+]
+
+
 def call_main(args):
     pu.run_on_subjects(args, main)
 
@@ -25,6 +25,7 @@ STAT_AVG, STAT_DIFF = range(2)
 STAT_NAME = {STAT_DIFF: 'diff', STAT_AVG: 'avg'}
 HEMIS_WITHIN, HEMIS_BETWEEN = range(2)
 ROIS_TYPE, ELECTRODES_TYPE = range(2)
+SEED_CORR_CHUNK_SIZE = 10000
 
 #todo: Add the necessary parameters
 # args.conditions, args.mat_fname, args.t_max, args.stat, args.threshold)
@@ -337,6 +338,7 @@ def calc_lables_connectivity(subject, labels_extract_mode, args):
             (data.ndim == 3 and len(conditions) == data.shape[2]):
         # No windows yet
         windows = calc_windows(data.shape[1], args.windows_length, args.windows_shift)
+        windows_num = len(windows)
         # import math
         # T = data.shape[1] # If this is fMRI data, the real T is T*tr
         # if args.windows_length == 0:
@@ -361,6 +363,54 @@ def calc_lables_connectivity(subject, labels_extract_mode, args):
     output_fname = get_output_fname(
         subject, args.connectivity_method[0], args.connectivity_modality, labels_extract_mode, identifier)
     output_mat_fname = get_output_mat_fname(args.connectivity_method[0], labels_extract_mode)
+    if args.stream_connectivity and 'corr' in args.connectivity_method and data.ndim == 2 and \
+            not labels_extract_mode.startswith('pca_') and windows_num > 1:
+        # Streaming mode: the windows are written one by one to a windows major memmap, and the summaries are
+        # calculated on the fly, without holding the (labels, labels, windows) tensor in memory
+        windows_mat_fname = utils.add_str_to_file_name(output_mat_fname, '_windows')
+        backup(windows_mat_fname)
+        print('Streaming the windows correlation into {}'.format(windows_mat_fname))
+        summary = calc_corr_windows_stream(
+            data, windows[:windows_num], windows_mat_fname, args.stream_upper_triangle,
+            degree_threshold=args.connectivity_threshold, recalc_every=args.stream_recalc_every)
+        abs_minmax = summary['abs_minmax']
+        for hemi in utils.HEMIS:
+            inds = labels_hemi_indices[hemi]
+            backup(labels_avg_output_fname.format(hemi=hemi))
+            np.savez(labels_avg_output_fname.format(hemi=hemi), data=summary['labels_avg'][inds],
+                     names=labels_names[inds], conditions=conditions, minmax=[-abs_minmax, abs_minmax])
+        if len(labels_subs_indices) > 0:
+            inds = labels_subs_indices
+            backup(subs_avg_output_fname)
+            np.savez(subs_avg_output_fname, data=summary['labels_avg'][inds], names=labels_names[inds],
+                     conditions=conditions, minmax=[-abs_minmax, abs_minmax])
+        if 'cv' in args.connectivity_method:
+            backup(static_output_mat_fname)
+            print('Saving {}, {}'.format(static_output_mat_fname, summary['static_conn'].shape))
+            np.savez(static_output_mat_fname, static_conn=summary['static_conn'], conn_std=summary['conn_std'])
+            dFC = np.nanmean(summary['static_conn'], 1)
+            std_mean = np.nanmean(summary['conn_std'], 1)
+            stat_conn = np.nanmean(summary['abs_mean'], 1)
+            backup(static_mean_output_mat_fname)
+            print('Saving {}, {}'.format(static_mean_output_mat_fname, std_mean.shape))
+            np.savez(static_mean_output_mat_fname, dFC=dFC, std_mean=std_mean, stat_conn=stat_conn)
+            lu.create_labels_coloring(subject, labels_names, dFC, '{}_{}_cv_mean'.format(
+                args.connectivity_modality, args.connectivity_method[0]), norm_percs=(1, 99),
+                norm_by_percentile=True, colors_map='YlOrRd')
+        np.save(conn_mean_mat_fname, summary['conn_mean'])
+        degree_fname = utils.add_str_to_file_name(
+            output_mat_fname, '_{}_degree'.format(str(args.connectivity_threshold)))
+        print('Saving {}, {}'.format(degree_fname, summary['degree'].shape))
+        np.save(degree_fname, summary['degree'])
+        if not args.save_mmvt_connectivity:
+            return op.isfile(windows_mat_fname)
+        # The MMVT connectivity file is read from the windows memmap
+        save_connectivity(
+            subject, None, args.atlas, args.connectivity_method, ROIS_TYPE, labels_names, conditions, output_fname,
+            stat=args.stat, norm_by_percentile=args.norm_by_percentile, norm_percs=args.norm_percs,
+            threshold=args.threshold, threshold_percentile=args.threshold_percentile,
+            symetric_colors=args.symetric_colors, windows_mat_fname=windows_mat_fname)
+        return op.isfile(windows_mat_fname) and op.isfile(output_fname)
     static_conn = None
     if op.isfile(output_mat_fname) and not args.recalc_connectivity:
         conn = np.load(output_mat_fname)
@@ -386,21 +436,10 @@ def calc_lables_connectivity(subject, labels_extract_mode, args):
                     conn[:, :, w] = np.corrcoef(data[:, :, w])
             else:
                 if not labels_extract_mode.startswith('pca_'):
-                    for w in range(windows_num):
-                        conn[:, :, w] = np.corrcoef(data[:, windows[w, 0]:windows[w, 1]])
-                        np.fill_diagonal(conn[:, :, w], 0)
+                    conn = corr_windows(get_windows_data(data, windows[:windows_num]))
                 else:
-                    params = []
                     for w in range(windows_num):
-                        w1, w2 = int(windows[w, 0]), int(windows[w, 1])
-                        data_w = data[:, w1:w2]
-                        params.append((data_w, comps_num))
-                    # params = [(data, w, windows, comps_num) for w in range(windows_num)]
-                    chunks = utils.chunks(list(enumerate(params)), windows_num / args.n_jobs)
-                    results = utils.run_parallel(_corr_matrix_parallel, chunks, args.n_jobs)
-                    for chunk in results:
-                        for w, con in chunk.items():
-                            conn[:, :, w] = con
+                        conn[:, :, w] = corr_matrix(data[:, windows[w, 0]:windows[w, 1]], comps_num)
             if conn.shape[2] == 1:
                 conn = conn.squeeze()
             backup(output_mat_fname)
@@ -415,20 +454,11 @@ def calc_lables_connectivity(subject, labels_extract_mode, args):
             for cond_ind, cond_name in enumerate(conditions):
                 if data.ndim == 4:
                     cond_data = data[:, :, : cond_ind]
-                    conn_data = np.transpose(cond_data, [2, 1, 0])
+                    conn_data = np.transpose(cond_data, [2, 0, 1])
                 elif data.ndim == 3:
                     cond_data = data[:, :, cond_ind]
-                    conn_data = np.zeros((windows_num, cond_data.shape[0], args.windows_length))
-                    for w in range(windows_num):
-                        conn_data[w] = cond_data[:, windows[w, 0]:windows[w, 1]]
-                indices = np.array_split(np.arange(windows_num), args.n_jobs)
-                # chunks = utils.chunks(list(enumerate(conn_data)), windows_num / args.n_jobs)
-                chunks = [(conn_data[chunk_indices], chunk_indices, len(labels_names), args.windows_length)
-                      for chunk_indices in indices]
-                results = utils.run_parallel(_pli_parallel, chunks, args.n_jobs)
-                for chunk in results:
-                    for w, con in chunk.items():
-                        conn[:, :, w, cond_ind] = con
+                    conn_data = get_windows_data(cond_data, windows[:windows_num])
+                conn[:, :, :, cond_ind] = pli_windows(conn_data)
                 # output_mat_fname = op.join(utils.get_parent_fol(output_fname), '{}_{}.npy'.format(
                 #     utils.namebase(output_mat_fname), cond_name))
                 backup(output_mat_fname)
@@ -457,7 +487,6 @@ def calc_lables_connectivity(subject, labels_extract_mode, args):
 
         if 'mi' in args.connectivity_method or 'mi_vec' in args.connectivity_method:
             conn = np.zeros((data.shape[0], data.shape[0], windows_num))
-            corr = np.zeros((data.shape[0], data.shape[0], windows_num))
             # corr_fname = get_output_mat_fname('corr', labels_extract_mode)
             # if op.isfile(corr_fname):
             #     corr = np.load(get_output_mat_fname('corr', labels_extract_mode))
@@ -466,21 +495,13 @@ def calc_lables_connectivity(subject, labels_extract_mode, args):
             #     new_args.connectivity_method = ['corr']
             #     calc_lables_connectivity(subject, labels_extract_mode, new_args)
             #     corr = np.load(get_output_mat_fname('corr', labels_extract_mode))
-            for w in range(windows_num):
-                corr[:, :, w] = np.corrcoef(data[:, windows[w, 0]:windows[w, 1]])
-                np.fill_diagonal(corr[:, :, w], 0)
+            corr = corr_windows(get_windows_data(data, windows[:windows_num]))
             if 'mi' in args.connectivity_method or 'mi_vec' in args.connectivity_method and corr.ndim == 3:
                 conn_fname = get_output_mat_fname('mi', labels_extract_mode)
                 if op.isfile(conn_fname) and not args.recalc_connectivity:
                     conn = np.load(conn_fname)
                 if not op.isfile(conn_fname) or conn.shape[0] != data.shape[0] or args.recalc_connectivity:
-                    conn = np.zeros(corr.shape)
-                    params = [(corr[:, :, w]) for w in range(windows_num)]
-                    chunks = utils.chunks(list(enumerate(params)), windows_num / args.n_jobs)
-                    results = utils.run_parallel(_mi_parallel, chunks, args.n_jobs)
-                    for chunk in results:
-                        for w, con in chunk.items():
-                            conn[:, :, w] = con
+                    conn = mi(corr)
                     backup(conn_fname)
                     np.save(conn_fname, conn)
             if 'mi_vec' in args.connectivity_method and corr.ndim == 5:
@@ -489,14 +510,7 @@ def calc_lables_connectivity(subject, labels_extract_mode, args):
                     conn = np.load(conn_fname)
                 if not op.isfile(conn_fname) or conn.shape[0] != data.shape[0]:
                     # comps_num = int(labels_extract_mode.split('_')[1])
-                    dims = (data.shape[0], data.shape[0], windows_num)
-                    conn = np.zeros(dims)
-                    params = [(corr[:, :, w]) for w in range(windows_num)]
-                    chunks = utils.chunks(list(enumerate(params)), windows_num / args.n_jobs)
-                    results = utils.run_parallel(_mi_vec_parallel, chunks, args.n_jobs)
-                    for chunk in results:
-                        for w, con in chunk.items():
-                            conn[:, :, w] = con
+                    conn = mi_vec(corr)
                     backup(conn_fname)
                     np.save(conn_fname, conn)
             connectivity_method = 'MI'
@@ -582,40 +596,148 @@ def calc_lables_connectivity(subject, labels_extract_mode, args):
     return ret
 
 
+def get_windows_data(data, windows):
+    # Returns the windows data (windows x channels x time). If the windows are evenly spaced (like the ones
+    # calc_windows creates), it's a read only strided view of the data, so nothing is copied.
+    windows = np.array(windows, dtype=int)
+    lengths, shifts = windows[:, 1] - windows[:, 0], np.diff(windows[:, 0])
+    if np.all(lengths == lengths[0]) and np.all(shifts == shifts[:1]) and windows[-1, 1] <= data.shape[1]:
+        shift = shifts[0] if len(shifts) > 0 else 0
+        return np.lib.stride_tricks.as_strided(
+            data[:, windows[0, 0]:], shape=(len(windows), data.shape[0], lengths[0]),
+            strides=(shift * data.strides[1], data.strides[0], data.strides[1]), writeable=False)
+    else:
+        return np.array([data[:, w1:w2] for w1, w2 in windows])
+
+
+def corr_windows(windows_data, fill_diagonal=True, max_elements=1e8):
+    # Pearson correlation of all the channels pairs in all the windows (windows_data: windows x channels x time)
+    # Returns a channels x channels x windows matrix, like calling np.corrcoef for every window.
+    windows_num, channels_num, window_length = windows_data.shape
+    conn = np.zeros((channels_num, channels_num, windows_num))
+    chunk_size = max(1, int(max_elements // (channels_num * window_length)))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for w1 in range(0, windows_num, chunk_size):
+            w2 = min(windows_num, w1 + chunk_size)
+            x = np.array(windows_data[w1:w2], dtype=np.float64)
+            x -= np.mean(x, axis=2, keepdims=True)
+            cov = np.matmul(x, np.transpose(x, (0, 2, 1)))
+            std = np.sqrt(np.diagonal(cov, axis1=1, axis2=2))
+            corr = cov / std[:, :, np.newaxis] / std[:, np.newaxis, :]
+            np.clip(corr, -1, 1, out=corr)
+            conn[:, :, w1:w2] = np.transpose(corr, (1, 2, 0))
+    if fill_diagonal:
+        conn[np.arange(channels_num), np.arange(channels_num)] = 0
+    return conn
+
+
+def corr_windows_generator(data, windows, upper_triangle=False, dtype=np.float64, recalc_every=1000):
+    # Yields (window index, correlation matrix) for every window, with zeros on the diagonal. Instead of calling
+    # np.corrcoef for every window, the running sums (sum(x), sum(x*y)) are updated only with the samples that
+    # enter and leave the window. The sums are recalculated from scratch every recalc_every windows, or when
+    # the windows don't overlap. If upper_triangle is True, only the upper triangle values are yielded.
+    # The data is centered first, which doesn't change the correlations but keeps the sums small.
+    data = np.array(data, dtype=np.float64)
+    data -= np.mean(data, axis=1, keepdims=True)
+    channels_num = data.shape[0]
+    upper_indices = np.triu_indices(channels_num, 1)
+    diag = np.arange(channels_num)
+    sum_x, sum_xy, prev_window = None, None, None
+    for w, (w1, w2) in enumerate(windows):
+        if prev_window is None or w % recalc_every == 0 or not prev_window[0] <= w1 < prev_window[1] or \
+                w2 < prev_window[1]:
+            x = data[:, w1:w2]
+            sum_x, sum_xy = np.sum(x, axis=1), np.dot(x, x.T)
+        else:
+            x_out, x_in = data[:, prev_window[0]:w1], data[:, prev_window[1]:w2]
+            sum_x += np.sum(x_in, axis=1) - np.sum(x_out, axis=1)
+            sum_xy += np.dot(x_in, x_in.T) - np.dot(x_out, x_out.T)
+        prev_window = (w1, w2)
+        cov = sum_xy - np.outer(sum_x, sum_x) / (w2 - w1)
+        std = np.sqrt(np.maximum(np.diag(cov), 0))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            corr = cov / std[:, np.newaxis] / std[np.newaxis, :]
+        np.clip(corr, -1, 1, out=corr)
+        corr[diag, diag] = 0
+        corr = corr[upper_indices] if upper_triangle else corr
+        yield w, corr.astype(dtype, copy=False)
+
+
+def calc_corr_windows_stream(data, windows, output_fname='', upper_triangle=True, dtype=np.float32,
+                             degree_threshold=0.7, recalc_every=1000):
+    # Calculates the sliding windows correlation without holding all the windows in memory. Every window is
+    # written (if output_fname is set) to a windows major memmap (windows x pairs if upper_triangle, otherwise
+    # windows x channels x channels), and the summaries are calculated on the fly:
+    # conn_mean, conn_std and abs_mean (over windows, nan ignored), static_conn (the CV: std / mean(abs)),
+    # labels_avg and degree (channels x windows), and abs_minmax.
+    channels_num, windows_num = data.shape[0], len(windows)
+    upper_indices = np.triu_indices(channels_num, 1)
+    store = None
+    if output_fname != '':
+        shape = (windows_num, len(upper_indices[0])) if upper_triangle else (windows_num, channels_num, channels_num)
+        store = np.lib.format.open_memmap(output_fname, mode='w+', dtype=dtype, shape=shape)
+    n = np.zeros((channels_num, channels_num))
+    conn_mean, m2, abs_sum = np.zeros(n.shape), np.zeros(n.shape), np.zeros(n.shape)
+    labels_avg = np.zeros((channels_num, windows_num))
+    degree = np.zeros((channels_num, windows_num), dtype=int)
+    abs_max = 0
+    for w, corr in tqdm(corr_windows_generator(data, windows, recalc_every=recalc_every), total=windows_num):
+        if store is not None:
+            store[w] = corr[upper_indices] if upper_triangle else corr
+        labels_avg[:, w] = np.mean(corr, 0)
+        valid = ~np.isnan(corr)
+        degree[:, w] = np.sum(np.where(valid, corr, 0) > degree_threshold, 1)
+        # Welford's online mean and variance
+        n += valid
+        delta = np.where(valid, corr - conn_mean, 0)
+        conn_mean += delta / np.maximum(n, 1)
+        m2 += delta * np.where(valid, corr - conn_mean, 0)
+        abs_sum += np.where(valid, np.abs(corr), 0)
+        if np.any(valid):
+            abs_max = max(abs_max, np.max(np.abs(corr[valid])))
+    if store is not None:
+        store.flush()
+        del store
+    with np.errstate(divide='ignore', invalid='ignore'):
+        conn_std = np.sqrt(m2 / n)
+        abs_mean = abs_sum / n
+        static_conn = conn_std / abs_mean
+    np.fill_diagonal(static_conn, 0)
+    return dict(conn_mean=conn_mean, conn_std=conn_std, static_conn=static_conn, abs_mean=abs_mean,
+                labels_avg=labels_avg, degree=degree, abs_minmax=abs_max)
+
+
+def pli_windows(windows_data, max_elements=1e7):
+    # Phase lag index of all the channels pairs in all the windows (windows_data: windows x channels x time)
+    # The analytic signal is calculated once for all the windows, and then the sign of the imaginary part of the
+    # cross spectrum is averaged over time for blocks of channels, to keep the memory bounded.
+    from scipy.signal import hilbert
+    windows_num, channels_num, window_length = windows_data.shape
+    data_hil = hilbert(windows_data, axis=-1)
+    conn = np.zeros((channels_num, channels_num, windows_num))
+    windows_chunk = max(1, min(windows_num, int(max_elements // (channels_num * window_length))))
+    for w1 in range(0, windows_num, windows_chunk):
+        w2 = min(windows_num, w1 + windows_chunk)
+        rows_chunk = max(1, int(max_elements // ((w2 - w1) * channels_num * window_length)))
+        for i1 in range(0, channels_num, rows_chunk):
+            i2 = min(channels_num, i1 + rows_chunk)
+            # sign(imag(x / y)) == sign(imag(x * conj(y)))
+            cross = data_hil[w1:w2, i1:i2, np.newaxis] * np.conj(data_hil[w1:w2, np.newaxis])
+            conn[i1:i2, :, w1:w2] = np.transpose(np.abs(np.mean(np.sign(np.imag(cross)), axis=-1)), (1, 2, 0))
+    conn[np.arange(channels_num), np.arange(channels_num)] = 0
+    return conn
+
+
 def pli(data, channels_num, window_length):
     try:
-        from scipy.signal import hilbert
         if data.shape[0] != channels_num:
             data = data.T
-        data_hil = hilbert(data)
-        # if data_hil.shape != (channels_num, window_length):
-        #     raise Exception('PLI: Wrong dimentions!')
-        m = np.zeros((channels_num, channels_num))
-        for i in range(channels_num):
-            for j in range(channels_num):
-                if i < j:
-                    m[i, j] = abs(np.mean(np.sign(np.imag(data_hil[i] / data_hil[j]))))
-                    # m[i, j] = abs(np.mean(np.sign(np.imag(data_hil[:, i] / data_hil[:, j]))))
-        return m + m.T
+        return pli_windows(data[np.newaxis])[:, :, 0]
     except:
         print(traceback.format_exc())
         return None
 
 
-def _pli_parallel(p):
-    res = {}
-    conn_data, indices, channels_num, window_length = p
-    # for window_ind, window in windows_chunk:
-    for window_ind, window in zip(indices, conn_data):
-        print('PLI: Window ind {}'.format(window_ind))
-        pli_val = pli(window, channels_num, window_length)
-        if not pli_val is None:
-            res[window_ind] = pli_val
-        else:
-            print('Error in PLI! windowsw ind {}'.format(window_ind))
-    return res
-
-
 def _coh_parallel(p):
     res = {}
     conn_data, indices, sfreq, bands = p
@@ -641,72 +763,55 @@ def coherence(data, sfreq, fmin, fmax):
 
 
 def corr_matrix(data, comps_num):
-    corr = np.zeros((data.shape[0], data.shape[0], comps_num * 2, comps_num * 2))
-    # w1, w2 = int(windows[w, 0]), int(windows[w, 1])
-    for i in range(data.shape[0]):
-        for j in range(data.shape[0]):
-            if i < j:
-                corr[i, j] = np.corrcoef(data[i].T, data[j].T)
-    for i in range(data.shape[0]):
-        for j in range(data.shape[0]):
-            if i > j:
-                corr[i, j] = corr[j, i]
+    # data: labels x time x comps. corr[i, j] is np.corrcoef(data[i].T, data[j].T) for i < j, and corr[j, i]
+    # for i > j. All the pairs are taken from one correlation matrix of all the labels components.
+    labels_num = data.shape[0]
+    comps = np.transpose(data, (0, 2, 1)).reshape((labels_num * comps_num, -1))
+    all_corr = np.corrcoef(comps).reshape((labels_num, comps_num, labels_num, comps_num))
+    diag_blocks = all_corr[np.arange(labels_num), :, np.arange(labels_num), :]
+    off_blocks = np.transpose(all_corr, (0, 2, 1, 3))
+    corr = np.zeros((labels_num, labels_num, comps_num * 2, comps_num * 2))
+    corr[:, :, :comps_num, :comps_num] = diag_blocks[:, np.newaxis]
+    corr[:, :, :comps_num, comps_num:] = off_blocks
+    corr[:, :, comps_num:, :comps_num] = np.transpose(off_blocks, (1, 0, 2, 3))
+    corr[:, :, comps_num:, comps_num:] = diag_blocks[np.newaxis, :]
+    lower = np.tril_indices(labels_num)
+    corr[lower] = np.transpose(corr, (1, 0, 2, 3))[lower]
+    corr[np.arange(labels_num), np.arange(labels_num)] = 0
     return corr
 
 
-def _corr_matrix_parallel(windows_chunk):
-    res = {}
-    for window_ind, window in windows_chunk:
-        print('_corr_matrix_parallel: window ind {}'.format(window_ind))
-        data_w, comps_num = window
-        res[window_ind] = corr_matrix(data_w, comps_num)
-    return res
+def _symmetric_from_upper(conn):
+    # Keeps only the upper triangle (over the first two axes) and mirrors it
+    nch = conn.shape[0]
+    upper = np.triu(np.ones((nch, nch), dtype=bool), 1).reshape((nch, nch) + (1,) * (conn.ndim - 2))
+    conn = np.where(upper, conn, 0)
+    return conn + np.swapaxes(conn, 0, 1)
 
 
 def mi(conn_w):
-    nch = conn_w.shape[0]
-    conn = np.zeros((nch, nch))
-    for i in range(nch):
-        for j in range(nch):
-            if i < j:
-                conn[i, j] = -0.5 * np.log(1 - conn_w[i, j] ** 2)
-    conn = conn + conn.T
-    return conn
-
-
-def _mi_parallel(windows_chunk):
-    res = {}
-    for window_ind, corr_w in windows_chunk:
-        print('_mi_parallel: window ind {}'.format(window_ind))
-        res[window_ind] = mi(corr_w)
-    return res
+    # conn_w: channels x channels (x windows) correlation matrix
+    with np.errstate(divide='ignore'):
+        conn = -0.5 * np.log(1 - conn_w ** 2)
+    return _symmetric_from_upper(conn)
 
 
 def mi_vec(corr_w):
-    nch = corr_w.shape[0]
-    conn = np.zeros((nch, nch))
-    for i in range(nch):
-        for j in range(nch):
-            if i < j:
-                conn[i, j] = -0.5 * np.log(np.linalg.norm(
-                    np.eye(corr_w.shape[3]) - corr_w[i, j] * corr_w[i, j].T))
-    conn = conn + conn.T
-    return conn
-
-
-def _mi_vec_parallel(windows_chunk):
-    res = {}
-    for window_ind, corr_w in windows_chunk:
-        print('_mi_vec_parallel: window ind {}'.format(window_ind))
-        res[window_ind] = mi_vec(corr_w)
-    return res
+    # corr_w: channels x channels (x windows) x comps x comps correlation matrices (see corr_matrix)
+    eye = np.eye(corr_w.shape[-1])
+    norms = np.linalg.norm(eye - corr_w * np.swapaxes(corr_w, -1, -2), axis=(-2, -1))
+    with np.errstate(divide='ignore'):
+        conn = -0.5 * np.log(norms)
+    return _symmetric_from_upper(conn)
 
 
 @utils.tryit()
 def save_connectivity(subject, conn, atlas, connectivity_method, obj_type, labels_names, conditions, output_fname,
                       windows=0, stat=STAT_DIFF, norm_by_percentile=True, norm_percs=[1, 99],
                       threshold=0, threshold_percentile=0, symetric_colors=True, labels=None, locations=None,
-                      hemis=None, symetric_con=True, reduce_to_3d=False):
+                      hemis=None, symetric_con=True, reduce_to_3d=False, windows_mat_fname=''):
+    # If windows_mat_fname is set (the windows memmap of calc_corr_windows_stream), the connectivity is read from it
+    # instead of conn
     d = dict()
     d['conditions'] = conditions
     # args.labels_exclude = []
@@ -729,15 +834,19 @@ def save_connectivity(subject, conn, atlas, connectivity_method, obj_type, label
                 print(wrong_assigments)
     else:
         d['labels'], d['locations'], d['hemis'] = labels, locations, hemis
+    if windows_mat_fname != '':
+        calc_con = lambda pick_lower_inds, threshold: calc_connectivity_from_windows_store(
+            windows_mat_fname, d['labels'], d['hemis'], stat, norm_by_percentile, norm_percs, threshold,
+            threshold_percentile, symetric_colors, pick_lower_inds)
+    else:
+        calc_con = lambda pick_lower_inds, threshold: calc_connectivity(
+            conn, d['labels'], d['hemis'], conditions, windows, stat, norm_by_percentile, norm_percs, threshold,
+            threshold_percentile, symetric_colors, pick_lower_inds)
     (_, d['con_indices'], d['con_names'], d['con_values'], d['con_types'],
-     d['data_max'], d['data_min'], threshold) = calc_connectivity(
-        conn, d['labels'], d['hemis'], conditions, windows, stat, norm_by_percentile, norm_percs, threshold,
-        threshold_percentile, symetric_colors)
+     d['data_max'], d['data_min'], threshold) = calc_con(True, threshold)
     if not symetric_con:
         (_, d['con_indices2'], d['con_names2'], d['con_values2'], d['con_types2'],
-         d['data_max2'], d['data_min2'], threshold) = calc_connectivity(
-            conn, d['labels'], d['hemis'], conditions, windows, stat, norm_by_percentile, norm_percs, threshold,
-            threshold_percentile, symetric_colors, False)
+         d['data_max2'], d['data_min2'], threshold) = calc_con(False, threshold)
     d['connectivity_method'] = connectivity_method
     d['vertices'], d['vertices_lookup'] = create_vertices_lookup(d['con_indices'], d['con_names'], d['labels'])
     if reduce_to_3d:
@@ -825,8 +934,6 @@ def calc_connectivity(data, labels, hemis, conditions='', windows=0, stat=STAT_D
     else:
         conds_len = len(conditions) if conditions != '' else 1
     con_values = np.zeros((L, W, conds_len))
-    con_names = [None] * L
-    con_type = np.zeros((L))
     rec_indices = list(utils.lower_rec_indices(M)) if pick_lower_inds else list(utils.upper_rec_indices(M))
     data[np.where(np.isnan(data))] = 0
     for cond in range(conds_len):
@@ -839,13 +946,44 @@ def calc_connectivity(data, labels, hemis, conditions='', windows=0, stat=STAT_D
                 con_values[:, w, cond] = [data[i, j, cond] for i, j in rec_indices]
             else:
                 con_values[:, w, cond] = [data[i, j] for i, j in rec_indices]
-    if conds_len == 2:
+    return calc_connectivity_info(con_values, rec_indices, labels, hemis, stat, norm_by_percentile, norm_percs,
+                                  threshold, threshold_percentile, symetric_colors)
+
+
+def calc_connectivity_from_windows_store(windows_mat_fname, labels, hemis, stat=STAT_DIFF, norm_by_percentile=True,
+                                         norm_percs=[1, 99], threshold=0, threshold_percentile=0,
+                                         symetric_colors=True, pick_lower_inds=True):
+    # Like calc_connectivity, for the windows major memmap of calc_corr_windows_stream (windows x the upper
+    # triangle pairs, or windows x channels x channels), without building the channels x channels x windows tensor
+    store = np.load(windows_mat_fname, mmap_mode='r')
+    M = len(labels)
+    rec_indices = list(utils.lower_rec_indices(M)) if pick_lower_inds else list(utils.upper_rec_indices(M))
+    rows, cols = np.array(rec_indices, dtype=int).reshape((-1, 2)).T
+    if store.ndim == 2:
+        # The correlation is symmetric, so (i, j) and (j, i) are the same pair
+        pairs_indices = np.zeros((M, M), dtype=int)
+        pairs_indices[np.triu_indices(M, 1)] = np.arange(store.shape[1])
+        pairs_indices += pairs_indices.T
+        con_values = np.array(store[:, pairs_indices[rows, cols]], dtype=np.float64).T
+    else:
+        con_values = np.array(store[:, rows, cols], dtype=np.float64).T
+    con_values[np.isnan(con_values)] = 0
+    return calc_connectivity_info(con_values[:, :, np.newaxis], rec_indices, labels, hemis, stat,
+                                  norm_by_percentile, norm_percs, threshold, threshold_percentile, symetric_colors)
+
+
+def calc_connectivity_info(con_values, rec_indices, labels, hemis, stat=STAT_DIFF, norm_by_percentile=True,
+                           norm_percs=[1, 99], threshold=0, threshold_percentile=0, symetric_colors=True):
+    # con_values: pairs (rec_indices) x windows x conditions
+    con_names = [None] * len(rec_indices)
+    con_type = np.zeros((len(rec_indices)))
+    if con_values.shape[2] == 2:
         stat_data = utils.calc_stat_data(con_values, stat)
     else:
         stat_data = np.squeeze(con_values)
 
     con_indices = np.array(rec_indices)
-    for ind, (i, j) in enumerate(utils.lower_rec_indices(M) if pick_lower_inds else utils.upper_rec_indices(M)):
+    for ind, (i, j) in enumerate(rec_indices):
         try:
             con_names[ind] = '{}-{}'.format(labels[i], labels[j])
             con_type[ind] = HEMIS_WITHIN if hemis[i] == hemis[j] else HEMIS_BETWEEN
@@ -946,13 +1084,8 @@ def calc_electrodes_rest_connectivity(subject, args):
             windows_num = min(args.max_windows_num, windows_num)
 
         # pli_wins = 1
-        conn = np.zeros((E, E, windows_num))
         conn_data = conn_data[:windows_num]
-        chunks = utils.chunks(list(enumerate(conn_data)), windows_num / args.n_jobs)
-        results = utils.run_parallel(_pli_parallel, chunks, args.n_jobs)
-        for chunk in results:
-            for w, con in chunk.items():
-                conn[:, :, w] = con
+        conn = pli_windows(conn_data)
 
         # five_cycle_freq = 5. * args.sfreq / float(conn_data.shape[2])
         # for w in range(windows_num - pli_wins):
@@ -989,11 +1122,12 @@ def calc_electrodes_rest_connectivity(subject, args):
 
 
 def calc_seed_corr(subject, atlas, identifier, labels_regex, new_label_name, new_label_r=5, overwrite=False,
-                        n_jobs=6):
+                        n_jobs=6, fisher_z=False, threshold=0, chunk_size=SEED_CORR_CHUNK_SIZE):
     new_label, hemi = get_new_label(
         subject, atlas, labels_regex, new_label_name, new_label_r, overwrite, n_jobs)
-    x = fmri.load_fmri_data_for_both_hemis(subject, identifier)
-    return calc_label_corr(subject, x, new_label, hemi, new_label_name, identifier, overwrite, n_jobs)
+    x, fmri_fname = fmri.load_fmri_data_for_both_hemis(subject, identifier, return_fname=True)
+    return calc_label_corr(subject, x, new_label, hemi, new_label_name, identifier, overwrite, n_jobs, fisher_z,
+                           threshold, chunk_size, fmri_fname)
 
 
 def get_new_label(subject, atlas, regex, new_label_name, new_label_r=5, overwrite=False, n_jobs=6):
@@ -1018,7 +1152,9 @@ def get_new_label(subject, atlas, regex, new_label_name, new_label_r=5, overwrit
     return new_label, selected_hemi
 
 
-def calc_label_corr(subject, x, label, hemi, label_name, identifier, overwrite=False, n_jobs=6):
+def calc_label_corr(subject, x, label, hemi, label_name, identifier, overwrite=False, n_jobs=6, fisher_z=False,
+                    threshold=0, chunk_size=SEED_CORR_CHUNK_SIZE, fmri_fname=''):
+    # fmri_fname is the template ({hemi}) of the fMRI files x was loaded from, for caching the z-scored data
     identifier = identifier if identifier != '' else '{}_'.format(identifier)
     output_fname_template = op.join(MMVT_DIR, subject, 'fmri', 'fmri_seed_{}_{}_{}.npy'.format(
         identifier, label_name, '{hemi}'))
@@ -1027,16 +1163,11 @@ def calc_label_corr(subject, x, label, hemi, label_name, identifier, overwrite=F
         print('All files already exist ({}, {})'.format(output_fname_template, minmax_fname))
         return True
     label_ts = np.mean(x[hemi][label.vertices, :], 0)
-    corr_min, corr_max = 0 , 0
+    zscored_x = get_zscored_fmri_data(subject, fmri_fname, x, overwrite, chunk_size)
+    corr_min, corr_max = 0, 0
     for hemi in utils.HEMIS:
-        verts_num = x[hemi].shape[0]
-        corr_vals = np.zeros((verts_num))
-        indices = np.array_split(np.arange(verts_num), n_jobs)
-        chunks = [(x[hemi][indices_chunk], indices_chunk, label_ts, thread) for thread, indices_chunk in enumerate(indices)]
-        for hemi_corr_chunk, indices_chunk in utils.run_parallel(_calc_label_corr, chunks, n_jobs):
-            corr_vals[indices_chunk] = hemi_corr_chunk
-        corr_vals[np.isnan(corr_vals)] = 0
-        np.save(output_fname_template.format(hemi=hemi), corr_vals)
+        corr_vals = calc_seeds_corr(
+            zscored_x[hemi], label_ts, output_fname_template.format(hemi=hemi), fisher_z, threshold, chunk_size)
         corr_min = min(corr_min, np.min(corr_vals))
         corr_max = max(corr_max, np.max(corr_vals))
     corr_minmax = utils.get_max_abs(corr_max, corr_min)
@@ -1045,13 +1176,104 @@ def calc_label_corr(subject, x, label, hemi, label_name, identifier, overwrite=F
     return utils.both_hemi_files_exist(output_fname_template) and op.isfile(minmax_fname)
 
 
-@utils.ignore_warnings
-def _calc_label_corr(p):
-    hemi_data, indices_chunk, label_ts, thread = p
-    hemi_corr = np.zeros((len(indices_chunk)))
-    for ind, v_ts in tqdm(enumerate(hemi_data), total=len(indices_chunk)):
-        hemi_corr[ind] = np.corrcoef(label_ts, v_ts)[0, 1]
-    return hemi_corr, indices_chunk
+def calc_atlas_seeds_corr(subject, atlas, identifier, labels_exclude=('unknown', 'corpuscallosum'), overwrite=False,
+                          fisher_z=False, threshold=0, chunk_size=SEED_CORR_CHUNK_SIZE, n_jobs=6):
+    # The correlation maps of all the atlas' labels (as seeds) in a single pass over the vertices. The maps are
+    # saved per hemi as vertices x labels, and the labels names and the maps min/max in the info file. They are
+    # saved in fmri/seeds_corr, so get_all_fmri_files won't take them as fMRI files
+    output_fol = op.join(MMVT_DIR, subject, 'fmri', 'seeds_corr')
+    output_fname_template = op.join(output_fol, 'seeds_{}_{}_{}.npy'.format(identifier, atlas, '{hemi}'))
+    info_fname = op.join(output_fol, 'seeds_{}_{}_info.pkl'.format(identifier, atlas))
+    if utils.both_hemi_files_exist(output_fname_template) and op.isfile(info_fname) and not overwrite:
+        print('All files already exist ({}, {})'.format(output_fname_template, info_fname))
+        return True
+    labels = lu.read_labels(subject, SUBJECTS_DIR, atlas, exclude=labels_exclude, n_jobs=n_jobs)
+    if len(labels) == 0:
+        print("Can't find the {} labels!".format(atlas))
+        return False
+    x, fmri_fname = fmri.load_fmri_data_for_both_hemis(subject, identifier, return_fname=True)
+    utils.make_dir(output_fol)
+    seeds_ts = np.array([np.mean(x[label.hemi][label.vertices, :], 0) for label in labels])
+    zscored_x = get_zscored_fmri_data(subject, fmri_fname, x, overwrite, chunk_size)
+    corr_min, corr_max = 0, 0
+    for hemi in utils.HEMIS:
+        corr_vals = calc_seeds_corr(
+            zscored_x[hemi], seeds_ts, output_fname_template.format(hemi=hemi), fisher_z, threshold, chunk_size)
+        corr_min = min(corr_min, np.min(corr_vals))
+        corr_max = max(corr_max, np.max(corr_vals))
+    corr_minmax = utils.get_max_abs(corr_max, corr_min)
+    utils.save(dict(names=[label.name for label in labels], minmax=(-corr_minmax, corr_minmax)), info_fname)
+    return utils.both_hemi_files_exist(output_fname_template) and op.isfile(info_fname)
+
+
+def zscore_ts(x, output_fname='', chunk_size=SEED_CORR_CHUNK_SIZE, dtype=np.float32):
+    # Centers every time series and scales it to a unit norm, so the dot product of two of them is their Pearson
+    # correlation. A constant time series is set to zeros. If output_fname is set, the results are written to it
+    # (npy) in chunks, and returned memory mapped
+    shape = (x.shape[0], int(np.prod(x.shape[1:])))
+    if output_fname != '':
+        zscored_x = np.lib.format.open_memmap(output_fname, mode='w+', dtype=dtype, shape=shape)
+    else:
+        zscored_x = np.zeros(shape, dtype=dtype)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for ind in range(0, shape[0], chunk_size):
+            chunk = np.array(x[ind:ind + chunk_size], dtype=np.float64).reshape((-1, shape[1]))
+            chunk -= np.mean(chunk, axis=1, keepdims=True)
+            norm = np.sqrt(np.sum(chunk ** 2, axis=1, keepdims=True))
+            zscored_x[ind:ind + chunk_size] = np.where(norm > 0, chunk / norm, 0)
+    if output_fname != '':
+        zscored_x.flush()
+        del zscored_x
+        zscored_x = np.load(output_fname, mmap_mode='r')
+    return zscored_x
+
+
+def get_zscored_fmri_data(subject, fmri_fname, x, overwrite=False, chunk_size=SEED_CORR_CHUNK_SIZE):
+    # The z-scored vertices time series of both hemis are saved once per fMRI file (fmri_fname, a {hemi} template)
+    # in fmri/cache, and again if the fMRI file was changed, and memory mapped. Without fmri_fname, they aren't saved
+    cache_fol = op.join(MMVT_DIR, subject, 'fmri', 'cache')
+    zscored_x = {}
+    for hemi in utils.HEMIS:
+        if fmri_fname == '':
+            zscored_x[hemi] = zscore_ts(x[hemi], chunk_size=chunk_size)
+            continue
+        hemi_fmri_fname = fmri_fname.format(hemi=hemi)
+        zscored_fname = op.join(cache_fol, 'zscored_{}.npy'.format(utils.namebase(hemi_fmri_fname)))
+        if op.isfile(zscored_fname) and not overwrite and \
+                (not op.isfile(hemi_fmri_fname) or op.getmtime(zscored_fname) >= op.getmtime(hemi_fmri_fname)):
+            zscored_x[hemi] = np.load(zscored_fname, mmap_mode='r')
+            if zscored_x[hemi].shape[0] == x[hemi].shape[0]:
+                continue
+        utils.make_dir(cache_fol)
+        zscored_x[hemi] = zscore_ts(x[hemi], zscored_fname, chunk_size)
+    return zscored_x
+
+
+def calc_seeds_corr(zscored_x, seeds_ts, output_fname='', fisher_z=False, threshold=0,
+                    chunk_size=SEED_CORR_CHUNK_SIZE, dtype=np.float32):
+    # The correlations of every vertex (zscored_x, from zscore_ts) with every seed (seeds_ts: seeds x time, or a
+    # single seed's time series), as one matrix product per vertices chunk. The results (vertices x seeds, or
+    # vertices for a single seed) are written chunk by chunk to output_fname (npy) if it's set. If fisher_z, the
+    # correlations are Fisher z transformed, and absolute values below the threshold are set to zero
+    single_seed = np.ndim(seeds_ts) == 1
+    zscored_seeds = zscore_ts(np.atleast_2d(seeds_ts), dtype=np.float64)
+    shape = (zscored_x.shape[0],) if single_seed else (zscored_x.shape[0], zscored_seeds.shape[0])
+    if output_fname != '':
+        corr_vals = np.lib.format.open_memmap(output_fname, mode='w+', dtype=dtype, shape=shape)
+    else:
+        corr_vals = np.zeros(shape, dtype=dtype)
+    for ind in range(0, zscored_x.shape[0], chunk_size):
+        corr = np.dot(np.asarray(zscored_x[ind:ind + chunk_size], dtype=np.float64), zscored_seeds.T)
+        corr[np.isnan(corr)] = 0
+        np.clip(corr, -1, 1, out=corr)
+        if fisher_z:
+            corr = np.arctanh(np.clip(corr, -1 + 1e-7, 1 - 1e-7))
+        if threshold > 0:
+            corr[np.abs(corr) < threshold] = 0
+        corr_vals[ind:ind + chunk_size] = corr[:, 0] if single_seed else corr
+    if output_fname != '':
+        corr_vals.flush()
+    return corr_vals
 
 
 def calc_fmri_corr_degree(subject, identifier='', threshold=0.7, connectivity_method='corr'):
@@ -1097,7 +1319,12 @@ def main(subject, remote_subject_dir, args, flags):
     if utils.should_run(args, 'calc_seed_corr'):
         flags['calc_seed_corr'] = calc_seed_corr(
             subject, args.atlas, args.identifier, args.labels_regex, args.seed_label_name, args.seed_label_r,
-            args.overwrite_seed_data, args.n_jobs)
+            args.overwrite_seed_data, args.n_jobs, args.seed_fisher_z, args.seed_threshold, args.seed_chunk_size)
+
+    if utils.should_run(args, 'calc_atlas_seeds_corr'):
+        flags['calc_atlas_seeds_corr'] = calc_atlas_seeds_corr(
+            subject, args.atlas, args.identifier, args.labels_exclude, args.overwrite_seed_data, args.seed_fisher_z,
+            args.seed_threshold, args.seed_chunk_size, args.n_jobs)
 
     if utils.should_run(args, 'calc_fmri_corr_degree'):
         flags['calc_fmri_corr_degree'] = calc_fmri_corr_degree(
@@ -1155,11 +1382,18 @@ def read_cmd_args(argv=None):
     parser.add_argument('--backup_existing_files', help='', required=False, default=1, type=au.is_true)
     parser.add_argument('--identifier', help='', required=False, default='')
     parser.add_argument('--connectivity_threshold', help='', required=False, default=0.7, type=float)
+    parser.add_argument('--stream_connectivity', help='', required=False, default=0, type=au.is_true)
+    parser.add_argument('--stream_upper_triangle', help='', required=False, default=1, type=au.is_true)
+    parser.add_argument('--stream_recalc_every', help='', required=False, default=1000, type=int)
 
     parser.add_argument('--labels_regex', help='labels regex', required=False, default='post*cingulate*rh')
     parser.add_argument('--seed_label_name', help='', required=False, default='posterior_cingulate_rh')
     parser.add_argument('--seed_label_r', help='', required=False, default=5, type=int)
     parser.add_argument('--overwrite_seed_data', help='', required=False, default=0, type=au.is_true)
+    parser.add_argument('--seed_fisher_z', help='', required=False, default=0, type=au.is_true)
+    parser.add_argument('--seed_threshold', help='', required=False, default=0, type=float)
+    parser.add_argument('--seed_chunk_size', help='vertices per chunk', required=False, default=SEED_CORR_CHUNK_SIZE,
+                        type=int)
 
     pu.add_common_args(parser)
     args = utils.Bag(au.parse_parser(parser, argv))
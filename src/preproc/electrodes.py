@@ -21,6 +21,7 @@ from src.utils import utils
 from src.mmvt_addon import colors_utils as cu
 from src.utils import matlab_utils as mu
 from src.utils import preproc_utils as pu
+from src.utils import pipeline_utils as plu
 from src.utils import geometry_utils as gu
 from src.utils import labels_utils as lu
 from src.utils import args_utils as au
@@ -1723,6 +1724,19 @@ def create_labels_around_electrodes(subject, bipolar=False, labels_fol_name='ele
     return ret
 
 
+# The main's steps, for running the subjects with --scheduler 1 (pipeline_utils). Most of the outputs names depend on
+# the electrodes type and bipolar args, so only the order is declared
+PIPELINE_STEPS = [
+    plu.Step('get_ras_file', outputs=['{mmvt_dir}/{subject}/electrodes/{subject}_RAS.xlsx']),
+    plu.Step('convert_electrodes_pos', after=['get_ras_file']),
+    plu.Step('calc_dist_mat', after=['convert_electrodes_pos']),
+    plu.Step('find_electrodes_hemis', after=['convert_electrodes_pos']),
+    plu.Step('create_electrode_data_file', after=['convert_electrodes_pos']),
+    plu.Step('create_electrodes_labeling_coloring', after=['convert_electrodes_pos']),
+    plu.Step('create_electrodes_groups_coloring', after=['convert_electrodes_pos']),
+]
+
+
 def call_main(args):
     return pu.run_on_subjects(args, main)
 
@@ -21,6 +21,7 @@ SUBJECTS_DIR, MMVT_DIR, FREESURFER_HOME = pu.get_links()
 SUBJECTS_MEG_DIR = utils.get_link_dir(utils.get_links_dir(), 'meg')
 FMRI_DIR = utils.get_link_dir(utils.get_links_dir(), 'fMRI')
 
+PROJECTION_MAX_ELEMENTS = 2e7
 FSAVG_VERTS = 163842
 FSAVG5_VERTS = 10242
 COLIN27_VERTS = dict(lh=166836, rh=165685)
@@ -226,18 +227,23 @@ def find_clusters(subject, surf_template_fname, t_val, atlas, min_cluster_max=2,
     surf_full_input_fname = utils.select_one_file(surf_full_input_fnames, surf_full_input_fname, 'fMRI surf')
     contrast, connectivity, verts = init_clusters(subject, surf_full_input_fname)
     clusters_labels = dict(threshold=t_val, values=[], atlas=atlas)
+    overlap_time = 0
     for hemi in utils.HEMIS:
         clusters, _ = mne_clusters._find_clusters(contrast[hemi], t_val, connectivity=connectivity[hemi])
         # blobs_output_fname = op.join(input_fol, 'blobs_{}_{}.npy'.format(contrast_name, hemi))
         # print('Saving blobs: {}'.format(blobs_output_fname))
         # save_clusters_for_blender(clusters, contrast[hemi], blobs_output_fname)
+        now = time.time()
         clusters_labels_hemi = lu.find_clusters_overlapped_labeles(
             subject, clusters, contrast[hemi], atlas, hemi, verts[hemi], None, min_cluster_max, min_cluster_size,
-            clusters_label, n_jobs)
+            clusters_label, n_jobs=n_jobs)
+        overlap_time += time.time() - now
         if clusters_labels_hemi is None:
             print("Can't find clusters in {}!".format(hemi))
         else:
             clusters_labels['values'].extend(clusters_labels_hemi)
+    print('{}: {} clusters overlapped with {} in {:.2f}s'.format(
+        utils.namebase(surf_full_input_fname), len(clusters_labels['values']), atlas, overlap_time))
 
     if new_atlas_name == '':
         new_atlas_name = utils.namebase(surf_full_input_fname).replace('_{hemi}', '').replace('.{hemi}', '').replace(
@@ -1211,7 +1217,8 @@ def save_dynamic_activity_map(subject, fmri_file_template='', template_brains='f
         # Check if there is a morphed file
         data = nib.load(fmri_fname).get_data().squeeze()
         T = data.shape[1]
-        if not overwrite and len(glob.glob(op.join(fol, '*.npy'))) == T:
+        header = utils.read_activity_map_header(fol)
+        if not overwrite and header is not None and header['T'] == T:
             hemi_minmax.append(utils.calc_min_max(data, norm_percs=norm_percs))
             continue
         verts, faces = utils.read_pial(subject, MMVT_DIR, hemi)
@@ -1235,17 +1242,15 @@ def save_dynamic_activity_map(subject, fmri_file_template='', template_brains='f
             data = nib.load(fmri_fname).get_data().squeeze()
         assert (data.shape[0] == subject_verts_num)
         hemi_minmax.append(utils.calc_min_max(data, norm_percs=norm_percs))
-        utils.delete_folder_files(fol)
-        now = time.time()
-        T = data.shape[1]
-        for t in range(T):
-            utils.time_to_go(now, t, T, runs_num_to_print=10)
-            np.save(op.join(fol, 't{}'.format(t)), data[:, t])
+        if op.isdir(fol):
+            # Removes the legacy t{t}.npy files
+            utils.delete_folder_files(fol, delete_folder=True)
+        utils.save_activity_map(fol, data)
 
     data_min, data_max = utils.calc_minmax_from_arr(hemi_minmax)
     print('save_dynamic_activity_map minmax: {},{}'.format(data_min, data_max))
     np.save(minmax_fname, (data_min, data_max))
-    return np.all([len(glob.glob(op.join(MMVT_DIR, subject, 'fmri', 'activity_map_{}'.format(hemi), '*.npy'))) == T
+    return np.all([utils.activity_map_exists(op.join(MMVT_DIR, subject, 'fmri', 'activity_map_{}'.format(hemi)))
                    for hemi in utils.HEMIS])
 
 
@@ -1727,12 +1732,12 @@ def load_fmri_data(fmri_surf_fname):
     return x
 
 
-def load_fmri_data_for_both_hemis(subject, surf_name):
+def load_fmri_data_for_both_hemis(subject, surf_name, return_fname=False):
+    # If return_fname, the template ({hemi}) of the files that were loaded is returned too
     surf_name = surf_name if surf_name != '' else '{}_'.format(surf_name)
     fname_temp = op.join(MMVT_DIR, subject, 'fmri', 'fmri_{}{}.npy'.format(surf_name, '{hemi}'))
     if utils.both_hemi_files_exist(fname_temp):
-        return {hemi:load_fmri_data(op.join(MMVT_DIR, subject, 'fmri', 'fmri_{}_{}.npy'.format(surf_name, hemi)))
-                for hemi in utils.HEMIS}
+        fname = op.join(MMVT_DIR, subject, 'fmri', 'fmri_{}_{}.npy'.format(surf_name, '{hemi}'))
     else:
         fmri_files = get_all_fmri_files(subject)
         if len(fmri_files) > 0:
@@ -1742,10 +1747,11 @@ def load_fmri_data_for_both_hemis(subject, surf_name):
             else:
                 fname = fmri_files[0]
             fname = op.join(MMVT_DIR, subject, 'fmri', fname)
-            return {hemi: load_fmri_data(fname.format(hemi=hemi)) for hemi in utils.HEMIS}
         else:
             raise Exception("Can't find {} or any other fMRI files in {}!".format(
                 'fmri_{}_{}.npy'.format(surf_name, '{hemi}'), op.join(MMVT_DIR, subject, 'fmri')))
+    x = {hemi: load_fmri_data(fname.format(hemi=hemi)) for hemi in utils.HEMIS}
+    return (x, fname) if return_fname else x
 
 
 def get_all_fmri_files(subject):
@@ -1908,13 +1914,14 @@ def calc_surf_files_min_max(surf_files, min_val=1e-3):
 
 
 def direct_project_volume_to_surf(subject, vol_fname, r=1, labels_restrict=None, atlas='aparc.DKTatlas40',
-                                  overwrite=False):
+                                  overwrite=False, reduction='max', max_elements=PROJECTION_MAX_ELEMENTS):
+    # Projects a 3D volume, or a 4D series (in time chunks), on the pial surface. The vertices voxels neighborhoods
+    # table is calculated once per surface, volume grid (affine and shape) and labels restriction, and cached
     surf_template = surf_files_tempalte(subject, vol_fname)
     vol = nib.load(vol_fname)
-    data = vol.get_data()
 
     if labels_restrict is not None:
-        vertices_labels_lookup = utils.load(op.join(MMVT_DIR, subject, '{}_vertices_labels_lookup.pkl'.format(atlas)))
+        vertices_labels_lookup = lu.create_vertices_labels_lookup(subject, atlas)
     else:
         vertices_labels_lookup = {hemi: None for hemi in utils.HEMIS}
     t1 = nib.load(op.join(SUBJECTS_DIR, subject, 'mri', 'T1.mgz'))
@@ -1927,24 +1934,115 @@ def direct_project_volume_to_surf(subject, vol_fname, r=1, labels_restrict=None,
         t1_vox = utils.apply_trans(np.linalg.inv(t1.header.get_vox2ras_tkr()), vertices)
         ras = utils.apply_trans(t1.header.get_vox2ras(), t1_vox)
         vol_vox = np.rint(utils.apply_trans(np.linalg.inv(vol.header.get_vox2ras()), ras)).astype(int)
-        vertices_data = calc_vox_avg(data, vol_vox, r, labels_restrict, vertices_labels_lookup[hemi])
+        neighborhoods = get_vertices_neighborhoods(
+            subject, hemi, vol_vox, vol.affine, vol.shape[:3], r, labels_restrict, vertices_labels_lookup[hemi], atlas)
+        vertices_data = project_volume_data(vol.dataobj, neighborhoods, reduction, max_elements)
         print('direct_project_volume_to_surf: Saving results in {}'.format(output_fname))
         np.save(output_fname, vertices_data)
 
 
-def calc_vox_avg(data, voxels, r=1, labels_restrict=None, vertices_labels_lookup=None):
-    if r == 1 and vertices_labels_lookup is None:
-        return data[tuple([voxels[:, k] for k in range(3)])]
+def calc_vox_avg(data, voxels, r=1, labels_restrict=None, vertices_labels_lookup=None, reduction='max'):
+    vertices_mask = calc_labels_restrict_mask(vertices_labels_lookup, labels_restrict, len(voxels))
+    neighborhoods = calc_vertices_neighborhoods(voxels, data.shape[:3], r, vertices_mask)
+    return project_volume_data(data, neighborhoods, reduction)
 
-    vertices_data = np.zeros(len(voxels))
-    vertices_indices = range(len(vertices_data))
-    for vertice_ind, vox in zip(vertices_indices, voxels):
-        if vertices_labels_lookup is not None:
-            vert_label = vertices_labels_lookup[vertice_ind]
-            if all([not vert_label.startswith(l) for l in labels_restrict]):
-                continue
-        vertices_data[vertice_ind] = \
-            np.max(data[vox[0] - r: vox[0] + r + 1, vox[1] - r: vox[1] + r + 1, vox[2] - r: vox[2] + r + 1])
+
+def calc_labels_restrict_mask(vertices_labels_lookup, labels_restrict, vertices_num):
+    # The vertices whose label starts with one of labels_restrict (None if there is no restriction)
+    if vertices_labels_lookup is None or labels_restrict is None:
+        return None
+    if isinstance(labels_restrict, str):
+        labels_restrict = [labels_restrict]
+    starts_with = lambda label_name: any([utils.to_str(label_name).startswith(l) for l in labels_restrict])
+    if hasattr(vertices_labels_lookup, 'labels_names'):
+        # tu.VerticesLabelsLookup
+        labels_mask = np.array([starts_with(label_name) for label_name in vertices_labels_lookup.labels_names],
+                               dtype=bool)
+        return labels_mask[np.asarray(vertices_labels_lookup)]
+    return np.array([starts_with(vertices_labels_lookup[vert]) for vert in range(vertices_num)], dtype=bool)
+
+
+def calc_vertices_neighborhoods(voxels, vol_shape, r=1, vertices_mask=None):
+    # The vertices (in vertices_mask) voxels, as flat indices in the volume padded by r on every side, where the r-cube
+    # around every voxel (like the previous data[x-r:x+r+1, y-r:y+r+1, z-r:z+r+1]) is reduced by a filter. Like
+    # before, without a labels restriction r=1 is the vertex's voxel only. A voxel outside the padded volume is marked
+    # as not valid
+    voxels = np.asarray(voxels, dtype=int)
+    if r == 1 and vertices_mask is None:
+        r = 0
+    vertices_inds = np.arange(len(voxels)) if vertices_mask is None else np.where(vertices_mask)[0]
+    padded_shape = tuple([s + 2 * r for s in vol_shape[:3]])
+    padded_voxels = voxels[vertices_inds] + r
+    valid = np.all((padded_voxels >= 0) & (padded_voxels < np.array(padded_shape)), axis=1)
+    indices = np.ravel_multi_index(tuple([padded_voxels[:, k] for k in range(3)]), padded_shape, mode='clip')
+    return utils.Bag(dict(vertices_num=len(voxels), vertices_inds=vertices_inds, indices=indices, valid=valid, r=r))
+
+
+def get_vertices_neighborhoods(subject, hemi, voxels, vol_affine, vol_shape, r=1, labels_restrict=None,
+                               vertices_labels_lookup=None, atlas='', overwrite=False):
+    # The neighborhoods table is cached in fmri/projection_tables, by the vertices voxels, the volume's affine and
+    # shape, r and the labels restriction
+    if isinstance(labels_restrict, str):
+        labels_restrict = [labels_restrict]
+    key = utils.calc_arrays_hash([
+        np.asarray(voxels, dtype=np.int64), np.asarray(vol_affine, dtype=np.float64),
+        np.array(vol_shape[:3], dtype=np.int64), str(r), atlas if labels_restrict is not None else '',
+        ','.join(labels_restrict) if labels_restrict is not None else ''])
+    tables_fol = utils.make_dir(op.join(MMVT_DIR, subject, 'fmri', 'projection_tables'))
+    table_fname = op.join(tables_fol, '{}_{}.npz'.format(hemi, key))
+    if op.isfile(table_fname) and not overwrite:
+        d = np.load(table_fname)
+        return utils.Bag(dict(vertices_num=int(d['vertices_num']), vertices_inds=d['vertices_inds'],
+                              indices=d['indices'], valid=d['valid'], r=int(d['r'])))
+    vertices_mask = calc_labels_restrict_mask(vertices_labels_lookup, labels_restrict, len(voxels))
+    neighborhoods = calc_vertices_neighborhoods(voxels, vol_shape, r, vertices_mask)
+    np.savez(table_fname, **neighborhoods)
+    return neighborhoods
+
+
+def project_volume_data(data, neighborhoods, reduction='max', max_elements=PROJECTION_MAX_ELEMENTS):
+    # Reduces the r-cube around every vertex's voxel (max, mean, or weighted: a Gaussian of the distance from the
+    # voxel, with sigma=r) for a 3D volume (returns vertices) or a 4D series (returns vertices x time), which is read
+    # in time chunks of about max_elements voxels. data can be an array proxy (nibabel's dataobj). The reductions are
+    # separable filters over the whole chunk, where the voxels outside the volume are ignored. The vertices outside
+    # the labels restriction, or without voxels in the volume, are zeros
+    from scipy import ndimage
+    if reduction not in ('max', 'mean', 'weighted'):
+        raise Exception('Unknown reduction {}!'.format(reduction))
+    T = data.shape[3] if len(data.shape) > 3 else 0
+    vertices_data = np.zeros((neighborhoods.vertices_num, T) if T > 0 else neighborhoods.vertices_num)
+    if len(neighborhoods.vertices_inds) == 0:
+        return vertices_data
+    r = neighborhoods.r
+    pad_width = ((r, r),) * 3 + ((0, 0),)
+    if reduction != 'max':
+        kernel = np.exp(-np.arange(-r, r + 1) ** 2 / (2 * max(r, 1) ** 2)) if reduction == 'weighted' else \
+            np.ones(2 * r + 1)
+        # The weights sum of the voxels inside the volume, for normalizing the filtered (weighted) sums
+        weights_sum = np.pad(np.ones(data.shape[:3] + (1,)), pad_width, mode='constant')
+        for axis in range(3):
+            weights_sum = ndimage.correlate1d(weights_sum, kernel, axis, mode='constant')
+        weights_sum = weights_sum.reshape((-1, 1))[neighborhoods.indices]
+    time_chunk = max(1, int(max_elements // np.prod([s + 2 * r for s in data.shape[:3]])))
+    for t1 in range(0, max(T, 1), time_chunk):
+        t2 = min(t1 + time_chunk, T)
+        chunk_data = np.asarray(data[..., t1:t2] if T > 0 else data, dtype=np.float64)
+        chunk_data = chunk_data.reshape(chunk_data.shape[:3] + (-1,))
+        if r > 0 and reduction == 'max':
+            chunk_data = np.pad(chunk_data, pad_width, mode='constant', constant_values=-np.inf)
+            chunk_data = ndimage.maximum_filter(chunk_data, size=(2 * r + 1,) * 3 + (1,), mode='constant', cval=-np.inf)
+        elif r > 0:
+            chunk_data = np.pad(chunk_data, pad_width, mode='constant')
+            for axis in range(3):
+                chunk_data = ndimage.correlate1d(chunk_data, kernel, axis, mode='constant')
+        chunk_vertices_data = chunk_data.reshape((-1, chunk_data.shape[3]))[neighborhoods.indices]
+        if r > 0 and reduction != 'max':
+            chunk_vertices_data /= np.maximum(weights_sum, 1e-12)
+        chunk_vertices_data[~neighborhoods.valid | ~np.all(np.isfinite(chunk_vertices_data), axis=1)] = 0
+        if T > 0:
+            vertices_data[neighborhoods.vertices_inds, t1:t2] = chunk_vertices_data
+        else:
+            vertices_data[neighborhoods.vertices_inds] = chunk_vertices_data[:, 0]
     return vertices_data
 
 
@@ -2030,6 +2128,10 @@ def main(subject, remote_subject_dir, args, flags):
     #         subject, args.fmri_file_template, template_brains=args.template_brain,
     #         norm_percs=args.norm_percs, overwrite=args.overwrite_activity_data)
 
+    if 'convert_activity_maps' in args.function:
+        flags['convert_activity_maps'] = utils.convert_activity_map_folders(
+            op.join(MMVT_DIR, subject), args.delete_activity_maps_folders)
+
     if 'calc_labels_minmax' in args.function:
         flags['calc_labels_minmax'] = calc_labels_minmax(subject, args.atlas, args.labels_extract_mode)
 
@@ -2152,6 +2254,8 @@ def read_cmd_args(argv=None):
     parser.add_argument('--overwrite_labels_data', help='', required=False, default=0, type=au.is_true)
     parser.add_argument('--overwrite_activity_data', help='', required=False, default=0, type=au.is_true)
     parser.add_argument('--overwrite_mri_segstat', help='', required=False, default=0, type=au.is_true)
+    parser.add_argument('--delete_activity_maps_folders', help='delete the legacy t{t}.npy folders after converting',
+                        required=False, default=0, type=au.is_true)
     # parser.add_argument('--raw_fwhm', help='Raw Full Width at Half Maximum for Spatial Smoothing', required=False, default=5, type=float)
     parser.add_argument('--template_brain', help='', required=False, default='')
     parser.add_argument('--target_subject', help='', required=False, default='')
@@ -24,6 +24,7 @@ from mne.preprocessing import create_ecg_epochs, create_eog_epochs
 
 from src.utils import utils
 from src.utils import preproc_utils as pu
+from src.utils import cache_utils
 from src.utils import labels_utils as lu
 from src.utils import args_utils as au
 from src.utils import freesurfer_utils as fu
@@ -44,6 +45,8 @@ LOOKUP_TABLE_SUBCORTICAL = op.join(MMVT_DIR, 'sub_cortical_codes.txt')
 
 STAT_AVG, STAT_DIFF = range(2)
 HEMIS = ['rh', 'lh']
+# The extract modes that are a linear combination of the label's sources
+LINEAR_EXTRACT_MODES = ['mean', 'mean_flip']
 
 SUBJECT, MRI_SUBJECT, SUBJECT_MEG_FOLDER, RAW, RAW_ICA, INFO, EVO, EVE, COV, EPO, EPO_NOISE, FWD_EEG, FWD_MEG, FWD_MEEG, FWD_SUB, FWD_X,\
 FWD_SMOOTH, INV_EEG, INV_MEG, INV_MEEG, INV_SMOOTH, INV_EEG_SMOOTH, INV_SUB, INV_X, EMPTY_ROOM, MRI, SRC, SRC_SMOOTH, BEM, STC, \
@@ -2289,6 +2292,7 @@ def calc_inverse_operator(
     epo_fname = get_epo_fname(epo_fname)
     if use_empty_room_for_noise_cov:
         empty_fname = get_empty_fname(empty_fname)
+    use_cache = args is not None and args.get('use_cache', False)
     noise_cov = None
     if noise_cov_fname == '':
         if fwd_usingEEG and fwd_usingMEG:
@@ -2337,23 +2341,25 @@ def calc_inverse_operator(
                     cortical_fwd = get_cond_fname(fwd_fname, cond)
                 _calc_inverse_operator(
                     cortical_fwd, get_cond_fname(inv_fname, cond), raw_fname, get_cond_fname(evo_fname, cond),
-                    epo_fname, noise_cov, bad_channels, fwd_usingMEG, fwd_usingEEG, inv_loose, inv_depth, noise_cov_fname,
-                    check_for_channels_inconsistency)
+                    get_cond_fname(epo_fname, cond), noise_cov, bad_channels, fwd_usingMEG, fwd_usingEEG, inv_loose,
+                    inv_depth, noise_cov_fname, check_for_channels_inconsistency, use_cache, overwrite_inverse_operator)
             if calc_for_sub_cortical_fwd and (not op.isfile(get_cond_fname(INV_SUB, cond))
                                               or overwrite_inverse_operator):
                 if subcortical_fwd is None:
                     subcortical_fwd = get_cond_fname(FWD_SUB, cond)
-                _calc_inverse_operator(subcortical_fwd, get_cond_fname(INV_SUB, cond), raw_fname, evo_fname, epo_fname,
-                                       noise_cov, bad_channels, fwd_usingMEG, fwd_usingEEG,
-                                       check_for_channels_inconsistency=check_for_channels_inconsistency)
+                _calc_inverse_operator(subcortical_fwd, get_cond_fname(INV_SUB, cond), raw_fname, evo_fname,
+                                       get_cond_fname(epo_fname, cond), noise_cov, bad_channels, fwd_usingMEG,
+                                       fwd_usingEEG, check_for_channels_inconsistency=check_for_channels_inconsistency,
+                                       use_cache=use_cache, overwrite=overwrite_inverse_operator)
             if calc_for_spec_sub_cortical and (not op.isfile(get_cond_fname(INV_X, cond, region=region))
                                                or overwrite_inverse_operator):
                 if spec_subcortical_fwd is None:
                     spec_subcortical_fwd = get_cond_fname(FWD_X, cond, region=region)
                 _calc_inverse_operator(
                     spec_subcortical_fwd, get_cond_fname(INV_X, cond, region=region), raw_fname,
-                    evo_fname, epo_fname, noise_cov, bad_channels, fwd_usingMEG, fwd_usingEEG,
-                    check_for_channels_inconsistency=check_for_channels_inconsistency)
+                    evo_fname, get_cond_fname(epo_fname, cond), noise_cov, bad_channels, fwd_usingMEG, fwd_usingEEG,
+                    check_for_channels_inconsistency=check_for_channels_inconsistency, use_cache=use_cache,
+                    overwrite=overwrite_inverse_operator)
             flag = True
         except:
             print(traceback.format_exc())
@@ -2362,6 +2368,12 @@ def calc_inverse_operator(
     return flag
 
 
+def calc_cache_code_version(func):
+    # The source of the cached function's module, which has the helpers it calls (like get_info and
+    # check_noise_cov_channels), and the mne version, so a change in any of them invalidates the cached outputs
+    return cache_utils.calc_code_versions([inspect.getmodule(func), mne.__version__])
+
+
 @utils.tryit(None)
 def read_noise_cov(noise_cov_fname):
     return mne.read_cov(noise_cov_fname)
@@ -2369,18 +2381,34 @@ def read_noise_cov(noise_cov_fname):
 
 def _calc_inverse_operator(
         fwd_name, inv_name, raw_fname, evoked_fname, epochs_fname, noise_cov, bad_channels, fwd_usingMEG, fwd_usingEEG,
-        inv_loose=0.2, inv_depth=0.8, noise_cov_fname='', check_for_channels_inconsistency=True):
-    fwd = mne.read_forward_solution(fwd_name)
-    info = get_info(epochs_fname, evoked_fname, raw_fname, bad_channels,
-                    fwd_usingEEG=fwd_usingEEG, fwd_usingMEG=fwd_usingMEG)
-    if info is None:
-        raise Exception("Can't find info for calculating the inverse operator!")
-    # noise_cov['bads'] = info['bads']
-    noise_cov = check_noise_cov_channels(
-        noise_cov, info, fwd, fwd_usingMEG, fwd_usingEEG, noise_cov_fname, check_for_channels_inconsistency)
-    inverse_operator = make_inverse_operator(info, fwd, noise_cov,
-        loose=inv_loose, depth=inv_depth)
-    write_inverse_operator(inv_name, inverse_operator)
+        inv_loose=0.2, inv_depth=0.8, noise_cov_fname='', check_for_channels_inconsistency=True, use_cache=False,
+        overwrite=False):
+    # With use_cache, the inverse operator is restored from the subject's artifacts cache if it was already
+    # calculated from the same forward solution, data files, noise covariance, parameters and code
+    def calc_and_write():
+        fwd = mne.read_forward_solution(fwd_name)
+        info = get_info(epochs_fname, evoked_fname, raw_fname, bad_channels,
+                        fwd_usingEEG=fwd_usingEEG, fwd_usingMEG=fwd_usingMEG)
+        if info is None:
+            raise Exception("Can't find info for calculating the inverse operator!")
+        # noise_cov['bads'] = info['bads']
+        fixed_noise_cov = check_noise_cov_channels(
+            noise_cov, info, fwd, fwd_usingMEG, fwd_usingEEG, noise_cov_fname, check_for_channels_inconsistency)
+        inverse_operator = make_inverse_operator(info, fwd, fixed_noise_cov,
+            loose=inv_loose, depth=inv_depth)
+        write_inverse_operator(inv_name, inverse_operator)
+        return op.isfile(inv_name)
+
+    if not use_cache:
+        return calc_and_write()
+    params = dict(bad_channels=sorted(bad_channels), fwd_usingMEG=fwd_usingMEG, fwd_usingEEG=fwd_usingEEG,
+                  inv_loose=inv_loose, inv_depth=inv_depth, inv_name=op.basename(inv_name),
+                  noise_cov=utils.calc_arrays_hash([noise_cov.data, ','.join(noise_cov.ch_names)]),
+                  check_for_channels_inconsistency=check_for_channels_inconsistency)
+    return cache_utils.run_cached(
+        op.join(MMVT_DIR, MRI_SUBJECT), 'calc_inverse_operator', calc_and_write,
+        [fwd_name, raw_fname, evoked_fname, epochs_fname, get_info_fname()[0]], [inv_name], params,
+        calc_cache_code_version(calc_and_write), overwrite)
 
 
 def get_bad_channels(info, bad_channels, fwd_usingEEG=True, fwd_usingMEG=True):
@@ -3654,7 +3682,9 @@ def create_stc_t_from_data(subject, rh_data, lh_data, tstep=0.001):
 
 @utils.files_needed({'surf': ['lh.sphere.reg', 'rh.sphere.reg']})
 def morph_stc(subject, events, morph_to_subject, inverse_method='dSPM', grade=5, smoothing_iterations=None,
-              stc_name='', overwrite=False, n_jobs=6):
+              stc_name='', overwrite=False, n_jobs=6, use_cache=False):
+    # With use_cache, the morphed stcs are restored from the subject's artifacts cache if they were already
+    # calculated from the same stc, surfaces, parameters and code
     ret = True
     # if utils.both_hemi_files_exist(op.join(MMVT_DIR, subject, 'meg', '{}-{}.stc'.format(stc_name, '{hemi}'))):
     #         output_fname = op.join(MMVT_DIR, morph_to_subject stc_name.replace(subject, morph_to_subject)
@@ -3675,11 +3705,27 @@ def morph_stc(subject, events, morph_to_subject, inverse_method='dSPM', grade=5,
         if utils.both_hemi_files_exist('{}-{}.stc'.format(output_fname, '{hemi}')) and not overwrite:
             continue
         utils.make_dir(utils.get_parent_fol(output_fname))
-        stc = mne.read_source_estimate(stc_fname)
-        stc_morphed = mne.morph_data(
-            subject, morph_to_subject, stc, grade=grade, smooth=smoothing_iterations, n_jobs=n_jobs)
-        stc_morphed.save(output_fname)
-        print('Morphed stc file was saves in {}'.format(output_fname))
+
+        def morph_and_save():
+            stc = mne.read_source_estimate(stc_fname)
+            stc_morphed = mne.morph_data(
+                subject, morph_to_subject, stc, grade=grade, smooth=smoothing_iterations, n_jobs=n_jobs)
+            stc_morphed.save(output_fname)
+            print('Morphed stc file was saves in {}'.format(output_fname))
+            return True
+
+        if not use_cache:
+            morph_and_save()
+        else:
+            # The morph maps are calculated from both subjects' spheres
+            spheres_fnames = [op.join(SUBJECTS_MRI_DIR, subj, 'surf', '{}.sphere.reg'.format(hemi))
+                              for subj in [subject, morph_to_subject] for hemi in utils.HEMIS]
+            cache_utils.run_cached(
+                op.join(MMVT_DIR, subject), 'morph_stc', morph_and_save,
+                [input_fname, '{}-lh.stc'.format(input_fname[:-len('-rh.stc')])] + spheres_fnames,
+                ['{}-{}.stc'.format(output_fname, hemi) for hemi in utils.HEMIS],
+                dict(morph_to_subject=morph_to_subject, grade=grade, smoothing_iterations=smoothing_iterations,
+                     output_fname=utils.namebase(output_fname)), calc_cache_code_version(morph_and_save), overwrite)
         ret = ret and utils.both_hemi_files_exist(output_fname)
     # diff_template = op.join(SUBJECT_MEG_FOLDER, '{cond}-{hemi}.stc').replace(SUBJECT, morph_to_subject)
     diff_template = STC_HEMI.format(cond='{cond}', hemi='{hemi}', method=inverse_method).replace(SUBJECT, morph_to_subject)
@@ -3759,15 +3805,12 @@ def save_activity_map(events, stat, stcs_conds=None, inverse_method='dSPM', smoo
             if morph_to_subject != '':
                 fol = fol.replace(MRI_SUBJECT, morph_to_subject)
             if stc_t == -1:
-                utils.delete_folder_files(fol)
-                now = time.time()
-                T = data.shape[1]
-                for t in range(T):
-                    utils.time_to_go(now, t, T, runs_num_to_print=10)
-                    np.save(op.join(fol, 't{}'.format(t)), data[:, t])
+                if op.isdir(fol):
+                    # Removes the legacy t{t}.npy files
+                    utils.delete_folder_files(fol, delete_folder=True)
+                utils.save_activity_map(fol, data)
             else:
-                utils.make_dir(fol)
-                np.save(op.join(fol, 't{}'.format(stc_t)), data)
+                utils.save_activity_map_t(fol, np.squeeze(data), stc_t)
         flag = True
     except:
         print(traceback.format_exc())
@@ -4105,6 +4148,7 @@ def calc_labels_avg_per_condition(
 
         inv_fname = get_inv_fname(inv_fname, fwd_usingMEG, fwd_usingEEG)
         global_inverse_operator = False
+        src_fname = ''
         if events is None or len(events) == 0:
             events = dict(all=0)
         if '{cond}' not in inv_fname:
@@ -4115,6 +4159,7 @@ def calc_labels_avg_per_condition(
             if src is None:
                 inverse_operator = read_inverse_operator(inv_fname)
                 src = inverse_operator['src']
+                src_fname = inv_fname
 
         if do_plot:
             utils.make_dir(op.join(SUBJECT_MEG_FOLDER, 'figures'))
@@ -4124,7 +4169,7 @@ def calc_labels_avg_per_condition(
         #     stcs = get_stc_conds(events, hemi, inverse_method, stc_hemi_template)
         conds_incdices = {cond_id:ind for ind, cond_id in zip(range(len(stcs)), events.values())}
         conditions = []
-        labels_data = {}
+        labels_data, labels_matrices, src_hashes = {}, {}, {}
 
         if not check_source_and_labels_interestion(src, labels):
             return False
@@ -4134,12 +4179,14 @@ def calc_labels_avg_per_condition(
                 plt.figure()
             conditions.append(cond_name)
             if not global_inverse_operator:
-                if src is None:
+                # The source space is read again if it was read from another condition's inverse operator
+                if src is None or src_fname not in ('', inv_fname.format(cond=cond_name)):
                     if not op.isfile(inv_fname.format(cond=cond_name)):
                         print('No inverse operator found!')
                         return False
                     inverse_operator = read_inverse_operator(inv_fname.format(cond=cond_name))
                     src = inverse_operator['src']
+                    src_fname = inv_fname.format(cond=cond_name)
 
             if isinstance(stc_cond, types.GeneratorType):
                 stc_cond_num = stcs_num[cond_name]
@@ -4148,16 +4195,28 @@ def calc_labels_avg_per_condition(
                 stc_cond_num = 1
             for stc_ind, stc in enumerate(stc_cond):
                 for em in extract_modes:
-                    for ind, label in enumerate(labels):
-                        label_data = stc.extract_label_time_course(label, src, mode=em, allow_empty=True)
-                        label_data = np.squeeze(label_data)
-                        # Set flip to be always positive
-                        # mean_flip *= np.sign(mean_flip[np.argmax(np.abs(mean_flip))])
-                        if em not in labels_data:
-                            T = len(stc.times)
-                            labels_data[em] = np.zeros((len(labels), T, len(stcs), stc_cond_num))
-                        labels_data[em][ind, :, conds_incdices[cond_id], stc_ind] = label_data
-                        if do_plot:
+                    if em not in labels_data:
+                        T = len(stc.times)
+                        labels_data[em] = np.zeros((len(labels), T, len(stcs), stc_cond_num))
+                    # The matrices are kept per source space, in case the conditions have different ones
+                    if (id(src), src_fname) not in src_hashes:
+                        src_hashes[(id(src), src_fname)] = calc_src_hash(src, src_fname)
+                    matrix_key = (em, src_hashes[(id(src), src_fname)])
+                    if em in LINEAR_EXTRACT_MODES and matrix_key not in labels_matrices:
+                        labels_matrices[matrix_key] = get_labels_extraction_matrix(
+                            atlas, hemi, labels, src, em, src_fname, src_hash=matrix_key[1])
+                    if matrix_key in labels_matrices and labels_matrices[matrix_key].shape[1] == stc.data.shape[0]:
+                        # All the labels time courses in one sparse multiplication
+                        labels_data[em][:, :, conds_incdices[cond_id], stc_ind] = \
+                            labels_matrices[matrix_key].dot(stc.data)
+                    else:
+                        for ind, label in enumerate(labels):
+                            label_data = stc.extract_label_time_course(label, src, mode=em, allow_empty=True)
+                            labels_data[em][ind, :, conds_incdices[cond_id], stc_ind] = np.squeeze(label_data)
+                    # Set flip to be always positive
+                    # mean_flip *= np.sign(mean_flip[np.argmax(np.abs(mean_flip))])
+                    if do_plot:
+                        for ind, label in enumerate(labels):
                             plt.plot(labels_data[em][ind, :, conds_incdices[cond_id]], label=label.name)
 
             if do_plot:
@@ -4895,23 +4954,33 @@ def calc_labels_avg_for_rest(
         if raw is None:
             raw_fname = get_raw_fname(raw_fname)
             if op.isfile(raw_fname):
-                mne.io.read_raw_fif(raw_fname)
+                raw = mne.io.read_raw_fif(raw_fname)
             else:
                 raise Exception("Can't find the raw file! ({})".format(raw_fname))
         if not isinstance(inverse_method, str) and isinstance(inverse_method, Iterable):
             inverse_method = inverse_method[0]
         inverse_operator = read_inverse_operator(inv_fname.format(cond=cond_name))
-        src = inverse_operator['src']
         lambda2 = 1.0 / snr ** 2
-        labels_data = {}
-        for hemi in utils.HEMIS:
-            labels = lu.read_labels(MRI_SUBJECT, SUBJECTS_MRI_DIR, atlas, hemi=hemi)
-            indices = np.array_split(np.arange(len(labels)), n_jobs)
-            chunks = [([labels[ind] for ind in indices_chunk], raw, src, inverse_operator, lambda2, inverse_method,
-                       extract_modes, pick_ori, save_data_files, labels_output_fol_template, overwrite_stc,
-                       do_plot_time_series) for indices_chunk in indices]
-            results = utils.run_parallel(calc_stc_labels_parallel, chunks, n_jobs)
-            labels_data[hemi] = collect_parallel_results(indices, results, len(labels))
+        labels = {hemi: lu.read_labels(MRI_SUBJECT, SUBJECTS_MRI_DIR, atlas, hemi=hemi) for hemi in utils.HEMIS}
+        labels_data = {hemi: {} for hemi in utils.HEMIS}
+        for em in extract_modes:
+            if em != 'mean_flip':
+                print("{} isn't implemented yet for rest data!".format(em))
+                continue
+            all_labels_data = calc_labels_rest_data(
+                raw, inverse_operator, labels['lh'] + labels['rh'], lambda2, inverse_method, pick_ori, n_jobs)
+            labels_data['lh'][em] = all_labels_data[:len(labels['lh'])]
+            labels_data['rh'][em] = all_labels_data[len(labels['lh']):]
+            if not save_data_files and not do_plot_time_series:
+                continue
+            labels_output_fol = utils.make_dir(labels_output_fol_template.format(extract_mode=em))
+            for hemi in utils.HEMIS:
+                for label, label_data in zip(labels[hemi], labels_data[hemi][em]):
+                    if do_plot_time_series:
+                        plot_label_data(label_data, label.name, em, labels_output_fol)
+                    label_fname = op.join(labels_output_fol, '{}-{}.npy'.format(label.name, em))
+                    if save_data_files and not op.isfile(label_fname) and not overwrite_stc:
+                        np.save(label_fname, label_data)
 
     elif (not labels_data_exist) or overwrite_labels_data:
         labels_data = {}
@@ -4935,7 +5004,8 @@ def calc_labels_avg_for_rest(
             for hemi in utils.HEMIS:
                 labels_names = lu.get_labels_names(MRI_SUBJECT, SUBJECTS_MRI_DIR, atlas, hemi)
                 save_labels_data(labels_data[hemi], hemi, labels_names, atlas, ['all'], extract_modes,
-                                 labels_data_template, 'rest', factor, positive, moving_average_win_size)
+                                 [inverse_method], labels_data_template, 'rest', factor, positive,
+                                 moving_average_win_size)
 
     output_fol = op.join(MMVT_DIR, MRI_SUBJECT, 'meg')
     flag = all([op.isfile(op.join(output_fol, op.basename(labels_data_template.format('rest', atlas, em, hemi)))) for \
@@ -4944,34 +5014,113 @@ def calc_labels_avg_for_rest(
     return flag
 
 
-def calc_stc_labels_parallel(p):
-    (labels, raw, src, inverse_operator, lambda2, inverse_method, extract_modes, pick_ori,
-     save_data_files, labels_output_fol_template, overwrite, do_plot_time_series) = p
-    labels_data = {}
-    for ind, label in enumerate(labels):
-        stc = mne.minimum_norm.apply_inverse_raw(
-            raw, inverse_operator, lambda2, inverse_method, label=label, pick_ori=pick_ori)
-        for em in extract_modes:
-            # label_data = stc.extract_label_time_course(label, src, mode=em, allow_empty=True)
-            if em != 'mean_flip':
-                print("{} isn't implemented yet for rest data!".format(em))
-                continue
-            labels_output_fol = labels_output_fol_template.format(extract_mode=em)
-            utils.make_dir(labels_output_fol)
-            label_data = extract_label_data(label, src, stc)
-            label_data = np.squeeze(label_data)
-            if do_plot_time_series:
-                plot_label_data(label_data, label.name, em, labels_output_fol)
-            if save_data_files:
-                # fol = utils.make_dir(op.join(SUBJECT_MEG_FOLDER, 'rest_labels_data_{}'.format(em)))
-                label_fname = op.join(labels_output_fol, '{}-{}.npy'.format(label.name, em))
-                if not op.isfile(label_fname) and not overwrite:
-                    np.save(label_fname, label_data)
-            if em not in labels_data:
-                T = len(stc.times)
-                labels_data[em] = np.zeros((len(labels), T))
-            labels_data[em][ind, :] = label_data
-    return labels_data
+def calc_labels_rest_data(raw, inverse_operator, labels, lambda2, inverse_method, pick_ori=None, n_jobs=6,
+                          chunk_size=10000):
+    # The mean_flip labels time series of apply_inverse_raw, without calling it for every label:
+    # The imaging kernel is calculated once, and the sensors data is projected in time chunks, averaging the
+    # sources in every label with a sparse labels x sources sign flip matrix. The sensors data (and the kernel, for
+    # free orientation) are shared with the workers through memmaps, instead of pickling raw and the inverse operator.
+    from mne.minimum_norm.inverse import prepare_inverse_operator, _assemble_kernel, _pick_channels_inverse_operator
+    inv = prepare_inverse_operator(inverse_operator, 1, lambda2, inverse_method)
+    sel = _pick_channels_inverse_operator(raw.ch_names, inv)
+    kernel, noise_norm, vertno = _assemble_kernel(inv, None, inverse_method, pick_ori)[:3]
+    is_free_ori = inverse_operator['source_ori'] == mne.io.constants.FIFF.FIFFV_MNE_FREE_ORI and pick_ori != 'normal'
+    labels_matrix = create_labels_extraction_matrix(labels, inverse_operator['src'], 'mean_flip', vertno)
+    if not is_free_ori:
+        # Without combining the orientations everything is linear, and the labels kernel is labels x channels
+        if noise_norm is not None:
+            kernel = kernel * noise_norm
+        kernel, labels_matrix, noise_norm = np.asarray(labels_matrix.dot(kernel)), None, None
+
+    tmp_fol = utils.make_dir(op.join(SUBJECT_MEG_FOLDER, 'tmp_rest_inverse'))
+    data_fname, kernel_fname = op.join(tmp_fol, 'sensors_data.npy'), op.join(tmp_fol, 'kernel.npy')
+    T = raw.n_times
+    time_chunks = [(start, min(start + chunk_size, T)) for start in range(0, T, chunk_size)]
+    data = np.lib.format.open_memmap(data_fname, mode='w+', dtype=np.float64, shape=(len(sel), T))
+    for start, stop in time_chunks:
+        data[:, start:stop] = raw[sel, start:stop][0]
+    data.flush()
+    del data
+    np.save(kernel_fname, kernel)
+    del kernel
+
+    indices = np.array_split(np.arange(len(time_chunks)), n_jobs)
+    chunks = [(data_fname, kernel_fname, labels_matrix, noise_norm, is_free_ori,
+               [time_chunks[ind] for ind in indices_chunk]) for indices_chunk in indices if len(indices_chunk) > 0]
+    results = utils.run_parallel(_calc_labels_rest_data_parallel, chunks, n_jobs, reuse_pool=True)
+    utils.delete_folder_files(tmp_fol, delete_folder=True)
+    return np.concatenate(results, axis=1)
+
+
+def _calc_labels_rest_data_parallel(p):
+    data_fname, kernel_fname, labels_matrix, noise_norm, is_free_ori, time_chunks = p
+    data = np.load(data_fname, mmap_mode='r')
+    kernel = np.load(kernel_fname, mmap_mode='r')
+    labels_data = []
+    for start, stop in time_chunks:
+        sol = np.dot(kernel, data[:, start:stop])
+        if is_free_ori:
+            # Combine the xyz orientations of every source
+            sol = np.sqrt(np.sum(sol.reshape((-1, 3, sol.shape[1])) ** 2, axis=1))
+        if noise_norm is not None:
+            sol *= noise_norm
+        labels_data.append(labels_matrix.dot(sol) if labels_matrix is not None else sol)
+    return np.concatenate(labels_data, axis=1)
+
+
+def create_labels_extraction_matrix(labels, src, mode='mean_flip', vertno=None):
+    # A sparse labels x sources matrix, which multiplied by the sources data gives the labels time courses of
+    # stc.extract_label_time_course for the linear modes: the rows are 1 / n for mean, and the label's sign flip
+    # (mne.label_sign_flip) / n for mean_flip. Labels without sources are all zeros (like allow_empty=True).
+    from scipy import sparse
+    if mode not in LINEAR_EXTRACT_MODES:
+        raise Exception('{} is not a linear extract mode!'.format(mode))
+    if vertno is None:
+        vertno = [s['vertno'] for s in src]
+    labels_vertidx, _ = utils.get_labels_vertices(labels, vertno)
+    rows, cols, vals = [], [], []
+    for label_ind, (label, vertidx) in enumerate(zip(labels, labels_vertidx)):
+        if vertidx is None:
+            continue
+        rows.append(np.ones(len(vertidx), dtype=int) * label_ind)
+        cols.append(vertidx)
+        vals.append((mne.label_sign_flip(label, src) if mode == 'mean_flip' else np.ones(len(vertidx))) / len(vertidx))
+    sources_num = len(vertno[0]) + len(vertno[1])
+    if len(rows) == 0:
+        return sparse.csr_matrix((len(labels), sources_num))
+    return sparse.csr_matrix(
+        (np.concatenate(vals), (np.concatenate(rows), np.concatenate(cols))), shape=(len(labels), sources_num))
+
+
+def calc_src_hash(src, src_fname=''):
+    # The hash of the inverse operator file the source space was read from, or of its vertices
+    if src_fname != '' and op.isfile(src_fname):
+        return utils.calc_file_hash(src_fname)
+    return utils.calc_arrays_hash([s['vertno'] for s in src])
+
+
+def get_labels_extraction_matrix(atlas, hemi, labels, src, mode, src_fname='', overwrite=False, src_hash=None):
+    # The labels extraction matrix is saved in the subject's meg folder, keyed on the hashes of the source space
+    # (the inverse operator file it was read from) and of the annotation files, so it's recalculated if they change
+    from scipy import sparse
+    annot_fnames = [f for f in lu.get_annot_fnames(MRI_SUBJECT, SUBJECTS_MRI_DIR, atlas, hemi) if op.isfile(f)]
+    if src_hash is None:
+        src_hash = calc_src_hash(src, src_fname)
+    if len(annot_fnames) > 0:
+        labels_hash = utils.calc_arrays_hash([utils.calc_file_hash(f) for f in annot_fnames])
+    else:
+        labels_hash = utils.calc_arrays_hash([label.vertices for label in labels])
+    key = utils.calc_arrays_hash([src_hash, labels_hash, mode])
+    output_fname = op.join(SUBJECT_MEG_FOLDER, 'labels_extraction_matrices', '{}_{}_{}_{}.npz'.format(
+        atlas, hemi, mode, key))
+    if op.isfile(output_fname) and not overwrite:
+        labels_matrix = sparse.load_npz(output_fname)
+        if labels_matrix.shape[0] == len(labels):
+            return labels_matrix
+    labels_matrix = create_labels_extraction_matrix(labels, src, mode)
+    utils.make_dir(utils.get_parent_fol(output_fname))
+    sparse.save_npz(output_fname, labels_matrix)
+    return labels_matrix
 
 
 def _load_labels_data_parallel(p):
@@ -5380,6 +5529,7 @@ def find_functional_rois_in_stc(
         dict(stc_name=stc_name, threshold=threshold, time=time_index, label_name_template=label_name_template, values=[],
              min_cluster_max=min_cluster_max, min_cluster_size=min_cluster_size, clusters_label=clusters_label))
     contours = {}
+    overlap_time = 0
     for hemi in utils.HEMIS:
         stc_data = (stc_t_smooth.rh_data if hemi == 'rh' else stc_t_smooth.lh_data).squeeze()
         if np.max(stc_data) < 1e-4:
@@ -5391,9 +5541,11 @@ def find_functional_rois_in_stc(
             continue
         labels_hemi = None if labels is None else labels[hemi]
         if find_clusters_overlapped_labeles:
+            now = time.time()
             clusters_labels_hemi = lu.find_clusters_overlapped_labeles(
                 subject, clusters, stc_data, atlas, hemi, verts[hemi], labels_hemi, min_cluster_max, min_cluster_size,
                 clusters_label, abs_max, n_jobs)
+            overlap_time += time.time() - now
         else:
             clusters_labels_hemi = []
             for cluster_ind, cluster in enumerate(clusters):
@@ -5418,6 +5570,9 @@ def find_functional_rois_in_stc(
                     subject, new_atlas_name, hemi, clusters_cortical_labels, clusters_fol, mri_subject,
                     verts, verts_neighbors_dict)
             clusters_labels.values.extend(clusters_labels_hemi)
+    if find_clusters_overlapped_labeles:
+        print('{}: {} clusters overlapped with {} in {:.2f}s'.format(
+            stc_name, len(clusters_labels.values), atlas, overlap_time))
     if save_results:
         if clusters_output_name == '':
             clusters_output_name = 'clusters_labels_{}.pkl'.format(stc_name, atlas)
@@ -5939,8 +6094,7 @@ def stc_to_contours(subject, stc_name, pick_t=0, thresholds_min=None, thresholds
     thresholds = np.arange(thresholds_min, thresholds_max + thresholds_dx, thresholds_dx)
     print('threshold: {}'.format(thresholds))
 
-    verts_neighbors_fname = op.join(MMVT_DIR, subject, 'verts_neighbors_{}.pkl')
-    verts_neighbors_dict = {hemi: utils.load(verts_neighbors_fname.format(hemi)) for hemi in utils.HEMIS}
+    verts_neighbors_dict = anat.load_verts_neighbors(subject)
 
     all_contours = {}
     now = time.time()
@@ -5980,8 +6134,7 @@ def find_clusters_over_time(
     if times is None:
         times = range(stc.shape[1])
 
-    verts_neighbors_fname = op.join(MMVT_DIR, subject, 'verts_neighbors_{}.pkl')
-    verts_neighbors_dict = {hemi: utils.load(verts_neighbors_fname.format(hemi)) for hemi in utils.HEMIS}
+    verts_neighbors_dict = anat.load_verts_neighbors(subject)
 
     all_contours = {}
     indices = np.array_split(np.arange(len(times)), n_jobs)
@@ -6147,6 +6300,10 @@ def main(tup, remote_subject_dir, org_args, flags=None):
     # if 'calc_activity_significance' in args.function:
     #     calc_activity_significance(conditions, inverse_method, stcs_conds)
 
+    if 'convert_activity_maps' in args.function:
+        flags['convert_activity_maps'] = utils.convert_activity_map_folders(
+            op.join(MMVT_DIR, mri_subject), args.delete_activity_maps_folders)
+
     if 'save_activity_map_minmax' in args.function:
         flags['save_activity_map_minmax'] = save_activity_map_minmax(
             None, conditions, stat, stcs_conds_smooth, inverse_method, args.morph_to_subject,
@@ -6161,7 +6318,8 @@ def main(tup, remote_subject_dir, org_args, flags=None):
     if 'morph_stc' in args.function:
         flags['morph_stc'] = morph_stc(
             MRI_SUBJECT, conditions, args.morph_to_subject, args.inverse_method[0], args.grade,
-            args.smoothing_iterations, args.overwrite_stc, args.n_jobs)
+            args.smoothing_iterations, overwrite=args.overwrite_stc, n_jobs=args.n_jobs,
+            use_cache=args.get('use_cache', False))
 
     if 'calc_stc_diff' in args.function:
         flags['calc_stc_diff'] = calc_stc_diff_both_hemis(
@@ -6324,6 +6482,8 @@ def read_cmd_args(argv=None):
     parser.add_argument('--overwrite_labels_induced_power', help='', required=False, default=0, type=au.is_true)
     parser.add_argument('--overwrite_baseline_sensors_bands_psd', help='', required=False, default=0, type=au.is_true)
     parser.add_argument('--overwrite_source_baseline_psd', help='', required=False, default=0, type=au.is_true)
+    parser.add_argument('--delete_activity_maps_folders', help='delete the legacy t{t}.npy folders after converting',
+                        required=False, default=0, type=au.is_true)
     parser.add_argument('--read_events_from_file', help='read_events_from_file', required=False, default=0, type=au.is_true)
     parser.add_argument('--read_events_as_annotation', help='read_events_as_annotation', required=False, default=0, type=au.is_true)
     parser.add_argument('--events_fname', help='events_fname', required=False, default='')
@@ -1,8 +1,5 @@
 import numpy as np
 import os.path as op
-import glob
-import time
-import traceback
 
 from src.utils import utils
 from src.utils import labels_utils as lu
@@ -13,10 +10,18 @@ SUBJECTS_DIR = utils.get_link_dir(links_dir, 'subjects', 'SUBJECTS_DIR')
 MMVT_DIR = utils.get_link_dir(links_dir, 'mmvt',)
 
 
-def mode(arr):
-    return np.bincount(arr).argmax()
-    #from collections import Counter
-    #return Counter(arr).most_common(1)
+def labels_ids_lookup_to_array(vertices_labels_ids_lookup, verts_num):
+    if isinstance(vertices_labels_ids_lookup, dict):
+        lookup = np.zeros(verts_num, dtype=int)
+        lookup[list(vertices_labels_ids_lookup.keys())] = list(vertices_labels_ids_lookup.values())
+        return lookup
+    return np.asarray(vertices_labels_ids_lookup, dtype=int)
+
+
+def faces_mode(faces_labels):
+    # The same as mode (bincount(x).argmax()) for every row: the most common label, or the smallest if all differ
+    l0, l1, l2 = faces_labels.T
+    return np.where((l0 == l1) | (l0 == l2), l0, np.where(l1 == l2, l1, np.min(faces_labels, axis=1)))
 
 
 # @utils.profileit(root_folder=op.join(MMVT_DIR, 'profileit'))
@@ -34,126 +39,64 @@ def parcelate(subject, atlas, hemi, surface_type, vertices_labels_ids_lookup=Non
         labels.append(lu.Label([], name='unknown-{}'.format(hemi), hemi=hemi))
 
     nV = vtx.shape[0]
-    nF = fac.shape[0]
     nL = len(labels)
-    # print('The number of unique labels is {}'.format(nL))
-
-    vtxL = [[] for _ in range(nL)]
-    facL = [[] for _ in range(nL)]
-
-    now = time.time()
-    for f in range(nF):
-        utils.time_to_go(now, f, nF, runs_num_to_print=50000)
-        # Current face & labels
-        Cfac = fac[f]
-        Cidx = [vertices_labels_ids_lookup[vert_ind] for vert_ind in Cfac]
-        # Depending on how many vertices of the current face
-        # are in different labels, behave differently
-        # nuCidx = len(np.unique(Cidx))
-        # if nuCidx == 1: # If all vertices share same label
-        # same_label = utils.all_items_equall(Cidx)
-        # if same_label:
-        if Cidx[0] == Cidx[1] == Cidx[2]:
-            # Add the current face to the list of faces of the
-            # respective label, and don't create new faces
-            facL[Cidx[0]] += [Cfac.tolist()]
-        else: # If 2 or 3 vertices are in different labels
-            # Create 3 new vertices at the midpoints of the 3 edges
-            vtxCfac = vtx[Cfac]
-            vtxnew = (vtxCfac + vtxCfac[[1, 2, 0]]) / 2
-            vtx = np.concatenate((vtx, vtxnew))
-            # Define 4 new faces, with care preserve normals (all CCW)
-            facnew = [
-                [Cfac[0], nV, nV + 2],
-                [nV,  Cfac[1], nV + 1],
-                [nV + 2,  nV + 1, Cfac[2]],
-                [nV, nV + 1, nV + 2]]
-            # Update nV for the next loop
-            nV = vtx.shape[0]
-            # Add the new faces to their respective labels
-            facL[Cidx[0]] += [facnew[0]]
-            facL[Cidx[1]] += [facnew[1]]
-            facL[Cidx[2]] += [facnew[2]]
-            freq_Cidx = mode(Cidx)
-            facL[freq_Cidx] += [facnew[3]] # central face
-    # Having defined new faces and assigned all faces to labels, now
-    # select the vertices and redefine faces to use the new vertex indices
-    # Also, create the file for the indices
-    # fidx = fopen(sprintf('%s.index.csv', srfprefix), 'w');
+    lookup = labels_ids_lookup_to_array(vertices_labels_ids_lookup, nV)
+    # The labels of the faces' vertices
+    fac_labels = lookup[fac]
+    same_label = (fac_labels[:, 0] == fac_labels[:, 1]) & (fac_labels[:, 1] == fac_labels[:, 2])
+    # Faces where all vertices share the same label are added to the label as they are
+    inner_faces_inds = np.where(same_label)[0]
+    # Faces where 2 or 3 vertices are in different labels are split into 4 new faces, using the midpoints of the
+    # 3 edges. The midpoints are shared between the faces that have the same edge.
+    border_faces_inds = np.where(~same_label)[0]
+    border_fac, border_labels = fac[border_faces_inds], fac_labels[border_faces_inds]
+    # The edges (v0, v1), (v1, v2), (v2, v0) of every border face
+    edges = np.stack((border_fac, border_fac[:, [1, 2, 0]]), axis=2)
+    edges = np.sort(edges, axis=2).astype(np.int64)
+    edges_keys = edges[:, :, 0] * nV + edges[:, :, 1]
+    unique_keys, mid_inds = np.unique(edges_keys.ravel(), return_inverse=True)
+    unique_edges = np.column_stack((unique_keys // nV, unique_keys % nV))
+    vtx = np.concatenate((vtx, (vtx[unique_edges[:, 0]] + vtx[unique_edges[:, 1]]) / 2))
+    mid_inds = mid_inds.reshape(edges_keys.shape) + nV
+    # Define 4 new faces, with care preserve normals (all CCW)
+    m0, m1, m2 = mid_inds.T
+    c0, c1, c2 = border_fac.T
+    new_faces = np.stack((
+        np.column_stack((c0, m0, m2)),
+        np.column_stack((m0, c1, m1)),
+        np.column_stack((m2, m1, c2)),
+        np.column_stack((m0, m1, m2))), axis=1).reshape((-1, 3))
+    # The new faces go to their vertex's label, and the central face goes to the most frequent label
+    new_faces_labels = np.column_stack((border_labels, faces_mode(border_labels))).ravel()
+    # Keep the faces in their original order inside each label
+    faces_order = np.concatenate((inner_faces_inds * 4, (border_faces_inds[:, np.newaxis] * 4 + np.arange(4)).ravel()))
+    all_faces = np.concatenate((fac[inner_faces_inds], new_faces))
+    all_faces_labels = np.concatenate((fac_labels[inner_faces_inds, 0], new_faces_labels))
+    sort_inds = np.lexsort((faces_order, all_faces_labels))
+    all_faces = all_faces[sort_inds]
+    labels_limits = np.concatenate(([0], np.cumsum(np.bincount(all_faces_labels, minlength=nL))))
 
-    # params = []
-    # for lab in range(nL):
-    #     facL_lab = facL[lab]
-    #     facL_lab_flat = utils.list_flatten(facL_lab)
-    #     vidx = list(set(facL_lab_flat))
-    #     vtxL_lab = vtx[vidx]
-    #     params.append((facL_lab, vtxL_lab, vidx, nV, labels[lab].name, hemi, output_fol))
-    # utils.run_parallel(writing_ply_files_parallel, params, njobs=n_jobs)
-    #
     ret = True
     for lab in range(nL):
-        ret = ret and writing_ply_files(subject, surface_type, lab, facL[lab], vtx, vtxL, labels, hemi, output_fol)
+        ret = ret and writing_ply_files(
+            surface_type, lab, all_faces[labels_limits[lab]:labels_limits[lab + 1]], vtx, labels, hemi, output_fol)
     return ret
-    # if ret:
-    #     labels_files_num = len(glob.glob(op.join(MMVT_DIR, subject, 'labels', '{}.{}.{}'.format(
-    #         atlas, surface_type, hemi), '*.ply')))
-    #     # print(atlas, surface_type, hemi, labels_files_num, len(labels))
-    #     if labels_files_num != len(labels):
-    #          print('labels_files_num = {}, but len(labels) = {}'.format(labels_files_num, len(labels)))
-    #     # todo: should check the the -1 is becase the unknowns weren't written
-    #     return labels_files_num <= len(labels) -1
-    # else:
-    #     return False
 
 
-def writing_ply_files(subject, surface_type, lab, facL_lab, vtx, vtxL, labels, hemi, output_fol):
-    # Vertices for the current label
-    nV = vtx.shape[0]
-    facL_lab_flat = utils.list_flatten(facL_lab)
-    if len(facL_lab_flat) == 0:
+def writing_ply_files(surface_type, lab, facL_lab, vtx, labels, hemi, output_fol):
+    if len(facL_lab) == 0:
         print("Cant write {}, no vertices!".format(labels[lab]))
         return True
-    vidx = list(set(facL_lab_flat))
-    vtxL[lab] = vtx[vidx]
-    # Reindex the faces
-    tmp = np.zeros(nV, dtype=np.int)
-    tmp[vidx] = np.arange(len(vidx))
-    try:
-        facL_lab = np.reshape(tmp[facL_lab_flat], (len(facL_lab), len(facL_lab[0])))
-    except:
-        print(traceback.format_exc())
-        dumps_fol = utils.make_dir(op.join(MMVT_DIR, subject, 'dumps'))
-        utils.save((lab, facL_lab, vtx, vtxL, labels, hemi, output_fol),
-                   op.join(dumps_fol, 'parcelate_cortex_writing_ply_files.pkl'))
-        return False
-
+    # Vertices for the current label, and the faces reindexed to them
+    vidx, facL_lab = np.unique(facL_lab, return_inverse=True)
+    facL_lab = facL_lab.reshape((-1, 3))
+    vtxL_lab = vtx[vidx]
     # Save the resulting surface
     label_name = '{}-{}.ply'.format(lu.get_label_hemi_invariant_name(labels[lab].name), hemi)
     # print('Writing {}'.format(op.join(output_fol, label_name)))
     # todo: add distance between hemis if inflated like with the activity surfaces
     if surface_type == 'inflated':
         verts_offset = 55 if hemi == 'rh' else -55
-        vtxL[lab][:, 0] = vtxL[lab][:, 0] + verts_offset
-    utils.write_ply_file(vtxL[lab], facL_lab, op.join(output_fol, label_name), True)
-    return op.isfile(op.join(output_fol, label_name))
-
-
-def writing_ply_files_parallel(p):
-    facL_lab, vtxL_lab, vidx, nV, label_name, hemi, output_fol = p
-    # Reindex the faces
-    tmp = np.zeros(nV, dtype=np.int)
-    tmp[vidx] = np.arange(len(vidx))
-    facL_lab_flat = utils.list_flatten(facL_lab)
-    facL_lab = np.reshape(tmp[facL_lab_flat], (len(facL_lab), len(facL_lab[0])))
-    # Save the resulting surface
-    label_name = '{}-{}.ply'.format(lu.get_label_hemi_invariant_name(label_name), hemi)
-    # print('Writing {}'.format(op.join(output_fol, label_name)))
+        vtxL_lab[:, 0] = vtxL_lab[:, 0] + verts_offset
     utils.write_ply_file(vtxL_lab, facL_lab, op.join(output_fol, label_name), True)
-
-
-if __name__ == '__main__':
-    subject = 'nmr01121'
-    dumps_fol = op.join(MMVT_DIR, subject, 'dumps')
-    (lab, facL_lab, vtx, vtxL, labels, hemi, output_fol) = utils.load(
-        op.join(dumps_fol, 'parcelate_cortex_writing_ply_files.pkl'))
-    writing_ply_files(subject, lab, facL_lab, vtx, vtxL, labels, hemi, output_fol)
\ No newline at end of file
+    return op.isfile(op.join(output_fol, label_name))
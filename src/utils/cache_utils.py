@@ -0,0 +1,280 @@
+import os
+import os.path as op
+import glob
+import json
+import time
+import shutil
+import hashlib
+import inspect
+
+# A content addressed cache of preprocessing steps outputs, in the subject's folder ({root}/artifacts_cache):
+# * objects/{hash[:2]}/{hash}: the outputs files, stored once by their content hash.
+# * steps/{key}.json: the manifest of a step's run, {output file: content hash}, where the key is a hash of the step
+#   name, the input files contents, the parameters and the step's code (its source).
+# * file_hashes.json: the inputs and outputs hashes, by their size and mtime, so unchanged files aren't read again.
+# * stats.log: a line per lookup (hit / miss), for the hits and misses stats and the time the hits saved.
+# If a step runs again with the same inputs, parameters and code, its outputs are restored from the cache instead.
+
+CACHE_FOL = 'artifacts_cache'
+
+
+class ArtifactsCache(object):
+
+    def __init__(self, root_fol):
+        self.root_fol = root_fol
+        self.cache_fol = op.join(root_fol, CACHE_FOL)
+        self.objects_fol = op.join(self.cache_fol, 'objects')
+        self.steps_fol = op.join(self.cache_fol, 'steps')
+        self.hashes_fname = op.join(self.cache_fol, 'file_hashes.json')
+        self.stats_fname = op.join(self.cache_fol, 'stats.log')
+        self.file_hashes = None
+
+    def _load_file_hashes(self):
+        if self.file_hashes is None:
+            self.file_hashes = {}
+            if op.isfile(self.hashes_fname):
+                try:
+                    with open(self.hashes_fname, 'r') as f:
+                        self.file_hashes = json.load(f)
+                except ValueError:
+                    pass
+        return self.file_hashes
+
+    def _save_file_hashes(self):
+        os.makedirs(self.cache_fol, exist_ok=True)
+        _write_json_atomic(self._load_file_hashes(), self.hashes_fname)
+
+    def file_hash(self, fname):
+        fname = op.abspath(fname)
+        stat = os.stat(fname)
+        file_hashes = self._load_file_hashes()
+        if fname in file_hashes and file_hashes[fname][:2] == [stat.st_size, stat.st_mtime]:
+            return file_hashes[fname][2]
+        md5 = hashlib.md5()
+        with open(fname, 'rb') as f:
+            for block in iter(lambda: f.read(2 ** 20), b''):
+                md5.update(block)
+        file_hashes[fname] = [stat.st_size, stat.st_mtime, md5.hexdigest()]
+        return file_hashes[fname][2]
+
+    def calc_key(self, step_name, inputs=(), params=None, code=None):
+        md5 = hashlib.md5()
+        md5.update(step_name.encode())
+        for fname in expand_files(inputs):
+            md5.update(self.rel_path(fname).encode())
+            md5.update(self.file_hash(fname).encode() if op.isfile(fname) else b'missing')
+        md5.update(json.dumps(params, sort_keys=True, default=str).encode())
+        md5.update(calc_code_version(code).encode())
+        self._save_file_hashes()
+        return md5.hexdigest()
+
+    def rel_path(self, fname):
+        fname = op.abspath(fname)
+        root = op.abspath(self.root_fol) + os.sep
+        return fname[len(root):] if fname.startswith(root) else fname
+
+    def abs_path(self, fname):
+        return fname if op.isabs(fname) else op.join(self.root_fol, fname)
+
+    def object_fname(self, file_hash):
+        return op.join(self.objects_fol, file_hash[:2], file_hash)
+
+    def manifest_fname(self, key):
+        return op.join(self.steps_fol, '{}.json'.format(key))
+
+    def restore(self, key, step_name=''):
+        # Restores the outputs of the step's run with this key. Returns False if it's not in the cache
+        manifest_fname = self.manifest_fname(key)
+        if not op.isfile(manifest_fname):
+            self.log('miss', step_name)
+            return False
+        with open(manifest_fname, 'r') as f:
+            manifest = json.load(f)
+        files = manifest['files']
+        if not all([op.isfile(self.object_fname(file_hash)) for file_hash in files.values()]):
+            self.log('miss', step_name)
+            return False
+        for fname, file_hash in files.items():
+            fname = self.abs_path(fname)
+            if op.isfile(fname) and self.file_hash(fname) == file_hash:
+                continue
+            os.makedirs(op.dirname(fname), exist_ok=True)
+            _copy_atomic(self.object_fname(file_hash), fname)
+            # The restored file has a new mtime
+            stat = os.stat(fname)
+            self._load_file_hashes()[op.abspath(fname)] = [stat.st_size, stat.st_mtime, file_hash]
+        self._save_file_hashes()
+        os.utime(manifest_fname)
+        self.log('hit', step_name, manifest.get('run_time', 0))
+        return True
+
+    def store(self, key, step_name, outputs, run_time=0):
+        files = {}
+        for fname in expand_files(outputs):
+            if not op.isfile(fname):
+                continue
+            file_hash = self.file_hash(fname)
+            object_fname = self.object_fname(file_hash)
+            if not op.isfile(object_fname):
+                os.makedirs(op.dirname(object_fname), exist_ok=True)
+                _copy_atomic(fname, object_fname)
+            files[self.rel_path(fname)] = file_hash
+        if len(files) == 0:
+            return False
+        self._save_file_hashes()
+        os.makedirs(self.steps_fol, exist_ok=True)
+        _write_json_atomic(dict(step=step_name, created=time.time(), run_time=run_time, files=files),
+                           self.manifest_fname(key))
+        return True
+
+    def log(self, event, step_name, run_time=0):
+        os.makedirs(self.cache_fol, exist_ok=True)
+        with open(self.stats_fname, 'a') as f:
+            f.write('{}\t{}\t{}\t{:.3f}\n'.format(time.time(), event, step_name, run_time))
+
+    def stats(self):
+        # step -> [hits, misses, the time the hits saved]
+        stats = {}
+        if not op.isfile(self.stats_fname):
+            return stats
+        with open(self.stats_fname, 'r') as f:
+            for line in f:
+                fields = line.strip().split('\t')
+                if len(fields) != 4:
+                    continue
+                _, event, step_name, run_time = fields
+                step_stats = stats.setdefault(step_name, [0, 0, 0.0])
+                if event == 'hit':
+                    step_stats[0] += 1
+                    step_stats[2] += float(run_time)
+                else:
+                    step_stats[1] += 1
+        return stats
+
+    def manifests(self):
+        manifests = {}
+        for manifest_fname in glob.glob(op.join(self.steps_fol, '*.json')):
+            with open(manifest_fname, 'r') as f:
+                manifests[op.basename(manifest_fname)[:-len('.json')]] = json.load(f)
+        return manifests
+
+    def disk_usage(self):
+        # The objects size (MB), total and per step (an object which is used by several steps is counted in each)
+        objects_sizes = {op.basename(fname): op.getsize(fname)
+                         for fname in glob.glob(op.join(self.objects_fol, '*', '*'))}
+        steps_sizes = {}
+        for manifest in self.manifests().values():
+            steps_sizes[manifest['step']] = steps_sizes.get(manifest['step'], 0) + sum(
+                [objects_sizes.get(file_hash, 0) for file_hash in manifest['files'].values()])
+        to_mb = lambda size: size / 2 ** 20
+        return to_mb(sum(objects_sizes.values())), {step: to_mb(size) for step, size in steps_sizes.items()}
+
+    def prune(self, max_age_days=None):
+        # Removes the manifests which weren't used in max_age_days, and the objects no manifest uses
+        if max_age_days is not None:
+            for manifest_fname in glob.glob(op.join(self.steps_fol, '*.json')):
+                if time.time() - op.getmtime(manifest_fname) > max_age_days * 24 * 3600:
+                    os.remove(manifest_fname)
+        used_hashes = set([file_hash for manifest in self.manifests().values()
+                           for file_hash in manifest['files'].values()])
+        removed_size = 0
+        for object_fname in glob.glob(op.join(self.objects_fol, '*', '*')):
+            if op.basename(object_fname) not in used_hashes:
+                removed_size += op.getsize(object_fname)
+                os.remove(object_fname)
+        return removed_size / 2 ** 20
+
+    def clear(self):
+        if op.isdir(self.cache_fol):
+            shutil.rmtree(self.cache_fol)
+        self.file_hashes = None
+
+
+def expand_files(fnames):
+    files = []
+    for fname in fnames:
+        files.extend(sorted(glob.glob(fname)) if glob.has_magic(fname) else [fname])
+    return files
+
+
+def calc_code_versions(codes):
+    # One version for several functions / modules sources, and version strings (like the libraries versions)
+    return hashlib.md5(','.join([calc_code_version(code) for code in codes]).encode()).hexdigest()
+
+
+def calc_code_version(code):
+    # A hash of the function's source, or of its module file if the source isn't available
+    if code is None:
+        return ''
+    if isinstance(code, str):
+        return code
+    try:
+        return hashlib.md5(inspect.getsource(code).encode()).hexdigest()
+    except (TypeError, OSError):
+        module = inspect.getmodule(code)
+        module_fname = getattr(module, '__file__', None)
+        if module_fname is None or not op.isfile(module_fname):
+            return ''
+        with open(module_fname, 'rb') as f:
+            return hashlib.md5(f.read()).hexdigest()
+
+
+def run_cached(root_fol, step_name, func, inputs, outputs, params=None, code=None, overwrite=False):
+    # Restores the step's outputs from the cache if it already ran with the same inputs, parameters and code,
+    # otherwise calls func() and stores the outputs. The outputs can be glob patterns. With overwrite, func() is
+    # always called, and its outputs replace the cached ones
+    cache = ArtifactsCache(root_fol)
+    key = cache.calc_key(step_name, inputs, params, func if code is None else code)
+    if not overwrite and cache.restore(key, step_name):
+        print('{}: The outputs were restored from the cache'.format(step_name))
+        return True
+    now = time.time()
+    ret = func()
+    if ret is not False and ret is not None:
+        cache.store(key, step_name, outputs, time.time() - now)
+    return ret
+
+
+def report(root_fol):
+    cache = ArtifactsCache(root_fol)
+    stats = cache.stats()
+    total_size, steps_sizes = cache.disk_usage()
+    print('Cache {}: {:.1f}MB'.format(cache.cache_fol, total_size))
+    for step_name in sorted(set(stats.keys()) | set(steps_sizes.keys())):
+        hits, misses, saved_time = stats.get(step_name, [0, 0, 0])
+        print('{}: {} hits, {} misses ({:.0f}% hits), saved {:.1f}s, {:.1f}MB'.format(
+            step_name, hits, misses, hits / (hits + misses) * 100 if hits + misses > 0 else 0, saved_time,
+            steps_sizes.get(step_name, 0)))
+
+
+def _copy_atomic(src_fname, dst_fname):
+    tmp_fname = '{}.{}.tmp'.format(dst_fname, os.getpid())
+    shutil.copyfile(src_fname, tmp_fname)
+    os.replace(tmp_fname, dst_fname)
+
+
+def _write_json_atomic(obj, fname):
+    tmp_fname = '{}.{}.tmp'.format(fname, os.getpid())
+    with open(tmp_fname, 'w') as f:
+        json.dump(obj, f)
+    os.replace(tmp_fname, fname)
+
+
+if __name__ == '__main__':
+    import argparse
+    from src.utils import utils
+    from src.utils import args_utils as au
+    parser = argparse.ArgumentParser(description='MMVT artifacts cache')
+    parser.add_argument('-s', '--subject', help='subject name', required=True, type=au.str_arr_type)
+    parser.add_argument('-f', '--function', help='report, prune or clear', required=False, default='report')
+    parser.add_argument('--max_age_days', required=False, default=None, type=float)
+    args = utils.Bag(au.parse_parser(parser))
+    mmvt_dir = op.join(utils.get_links_dir(), 'mmvt')
+    for subject in args.subject:
+        subject_fol = op.join(mmvt_dir, subject)
+        if args.function == 'report':
+            report(subject_fol)
+        elif args.function == 'prune':
+            print('{}: {:.1f}MB were removed'.format(subject, ArtifactsCache(subject_fol).prune(args.max_age_days)))
+        elif args.function == 'clear':
+            ArtifactsCache(subject_fol).clear()
@@ -7,13 +7,14 @@ import shutil
 import glob
 import traceback
 import functools
-from collections import defaultdict, Counter
+from collections import defaultdict
 from tqdm import tqdm
 import nibabel as nib
 from functools import partial
 import re
 
 from src.mmvt_addon import mmvt_utils as mu
+from src.mmvt_addon import topology_utils as tu
 from src.utils import freesurfer_utils as fu
 from src.utils import args_utils as au
 
@@ -232,9 +233,10 @@ def create_vertices_labels_lookup(subject, atlas, save_labels_ids=False, overwri
     from src.utils import geometry_utils as gu
 
     def check_loopup_is_ok(lookup):
-        unique_values_num = sum([len(set(lookup[hemi].values())) for hemi in hemis])
+        unique_values = {hemi: np.unique(lookup[hemi].values()) for hemi in hemis}
+        unique_values_num = sum([len(unique_values[hemi]) for hemi in hemis])
         # check it's not only the unknowns
-        lookup_ok = not all([len(set(lookup[hemi].values())) == 1 and 'unknown' in lookup[hemi].values() for hemi in hemis])
+        lookup_ok = not all([len(unique_values[hemi]) == 1 and 'unknown' in unique_values[hemi] for hemi in hemis])
         err = ''
         if not lookup_ok:
             err = 'unique_values_num = {}\n'.format(unique_values_num)
@@ -258,17 +260,17 @@ def create_vertices_labels_lookup(subject, atlas, save_labels_ids=False, overwri
         return lookup_ok, err
 
     hemis = utils.HEMIS if hemi == 'both' else [hemi]
-    output_fname = op.join(MMVT_DIR, subject, '{}_vertices_labels_{}lookup.pkl'.format(
-        atlas, 'ids_' if save_labels_ids else ''))
-    if op.isfile(output_fname) and not overwrite:
-        lookup = utils.load(output_fname)
-        loopup_is_ok, _ = check_loopup_is_ok(lookup)
-        if loopup_is_ok:
-            return lookup
+    subject_fol = op.join(MMVT_DIR, subject)
+    if not overwrite:
+        lookup = {hemi: tu.load_atlas_vertices_labels_lookup(subject_fol, atlas, hemi, save_labels_ids)
+                  for hemi in hemis}
+        if all([lookup[hemi] is not None for hemi in hemis]):
+            loopup_is_ok, _ = check_loopup_is_ok(lookup)
+            if loopup_is_ok:
+                return lookup
     lookup = {}
 
     for hemi in hemis:
-        lookup[hemi] = {}
         if labels_dict is None:
             if read_labels_from_fol != '':
                 labels = read_labels(subject, SUBJECTS_DIR, atlas, hemi=hemi, try_first_from_annotation=False,
@@ -317,22 +319,22 @@ def create_vertices_labels_lookup(subject, atlas, save_labels_ids=False, overwri
                 hemi, sum([len(l.vertices) for l in labels]), len(verts)))
             if not au.is_true(ret):
                 raise Exception('Wrong number of vertices!')
-        verts_indices = set(range(len(verts)))
-        assign_vertices = set()
-        for label in labels:
-            for vertice in label.vertices:
-                if vertice in verts_indices:
-                    lookup[hemi][vertice] = labels_names.index(label.name) if save_labels_ids else label.name
-                    assign_vertices.add(vertice)
-                else:
-                    print('vertice {} of label {} not in verts! ({}, {})'.format(vertice, label.name, subject, hemi))
-        not_assign_vertices = verts_indices - assign_vertices
-        for vertice in not_assign_vertices:
-            lookup[hemi][vertice] = len(labels_names) if save_labels_ids else 'unknown_{}'.format(hemi)
+        # The not assigned vertices get the last id, which is 'unknown_{hemi}'
+        labels_ids = np.full(len(verts), len(labels_names), dtype=np.int16)
+        for label_ind, label in enumerate(labels):
+            label_vertices = np.asarray(label.vertices)
+            out_of_verts = label_vertices >= len(verts)
+            for vertice in label_vertices[out_of_verts]:
+                print('vertice {} of label {} not in verts! ({}, {})'.format(vertice, label.name, subject, hemi))
+            labels_ids[label_vertices[~out_of_verts]] = labels_names.index(label.name)
+        lookup[hemi] = tu.VerticesLabelsLookup(
+            labels_ids, labels_names + ['unknown_{}'.format(hemi)], save_labels_ids)
     loopup_is_ok, err = check_loopup_is_ok(lookup)
     if loopup_is_ok:
         if save_lookup:
-            utils.save(lookup, output_fname)
+            for hemi in hemis:
+                tu.save_vertices_labels_lookup(
+                    subject_fol, atlas, hemi, lookup[hemi].labels_ids, lookup[hemi].labels_names)
         return lookup
     else:
         print('unknown labels: ', [l for l in labels_names if 'unknown' in l])
@@ -411,18 +413,26 @@ def morph_annot(subject, template_brain, atlas, overwrite_subject_vertices_label
 
 
 def calc_subject_vertices_labels_lookup_from_template(subject, template_brain, atlas, overwrite=False):
-    # from scipy.spatial.distance import cdist
-    # max_upper_limit = 4
-    # check_distances = False
-    filter_unknown = True
-
-    output_fname = op.join(MMVT_DIR, subject, '{}_vertices_labels_lookup.pkl'.format(atlas))
-    if op.isfile(output_fname) and not overwrite:
-        subject_vertices_labels_lookup = utils.load(output_fname)
-        if len(subject_vertices_labels_lookup.get('rh', {})) > 0 and \
-                len(subject_vertices_labels_lookup.get('lh', {})) > 0:
-            return subject_vertices_labels_lookup
-    template_vertices_labels_lookup = create_vertices_labels_lookup(template_brain, atlas)
+    return calc_subject_atlases_vertices_labels_lookups_from_template(
+        subject, template_brain, [atlas], overwrite)[atlas]
+
+
+def calc_subject_atlases_vertices_labels_lookups_from_template(subject, template_brain, atlases, overwrite=False):
+    # Transfers the template's atlases labels to the subject: every subject vertex gets the label of its highest
+    # weight template vertex in the morph map, which isn't unknown. The morph map is read and ranked once for all
+    # the atlases. Returns {atlas: {hemi: lookup}}
+    subject_fol = op.join(MMVT_DIR, subject)
+    subject_vertices_labels_lookups = {}
+    if not overwrite:
+        for atlas in atlases:
+            lookup = {hemi: tu.load_atlas_vertices_labels_lookup(subject_fol, atlas, hemi) for hemi in utils.HEMIS}
+            if all([hemi_lookup is not None and len(hemi_lookup) > 0 for hemi_lookup in lookup.values()]):
+                subject_vertices_labels_lookups[atlas] = lookup
+    atlases = [atlas for atlas in atlases if atlas not in subject_vertices_labels_lookups]
+    if len(atlases) == 0:
+        return subject_vertices_labels_lookups
+    templates_vertices_labels_lookups = {
+        atlas: create_vertices_labels_lookup(template_brain, atlas) for atlas in atlases}
     for morph_maps_root in [MMVT_DIR, SUBJECTS_DIR]:
         morph_maps_fol = op.join(morph_maps_root, 'morph_maps')
         if op.isfile(op.join(morph_maps_fol, '{}-{}-morph.fif'.format(subject, template_brain))) and \
@@ -431,41 +441,58 @@ def calc_subject_vertices_labels_lookup_from_template(subject, template_brain, a
     # left_map, right_map : sparse matrix, subject verts x template verts
     morph_maps = mne.read_morph_map(template_brain, subject, subjects_dir=morph_maps_root)
 
-    subject_vertices_labels_lookup = defaultdict(dict)
-    vertices_num = []
+    for atlas in atlases:
+        subject_vertices_labels_lookups[atlas] = {}
     for hemi_ind, hemi in enumerate(['lh', 'rh']):
+        now = time.time()
         subject_vertices, _ = read_pial(subject, hemi)
         template_vertices, _ = read_pial(template_brain, hemi)
-
         if len(subject_vertices) != morph_maps[hemi_ind].shape[0]:
             raise Exception('Wrong number of vertices!')
-        if not (len(template_vertices) == morph_maps[hemi_ind].shape[1] ==
-                len(template_vertices_labels_lookup[hemi].keys())):
-            raise Exception('Wrong number of vertices in the morphing map!')
-
-        for subject_vert in tqdm(range(len(subject_vertices))):
-            template_verts_inds = morph_maps[hemi_ind][subject_vert].nonzero()[1]
-            verts_labels = [
-                template_vertices_labels_lookup[hemi][template_vert] for template_vert in template_verts_inds]
-            # if len(template_verts_inds) > 1 and check_distances:
-            #     dists = np.max(cdist(template_vertices[template_verts_inds], template_vertices[template_verts_inds]))
-            #     if np.max(dists) > max_upper_limit:
-            #         raise Exception('dist to high! {} max_dists {}'.format(verts_labels, dists))
-            # filter unknown
-            if filter_unknown:
-                verts_labels = [l for l in verts_labels if 'unknown' not in l]
-            vertices_num.append(len(verts_labels))
-            if len(verts_labels) == 0:
-                verts_label = 'unknown-{}'.format(hemi)
-            elif len(verts_labels) == 1:
-                verts_label = verts_labels[0]
-            else:
-                verts_label = Counter(verts_labels).most_common()[0][0]
-            if verts_label.endswith('_{}'.format(hemi)):
-                verts_label = '{}-{}'.format(verts_label[:-3], hemi)
-            subject_vertices_labels_lookup[hemi][subject_vert] = verts_label
-    utils.save(subject_vertices_labels_lookup, output_fname)
-    return subject_vertices_labels_lookup
+        for atlas in atlases:
+            if not (len(template_vertices) == morph_maps[hemi_ind].shape[1] ==
+                    len(templates_vertices_labels_lookups[atlas][hemi])):
+                raise Exception('Wrong number of vertices in the morphing map!')
+        ranked_template_vertices = calc_morph_map_ranked_vertices(morph_maps[hemi_ind])
+        for atlas in atlases:
+            template_lookup = templates_vertices_labels_lookups[atlas][hemi]
+            labels_names = [str(label_name) for label_name in template_lookup.labels_names]
+            known_labels = np.array(['unknown' not in label_name for label_name in labels_names], dtype=bool)
+            # The not assigned vertices get the template's last id, which is unknown_{hemi}
+            known_labels[-1] = False
+            labels_names = ['{}-{}'.format(label_name[:-3], hemi) if known and label_name.endswith('_{}'.format(hemi))
+                            else label_name for label_name, known in zip(labels_names, known_labels)]
+            labels_ids = transfer_vertices_labels_ids(
+                ranked_template_vertices, np.asarray(template_lookup), known_labels)
+            subject_vertices_labels_lookups[atlas][hemi] = tu.VerticesLabelsLookup(labels_ids, labels_names)
+            tu.save_vertices_labels_lookup(subject_fol, atlas, hemi, labels_ids, labels_names)
+        print('{} {}: {} atlases were transferred from {} in {:.2f}s'.format(
+            subject, hemi, len(atlases), template_brain, time.time() - now))
+    return subject_vertices_labels_lookups
+
+
+def calc_morph_map_ranked_vertices(morph_map):
+    # The template vertices of every subject vertex (a row in the morph map), ranked by their weights, and padded
+    # with -1. It's taken directly from the CSR arrays, where ties are ranked by the template vertex index
+    morph_map = morph_map.tocsr()
+    morph_map.sum_duplicates()
+    rows_nnz = np.diff(morph_map.indptr)
+    rows = np.repeat(np.arange(morph_map.shape[0]), rows_nnz)
+    order = np.lexsort((morph_map.indices, -morph_map.data, rows))
+    ranks = np.arange(len(order)) - morph_map.indptr[rows]
+    ranked_vertices = np.full((morph_map.shape[0], max(rows_nnz.max(initial=0), 1)), -1, dtype=np.int64)
+    ranked_vertices[rows, ranks] = morph_map.indices[order]
+    return ranked_vertices
+
+
+def transfer_vertices_labels_ids(ranked_template_vertices, template_labels_ids, known_labels):
+    # The label id of the first ranked template vertex with a known label, or the last id (unknown) if there isn't one
+    unknown_id = len(known_labels) - 1
+    labels_ids = np.where(
+        ranked_template_vertices >= 0, template_labels_ids[ranked_template_vertices], unknown_id)
+    known = known_labels[labels_ids]
+    rows, first_known = np.arange(len(labels_ids)), np.argmax(known, axis=1)
+    return np.where(known[rows, first_known], labels_ids[rows, first_known], unknown_id).astype(np.int16)
 
 
 def calc_subject_to_subject_vertices_lookup(subject_from, subject_to, overwrite=False):
@@ -812,7 +839,7 @@ def read_labels_parallel(subject, subjects_dir, atlas, hemi='', labels_fol='', n
         else:
             labels_files = glob.glob(op.join(labels_fol, '*.label'))
         files_chunks = utils.chunks(labels_files, len(labels_files) / n_jobs)
-        results = utils.run_parallel(_read_labels_parallel, files_chunks, njobs=n_jobs)
+        results = utils.run_parallel(_read_labels_parallel, files_chunks, njobs=n_jobs, reuse_pool=True)
         labels = []
         for labels_chunk in results:
             labels.extend(labels_chunk)
@@ -1081,18 +1108,78 @@ def grow_label(subject, vertice_indice, hemi, new_label_name, new_label_r=5, n_j
     return new_label_fname
 
 
+ATLAS_LABELS_IDS_CACHE = {}
+
+
+def load_atlas_labels_ids(subject, atlas, hemi, vertices_num=0, n_jobs=6):
+    # The hemi's vertex -> label id array and the labels names, from the subject's vertices labels lookup. They're
+    # kept in memory as long as the lookup file wasn't changed. If there is no lookup, they are calculated from the
+    # atlas' labels, without creating the lookup. Returns None and no names if the labels can't be read
+    key = (subject, atlas, hemi)
+    lookup_fname = tu.vertices_labels_fname(op.join(MMVT_DIR, subject), atlas, hemi)
+    try:
+        if key in ATLAS_LABELS_IDS_CACHE and op.isfile(lookup_fname) and \
+                ATLAS_LABELS_IDS_CACHE[key][0] == op.getmtime(lookup_fname):
+            return ATLAS_LABELS_IDS_CACHE[key][1]
+        lookup = tu.load_atlas_vertices_labels_lookup(op.join(MMVT_DIR, subject), atlas, hemi)
+        if lookup is None:
+            labels = read_labels(subject, SUBJECTS_DIR, atlas, hemi=hemi, n_jobs=n_jobs)
+            return calc_labels_ids(labels, vertices_num, hemi) if len(labels) > 0 else (None, [])
+        labels_ids = (np.asarray(lookup), lookup.labels_names)
+        if op.isfile(lookup_fname):
+            ATLAS_LABELS_IDS_CACHE[key] = (op.getmtime(lookup_fname), labels_ids)
+        return labels_ids
+    except:
+        print(traceback.format_exc())
+        return None, []
+
+
+def calc_labels_ids(labels, vertices_num, hemi):
+    # Like the vertices labels lookup, the not assigned vertices get the last id, unknown_{hemi}
+    labels_names = [label.name for label in labels] + ['unknown_{}'.format(hemi)]
+    vertices_num = max([vertices_num] + [np.max(label.vertices) + 1 for label in labels if len(label.vertices) > 0])
+    labels_ids = np.full(vertices_num, len(labels), dtype=np.int16)
+    for label_ind, label in enumerate(labels):
+        labels_ids[label.vertices] = label_ind
+    return labels_ids, labels_names
+
+
+def calc_clusters_labels_overlaps(clusters, labels_ids, labels_num):
+    # The clusters x labels number of overlapped vertices, from one bincount over all the clusters vertices, where
+    # every vertex is indexed by its cluster id and label id. Vertices which aren't in labels_ids are counted in the
+    # last label (unknown). Every vertex has one label, so with overlapping labels, a vertex is counted only in one
+    if len(clusters) == 0:
+        return np.zeros((0, labels_num), dtype=int)
+    clusters_vertices = np.concatenate(clusters)
+    clusters_ids = np.repeat(np.arange(len(clusters)), [len(cluster) for cluster in clusters])
+    vertices_labels = np.full(len(clusters_vertices), labels_num - 1)
+    in_lookup = clusters_vertices < len(labels_ids)
+    vertices_labels[in_lookup] = labels_ids[clusters_vertices[in_lookup]]
+    overlaps = np.bincount(clusters_ids * labels_num + vertices_labels, minlength=len(clusters) * labels_num)
+    return overlaps.reshape((len(clusters), labels_num))
+
+
 def find_clusters_overlapped_labeles(subject, clusters, data, atlas, hemi, verts, labels=None,
         min_cluster_max=0, min_cluster_size=0, clusters_label='', abs_max=True, n_jobs=6):
+    now = time.time()
     cluster_labels = []
     if not op.isfile(op.join(SUBJECTS_DIR, subject, 'surf', '{}.pial'.format(hemi))):
         from src.utils import freesurfer_utils as fu
         verts, faces = utils.read_pial(subject, MMVT_DIR, hemi)
         fu.write_surf(op.join(SUBJECTS_DIR, subject, 'surf', '{}.pial'.format(hemi)), verts, faces)
     if labels is None:
-        labels = read_labels(subject, SUBJECTS_DIR, atlas, hemi=hemi, n_jobs=n_jobs)
-    if len(labels) == 0:
+        labels_ids, labels_names = load_atlas_labels_ids(subject, atlas, hemi, len(verts), n_jobs)
+    elif len(labels) > 0:
+        labels_ids, labels_names = calc_labels_ids(labels, len(verts), hemi)
+    else:
+        labels_names = []
+    if len(labels_names) == 0:
         print('No labels!')
         return None
+    # The vertices which aren't in labels_ids are counted in the last label, which should be unknown
+    assert('unknown' in labels_names[-1])
+    known_labels = np.array(['unknown' not in label_name for label_name in labels_names], dtype=bool)
+    selected_clusters, clusters_max, max_verts = [], [], []
     for cluster in clusters:
         x = data[cluster]
         if abs_max:
@@ -1105,25 +1192,22 @@ def find_clusters_overlapped_labeles(subject, clusters, data, atlas, hemi, verts
             max_vert_ind = np.argmax(x)
             if cluster_max < min_cluster_max or len(cluster) < min_cluster_size:
                 continue
-        max_vert = cluster[max_vert_ind]
-        inter_labels, inter_labels_tups = [], []
-        for label in labels:
-            overlapped_vertices = np.intersect1d(cluster, label.vertices)
-            if len(overlapped_vertices) > 0:
-                if 'unknown' not in label.name:
-                    inter_labels_tups.append((len(overlapped_vertices), label.name))
-                    # inter_labels.append(dict(name=label.name, num=len(overlapped_vertices)))
-        inter_labels_tups = sorted(inter_labels_tups)[::-1]
-        for inter_labels_tup in inter_labels_tups:
-            inter_labels.append(dict(name=inter_labels_tup[1], num=inter_labels_tup[0]))
+        selected_clusters.append(cluster)
+        clusters_max.append(cluster_max)
+        max_verts.append(cluster[max_vert_ind])
+    overlaps = calc_clusters_labels_overlaps(selected_clusters, labels_ids, len(labels_names))
+    overlaps[:, ~known_labels] = 0
+    for cluster, cluster_max, max_vert, cluster_overlaps in zip(selected_clusters, clusters_max, max_verts, overlaps):
+        inter_labels_tups = sorted([(int(cluster_overlaps[label_id]), str(labels_names[label_id]))
+                                    for label_id in np.flatnonzero(cluster_overlaps)])[::-1]
+        inter_labels = [dict(name=name, num=num) for num, name in inter_labels_tups]
         if len(inter_labels) > 0 and (clusters_label in inter_labels[0]['name'] or clusters_label == ''):
             print('Cluster max {:.2f}, intersected: {}'.format(
                 cluster_max, ','.join(['{} {}'.format(t[1], t[0]) for t in inter_labels_tups])))
-            # max_inter = max([(il['num'], il['name']) for il in inter_labels])
             cluster_labels.append(dict(vertices=cluster, intersects=inter_labels, name=inter_labels[0]['name'],
                 coordinates=verts[cluster], max=cluster_max, hemi=hemi, size=len(cluster), max_vert=max_vert))
-        # else:
-        #     print('No intersected labels!')
+    print('find_clusters_overlapped_labeles {}: {} clusters ({} selected) x {} labels, {:.2f}s'.format(
+        hemi, len(clusters), len(selected_clusters), len(labels_names), time.time() - now))
     return cluster_labels
 
 
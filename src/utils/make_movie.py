@@ -4,6 +4,7 @@ import matplotlib.animation as animation
 import matplotlib.image as mpimg
 import matplotlib.pyplot as plt
 from matplotlib import gridspec
+import matplotlib.colors as mcolors
 import os.path as op
 import glob
 from PIL import Image
@@ -25,7 +26,62 @@ def ani_frame(time_range, xticks, images, dpi, fps, video_fname, cb_data_type,
         data_to_show_in_graph, fol, fol2, cb_title='', cb_min_max_eq=True, cb_norm_percs=None, color_map='jet',
         cb2_data_type='', cb2_title='', cb2_min_max_eq=True, color_map2='jet', bitrate=5000, images2=(),
         ylim=(), ylabels=(), xticklabels=(), xlabel='Time (ms)', show_first_pic=False,
-        show_animation=False, overwrite=True):
+        show_animation=False, overwrite=True, n_jobs=1):
+
+    movie_fig = create_movie_figure(
+        time_range, xticks, images, dpi, cb_data_type, data_to_show_in_graph, fol, fol2, cb_title, cb_min_max_eq,
+        cb_norm_percs, color_map, cb2_data_type, cb2_title, cb2_min_max_eq, color_map2, images2, ylim, ylabels,
+        xticklabels, xlabel)
+    fig, im, im2, t_line = movie_fig.fig, movie_fig.im, movie_fig.im2, movie_fig.t_line
+    ymin, ymax = movie_fig.ymin, movie_fig.ymax
+
+    now = time.time()
+    if show_first_pic:
+        plt.show()
+
+    def init_func():
+        return update_img(0)
+
+    def update_img(image_index):
+        # print(image_fname)
+        utils.time_to_go(now, image_index, len(images))
+        image = mpimg.imread(images[image_index])
+        im.set_data(image)
+        if im2:
+            image2 = mpimg.imread(images2[image_index])
+            im2.set_data(image2)
+
+        current_t = get_t(images, image_index, time_range)
+        if not current_t is None:
+            t_line.set_data([current_t, current_t], [ymin, ymax])
+            # print('Reading image {}, current t {}'.format(images[image_index], current_t))
+            return [im]
+        else:
+            return None
+
+    if show_animation:
+        ani = animation.FuncAnimation(fig, update_img, len(images), init_func=init_func, interval=1000, blit=True, repeat=False)
+        plt.show()
+        # Set up formatting for the movie files
+        # Writer = animation.writers['ffmpeg'] #FFMpegWriter #
+        # Writer = animation.AVConvWriter
+        # writer = Writer(fps=fps, bitrate=1800) #, extra_args=['-vcodec', 'libx264'])
+        # ani.save(op.join(fol, video_fname), writer=writer)
+        # writer = animation.writers['ffmpeg'](fps=fps, bitrate=bitrate)
+        # ani.save(op.join(fol, video_fname), writer=writer, dpi=dpi)
+    else:
+        images_fol = utils.get_parent_fol(images[0])
+        movie_fname = '{}.mp4'.format(op.join(utils.get_parent_fol(images_fol), utils.namebase(images_fol)))
+        if op.isfile(movie_fname) and not overwrite:
+            print('{} already exists'.format(movie_fname))
+            return
+        stream_movie(movie_fig, images, images2, time_range, fps, movie_fname, n_jobs)
+    plt.close(fig)
+
+
+def create_movie_figure(time_range, xticks, images, dpi, cb_data_type, data_to_show_in_graph, fol, fol2,
+        cb_title='', cb_min_max_eq=True, cb_norm_percs=None, color_map='jet', cb2_data_type='', cb2_title='',
+        cb2_min_max_eq=True, color_map2='jet', images2=(), ylim=(), ylabels=(), xticklabels=(), xlabel='Time (ms)'):
 
     def two_brains_two_graphs():
         if cb2_data_type == '':
@@ -133,55 +189,57 @@ def ani_frame(time_range, xticks, images, dpi, fps, video_fname, cb_data_type,
     else:
         plot_color_bar(ax_cb, graph_data, cb_title, cb_data_type, cb_min_max_eq, cb_norm_percs, color_map)
 
-    now = time.time()
-    if show_first_pic:
-        plt.show()
+    return utils.Bag(dict(fig=fig, im=im, im2=im2, t_line=t_line, ymin=ymin, ymax=ymax, graph1_ax=graph1_ax))
 
-    def init_func():
-        return update_img(0)
 
-    def update_img(image_index):
-        # print(image_fname)
-        utils.time_to_go(now, image_index, len(images))
-        image = mpimg.imread(images[image_index])
-        im.set_data(image)
-        if im2:
-            image2 = mpimg.imread(images2[image_index])
-            im2.set_data(image2)
+def stream_movie(movie_fig, images, images2, time_range, fps, movie_fname, n_jobs=1):
+    # Instead of drawing and saving the whole figure for every frame, the figure is drawn once without the brain
+    # images and the time line. The frames are this overlay, with the decoded images pasted into the brain axes and
+    # the time line drawn on the graph, streamed into a single ffmpeg process. The images are decoded in n_jobs
+    # threads, and only a few decoded frames are kept in memory
+    fig, t_line = movie_fig.fig, movie_fig.t_line
+    brain_ims = [im for im in [movie_fig.im, movie_fig.im2] if im is not None]
+    for artist in brain_ims + [t_line]:
+        artist.set_visible(False)
+    fig.canvas.draw()
+    overlay = np.array(fig.canvas.buffer_rgba())[:, :, :3]
+    height, width = overlay.shape[:2]
+    boxes = [get_ax_pixels_box(im.axes, height) for im in brain_ims]
+    line_width = max(int(round(t_line.get_linewidth() * fig.dpi / 72)), 1)
+    line_color = np.rint(np.array(mcolors.to_rgb(t_line.get_color())) * 255).astype(np.uint8)
+    graph_trans = movie_fig.graph1_ax.transData
 
-        current_t = get_t(images, image_index, time_range)
-        if not current_t is None:
-            t_line.set_data([current_t, current_t], [ymin, ymax])
-            # print('Reading image {}, current t {}'.format(images[image_index], current_t))
-            return [im]
-        else:
-            return None
+    frames = [ind for ind in range(len(images)) if get_t(images, ind, time_range) is not None]
+    frames_images = [(images[ind],) if len(brain_ims) == 1 else (images[ind], images2[ind]) for ind in frames]
 
-    if show_animation:
-        ani = animation.FuncAnimation(fig, update_img, len(images), init_func=init_func, interval=1000, blit=True, repeat=False)
-        plt.show()
-        # Set up formatting for the movie files
-        # Writer = animation.writers['ffmpeg'] #FFMpegWriter #
-        # Writer = animation.AVConvWriter
-        # writer = Writer(fps=fps, bitrate=1800) #, extra_args=['-vcodec', 'libx264'])
-        # ani.save(op.join(fol, video_fname), writer=writer)
-        # writer = animation.writers['ffmpeg'](fps=fps, bitrate=bitrate)
-        # ani.save(op.join(fol, video_fname), writer=writer, dpi=dpi)
-    else:
-        images_fol = utils.get_parent_fol(images[0])
-        new_images_fol = op.join(images_fol, 'movie_images')
-        utils.make_dir(new_images_fol)
-        images_nb = utils.namebase(images_fol)
-        for image_index in range(len(images)):
-            new_image_fname = op.join(new_images_fol, 'mv_{}.png'.format(image_index))
-            if not op.isfile(new_image_fname) or overwrite:
-                img = update_img(image_index)
-                if not img is None:
-                    plt.savefig(new_image_fname, facecolor=fig.get_facecolor(), transparent=True)
-        movie_fname = op.join(utils.get_parent_fol(images_fol), images_nb)
-        if op.isfile('{}.mp4'.format(movie_fname)) and overwrite:
-            utils.remove_file('{}.mp4'.format(movie_fname))
-        mu.combine_images(new_images_fol, movie_fname , frame_rate=fps, movie_name_full_path=True)
+    def decode_frame(frame_images):
+        return [mu.read_rgb_image(image_fname, (x1 - x0, y1 - y0))
+                for image_fname, (x0, y0, x1, y1) in zip(frame_images, boxes)]
+
+    now = time.time()
+    with mu.FFmpegPipeWriter(movie_fname, width, height, fps) as writer:
+        for run, (image_index, brain_images) in enumerate(zip(
+                frames, mu.decode_images(frames_images, decode_frame, n_jobs))):
+            utils.time_to_go(now, run, len(frames))
+            frame = overlay.copy()
+            for brain_image, (x0, y0, x1, y1) in zip(brain_images, boxes):
+                frame[y0:y1, x0:x1] = brain_image
+            current_t = get_t(images, image_index, time_range)
+            (x, line_y0), (_, line_y1) = graph_trans.transform([(current_t, movie_fig.ymin), (current_t, movie_fig.ymax)])
+            x0 = min(max(int(round(x - line_width / 2)), 0), width - 1)
+            y0, y1 = sorted([height - int(round(line_y0)), height - int(round(line_y1))])
+            frame[max(y0, 0):min(y1, height), x0:x0 + line_width] = line_color
+            writer.write(frame)
+    print('{}: {} frames, {:.2f} frames per second'.format(
+        movie_fname, len(frames), len(frames) / max(time.time() - now, 1e-6)))
+    return movie_fname
+
+
+def get_ax_pixels_box(ax, fig_height):
+    # The axes box in the figure's pixels (x0, y0, x1, y1), where y goes down like in the image arrays
+    bbox = ax.get_window_extent()
+    return (int(round(bbox.x0)), fig_height - int(round(bbox.y1)),
+            int(round(bbox.x1)), fig_height - int(round(bbox.y0)))
 
 
 def get_t(images, image_index, time_range):
@@ -335,41 +393,18 @@ def create_movie(time_range, xticks, fol, dpi, fps, video_fname, cb_data_type,
                  bitrate=5000, fol2='', cb2_data_type='', cb2_title='', cb2_min_max_eq=True, color_map2='jet',
                  ylim=(), ylabels=(), xticklabels=(), xlabel='Time (ms)', pics_type='png', show_first_pic=False,
                  show_animation=False, overwrite=True, n_jobs=1):
-
+    # All the frames are streamed into one movie ({fol}.mp4), n_jobs is the number of threads decoding the images
     images1 = get_pics(fol, pics_type)[:len(time_range)]
-    images1_chunks = utils.chunks(images1, len(images1) / n_jobs)
     if fol2 != '':
         images2 = get_pics(fol2, pics_type)
         if len(images2) != len(images1):
             raise Exception('fol and fol2 have different number of pictures!')
-        images2_chunks = utils.chunks(images2, int(len(images2) / n_jobs))
     else:
-        images2_chunks = [''] * int(len(images1) / n_jobs)
-    params = [(images1_chunk, images2_chunk, time_range, xticks, dpi, fps,
-               video_fname, cb_data_type, data_to_show_in_graph, cb_title, cb_min_max_eq, cb_norm_percs, color_map,
-               bitrate, ylim, ylabels, xticklabels, xlabel, show_first_pic, fol, fol2,
-               cb2_data_type, cb2_title, cb2_min_max_eq, color_map2, run, show_animation, overwrite) for \
-              run, (images1_chunk, images2_chunk) in enumerate(zip(images1_chunks, images2_chunks))]
+        images2 = ()
     n_jobs = utils.get_n_jobs(n_jobs)
-    if n_jobs > 1:
-        utils.run_parallel(_create_movie_parallel, params, n_jobs)
-        video_name, video_type = op.splitext(video_fname)
-        mu.combine_movies(fol, video_name, video_type[1:])
-    else:
-        for p in params:
-            _create_movie_parallel(p)
-
-
-def _create_movie_parallel(params):
-    (images1, images2, time_range, xticks, dpi, fps,
-        video_fname, cb_data_type, data_to_show_in_graph, cb_title, cb_min_max_eq, cb_norm_percs, color_map, bitrate,
-        ylim, ylabels, xticklabels, xlabel, show_first_pic, fol, fol2, cb2_data_type, cb2_title, cb2_min_max_eq,
-        color_map2, run, show_animation, overwrite) = params
-    video_name, video_type = op.splitext(video_fname)
-    video_fname = '{}_{}{}'.format(video_name, run, video_type)
     ani_frame(time_range, xticks, images1, dpi, fps, video_fname, cb_data_type, data_to_show_in_graph, fol, fol2,
-              cb_title, cb_min_max_eq, cb_norm_percs, color_map, cb2_data_type, cb2_title, cb2_min_max_eq, color_map2, bitrate,
-              images2, ylim, ylabels, xticklabels, xlabel, show_first_pic, show_animation, overwrite)
+              cb_title, cb_min_max_eq, cb_norm_percs, color_map, cb2_data_type, cb2_title, cb2_min_max_eq, color_map2,
+              bitrate, images2, ylim, ylabels, xticklabels, xlabel, show_first_pic, show_animation, overwrite, n_jobs)
 
 
 def sort_pics_key(pic_fname):
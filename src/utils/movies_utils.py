@@ -1,5 +1,9 @@
 import os.path as op
 import glob
+import subprocess
+import numpy as np
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from src.utils import utils
 
 FFMPEG_DIR = utils.get_link_dir(utils.get_links_dir(), 'ffmpeg')
@@ -226,6 +230,95 @@ def combine_images(fol, movie_name, frame_rate=10, start_number=-1, images_prefi
     return '{}.mp4'.format(movie_name)
 
 
+class FFmpegPipeWriter(object):
+    # Encodes rgb24 frames (height x width x 3 uint8 arrays), which are written one by one into the stdin of a
+    # single ffmpeg process, with the encoding of combine_images (libx264, yuv420p, even width and height, 30 fps)
+
+    def __init__(self, movie_fname, width, height, frame_rate=10, ffmpeg_cmd='', debug=False):
+        if ffmpeg_cmd == '':
+            ffmpeg_cmd = FFMPEG_CMD
+        cmd = [ffmpeg_cmd, '-y', '-loglevel', 'debug' if debug else 'error',
+               '-f', 'rawvideo', '-pix_fmt', 'rgb24', '-s', '{}x{}'.format(width, height),
+               '-framerate', str(frame_rate), '-i', '-',
+               '-vf', 'scale=trunc(iw/2)*2:trunc(ih/2)*2', '-c:v', 'libx264', '-r', '30', '-pix_fmt', 'yuv420p',
+               movie_fname]
+        self.movie_fname, self.width, self.height = movie_fname, width, height
+        self.frames_num = 0
+        self.process = subprocess.Popen(cmd, stdin=subprocess.PIPE)
+
+    def write(self, frame):
+        frame = np.ascontiguousarray(frame, dtype=np.uint8)
+        if frame.shape != (self.height, self.width, 3):
+            raise Exception('FFmpegPipeWriter: The frame shape {} is not ({}, {}, 3)!'.format(
+                frame.shape, self.height, self.width))
+        self.process.stdin.write(memoryview(frame).cast('B'))
+        self.frames_num += 1
+
+    def close(self):
+        if self.process.stdin.closed:
+            return
+        self.process.stdin.close()
+        if self.process.wait() != 0:
+            raise Exception('FFmpegPipeWriter: ffmpeg failed to encode {}!'.format(self.movie_fname))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.process.kill()
+            self.process.wait()
+
+
+def decode_images(images, decode_func, n_jobs=1, max_pending=0):
+    # Yields decode_func(image) for the images, in their order. If n_jobs > 1, the images are decoded in a threads
+    # pool, and at most max_pending (2 * n_jobs by default) decoded images are waiting in memory
+    if n_jobs <= 1:
+        for image in images:
+            yield decode_func(image)
+        return
+    max_pending = 2 * n_jobs if max_pending <= 0 else max_pending
+    with ThreadPoolExecutor(n_jobs) as executor:
+        pending = deque()
+        for image in images:
+            pending.append(executor.submit(decode_func, image))
+            if len(pending) >= max_pending:
+                yield pending.popleft().result()
+        while len(pending) > 0:
+            yield pending.popleft().result()
+
+
+def read_rgb_image(image_fname, size=None, background=(255, 255, 255)):
+    # Reads an image as an rgb24 array, where the transparent pixels are blended with the background color. If size
+    # (width, height) is set, the image is resized to it
+    from PIL import Image
+    image = Image.open(image_fname)
+    if image.mode in ('RGBA', 'LA', 'P'):
+        image = image.convert('RGBA')
+        image = Image.alpha_composite(Image.new('RGBA', image.size, tuple(background) + (255,)), image)
+    image = image.convert('RGB')
+    if size is not None and image.size != tuple(size):
+        image = image.resize(tuple(size), Image.BILINEAR)
+    return np.asarray(image)
+
+
+def stream_images(images, movie_fname, frame_rate=10, n_jobs=1, ffmpeg_cmd='', debug=False):
+    # Like combine_images, but the images are decoded here and streamed into ffmpeg, so they don't have to be
+    # named or numbered in a specific format. All the images are resized to the size of the first one
+    if len(images) == 0:
+        print('stream_images: No images!')
+        return ''
+    first_image = read_rgb_image(images[0])
+    height, width = first_image.shape[:2]
+    read_func = lambda image_fname: read_rgb_image(image_fname, (width, height))
+    with FFmpegPipeWriter(movie_fname, width, height, frame_rate, ffmpeg_cmd, debug) as writer:
+        for frame in decode_images(images, read_func, n_jobs):
+            writer.write(frame)
+    return movie_fname
+
+
 def add_reverse_frames_fol(fol, images_prefix, images_type):
     images = sorted(glob.glob(op.join(fol, '*.{}'.format(images_type))), key=utils.natural_keys)
     last_frame = int(utils.find_num_in_str(utils.namebase(images[-1]))[0])
@@ -0,0 +1,172 @@
+import os
+import os.path as op
+import time
+import math
+import pickle
+import atexit
+import tempfile
+import multiprocessing
+import numpy as np
+
+# A workers pool for utils.run_parallel:
+# * With reuse_pool, the pools are kept warm across the calls (one pool per number of jobs), and closed when the
+#   process exits. It's opt-in, because the workers are forked once, so module globals and os.environ values which
+#   are changed later (like the subject's globals set by the modules' init_globals) aren't seen by them.
+# * Big numpy arrays in the params (also inside tuples, lists and dicts) are saved once as npy files (in /dev/shm if
+#   it exists), and the workers get a handle (SharedArray). Every task memory maps it again (copy on write), so a
+#   task which writes into its array doesn't change the array of the next tasks in the same worker. An array which
+#   is used in several calls can be shared explicitly with share_array, and released with release_array.
+# * The params are sent in chunks, where the chunk size is based on the mean run time of the function in the
+#   previous calls.
+# * Every call reports the time the chunks waited in the queue, the (de)serialization time and the compute time.
+
+SHARE_MIN_BYTES = 2 ** 20
+CHUNK_TARGET_TIME = 0.2
+CHUNKS_PER_WORKER = 4
+
+_POOLS = {}
+_FUNCS_TIMES = {}
+_SHARED_COUNTER = [0]
+
+
+class SharedArray(object):
+    # A picklable handle of an array which was saved in a shared (memory mapped) file
+
+    def __init__(self, fname, shape, dtype):
+        self.fname, self.shape, self.dtype = fname, shape, dtype
+
+    def load(self):
+        # A new copy on write map for every task. The pages are shared through the page cache, and the task's
+        # writes are private to its map
+        return np.load(self.fname, mmap_mode='c')
+
+
+def get_shared_fol():
+    return '/dev/shm' if op.isdir('/dev/shm') else tempfile.gettempdir()
+
+
+def share_array(arr):
+    # The pid and the counter make sure a file name isn't reused, so a worker can't load a released array
+    _SHARED_COUNTER[0] += 1
+    fd, fname = tempfile.mkstemp(prefix='mmvt_shared_{}_{}_'.format(os.getpid(), _SHARED_COUNTER[0]),
+                                 suffix='.npy', dir=get_shared_fol())
+    with os.fdopen(fd, 'wb') as f:
+        np.save(f, arr)
+    return SharedArray(fname, arr.shape, arr.dtype)
+
+
+def release_array(shared_array):
+    if op.isfile(shared_array.fname):
+        os.remove(shared_array.fname)
+
+
+def share_params(params, shared, min_bytes=SHARE_MIN_BYTES):
+    # Replaces the big arrays in params with handles. shared (id(arr) -> (arr, handle)) keeps every array
+    # shared only once
+    if isinstance(params, np.ndarray) and params.dtype != object and params.nbytes >= min_bytes:
+        if id(params) not in shared:
+            shared[id(params)] = (params, share_array(params))
+        return shared[id(params)][1]
+    elif type(params) in (tuple, list):
+        return type(params)([share_params(p, shared, min_bytes) for p in params])
+    elif type(params) is dict:
+        return {k: share_params(v, shared, min_bytes) for k, v in params.items()}
+    return params
+
+
+def load_params(params):
+    if isinstance(params, SharedArray):
+        return params.load()
+    elif type(params) in (tuple, list):
+        return type(params)([load_params(p) for p in params])
+    elif type(params) is dict:
+        return {k: load_params(v) for k, v in params.items()}
+    return params
+
+
+def get_pool(njobs):
+    if njobs not in _POOLS:
+        _POOLS[njobs] = multiprocessing.Pool(processes=njobs)
+    return _POOLS[njobs]
+
+
+def close_pools():
+    for pool in _POOLS.values():
+        pool.close()
+        pool.join()
+    _POOLS.clear()
+
+
+atexit.register(close_pools)
+# A forked process (like the pipeline_utils tasks) can't use its parent's pools
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_POOLS.clear)
+
+
+def func_key(func):
+    return '{}.{}'.format(func.__module__, getattr(func, '__qualname__', repr(func)))
+
+
+def calc_chunk_size(func, params_num, njobs):
+    # At least CHUNKS_PER_WORKER chunks per worker, and if the function's run time is known, chunks of about
+    # CHUNK_TARGET_TIME seconds
+    max_chunk_size = max(int(math.ceil(params_num / (njobs * CHUNKS_PER_WORKER))), 1)
+    func_time = _FUNCS_TIMES.get(func_key(func))
+    if func_time is None or func_time <= 0:
+        return max_chunk_size if params_num > njobs * CHUNKS_PER_WORKER else 1
+    return min(max(int(CHUNK_TARGET_TIME / func_time), 1), max_chunk_size)
+
+
+def _run_chunk(chunk_data):
+    # Runs in the worker. Returns the pickled results and the chunk's times
+    start_time = time.time()
+    func, chunk_params, submit_time = pickle.loads(chunk_data)
+    chunk_params = [load_params(p) for p in chunk_params]
+    loaded_time = time.time()
+    results = [func(p) for p in chunk_params]
+    compute_time = time.time() - loaded_time
+    now = time.time()
+    results_data = pickle.dumps(results, protocol=pickle.HIGHEST_PROTOCOL)
+    serialization_time = (loaded_time - start_time) + (time.time() - now)
+    return results_data, start_time - submit_time, serialization_time, compute_time
+
+
+def run_parallel(func, params, njobs, reuse_pool=False, report=True):
+    # Functions of the main module are run in a new pool, because they might be defined after the persistent pool
+    # was created
+    params = list(params)
+    if len(params) == 0:
+        return []
+    now = time.time()
+    reuse_pool = reuse_pool and func.__module__ != '__main__'
+    pool = get_pool(njobs) if reuse_pool else multiprocessing.Pool(processes=njobs)
+    shared = {}
+    try:
+        chunk_size = calc_chunk_size(func, len(params), njobs)
+        chunks_data = []
+        serialization_time = 0
+        for ind in range(0, len(params), chunk_size):
+            chunk_params = share_params(params[ind:ind + chunk_size], shared)
+            t = time.time()
+            chunks_data.append(pickle.dumps((func, chunk_params, time.time()), protocol=pickle.HIGHEST_PROTOCOL))
+            serialization_time += time.time() - t
+        results, queue_time, compute_time = [], 0, 0
+        for results_data, chunk_queue_time, chunk_serialization_time, chunk_compute_time in pool.imap(
+                _run_chunk, chunks_data):
+            t = time.time()
+            results.extend(pickle.loads(results_data))
+            serialization_time += chunk_serialization_time + time.time() - t
+            queue_time += chunk_queue_time
+            compute_time += chunk_compute_time
+    finally:
+        for _, shared_array in shared.values():
+            release_array(shared_array)
+        if not reuse_pool:
+            pool.close()
+    _FUNCS_TIMES[func_key(func)] = compute_time / len(params)
+    if report:
+        print('run_parallel {}: {} params in {} chunks of {} ({} shared arrays), {:.2f}s: queue {:.2f}s, '
+              'serialization {:.2f}s, compute {:.2f}s'.format(
+                func.__name__, len(params), len(chunks_data), chunk_size, len(shared), time.time() - now,
+                queue_time, serialization_time, compute_time))
+    return results
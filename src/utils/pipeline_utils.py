@@ -0,0 +1,266 @@
+import os
+import os.path as op
+import sys
+import csv
+import glob
+import time
+import inspect
+import traceback
+import multiprocessing
+from multiprocessing import connection
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# A scheduler for running a preproc module on a cohort of subjects (preproc_utils.run_on_subjects with
+# --scheduler 1):
+# * A module declares its steps in PIPELINE_STEPS, a list of Step, where every step is one of the module's main
+#   functions (the name used in args.function). The inputs and outputs are files templates, which can use {subject},
+#   {hemi} (both hemis), {mmvt_dir}, {subjects_dir}, the args ({atlas}, ...) and glob patterns. A step depends on the
+#   steps which output its inputs, and on the steps in its after list. A module without PIPELINE_STEPS runs its main
+#   as a single step.
+# * Every (subject, step) task runs in its own process, and the ready tasks of all the subjects run concurrently,
+#   as long as they fit in the cpus and memory budgets (a task always runs if nothing else is running). A step takes
+#   args.n_jobs cpus if it's declared with n_jobs, and its memory estimate is replaced by its measured peak RSS once
+#   it finished for one subject.
+# * A step is skipped if all its outputs exist and are newer than its inputs (unless args.overwrite).
+# * A failed task (an exception, a False flag or a crashed process) is recorded, and the subject's steps that depend
+#   on it are blocked. Nothing prompts the user.
+# * The wall time and peak RSS of every task are written to logs/pipeline_report_{time}.csv, with a per step summary.
+
+PENDING, RUNNING, DONE, SKIPPED, FAILED, BLOCKED = 'pending', 'running', 'done', 'skipped', 'failed', 'blocked'
+DEFAULT_STEP_MEMORY = 1  # GB
+
+
+class Step(object):
+
+    def __init__(self, name, inputs=(), outputs=(), after=(), n_jobs=False, memory=DEFAULT_STEP_MEMORY):
+        self.name, self.inputs, self.outputs, self.after = name, list(inputs), list(outputs), list(after)
+        self.n_jobs, self.memory = n_jobs, memory
+
+
+class Task(object):
+
+    def __init__(self, subject, step, run_func, deps=(), up_to_date=None):
+        self.subject, self.step, self.run_func, self.deps = subject, step, run_func, set(deps)
+        self.up_to_date = up_to_date
+        self.status, self.flags, self.error = PENDING, {}, ''
+        self.wall_time, self.peak_rss, self.cpus = 0, 0, 1
+        self.process, self.conn, self.start_time = None, None, 0
+
+    @property
+    def key(self):
+        return self.subject, self.step.name
+
+
+def get_module_steps(main_func):
+    return getattr(inspect.getmodule(main_func), 'PIPELINE_STEPS', None)
+
+
+def select_steps(steps, args):
+    # The declared steps which should run, and a step for every other function in args.function, which runs after
+    # all of them (like in the modules' main functions)
+    exclude = args.get('exclude', [])
+    should_run = lambda name: ('all' in args.function or name in args.function) and name not in exclude
+    selected = [step for step in steps if should_run(step.name)]
+    declared_names = set([step.name for step in steps])
+    after = [step.name for step in selected]
+    for func_name in args.function:
+        if func_name != 'all' and func_name not in declared_names and func_name not in exclude:
+            selected.append(Step(func_name, after=after))
+    return selected
+
+
+def calc_steps_deps(steps):
+    names = set([step.name for step in steps])
+    deps = {}
+    for step in steps:
+        deps[step.name] = set([name for name in step.after if name in names])
+        for other_step in steps:
+            if other_step is not step and len(set(step.inputs) & set(other_step.outputs)) > 0:
+                deps[step.name].add(other_step.name)
+    return deps
+
+
+def format_template(template, values):
+    # The template's files names (for both hemis if it uses {hemi}), which might be glob patterns
+    if '{hemi}' in template:
+        return [template.format(**dict(values, hemi=hemi)) for hemi in ['rh', 'lh']]
+    return [template.format(**values)]
+
+
+def expand_template(template, values):
+    fnames = []
+    for fname in format_template(template, values):
+        fnames.extend(glob.glob(fname) if glob.has_magic(fname) else [fname])
+    return fnames
+
+
+def is_up_to_date(step, values):
+    if len(step.outputs) == 0:
+        return False
+    outputs_mtimes = []
+    for template in step.outputs:
+        fnames = expand_template(template, values)
+        if len(fnames) == 0 or not all([op.isfile(fname) for fname in fnames]):
+            return False
+        outputs_mtimes.extend([op.getmtime(fname) for fname in fnames])
+    inputs_mtimes = [op.getmtime(fname) for template in step.inputs
+                     for fname in expand_template(template, values) if op.isfile(fname)]
+    return len(inputs_mtimes) == 0 or min(outputs_mtimes) >= max(inputs_mtimes)
+
+
+def get_memory_size():
+    # In GB
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / 2 ** 30
+    except (ValueError, OSError, AttributeError):
+        return 0
+
+
+def get_peak_rss():
+    # The peak RSS (MB) of the current process and its finished child processes (like FreeSurfer's commands)
+    if resource is None:
+        return 0
+    rss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+              resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    # ru_maxrss is in bytes on macOS and in KB on linux
+    return rss / 2 ** 20 if sys.platform == 'darwin' else rss / 2 ** 10
+
+
+def _run_task(run_func, conn=None):
+    now = time.time()
+    flags, error = {}, ''
+    try:
+        flags = run_func()
+    except:
+        error = traceback.format_exc()
+        print(error)
+    result = (flags, error, time.time() - now, get_peak_rss())
+    if conn is None:
+        return result
+    conn.send(result)
+    conn.close()
+
+
+class Scheduler(object):
+
+    def __init__(self, max_cpus, max_memory=0):
+        self.max_cpus = max_cpus
+        self.max_memory = max_memory if max_memory > 0 else get_memory_size() * 0.8
+        self.steps_memory = {}
+        self.fork = 'fork' in multiprocessing.get_all_start_methods()
+
+    def run(self, tasks):
+        tasks_dict = {task.key: task for task in tasks}
+        while True:
+            self.update_blocked(tasks, tasks_dict)
+            running = [task for task in tasks if task.status == RUNNING]
+            skipped = False
+            for task in tasks:
+                if task.status == PENDING and self.is_ready(task, tasks_dict) and self.fits(task, running):
+                    # The outputs are checked only now, after the steps which create the inputs finished
+                    if task.up_to_date is not None and task.up_to_date():
+                        print('Skipping {} {}, the outputs are up to date'.format(task.subject, task.step.name))
+                        task.status, skipped = SKIPPED, True
+                        continue
+                    self.start(task)
+                    running.append(task)
+            if skipped:
+                continue
+            if len(running) == 0:
+                break
+            self.wait(running)
+        return tasks
+
+    def is_ready(self, task, tasks_dict):
+        return all([tasks_dict[dep].status in (DONE, SKIPPED) for dep in task.deps])
+
+    def task_memory(self, task):
+        return max(self.steps_memory.get(task.step.name, task.step.memory), 0)
+
+    def fits(self, task, running):
+        if len(running) == 0:
+            return True
+        cpus = sum([t.cpus for t in running]) + task.cpus
+        memory = sum([self.task_memory(t) for t in running]) + self.task_memory(task)
+        return cpus <= self.max_cpus and (self.max_memory <= 0 or memory <= self.max_memory)
+
+    def update_blocked(self, tasks, tasks_dict):
+        changed = True
+        while changed:
+            changed = False
+            for task in tasks:
+                if task.status == PENDING and any(
+                        [tasks_dict[dep].status in (FAILED, BLOCKED) for dep in task.deps]):
+                    task.status, task.error = BLOCKED, 'blocked by {}'.format(', '.join(
+                        [dep[1] for dep in task.deps if tasks_dict[dep].status in (FAILED, BLOCKED)]))
+                    changed = True
+
+    def start(self, task):
+        print('Starting {} {}'.format(task.subject, task.step.name))
+        task.status, task.start_time = RUNNING, time.time()
+        if not self.fork:
+            # Without fork, the tasks run one by one in this process
+            self.finish(task, _run_task(task.run_func))
+            return
+        task.conn, child_conn = multiprocessing.Pipe(duplex=False)
+        task.process = multiprocessing.get_context('fork').Process(target=_run_task, args=(task.run_func, child_conn))
+        task.process.start()
+        child_conn.close()
+
+    def wait(self, running):
+        running = [task for task in running if task.process is not None]
+        if len(running) == 0:
+            return
+        ready = connection.wait([task.conn for task in running] + [task.process.sentinel for task in running])
+        for task in running:
+            if task.conn in ready or task.process.sentinel in ready:
+                try:
+                    result = task.conn.recv()
+                except (EOFError, OSError):
+                    # The process crashed (or was killed) without sending its results
+                    result = ({}, 'The process exited with code {}'.format(task.process.exitcode),
+                              time.time() - task.start_time, 0)
+                task.process.join()
+                task.conn.close()
+                task.process, task.conn = None, None
+                self.finish(task, result)
+
+    def finish(self, task, result):
+        task.flags, task.error, task.wall_time, task.peak_rss = result
+        if task.error == '' and isinstance(task.flags, dict) and \
+                any([not val for val in task.flags.values() if isinstance(val, bool)]):
+            task.error = 'False flags: {}'.format(', '.join([k for k, v in task.flags.items() if v is False]))
+        elif task.error == '' and not isinstance(task.flags, dict) and not task.flags:
+            task.error = 'The step returned {}'.format(task.flags)
+        task.status = DONE if task.error == '' else FAILED
+        if task.peak_rss > 0:
+            self.steps_memory[task.step.name] = max(
+                self.steps_memory.get(task.step.name, 0), task.peak_rss / 2 ** 10)
+        print('{} {} {} in {:.1f}s, peak RSS {:.0f}MB'.format(
+            task.subject, task.step.name, task.status, task.wall_time, task.peak_rss))
+
+
+def write_report(tasks, report_fname):
+    with open(report_fname, 'w') as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow(['subject', 'step', 'status', 'wall_time', 'peak_rss_mb', 'error'])
+        for task in tasks:
+            error = task.error.strip().split('\n')[-1] if task.error != '' else ''
+            writer.writerow([task.subject, task.step.name, task.status, '{:.2f}'.format(task.wall_time),
+                             '{:.0f}'.format(task.peak_rss), error])
+    print('Steps summary:')
+    steps_names = list(dict.fromkeys([task.step.name for task in tasks]))
+    for step_name in steps_names:
+        step_tasks = [task for task in tasks if task.step.name == step_name]
+        statuses = {status: len([t for t in step_tasks if t.status == status])
+                    for status in [DONE, SKIPPED, FAILED, BLOCKED]}
+        run_tasks = [task for task in step_tasks if task.status in (DONE, FAILED)]
+        print('{}: {}, wall time {:.1f}s (max {:.1f}s), peak RSS {:.0f}MB'.format(
+            step_name, ', '.join(['{} {}'.format(n, status) for status, n in statuses.items() if n > 0]),
+            sum([t.wall_time for t in run_tasks]), max([t.wall_time for t in run_tasks] + [0]),
+            max([t.peak_rss for t in run_tasks] + [0])))
+    print('The pipeline report was written to {}'.format(report_fname))
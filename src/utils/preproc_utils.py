@@ -1,4 +1,6 @@
 import os
+import sys
+import time
 import os.path as op
 from collections import defaultdict
 import glob
@@ -8,6 +10,8 @@ import collections
 import logging
 import re
 import warnings
+import inspect
+from functools import partial
 
 from src.utils import utils
 from src.utils import args_utils as au
@@ -58,6 +62,8 @@ def run_on_subjects(args, main_func, subjects_itr=None, subject_func=None):
         subjects_itr = args.subject
     subjects_flags, subjects_errors = {}, {}
     args = init_args(args)
+    if args.get('scheduler', False):
+        return run_on_subjects_with_scheduler(args, main_func, subjects_itr, subject_func)
     subject = ''
     for tup in subjects_itr:
         subject = get_subject(tup, subject_func)
@@ -81,6 +87,11 @@ def run_on_subjects(args, main_func, subjects_itr=None, subject_func=None):
             flags['prepare_subject_folder'], password = prepare_subject_folder(
                 subject, remote_subject_dir, args)
             if not flags['prepare_subject_folder'] and not args.ignore_missing:
+                # Don't block unattended runs
+                if not sys.stdin.isatty():
+                    print('Skipping subject {}, use --ignore_missing 1 to run it anyway'.format(subject))
+                    subjects_errors[subject] = 'prepare_subject_folder failed'
+                    continue
                 ans = input('Do you wish to continue (y/n)? ')
                 if not au.is_true(ans):
                     continue
@@ -97,6 +108,11 @@ def run_on_subjects(args, main_func, subjects_itr=None, subject_func=None):
     if subject == '':
         print('No subjects were found!')
         return False
+    report_subjects_flags(subjects_flags)
+    return subjects_flags
+
+
+def report_subjects_flags(subjects_flags):
     errors = defaultdict(list)
     ret = True
     good_subjects, bad_subjects = [], []
@@ -128,7 +144,98 @@ def run_on_subjects(args, main_func, subjects_itr=None, subject_func=None):
     logging.info('Good subjects:\n {}'.format(good_subjects))
     utils.write_list_to_file(good_subjects, op.join(utils.get_logs_fol(), 'good_subjects.txt'))
     utils.write_list_to_file(bad_subjects, op.join(utils.get_logs_fol(), 'bad_subjects.txt'))
-    return subjects_flags
+    return ret
+
+
+def run_on_subjects_with_scheduler(args, main_func, subjects_itr=None, subject_func=None):
+    # Runs the module's steps (pipeline_utils) of all the subjects concurrently
+    from src.utils import pipeline_utils as plu
+    if subjects_itr is None:
+        subjects_itr = args.subject
+    module_steps = plu.get_module_steps(main_func)
+    steps = plu.select_steps(module_steps, args) if module_steps is not None else [plu.Step('main')]
+    steps_deps = plu.calc_steps_deps(steps)
+    max_cpus = utils.get_n_jobs(args.get('max_cpus', -1))
+    tasks = []
+    for tup in subjects_itr:
+        subject = get_subject(tup, subject_func)
+        remote_subject_dir = utils.build_remote_subject_dir(args.remote_subject_dir, subject)
+        if remote_subject_dir == '':
+            remote_subject_dir = op.join(SUBJECTS_DIR, subject)
+        subject_args = utils.Bag(dict(args))
+        subject_args.atlas = utils.fix_atlas_name(subject, args.atlas, SUBJECTS_DIR)
+        values = dict(subject_args, subject=subject, mmvt_dir=MMVT_DIR, subjects_dir=SUBJECTS_DIR)
+        prepare_step = plu.Step('prepare_subject_folder')
+        tasks.append(plu.Task(subject, prepare_step, partial(
+            _prepare_subject_folder_task, subject, remote_subject_dir, subject_args)))
+        for step in steps:
+            task = plu.Task(subject, step, partial(
+                _run_step_task, main_func, tup, subject, remote_subject_dir, subject_args,
+                None if module_steps is None else step, values))
+            if module_steps is not None and not subject_args.get('overwrite', False):
+                task.up_to_date = partial(plu.is_up_to_date, step, values)
+            task.deps = set([(subject, dep) for dep in steps_deps[step.name]] + [(subject, prepare_step.name)])
+            task.cpus = min(subject_args.n_jobs, max_cpus) if step.n_jobs or module_steps is None else 1
+            tasks.append(task)
+    if len(tasks) == 0:
+        print('No subjects were found!')
+        return False
+    plu.Scheduler(max_cpus, args.get('max_memory', 0)).run(tasks)
+    report_fname = op.join(utils.get_logs_fol(), 'pipeline_report_{}.csv'.format(time.strftime('%Y%m%d_%H%M%S')))
+    plu.write_report(tasks, report_fname)
+    subjects_flags = defaultdict(dict)
+    for task in tasks:
+        if task.status in (plu.DONE, plu.FAILED) and isinstance(task.flags, dict):
+            subjects_flags[task.subject].update(task.flags)
+        if task.status in (plu.FAILED, plu.BLOCKED):
+            subjects_flags[task.subject][task.step.name] = False
+    report_subjects_flags(subjects_flags)
+    return dict(subjects_flags)
+
+
+# The args which don't change the steps' outputs
+CACHE_IGNORED_ARGS = ['subject', 'function', 'exclude', 'n_jobs', 'scheduler', 'max_cpus', 'max_memory', 'use_cache',
+                      'sftp_password', 'print_traceback']
+
+
+def _prepare_subject_folder_task(subject, remote_subject_dir, args):
+    os.environ['SUBJECT'] = subject
+    ret, _ = prepare_subject_folder(subject, remote_subject_dir, args)
+    return {'prepare_subject_folder': ret or args.ignore_missing}
+
+
+def _run_step_task(main_func, tup, subject, remote_subject_dir, args, step=None, values=None):
+    # Runs only the step's function of the module's main (or all the functions if step is None). With --use_cache 1,
+    # the step's outputs are restored from the subject's artifacts cache (cache_utils) if the step already ran with
+    # the same inputs, args and module code
+    os.environ['SUBJECT'] = subject
+    args = utils.Bag(dict(args))
+    if step is not None:
+        args.function, args.exclude = [step.name], []
+
+    def run_step():
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            return main_func(tup, remote_subject_dir, args, dict())
+
+    if step is None or not args.get('use_cache', False) or len(step.outputs) == 0:
+        return run_step()
+    from src.utils import cache_utils
+    from src.utils import pipeline_utils as plu
+    flags = {}
+
+    def run_step_and_check_flags():
+        # The outputs are stored in the cache only if all the step's flags are True
+        flags.update(run_step())
+        return all([val for val in flags.values() if isinstance(val, bool)])
+
+    inputs = [fname for template in step.inputs for fname in plu.format_template(template, values)]
+    outputs = [fname for template in step.outputs for fname in plu.format_template(template, values)]
+    params = {k: v for k, v in args.items() if k not in CACHE_IGNORED_ARGS and not k.startswith('overwrite')}
+    cache_utils.run_cached(op.join(MMVT_DIR, subject), step.name, run_step_and_check_flags, inputs, outputs, params,
+                           inspect.getmodule(main_func))
+    # The flags are empty if the outputs were restored from the cache
+    return flags if len(flags) > 0 else {step.name: True}
 
 
 def set_default_args(args, ini_name='default_args.ini'):
@@ -198,6 +305,14 @@ def add_common_args(parser):
     parser.add_argument('--sftp_password', help='sftp port', required=False, default='')
     parser.add_argument('--print_traceback', help='print_traceback', required=False, default=1, type=au.is_true)
 
+    # Run the subjects' steps concurrently (pipeline_utils)
+    parser.add_argument('--scheduler', help='use the steps scheduler', required=False, default=0, type=au.is_true)
+    parser.add_argument('--max_cpus', help='the scheduler cpus budget', required=False, default=-1, type=int)
+    parser.add_argument('--max_memory', help='the scheduler memory budget (GB)', required=False, default=0,
+                        type=float)
+    parser.add_argument('--use_cache', help='restore the steps outputs from the artifacts cache', required=False,
+                        default=0, type=au.is_true)
+
     # global folders
     parser.add_argument('--meg_dir', required=False, default='')
     parser.add_argument('--mri_dir', required=False, default='')
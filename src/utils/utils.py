@@ -2,7 +2,7 @@ import os
 import sys
 import shutil
 import numpy as np
-from collections import defaultdict, OrderedDict, Counter
+from collections import defaultdict, OrderedDict
 import itertools
 import time
 import re
@@ -34,6 +34,7 @@ except:
     pass
 
 from src.mmvt_addon import mmvt_utils as mu
+from src.mmvt_addon import ply_utils
 # links to mmvt_utils
 Bag = mu.Bag
 copy_file = mu.copy_file
@@ -89,6 +90,11 @@ get_label_for_full_fname = mu.get_label_for_full_fname
 to_str = mu.to_str
 argmax2d = mu.argmax2d
 file_modification_time = mu.file_modification_time
+activity_map_exists = mu.activity_map_exists
+read_activity_map_header = mu.read_activity_map_header
+save_activity_map = mu.save_activity_map
+save_activity_map_t = mu.save_activity_map_t
+convert_activity_map_folders = mu.convert_activity_map_folders
 
 atlas_exist = mu.atlas_exist
 get_atlas_template = mu.get_atlas_template
@@ -244,24 +250,17 @@ def read_srf_file(srf_file):
 
 
 def read_ply_file(ply_file, npz_fname=''):
+    # The ply is parsed only if its npz cache doesn't exist or is older (see ply_utils)
     if file_type(ply_file) == '':
         ply_file = '{}.ply'.format(ply_file)
     npz_file = change_fname_extension(ply_file, 'npz')
-    if file_type(ply_file) == 'ply' and not op.isfile(npz_file):
-        # print('Reading {}'.format(ply_file))
-        with open(ply_file, 'r') as f:
-            lines = f.readlines()
-            verts_num = int(lines[2].split(' ')[-1])
-            faces_num = int(lines[6].split(' ')[-1])
-            verts_lines = lines[9:9 + verts_num]
-            faces_lines = lines[9 + verts_num:]
-            verts = np.array([list(map(float, l.strip().split(' '))) for l in verts_lines])
-            faces = np.array([list(map(int, l.strip().split(' '))) for l in faces_lines])[:,1:]
+    if file_type(ply_file) == 'ply' and op.isfile(ply_file):
+        verts, faces = ply_utils.read_ply_file_cached(ply_file)
     elif file_type(ply_file) == 'npz' or op.isfile(npz_file):
         # print('Reading {}'.format(npz_file))
         d = np.load(npz_file)
         verts, faces = d['verts'], d['faces']
-        faces = faces.astype(np.int)
+        faces = faces.astype(int)
     # elif npz_fname != '' and op.isfile(npz_fname):
     #     d = np.load(npz_fname)
     #     verts, faces = d['verts'], d['faces']
@@ -316,20 +315,11 @@ def read_pial(subject, mmvt_dir, hemi, surface_type='pial'):
     return verts, faces
 
 
-def write_ply_file(verts, faces, ply_file_name, write_also_npz=False):
+def write_ply_file(verts, faces, ply_file_name, write_also_npz=False, binary=True):
     try:
-        verts_num = verts.shape[0]
-        faces_num = faces.shape[0]
-        with open(ply_file_name, 'w') as f:
-            f.write(PLY_HEADER.format(verts_num, faces_num))
-        with open(ply_file_name, 'ab') as f:
-            np.savetxt(f, verts, fmt='%.5f', delimiter=' ')
-            if faces_num > 0:
-                faces = faces.astype(np.int)
-                faces_for_ply = np.hstack((np.ones((faces_num, 1)) * faces.shape[1], faces))
-                np.savetxt(f, faces_for_ply, fmt='%d', delimiter=' ')
+        ply_utils.write_ply_file(verts, faces.astype(int), ply_file_name, binary)
         if write_also_npz:
-            np.savez('{}.npz'.format(op.splitext(ply_file_name)[0]), verts=verts, faces=faces)
+            ply_utils.write_cache(verts, faces.astype(int), ply_file_name)
         return True
     except:
         print('Error in write_ply_file! ({})'.format(ply_file_name))
@@ -388,17 +378,15 @@ def calc_ply_faces_verts(verts, faces, out_file, overwrite=False, ply_name='', e
             print('{}: verts: {}, faces: {}, faces ravel: {}'.format(
                 ply_name, verts.shape[0], faces.shape[0], len(_faces)))
         faces_arg_sort = np.argsort(_faces)
-        faces_sort = np.sort(_faces)
-        faces_count = Counter(faces_sort)
-        max_len = max([v for v in faces_count.values()])
+        faces_sort = _faces[faces_arg_sort]
+        faces_count = np.bincount(faces_sort, minlength=verts.shape[0])
+        max_len = np.max(faces_count)
         print(ply_name, verts.shape[0], max_len)
-        lookup = np.ones((verts.shape[0], max_len)) * -1
-        diff = np.diff(faces_sort)
-        n = 0
-        for ind, (k, v) in enumerate(zip(faces_sort, faces_arg_sort)):
-            lookup[k, n] = v
-            n = 0 if ind < len(diff) and diff[ind] > 0 else n+1
-        np.save(out_file, lookup.astype(np.int))
+        lookup = np.full((verts.shape[0], max_len), -1, dtype=int)
+        # Every vertex's faces are consecutive in faces_sort, so their columns are their positions in their group
+        groups_starts = np.cumsum(faces_count) - faces_count
+        lookup[faces_sort, np.arange(len(faces_sort)) - groups_starts[faces_sort]] = faces_arg_sort
+        np.save(out_file, lookup)
         if verbose:
             print('{} max lookup val: {}'.format(ply_name, int(np.max(lookup))))
         if len(_faces) != int(np.max(lookup)) + 1:
@@ -1091,7 +1079,10 @@ def check_for_necessary_files(necessary_files, root_fol):
                 raise Exception('{} does not exist!'.format(full_path))
 
 
-def run_parallel(func, params, njobs=1, print_time_to_go=True, runs_num_to_print=1):
+def run_parallel(func, params, njobs=1, print_time_to_go=True, runs_num_to_print=1, reuse_pool=False):
+    # For njobs > 1, the big arrays in the params are shared through memory mapped files (parallel_utils). With
+    # reuse_pool, the workers pool is kept for the next calls, so it should be used only if the function doesn't
+    # depend on globals or environment variables which might change between the calls (like the subject)
     if njobs == 1:
         results = []
         now = time.time()
@@ -1101,9 +1092,8 @@ def run_parallel(func, params, njobs=1, print_time_to_go=True, runs_num_to_print
             results.append(func(p))
         # results = [func(p) for p in params]
     else:
-        pool = multiprocessing.Pool(processes=njobs)
-        results = pool.map(func, params)
-        pool.close()
+        from src.utils import parallel_utils
+        results = parallel_utils.run_parallel(func, params, njobs, reuse_pool, report=print_time_to_go)
     return results
 
 
@@ -2016,6 +2006,24 @@ def file_is_newer(fname1, fname2):
     return time.gmtime(op.getmtime(fname1)) > time.gmtime(op.getmtime(fname2))
 
 
+def calc_file_hash(fname, block_size=2 ** 20):
+    import hashlib
+    md5 = hashlib.md5()
+    with open(fname, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            md5.update(block)
+    return md5.hexdigest()
+
+
+def calc_arrays_hash(arrays):
+    # A hash of a list of arrays / strings, like the vertices of the labels, or other hashes
+    import hashlib
+    md5 = hashlib.md5()
+    for arr in arrays:
+        md5.update(arr.encode() if isinstance(arr, str) else np.ascontiguousarray(arr).tobytes())
+    return md5.hexdigest()
+
+
 @decorator
 def ignore_warnings(f, *args, **kw):
     with warnings.catch_warnings():